@@ -3,15 +3,40 @@
 
 import argparse
 import collections
+import concurrent.futures
 import enum
 import functools
 import os
 import pathlib
+import re
 import shlex
+import shutil
 import subprocess
 import sys
 import tempfile
 
+from dbuild.cache import (
+    ArtifactCache,
+    get_digest_hasher,
+    update_digest_from_bytes,
+    update_digest_from_file,
+    update_digest_from_tree,
+)
+from dbuild.colindex import CollectionIndex
+from dbuild.config import load_config
+from dbuild.tarstream import SymlinkPrefixRewriter
+from dbuild.tarstream import TarStreamFilter
+from dbuild.trace import SpanTracer
+from dbuild.treecopy import METADATA_FILE_SUFFIX
+
+
+# bump when changing the inputs of the build cache key
+BUILD_CACHE_VERSION = '1'
+
+# cache namespaces (build cache, phase snapshots) sharing --cache-max-size
+CACHE_NAMESPACES = ['rootfs', 'snapshot']
+
+
 @functools.lru_cache(maxsize=128)
 def get_hook_name_prio(hook_name):
     prio_text, prio_sep, remainder = hook_name.partition('-')
@@ -31,9 +56,20 @@ def get_hook_name_prio(hook_name):
 class TargetImageFormat(enum.Enum):
     FMT_TAR  = 'tar'
     FMT_NULL = 'null'
+    # rootfs directory + metadata file in staging (see convert-tar-to-disk)
+    FMT_DIR  = 'dir'
 # --- end of TargetImageFormat ---
 
 
+@enum.unique
+class FixSymlinksMode(enum.Enum):
+    # rewrite symlinks in the target rootfs (customize hook)
+    FIX_DISK   = 'disk'
+    # rewrite symlinks while streaming the tarball (FMT_TAR only)
+    FIX_STREAM = 'stream'
+# --- end of FixSymlinksMode ---
+
+
 class RuntimeEnv(object):
 
     HOOK_PHASES = [
@@ -43,6 +79,14 @@ class RuntimeEnv(object):
         'customize',
     ]
 
+    # phases covered by the phase snapshot (incremental builds),
+    # the snapshot gets created at the beginning of the 'customize' phase
+    HOOK_PHASES_SNAPSHOT = [
+        'setup',
+        'extract',
+        'essential',
+    ]
+
     def __init__(self):
         super().__init__()
         self.script_file_called = None
@@ -52,12 +96,19 @@ class RuntimeEnv(object):
         self.project_share_dir  = None
         self.vmap               = None
         self.target_format      = None
+        self.fix_symlinks_mode  = None
 
         self.staging            = None
         self.config_file        = None
 
         self.build_collections  = None
         self.mm_argv            = None
+
+        self.phase_snapshot     = False
+        self.apt_proxy_url      = None
+        self.pwhash_cache_dir   = None
+
+        self.tracer             = None
     # --- end of __init__ (...) ---
 
     def get_mm_cmdv(self, quiet=False):
@@ -71,23 +122,42 @@ class RuntimeEnv(object):
         if self.mm_argv:
             cmdv.extend(self.mm_argv)
 
-        cmdv.append(f'--format={target_format.value}')
+        if target_format == TargetImageFormat.FMT_DIR:
+            cmdv.append('--format=directory')
+        else:
+            cmdv.append(f'--format={target_format.value}')
 
         cmdv.append(self.vmap['DBUILD_TARGET_CODENAME'])
 
         if target_format == TargetImageFormat.FMT_TAR:
-            tar_outfile = (self.staging.images_root / 'rootfs.tar.zst')
-            cmdv.append(str(tar_outfile))
+            if self.fix_symlinks_mode == FixSymlinksMode.FIX_STREAM:
+                # uncompressed tar to stdout, see main_run_mmdebstrap_tar_stream()
+                cmdv.append('-')
+            else:
+                tar_outfile = (self.staging.images_root / 'rootfs.tar.zst')
+                cmdv.append(str(tar_outfile))
 
         elif target_format == TargetImageFormat.FMT_NULL:
             # mmdebstrap < 0.8.0 compat FIXME
             tar_outfile = (self.staging.tmp_dir / 'rootfs.tar.zst')
             cmdv.append(str(tar_outfile))
+
+        elif target_format == TargetImageFormat.FMT_DIR:
+            cmdv.append(str(self.get_rootfs_dir()))
         # --
 
         return cmdv
     # --- end of get_mm_cmdv (...) ---
 
+    def get_rootfs_dir(self):
+        # FMT_DIR: rootfs directory, published along with its metadata file
+        return (self.staging.images_root / 'rootfs')
+    # --- end of get_rootfs_dir (...) ---
+
+    def get_rootfs_metadata_file(self):
+        return (self.staging.images_root / f'rootfs{METADATA_FILE_SUFFIX}')
+    # --- end of get_rootfs_metadata_file (...) ---
+
 # --- end of RuntimeEnv ---
 
 
@@ -121,6 +191,7 @@ class StagingEnv(object):
         self.root = staging_dir
         self.hook_dir = (self.root / 'hooks')
         self.images_root = (self.root / 'images')
+        self.hook_trace_file = (self.root / 'hook-trace.tsv')
 
         self.tmpdir_root = (self.root / 'tmp')
         self.tmp_dir = self.tmpdir_root
@@ -187,16 +258,170 @@ class StagingEnv(object):
         return proc
     # --- end of run_cmd (...) ---
 
+    def run_cmd_pipe(self, cmdv, stdout_func, line_callback=None, cwd=None, env=None):
+        # like run_cmd(), but passes the command's stdout to stdout_func
+        # (called with the pipe's file object in a separate thread),
+        # relays stderr line-wise as in run_cmd_relay() if line_callback is set
+        envp = dict(self.env)
+        if env:
+            envp.update(env)
+        # --
+
+        if cwd is self.CWD_TMPDIR:
+            with self.get_tmpdir() as tmpdir:
+                envp['TMPDIR'] = str(tmpdir)
+                self._run_cmd_pipe(cmdv, stdout_func, line_callback, tmpdir, envp)
+            # -- end with
+
+        else:
+            self._run_cmd_pipe(cmdv, stdout_func, line_callback, (cwd or self.root), envp)
+        # --
+    # --- end of run_cmd_pipe (...) ---
+
+    def _run_cmd_pipe(self, cmdv, stdout_func, line_callback, cwd, envp):
+        def run_stdout_func(fh):
+            try:
+                return stdout_func(fh)
+            finally:
+                # unblocks the command if stdout_func failed
+                fh.close()
+        # --- end of run_stdout_func (...) ---
+
+        with subprocess.Popen(
+            cmdv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=(subprocess.PIPE if line_callback is not None else None),
+            cwd=str(cwd), env=envp
+        ) as proc:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                stdout_job = executor.submit(run_stdout_func, proc.stdout)
+
+                if line_callback is not None:
+                    for line in proc.stderr:
+                        sys.stdout.buffer.write(line)
+                        sys.stdout.flush()
+
+                        line_callback(line.decode('utf-8', errors='replace'))
+                    # -- end for
+                # --
+
+                stdout_job.result()
+            # -- end with
+        # -- end with
+
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmdv)
+    # --- end of _run_cmd_pipe (...) ---
+
+    def run_cmd_relay(self, cmdv, line_callback, cwd=None, env=None):
+        # like run_cmd(), but relays the command's output line-wise
+        # to stdout (with stderr merged into stdout)
+        # and passes each line to line_callback
+        envp = dict(self.env)
+        if env:
+            envp.update(env)
+        # --
+
+        if cwd is self.CWD_TMPDIR:
+            with self.get_tmpdir() as tmpdir:
+                envp['TMPDIR'] = str(tmpdir)
+                self._run_cmd_relay(cmdv, line_callback, tmpdir, envp)
+            # -- end with
+
+        else:
+            self._run_cmd_relay(cmdv, line_callback, (cwd or self.root), envp)
+        # --
+    # --- end of run_cmd_relay (...) ---
+
+    def _run_cmd_relay(self, cmdv, line_callback, cwd, envp):
+        with subprocess.Popen(
+            cmdv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            cwd=str(cwd), env=envp
+        ) as proc:
+            for line in proc.stdout:
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+
+                line_callback(line.decode('utf-8', errors='replace'))
+            # -- end for
+        # -- end with
+
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmdv)
+    # --- end of _run_cmd_relay (...) ---
+
 # --- end of StagingEnv ---
 
 
+class MmdebstrapPhaseTracker(object):
+    """
+    Creates trace spans for mmdebstrap phases
+    based on its informational output ("I: ...").
+    """
+
+    PHASES = [
+        (re.compile(r'^I: running apt-get update'), 'apt update'),
+        (re.compile(r'^I: downloading packages'), 'download'),
+        (re.compile(r'^I: extracting archives'), 'extract'),
+        (re.compile(r'^I: installing essential packages'), 'install essential'),
+        (re.compile(r'^I: installing remaining packages'), 'install remaining'),
+        (re.compile(r'^I: running --(?P<hook>[a-z]+)-hook'), None),
+        (re.compile(r'^I: cleaning package lists'), 'cleanup'),
+        (re.compile(r'^I: creating tarball'), 'create tarball'),
+        (re.compile(r'^I: done'), None),
+    ]
+
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+        self.phase  = None
+    # --- end of __init__ (...) ---
+
+    def feed(self, line):
+        for regexp, phase in self.PHASES:
+            match = regexp.match(line)
+
+            if match:
+                if phase is None and 'hook' in regexp.groupindex:
+                    phase = '{} hooks'.format(match.group('hook'))
+                # --
+
+                if phase != self.phase:
+                    # also ends the previous phase
+                    if phase is None:
+                        self.tracer.end_step()
+                    else:
+                        self.tracer.step(phase, category='mmdebstrap')
+                    # --
+
+                    self.phase = phase
+                # --
+
+                break
+            # --
+        # -- end for
+    # --- end of feed (...) ---
+
+    def close(self):
+        self.tracer.end_step()
+        self.phase = None
+    # --- end of close (...) ---
+
+# --- end of MmdebstrapPhaseTracker ---
+
+
 class BuildCollectionInfo(object):
 
-    def __init__(self, name, prio, root):
+    def __init__(self, name, prio, root, index_info):
         super().__init__()
         self.name = name
         self.prio = prio
         self.root = root
+        # CollectionInfo (hooks, overlays, package list, ...)
+        self.index_info = index_info
         self.hooks_dir = (self.root / 'hooks')
         self.files_dir = (self.root / 'files')
         self.overlay_dir = (self.root / 'overlay')
@@ -236,13 +461,36 @@ def main(prog, argv):
         return 2
     # --
 
+    fix_symlinks_mode_str = (
+        cfg.vmap.get('DBUILD_TARGET_FIX_SYMLINKS', None) or 'disk'
+    )
+
+    try:
+        cfg.fix_symlinks_mode = FixSymlinksMode(fix_symlinks_mode_str)
+    except ValueError:
+        sys.stderr.write(f"Invalid fix symlinks mode config: {fix_symlinks_mode_str}\n")
+        return 2
+    # --
+
+    if cfg.target_format != TargetImageFormat.FMT_TAR:
+        # no tar stream to filter
+        cfg.fix_symlinks_mode = FixSymlinksMode.FIX_DISK
+    # --
+
     if cfg.vmap.get('DBUILD_TMPDIR_ROOT'):
         cfg.staging.tmpdir_root = cfg.vmap['DBUILD_TMPDIR_ROOT']
 
+    bcol_index              = CollectionIndex(
+        (cfg.project_root / 'collections'), arg_config.collection_index
+    )
+
     cfg.build_collections   = collections.OrderedDict((
         (
             name,
-            BuildCollectionInfo(name, prio, (cfg.project_root / 'collections' / name))
+            BuildCollectionInfo(
+                name, prio, (cfg.project_root / 'collections' / name),
+                bcol_index.get(name)
+            )
         )
         for prio, name in enumerate(
             filter(
@@ -252,23 +500,534 @@ def main(prog, argv):
         )
     ))
 
+    # target format 'dir': the build cache stores files only
+    # and the phase snapshot restores a tarball, so both are disabled
+    cache_dir               = (
+        None if cfg.target_format == TargetImageFormat.FMT_DIR else arg_config.cache_dir
+    )
+
+    cfg.phase_snapshot      = bool(arg_config.incremental and cache_dir)
+    cfg.apt_proxy_url       = arg_config.apt_proxy_url
+    cfg.pwhash_cache_dir    = (
+        os.path.join(arg_config.cache_dir, 'pwhash') if arg_config.cache_dir else None
+    )
+    # spans get attached to the caller's span (mkimage)
+    cfg.tracer              = SpanTracer.from_env('build-image')
+
     main_init_staging_env(cfg)
 
     main_init_staging_dir(cfg)
-    main_build_hooks(cfg)
-    main_build_mmdebstrap_opts(cfg)
+
+    with cfg.tracer.span('generate hooks'):
+        main_build_hooks(cfg)
+
+    with cfg.tracer.span('mmdebstrap options'):
+        main_build_mmdebstrap_opts(cfg)
+
+    bcol_index.save()
 
     mm_cmdv = cfg.get_mm_cmdv(quiet=arg_config.quiet)
 
+    build_cache = None
+    build_cache_key = None
+
+    phase_snapshot_cache = None
+    phase_snapshot_key = None
+
+    if cache_dir:
+        build_cache = ArtifactCache(
+            cache_dir, 'rootfs',
+            max_size=arg_config.cache_max_size, budget_namespaces=CACHE_NAMESPACES
+        )
+        build_cache_key = get_build_cache_key(cfg)
+
+        if cfg.phase_snapshot:
+            phase_snapshot_cache = ArtifactCache(
+                cache_dir, 'snapshot',
+                max_size=arg_config.cache_max_size, budget_namespaces=CACHE_NAMESPACES
+            )
+            phase_snapshot_key = get_phase_snapshot_key(cfg)
+        # --
+    # --
+
     if arg_config.dry_run:
+        if build_cache_key:
+            sys.stdout.write(f'build cache key: {build_cache_key}\n')
+        if phase_snapshot_key:
+            sys.stdout.write(f'phase snapshot key: {phase_snapshot_key}\n')
         sys.stdout.write('dry-run mode: scripts have been generated, exiting.\n')
         return True
     # --
 
-    cfg.staging.run_cmd(mm_cmdv, cwd=StagingEnv.CWD_TMPDIR)
+    if build_cache is not None and not arg_config.cache_refresh:
+        with cfg.tracer.span('build cache lookup', category='cache') as span:
+            published = build_cache.publish(build_cache_key, cfg.staging.images_root)
+            span.set_attr('hit', (published is not None))
+        # --
+
+        if published is not None:
+            sys.stdout.write(f'build cache hit: {build_cache_key}, skipping mmdebstrap\n')
+            return True
+        # --
+    # --
+
+    phase_snapshot_dir = cfg.staging.tmp_dir / 'phase-snapshot'
+
+    if phase_snapshot_cache is not None and not arg_config.cache_refresh:
+        # hardlink snapshot to staging first,
+        # the cache entry could get evicted by concurrent builds
+        # (only read and removed afterwards)
+        snapshot_files = phase_snapshot_cache.publish(
+            phase_snapshot_key, phase_snapshot_dir, hardlink=True
+        )
+
+        if snapshot_files is not None:
+            sys.stdout.write(
+                f'phase snapshot hit: {phase_snapshot_key}, running customize phase only\n'
+            )
+
+            try:
+                with cfg.tracer.span('incremental build', category='process') as span:
+                    main_run_incremental(cfg, phase_snapshot_dir)
+                    span.set_attr('bytes_written', get_staging_images_size(cfg))
+                # --
+            finally:
+                for filepath in snapshot_files:
+                    filepath.unlink(missing_ok=True)
+            # --
+
+            if build_cache is not None:
+                build_cache.store(build_cache_key, get_staging_images(cfg))
+            # --
+
+            return True
+        # --
+    # --
+
+    if phase_snapshot_cache is not None:
+        # request snapshot creation at the beginning of the customize phase
+        os.makedirs(phase_snapshot_dir, exist_ok=True)
+        cfg.staging.env['DBUILD_STAGING_SNAPSHOT'] = str(phase_snapshot_dir)
+    # --
+
+    with cfg.tracer.span('mmdebstrap', category='process') as span:
+        main_run_mmdebstrap(cfg, mm_cmdv)
+        span.set_attr('bytes_written', get_staging_images_size(cfg))
+    # --
+
+    if phase_snapshot_cache is not None:
+        snapshot_files = [
+            (phase_snapshot_dir / name) for name in ['rootfs.tar', 'rootfs.path']
+        ]
+
+        if all((f.is_file() for f in snapshot_files)):
+            sys.stdout.write(f'phase snapshot: storing {phase_snapshot_key}\n')
+            # removed from staging right afterwards
+            phase_snapshot_cache.store(phase_snapshot_key, snapshot_files, hardlink=True)
+        # --
+
+        for filepath in snapshot_files:
+            filepath.unlink(missing_ok=True)
+    # --
+
+    if build_cache is not None:
+        sys.stdout.write(f'build cache: storing {build_cache_key}\n')
+
+        with cfg.tracer.span('build cache store', category='cache'):
+            build_cache.store(build_cache_key, get_staging_images(cfg))
+    # --
 # --- end of main (...) ---
 
 
+def main_run_mmdebstrap(cfg, mm_cmdv):
+    if (
+        cfg.target_format == TargetImageFormat.FMT_TAR
+        and cfg.fix_symlinks_mode == FixSymlinksMode.FIX_STREAM
+    ):
+        main_run_mmdebstrap_tar_stream(cfg, mm_cmdv)
+        return
+    # --
+
+    if not cfg.tracer.enabled:
+        cfg.staging.run_cmd(mm_cmdv, cwd=StagingEnv.CWD_TMPDIR)
+        return
+    # --
+
+    # follow mmdebstrap's progress output for tracing its phases
+    phase_tracker = MmdebstrapPhaseTracker(cfg.tracer)
+
+    try:
+        cfg.staging.run_cmd_relay(
+            mm_cmdv, phase_tracker.feed, cwd=StagingEnv.CWD_TMPDIR
+        )
+    finally:
+        phase_tracker.close()
+# --- end of main_run_mmdebstrap (...) ---
+
+
+def main_run_mmdebstrap_tar_stream(cfg, mm_cmdv):
+    # mmdebstrap writes the uncompressed tarball to stdout,
+    # which gets piped through the symlink rewriting filter to zstd.
+    # The build-time rootfs path is written by the fix_symlinks hook
+    # (TARGET_ROOTFS is a temporary dir chosen by mmdebstrap),
+    # it is read once the first symlink shows up in the stream.
+    tar_outfile = (cfg.staging.images_root / 'rootfs.tar.zst')
+    rootfs_path_file = get_tar_rootfs_path_file(cfg)
+
+    def read_rootfs_path():
+        try:
+            with open(rootfs_path_file, 'rt') as fh:
+                return (fh.readline().rstrip('\n') or None)
+        except FileNotFoundError:
+            return None
+    # --- end of read_rootfs_path (...) ---
+
+    def filter_tar_stream(infh):
+        with subprocess.Popen(
+            ['zstd', '-q', '-T0', '-f', '-o', str(tar_outfile)],
+            stdin=subprocess.PIPE,
+            cwd=str(cfg.staging.root), env=cfg.staging.env
+        ) as zstd_proc:
+            try:
+                tar_filter = TarStreamFilter(
+                    infh, zstd_proc.stdin, SymlinkPrefixRewriter(read_rootfs_path, '/')
+                )
+                tar_filter.run()
+            finally:
+                zstd_proc.stdin.close()
+        # --
+
+        if zstd_proc.returncode:
+            raise subprocess.CalledProcessError(zstd_proc.returncode, zstd_proc.args)
+
+        sys.stdout.write(f'I: rewrote {tar_filter.num_rewritten} symlink(s) in tar stream\n')
+    # --- end of filter_tar_stream (...) ---
+
+    if cfg.tracer.enabled:
+        phase_tracker = MmdebstrapPhaseTracker(cfg.tracer)
+        line_callback = phase_tracker.feed
+    else:
+        phase_tracker = None
+        line_callback = None
+    # --
+
+    try:
+        cfg.staging.run_cmd_pipe(
+            mm_cmdv, filter_tar_stream, line_callback, cwd=StagingEnv.CWD_TMPDIR
+        )
+    finally:
+        if phase_tracker is not None:
+            phase_tracker.close()
+    # --
+# --- end of main_run_mmdebstrap_tar_stream (...) ---
+
+
+def get_tar_rootfs_path_file(cfg):
+    return (cfg.staging.tmp_dir / 'tar-rootfs.path')
+# --- end of get_tar_rootfs_path_file (...) ---
+
+
+def main_run_incremental(cfg, phase_snapshot_dir):
+    # Restores the target rootfs from the phase snapshot and runs
+    # the customize phase only, followed by the steps mmdebstrap
+    # would do after the customize hooks (cleanup, create tarball).
+    #
+    # Needs to run in a fakechroot/fakeroot environment like mmdebstrap,
+    # so that file ownership from the snapshot tarball is preserved.
+    #
+    incremental_script = cfg.staging.root / 'incremental.sh'
+
+    with open(incremental_script, 'wt') as outfh:
+        outfh.write(INCREMENTAL_BUILD_SCRIPT)
+    # --
+
+    os.chmod(incremental_script, 0o755)
+
+    if cfg.target_format == TargetImageFormat.FMT_TAR:
+        tar_outfile = str(cfg.staging.images_root / 'rootfs.tar.zst')
+    else:
+        tar_outfile = ''
+    # --
+
+    cfg.staging.run_cmd(
+        [
+            'fakechroot', 'fakeroot',
+            str(incremental_script),
+            str(phase_snapshot_dir),
+            str(cfg.staging.hook_dir / 'customize.sh'),
+            tar_outfile,
+        ],
+        cwd=StagingEnv.CWD_TMPDIR,
+        env=get_fakechroot_env(cfg.staging.env, 'customize')
+    )
+# --- end of main_run_incremental (...) ---
+
+
+def get_fakechroot_env(env, hook_phase):
+    # Environment set up by mmdebstrap --mode=fakechroot for running hooks,
+    # so that e.g. target_chroot() uses chroot.fakechroot
+    # and ldconfig is skipped as in a full build.
+    #
+    # Not reproduced: mmdebstrap's APT_CONFIG and the other
+    # MMDEBSTRAP_* variables, which the hooks do not use.
+    #
+    cmd_subst = []
+    for dirpath in ['/usr/sbin', '/usr/bin', '/sbin', '/bin']:
+        cmd_subst.extend([
+            f'{dirpath}/chroot=/usr/sbin/chroot.fakechroot',
+            f'{dirpath}/mkfifo=/bin/true',
+            f'{dirpath}/ldconfig=/bin/true',
+            f'{dirpath}/ldd=/usr/bin/ldd.fakechroot',
+            f'{dirpath}/ischroot=/bin/true',
+        ])
+    # --
+
+    if env.get('FAKECHROOT_CMD_SUBST'):
+        cmd_subst.extend(env['FAKECHROOT_CMD_SUBST'].split(':'))
+
+    exclude_path = '/dev:/proc:/sys'
+    if env.get('FAKECHROOT_EXCLUDE_PATH'):
+        exclude_path = f"{env['FAKECHROOT_EXCLUDE_PATH']}:{exclude_path}"
+
+    return {
+        'FAKECHROOT_CMD_SUBST'      : ':'.join(cmd_subst),
+        'FAKECHROOT_EXCLUDE_PATH'   : exclude_path,
+        'FAKECHROOT_AF_UNIX_PATH'   : '/tmp',
+        'MMDEBSTRAP_MODE'           : 'fakechroot',
+        'MMDEBSTRAP_HOOK'           : hook_phase,
+    }
+# --- end of get_fakechroot_env (...) ---
+
+
+INCREMENTAL_BUILD_SCRIPT = r"""#!/bin/sh
+# generated by build-image: incremental build from a phase snapshot
+#
+# Usage: incremental.sh <snapshot_dir> <customize_hook> [<tar_outfile>]
+#
+set -fu
+
+snapshot_dir="${1:?}"
+customize_hook="${2:?}"
+tar_outfile="${3-}"
+
+TARGET_ROOTFS="${TMPDIR:?}/rootfs"
+
+printf 'I: restoring phase snapshot\n'
+mkdir -- "${TARGET_ROOTFS}" || exit
+tar -C "${TARGET_ROOTFS}" \
+    --numeric-owner --xattrs --xattrs-include='*.*' \
+    -x -p -f "${snapshot_dir}/rootfs.tar" || exit
+
+# symlinks in the snapshot may still point to the snapshot's build-time rootfs
+read -r snapshot_rootfs < "${snapshot_dir}/rootfs.path" && \
+    [ -n "${snapshot_rootfs}" ] || exit
+if [ "${snapshot_rootfs}" != "${TARGET_ROOTFS}" ]; then
+    "${DBUILD_BUILD_SCRIPTS:?}/fix-symlinks.py" \
+        --from "${snapshot_rootfs}" --to "${TARGET_ROOTFS}" \
+        "${TARGET_ROOTFS}" > /dev/null || exit
+fi
+
+printf 'I: running customize hooks\n'
+"${customize_hook}" "${TARGET_ROOTFS}" || exit
+
+# cleanup as done by mmdebstrap after the customize phase
+printf 'I: cleaning up\n'
+(
+    cd "${TARGET_ROOTFS}" || exit
+    rm -f -- \
+        ./etc/apt/apt.conf.d/99mmdebstrap \
+        ./etc/dpkg/dpkg.cfg.d/99mmdebstrap \
+        ./var/cache/apt/pkgcache.bin \
+        ./var/cache/apt/srcpkgcache.bin \
+        ./var/log/dpkg.log \
+        ./var/log/apt/eipp.log.xz \
+        ./var/log/apt/history.log \
+        ./var/log/apt/term.log \
+        ./var/log/alternatives.log \
+        ./var/cache/ldconfig/aux-cache || exit
+
+    find ./var/cache/apt/archives ./var/lib/apt/lists ./tmp \
+        -mindepth 1 -maxdepth 1 \
+        ! -name 'partial' ! -name 'lock' \
+        -exec rm -rf -- '{}' + 2>/dev/null || :
+) || exit
+
+# /bin/sh has no pipefail: each pipeline stage records its exit status
+# in a file below pipe_status_dir, checked by check_pipe_status()
+pipe_status_dir="${TMPDIR:?}/pipe-status"
+
+check_pipe_status() {
+    local stage
+    local rc
+
+    for stage in "${@}"; do
+        rc=
+        read -r rc < "${pipe_status_dir}/${stage}" || rc=
+        if [ "${rc}" != '0' ]; then
+            printf 'E: %s failed (%s)\n' "${stage}" "${rc:-no status}" 1>&2
+            return 1
+        fi
+    done
+}
+
+create_tarball() {
+    tar -C "${TARGET_ROOTFS}" \
+        --sort=name --numeric-owner --one-file-system \
+        --xattrs --xattrs-include='*.*' \
+        -c -f - .
+}
+
+if [ -n "${tar_outfile}" ]; then
+    printf 'I: creating tarball %s\n' "${tar_outfile}"
+    mkdir -- "${pipe_status_dir}" || exit
+
+    if [ -n "${DBUILD_STAGING_TAR_ROOTFS_PATH-}" ]; then
+        # symlinks to TARGET_ROOTFS get rewritten in the tar stream
+        {
+            { create_tarball; echo "${?}" > "${pipe_status_dir}/tar"; } \
+            | "${DBUILD_BUILD_SCRIPTS:?}/fix-symlinks.py" \
+                --tar --from "${TARGET_ROOTFS}"
+            echo "${?}" > "${pipe_status_dir}/fix-symlinks"
+        } | zstd -q -T0 -o "${tar_outfile}"
+        echo "${?}" > "${pipe_status_dir}/zstd"
+
+        check_pipe_status tar fix-symlinks zstd || { rm -f -- "${tar_outfile}"; exit 1; }
+
+    else
+        { create_tarball; echo "${?}" > "${pipe_status_dir}/tar"; } \
+        | zstd -q -T0 -o "${tar_outfile}"
+        echo "${?}" > "${pipe_status_dir}/zstd"
+
+        check_pipe_status tar zstd || { rm -f -- "${tar_outfile}"; exit 1; }
+    fi
+fi
+"""
+
+
+def get_staging_images(cfg):
+    # same selection as in mkimage's publish step
+    with os.scandir(cfg.staging.images_root) as dir_it:
+        return sorted((
+            pathlib.Path(entry.path) for entry in dir_it
+            if not entry.name.startswith('.') and entry.is_file()
+        ))
+    # --
+# --- end of get_staging_images (...) ---
+
+
+def get_staging_images_size(cfg):
+    return sum((os.stat(f).st_size for f in get_staging_images(cfg)))
+# --- end of get_staging_images_size (...) ---
+
+
+def get_build_cache_key(cfg):
+    # The key covers the fully resolved build inputs:
+    # merged config, mmdebstrap options (incl. the sorted package list),
+    # generated hook scripts, overlay and files trees of all collections
+    # and the build scripts that get called by hooks.
+    hasher = get_digest_hasher()
+
+    update_digest_from_bytes(hasher, 'version', BUILD_CACHE_VERSION.encode('ascii'))
+
+    update_digest_from_file(hasher, 'config', cfg.config_file)
+
+    update_digest_from_bytes(
+        hasher, 'mmdebstrap',
+        '\0'.join((
+            [cfg.target_format.value]
+            + [
+                # hook dir is inside staging dir and differs between builds
+                arg for arg in cfg.mm_argv
+                if not arg.startswith('--hook-directory=')
+            ]
+        )).encode('utf-8')
+    )
+
+    for hook_phase in sorted(cfg.HOOK_PHASES):
+        update_digest_from_file(
+            hasher, f'hooks/{hook_phase}.sh',
+            (cfg.staging.hook_dir / f'{hook_phase}.sh')
+        )
+    # --
+
+    for bcol in cfg.build_collections.values():
+        update_digest_from_tree(hasher, f'{bcol.name}/overlay', bcol.overlay_dir)
+        update_digest_from_tree(hasher, f'{bcol.name}/files', bcol.files_dir)
+    # --
+
+    update_digest_from_tree(
+        hasher, 'build-scripts', cfg.script_dir,
+        exclude_names={'__pycache__', }
+    )
+
+    return hasher.hexdigest()
+# --- end of get_build_cache_key (...) ---
+
+
+def get_phase_snapshot_key(cfg):
+    # The key covers everything feeding the phases before 'customize':
+    # merged config, mmdebstrap options (incl. the sorted package list),
+    # hook base script, hooks, overlays and permtabs of these phases,
+    # collection functions.sh and files trees as well as the build scripts.
+    #
+    # Customize hooks, customize overlays and collection env.sh files
+    # are not part of the key.
+    hasher = get_digest_hasher()
+
+    update_digest_from_bytes(hasher, 'version', BUILD_CACHE_VERSION.encode('ascii'))
+
+    update_digest_from_file(hasher, 'config', cfg.config_file)
+
+    update_digest_from_bytes(
+        hasher, 'mmdebstrap',
+        '\0'.join((
+            arg for arg in cfg.mm_argv
+            if not arg.startswith('--hook-directory=')
+        )).encode('utf-8')
+    )
+
+    hooks_share_dir = cfg.project_share_dir / 'hooks'
+    for name in ['header.sh', 'functions.sh']:
+        update_digest_from_file(hasher, f'share/hooks/{name}', (hooks_share_dir / name))
+    # --
+
+    for bcol in cfg.build_collections.values():
+        functions_file = bcol.root / 'functions.sh'
+        if functions_file.is_file():
+            update_digest_from_file(hasher, f'{bcol.name}/functions.sh', functions_file)
+        # --
+
+        for hook_phase in cfg.HOOK_PHASES_SNAPSHOT:
+            update_digest_from_tree(
+                hasher, f'{bcol.name}/hooks/{hook_phase}',
+                (bcol.hooks_dir / hook_phase)
+            )
+
+            update_digest_from_tree(
+                hasher, f'{bcol.name}/overlay/{hook_phase}',
+                (bcol.overlay_dir / hook_phase)
+            )
+
+            permtab_file = bcol.overlay_dir / f'{hook_phase}.permtab'
+            if permtab_file.is_file():
+                update_digest_from_file(
+                    hasher, f'{bcol.name}/overlay/{hook_phase}.permtab', permtab_file
+                )
+            # --
+        # -- end for
+
+        update_digest_from_tree(hasher, f'{bcol.name}/files', bcol.files_dir)
+    # -- end for
+
+    update_digest_from_tree(
+        hasher, 'build-scripts', cfg.script_dir,
+        exclude_names={'__pycache__', }
+    )
+
+    return hasher.hexdigest()
+# --- end of get_phase_snapshot_key (...) ---
+
+
 def main_init_staging_env(cfg):
     extra_env = {}
 
@@ -278,6 +1037,28 @@ def main_init_staging_env(cfg):
     extra_env['DBUILD_STAGING_IMG']  = str(cfg.staging.images_root)
     extra_env['DBUILD_STAGING_TMP']  = str(cfg.staging.tmp_dir)
 
+    # hook timing records, collected by mkimage
+    extra_env['DBUILD_STAGING_TRACE'] = str(cfg.staging.hook_trace_file)
+
+    if cfg.fix_symlinks_mode == FixSymlinksMode.FIX_STREAM:
+        # fix_symlinks hook: record TARGET_ROOTFS instead of rewriting links
+        extra_env['DBUILD_STAGING_TAR_ROOTFS_PATH'] = str(get_tar_rootfs_path_file(cfg))
+    # --
+
+    if cfg.apt_proxy_url:
+        # not part of the config, keeps cache keys independent of the proxy
+        extra_env['DBUILD_APT_PROXY_LOCAL'] = cfg.apt_proxy_url
+    # --
+
+    if cfg.pwhash_cache_dir:
+        # shared with the *_PASSWORD config vars (mkimage), used by make_sysusers
+        extra_env['DBUILD_PWHASH_CACHE'] = cfg.pwhash_cache_dir
+    # --
+
+    if cfg.target_format == TargetImageFormat.FMT_DIR:
+        extra_env['DBUILD_STAGING_ROOTFS_META'] = str(cfg.get_rootfs_metadata_file())
+    # --
+
     cfg.staging.env.update(extra_env)
 # --- end of main_init_staging_env (...) ---
 
@@ -291,6 +1072,26 @@ def main_init_staging_dir(cfg):
     ]:
         os.makedirs(dirpath, exist_ok=True)
     # --
+
+    #> drop rootfs dir of previous runs (target format 'dir'),
+    #  mmdebstrap expects an empty or missing directory
+    rootfs_dir = cfg.get_rootfs_dir()
+    if rootfs_dir.is_dir():
+        shutil.rmtree(rootfs_dir)
+    # --
+
+    cfg.get_rootfs_metadata_file().unlink(missing_ok=True)
+
+    #> drop hook trace records of previous runs
+    for filepath in [
+        cfg.staging.hook_trace_file,
+        cfg.staging.hook_trace_file.with_name(cfg.staging.hook_trace_file.name + '.times'),
+    ]:
+        try:
+            os.unlink(filepath)
+        except FileNotFoundError:
+            pass
+    # --
 # --- end of main_init_staging_dir (...) ---
 
 
@@ -321,25 +1122,14 @@ def main_build_hooks(cfg):
 
     # walk through collections
     for bcol in cfg.build_collections.values():
-        if os.path.isdir(bcol.hooks_dir):
-            for hook_phase in cfg.HOOK_PHASES:
-                hook_list = hook_files_map[hook_phase]
-
-                try:
-                    with os.scandir(bcol.hooks_dir / hook_phase) as it:
-                        for entry in it:
-                            entry_fp = pathlib.Path(entry.path)
-                            if entry_fp.suffix == '.sh' and entry.is_file():
-                                hook_list.append((bcol, entry_fp.stem, entry_fp))
-                            # --
-                        # -- end for
-                    # -- end with
-
-                except FileNotFoundError:
-                    pass
-                # -- end try
+        for hook_phase in cfg.HOOK_PHASES:
+            hook_list = hook_files_map[hook_phase]
+
+            for hook_file_name in bcol.index_info.get_hooks(hook_phase):
+                hook_fp = bcol.hooks_dir / hook_phase / hook_file_name
+                hook_list.append((bcol, hook_fp.stem, hook_fp))
             # -- end for
-        # -- end if
+        # -- end for
     # -- end for
 
     os.makedirs(cfg.staging.hook_dir, exist_ok=True)
@@ -357,7 +1147,7 @@ def main_build_hooks(cfg):
             for bcol in cfg.build_collections.values():
                 env_file = bcol.root / 'env.sh'
 
-                if env_file.is_file():
+                if bcol.index_info.has_file('env.sh'):
                     outfh.write(f'## {bcol.name}\n')
 
                     for line in gen_passthrough_script(env_file):
@@ -372,7 +1162,7 @@ def main_build_hooks(cfg):
             for bcol in cfg.build_collections.values():
                 env_file = bcol.root / 'functions.sh'
 
-                if env_file.is_file():
+                if bcol.index_info.has_file('functions.sh'):
                     outfh.write(f'## {bcol.name}\n')
 
                     for line in gen_passthrough_script(env_file):
@@ -382,27 +1172,47 @@ def main_build_hooks(cfg):
                 # --
             # --
 
+            #> incremental builds: snapshot target rootfs before customizing
+            if cfg.phase_snapshot and hook_phase == 'customize':
+                outfh.write('\n### phase snapshot\n')
+                outfh.write('if [ -n "${DBUILD_STAGING_SNAPSHOT-}" ]; then\n')
+                outfh.write('    print_action "Creating phase snapshot"\n')
+                outfh.write('    dbuild_phase_snapshot_save "${DBUILD_STAGING_SNAPSHOT}" || exit\n')
+                outfh.write('fi\n')
+            # --
+
             #> add code for copying files from <collection>/overlay/<phase>
             outfh.write('\n### rootfs overlay(s)\n')
 
             for bcol in cfg.build_collections.values():
                 rootfs_overlay = bcol.overlay_dir / hook_phase
-                if rootfs_overlay.is_dir():
+                if hook_phase in bcol.index_info.overlay_phases:
                     outfh.write(f'## {bcol.name}\n')
                     outfh.write(f'printf "pull %s overlay: %s\\n" "{hook_phase}" "{bcol.name}"\n')
+                    outfh.write('dbuild_trace_begin\n')
                     outfh.write(
                         (
-                            'dbuild_import_overlay {src} || exit\n'
+                            'dbuild_import_overlay {src}\n'
                         ).format(
                             src=shlex.quote(str(rootfs_overlay))
                         )
                     )
+                    outfh.write(
+                        gen_trace_end_line(hook_phase, 'overlay', bcol.name, 'overlay')
+                    )
                 # --
 
                 rootfs_overlay_permtab = bcol.overlay_dir / f'{hook_phase}.permtab'
-                if rootfs_overlay_permtab.is_file():
+                if hook_phase in bcol.index_info.permtab_phases:
+                    # subshell: permtab lines exit on error
+                    outfh.write('dbuild_trace_begin\n')
+                    outfh.write('(\n')
                     for line in gen_permtab_script(rootfs_overlay_permtab):
                         outfh.write(line + '\n')
+                    outfh.write(')\n')
+                    outfh.write(
+                        gen_trace_end_line(hook_phase, 'permtab', bcol.name, 'permtab')
+                    )
                 # --
             # -- end for
 
@@ -420,6 +1230,7 @@ def main_build_hooks(cfg):
                 # start subshell
                 # (do not leak variables across hooks)
                 outfh.write(f'## {bcol.name} // {hook_name}\n')
+                outfh.write('dbuild_trace_begin\n')
                 outfh.write('(\n')
                 outfh.write(
                     '\n'.join((
@@ -440,9 +1251,19 @@ def main_build_hooks(cfg):
 
                 # end subshell
                 outfh.write('\n')
-                outfh.write('\n) || exit\n')
+                outfh.write('\n)\n')
+                outfh.write(gen_trace_end_line(hook_phase, 'hook', bcol.name, hook_name))
                 outfh.write(f'## end {bcol.name} // {hook_name}\n')
             # -- end for
+
+            #> target format 'dir': record metadata after customizing
+            if cfg.target_format == TargetImageFormat.FMT_DIR and hook_phase == 'customize':
+                outfh.write('\n### rootfs metadata\n')
+                outfh.write('print_action "Recording rootfs metadata"\n')
+                outfh.write(
+                    'dbuild_rootfs_metadata_save "${DBUILD_STAGING_ROOTFS_META:?}" || exit\n'
+                )
+            # --
         # -- end with
 
         os.chmod(hook_script, 0o755)
@@ -450,6 +1271,13 @@ def main_build_hooks(cfg):
 # --- end of main_build_hooks (...) ---
 
 
+def gen_trace_end_line(hook_phase, category, bcol_name, name):
+    return 'dbuild_trace_end "${{?}}" {args} || exit\n'.format(
+        args=' '.join(map(shlex.quote, [hook_phase, category, bcol_name, name]))
+    )
+# --- end of gen_trace_end_line (...) ---
+
+
 def main_build_mmdebstrap_opts(cfg):
     def update_pkg_list(pkg_list, items):
         # item may be one of
@@ -499,22 +1327,20 @@ def main_build_mmdebstrap_opts(cfg):
 
     for bcol in cfg.build_collections.values():
         # static package list
-        try:
-            pkg_list_file = bcol.root / 'package.list'
-            update_pkg_list(pkg_list, gen_read_list_file(pkg_list_file))
-
-        except FileNotFoundError:
-            pass
+        if bcol.index_info.package_list is not None:
+            update_pkg_list(pkg_list, bcol.index_info.package_list)
         # --
 
         # dynamic package list
         pkg_list_script = bcol.root / 'package.list.sh'
-        if os.path.isfile(pkg_list_script):  # racy, but OK
-            proc = cfg.staging.run_cmd(
-                [pkg_list_script],
-                env=cfg.vmap,   # export whole config as env vars
-                capture_output=True
-            )
+        if bcol.index_info.has_file('package.list.sh'):
+            with cfg.tracer.span('package.list.sh', category='process', collection=bcol.name):
+                proc = cfg.staging.run_cmd(
+                    [pkg_list_script],
+                    env=cfg.vmap,   # export whole config as env vars
+                    capture_output=True
+                )
+            # --
 
             update_pkg_list(
                 pkg_list,
@@ -551,27 +1377,52 @@ def get_arg_parser(prog):
         help='prepare files, but do not run mmdebstrap'
     )
 
-    return parser
-# --- end of get_arg_parser (...) ---
+    parser.add_argument(
+        '--cache-dir', metavar='<dir>',
+        dest='cache_dir', default=None,
+        help='look up and store build results in the build cache at <dir>'
+    )
 
+    parser.add_argument(
+        '--cache-max-size', metavar='<bytes>',
+        dest='cache_max_size', default=None, type=int,
+        help=(
+            'evict least recently used build cache entries above this total size'
+            ' (shared with phase snapshots)'
+        )
+    )
 
-def load_config(filepath):
-    return dict(gen_load_config(filepath))
-# --- end of load_config (...) ---
+    parser.add_argument(
+        '--refresh',
+        dest='cache_refresh',
+        default=False, action='store_true',
+        help='do not use cached build results, but store the new result in the cache'
+    )
 
+    parser.add_argument(
+        '--apt-proxy', metavar='<url>',
+        dest='apt_proxy_url', default=None,
+        help='use the local apt proxy at <url> (overrides DBUILD_APT_PROXY)'
+    )
 
-def gen_load_config(filepath):
-    with open(filepath, 'rt') as fh:
-        lexer = shlex.shlex(fh, filepath, posix=True, punctuation_chars=True)
+    parser.add_argument(
+        '--collection-index', metavar='<file>',
+        dest='collection_index', default=None,
+        help='collection index cache file (see mkimage)'
+    )
 
-        for tok in lexer:
-            varname, vsep, value = tok.partition('=')
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        default=False, action='store_true',
+        help=(
+            'snapshot the target rootfs before the customize phase (requires --cache-dir) '
+            'and re-run only the customize phase if a matching snapshot exists'
+        )
+    )
 
-            # no validation here.
-            yield (varname, value)
-        # --
-    # --
-# --- end of gen_load_config (...) ---
+    return parser
+# --- end of get_arg_parser (...) ---
 
 
 def gen_read_file(filepath):
@@ -583,16 +1434,6 @@ def gen_read_file(filepath):
 # --- end of gen_read_file (...) ---
 
 
-def gen_read_list_file(filepath):
-    return (
-        item
-        for line in gen_read_file(filepath)
-        for item in line.split()
-        if item
-    )
-# --- end of gen_read_list_file (...) ---
-
-
 def gen_permtab_script(filepath):
     for line in gen_read_file(filepath):
         fields = line.split(None, 3)
@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Functional check of the caching apt proxy (dbuild.aptproxy)
+#  against a local mirror, served by http.server from a temporary directory.
+#
+#  Checks that a .deb file is fetched once (miss) and then served
+#  from the cache (hit), that concurrent requests of the same file
+#  get coalesced into a single upstream download, that index files
+#  are served from the cache while fresh and revalidated upstream
+#  (304 Not Modified, or 200 after a mirror update) once stale,
+#  that objects evicted between lookup and open are fetched again,
+#  and that stale index files are served if the mirror is unreachable.
+#
+#  Usage: check-aptproxy.py [-c <clients>] [-s <seed>]
+#
+
+import argparse
+import functools
+import http.client
+import http.server
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from dbuild.aptproxy import AptCacheProxy
+
+
+MIRROR_FILES = {
+    'deb'       : 'debian/pool/main/h/hello/hello_2.10-3_amd64.deb',
+    'deb_coal'  : 'debian/pool/main/c/coreutils/coreutils_9.7-3_amd64.deb',
+    'release'   : 'debian/dists/trixie/InRelease',
+    'packages'  : 'debian/dists/trixie/main/binary-amd64/Packages.xz',
+}
+
+
+class MirrorRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.wait_delay()
+        super().do_GET()
+    # --- end of do_GET (...) ---
+
+    def send_response(self, code, message=None):
+        self.server.record_request(self.path, int(code), self.headers)
+        super().send_response(code, message)
+    # --- end of send_response (...) ---
+
+    def log_message(self, format, *args):
+        pass
+    # --- end of log_message (...) ---
+
+# --- end of MirrorRequestHandler ---
+
+
+class MirrorServer(http.server.ThreadingHTTPServer):
+    """
+    File-served mirror, records the (path, status, conditional) of requests.
+    """
+
+    def __init__(self, root):
+        super().__init__(
+            ('127.0.0.1', 0),
+            functools.partial(MirrorRequestHandler, directory=root)
+        )
+        self.root       = root
+        self.delay      = 0
+        self.requests   = []
+        self._lock      = threading.Lock()
+        self._thread    = None
+    # --- end of __init__ (...) ---
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+    # --- end of start (...) ---
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self.server_close()
+            self._thread.join()
+            self._thread = None
+        # --
+    # --- end of stop (...) ---
+
+    def wait_delay(self):
+        if self.delay:
+            time.sleep(self.delay)
+    # --- end of wait_delay (...) ---
+
+    def record_request(self, path, status, headers):
+        conditional = bool(headers.get('if-modified-since') or headers.get('if-none-match'))
+        with self._lock:
+            self.requests.append((path, status, conditional))
+    # --- end of record_request (...) ---
+
+    def get_requests(self, relpath):
+        path = '/' + relpath
+        with self._lock:
+            return [(status, conditional) for p, status, conditional in self.requests if p == path]
+    # --- end of get_requests (...) ---
+
+    def write_file(self, relpath, data, mtime=None):
+        filepath = os.path.join(self.root, relpath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        with open(filepath, 'wb') as fh:
+            fh.write(data)
+
+        if mtime is not None:
+            os.utime(filepath, (mtime, mtime))
+    # --- end of write_file (...) ---
+
+# --- end of MirrorServer ---
+
+
+class ProxyChecker(object):
+
+    def __init__(self, proxy, mirror):
+        super().__init__()
+        self.proxy       = proxy
+        self.mirror      = mirror
+        self.contents    = {}
+        self.num_checked = 0
+        self.num_failed  = 0
+    # --- end of __init__ (...) ---
+
+    def get_url(self, name):
+        return self.mirror.url + MIRROR_FILES[name]
+    # --- end of get_url (...) ---
+
+    def fetch(self, name):
+        """
+        Requests a mirror file through the proxy.
+        Returns (status, body), or (error name, b'') if the request failed.
+        """
+        proxy_parts = urllib.parse.urlsplit(self.proxy.url)
+        conn = http.client.HTTPConnection(proxy_parts.hostname, proxy_parts.port, timeout=30)
+        try:
+            conn.request('GET', self.get_url(name))
+            response = conn.getresponse()
+            return (response.status, response.read())
+        except (http.client.HTTPException, OSError) as err:
+            return (type(err).__name__, b'')
+        finally:
+            conn.close()
+    # --- end of fetch (...) ---
+
+    def check(self, case, name, expect_upstream, expect_stats):
+        """
+        Requests a mirror file through the proxy and checks the body,
+        the requests the mirror got for it (list of (status, conditional))
+        and the changes of the proxy stats (dict).
+        """
+        num_upstream = len(self.mirror.get_requests(MIRROR_FILES[name]))
+        stats = dict(self.proxy.stats)
+
+        result = self.fetch(name)
+
+        upstream = self.mirror.get_requests(MIRROR_FILES[name])[num_upstream:]
+        stats_diff = {
+            key: (value - stats[key]) for key, value in self.proxy.stats.items()
+            if key in expect_stats
+        }
+
+        return self.compare(
+            case, [result], [(200, self.contents[name])], upstream, expect_upstream,
+            stats_diff, expect_stats
+        )
+    # --- end of check (...) ---
+
+    def compare(self, case, results, expected, upstream, expect_upstream, stats_diff, expect_stats):
+        self.num_checked += 1
+
+        failed = []
+        if results != expected:
+            failed.append('  response: {!r}, expected {!r}'.format(
+                [(status, len(body)) for status, body in results],
+                [(status, len(body)) for status, body in expected],
+            ))
+
+        if upstream != expect_upstream:
+            failed.append(f'  upstream: {upstream!r}, expected {expect_upstream!r}')
+
+        if stats_diff != expect_stats:
+            failed.append(f'  stats:    {stats_diff!r}, expected {expect_stats!r}')
+
+        if failed:
+            self.num_failed += 1
+            sys.stdout.write(f'FAIL {case}\n' + '\n'.join(failed) + '\n')
+            return False
+        # --
+
+        return True
+    # --- end of compare (...) ---
+
+    def check_coalesced(self, case, name, num_clients):
+        num_upstream = len(self.mirror.get_requests(MIRROR_FILES[name]))
+        stats = dict(self.proxy.stats)
+        results = [None for _ in range(num_clients)]
+
+        def fetch_into(k):
+            results[k] = self.fetch(name)
+        # --- end of fetch_into (...) ---
+
+        threads = [
+            threading.Thread(target=fetch_into, args=(k,)) for k in range(num_clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect_stats = {'misses': 1, 'hits': (num_clients - 1)}
+
+        return self.compare(
+            case, results, [(200, self.contents[name]) for _ in range(num_clients)],
+            self.mirror.get_requests(MIRROR_FILES[name])[num_upstream:], [(200, False)],
+            {key: (self.proxy.stats[key] - stats[key]) for key in expect_stats}, expect_stats
+        )
+    # --- end of check_coalesced (...) ---
+
+    def evict_after_lookup(self, name):
+        """
+        Makes the next lookup of a mirror file remove its object
+        after finding it, as a concurrent eviction would.
+        """
+        store = self.proxy.store
+        lookup = store.lookup
+        url = self.get_url(name)
+
+        def evicting_lookup(lookup_url):
+            entry = lookup(lookup_url)
+            if entry is not None and lookup_url == url:
+                del store.lookup
+                os.unlink(store.get_object_path(entry['digest']))
+            return entry
+        # --- end of evicting_lookup (...) ---
+
+        store.lookup = evicting_lookup
+    # --- end of evict_after_lookup (...) ---
+
+# --- end of ProxyChecker ---
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    rng = random.Random(arg_config.seed)
+
+    with tempfile.TemporaryDirectory(prefix='check-aptproxy.') as tmpdir:
+        mirror = MirrorServer(os.path.join(tmpdir, 'mirror'))
+        proxy  = AptCacheProxy(os.path.join(tmpdir, 'cache'))
+        checker = ProxyChecker(proxy, mirror)
+
+        t_mtime = (time.time() - 3600)
+        for name, relpath in MIRROR_FILES.items():
+            checker.contents[name] = rng.randbytes(rng.randint(1, 2**20))
+            mirror.write_file(relpath, checker.contents[name], mtime=t_mtime)
+        # --
+
+        mirror.start()
+        proxy.start()
+        try:
+            run_checks(checker, arg_config.num_clients)
+        finally:
+            proxy.stop()
+            mirror.stop()
+        # --
+    # --
+
+    sys.stdout.write(proxy.format_stats() + '\n')
+    sys.stdout.write(
+        f'checked {checker.num_checked} case(s), {checker.num_failed} failure(s)\n'
+    )
+
+    return (checker.num_failed == 0)
+# --- end of main (...) ---
+
+
+def run_checks(checker, num_clients):
+    miss = {'misses': 1, 'hits': 0, 'revalidated': 0}
+    hit = {'misses': 0, 'hits': 1, 'revalidated': 0}
+
+    # package file: fetched once, then served from the cache
+    checker.check('deb miss', 'deb', [(200, False)], miss)
+    checker.check('deb hit', 'deb', [], hit)
+
+    # concurrent requests: one upstream download
+    checker.mirror.delay = 0.5
+    checker.check_coalesced(f'coalescing, {num_clients} clients', 'deb_coal', num_clients)
+    checker.mirror.delay = 0
+
+    # index files: served from the cache while fresh, revalidated once stale
+    checker.check('index miss', 'release', [(200, False)], miss)
+    checker.check('index hit', 'release', [], hit)
+    checker.check('index miss (Packages)', 'packages', [(200, False)], miss)
+
+    checker.proxy.index_max_age = 0
+    checker.check(
+        'index revalidated, not modified', 'release', [(304, True)],
+        {'misses': 0, 'hits': 0, 'revalidated': 1}
+    )
+
+    checker.contents['release'] = checker.contents['release'][::-1] + b'\n'
+    checker.mirror.write_file(MIRROR_FILES['release'], checker.contents['release'])
+    checker.check('index revalidated, modified', 'release', [(200, True)], miss)
+
+    # object evicted between lookup and open: cache miss
+    checker.evict_after_lookup('deb')
+    checker.check('deb evicted after lookup', 'deb', [(200, False)], miss)
+    checker.check('deb hit after eviction', 'deb', [], hit)
+
+    checker.evict_after_lookup('packages')
+    checker.check('stale index evicted after lookup', 'packages', [(200, False)], miss)
+
+    # mirror unreachable: stale index from the cache
+    checker.mirror.stop()
+    checker.check('stale index, mirror down', 'release', [], hit)
+# --- end of run_checks (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '-c', '--clients', metavar='<n>',
+        dest='num_clients', default=8, type=int,
+        help='number of concurrent clients for the coalescing check (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the mirror file contents (default: %(default)s)'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
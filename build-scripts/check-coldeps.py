@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Equivalence check and benchmark of the collection dependency resolver
+#  (dbuild.coldeps) on synthetic collection graphs.
+#
+#  The reference is the pass-based resolver that mkimage used before
+#  (repeated passes over the pending collections in scan order,
+#  quadratic in the number of collections).
+#  Both must produce the same build order, or both must fail (cycle),
+#  for small random graphs with depends/wants/after, 'after = *',
+#  virtual collections and collections without meta config.
+#
+#  The benchmark times both resolvers on large random DAGs
+#  and on dependency chains (worst case for the pass-based resolver).
+#
+#  Usage: check-coldeps.py [-n <num_random>] [-s <seed>] [-N <size>...]
+#
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+from dbuild.coldeps import CollectionDependencyCycleError
+from dbuild.coldeps import build_collection_graph
+
+
+class SyntheticCollectionIndex(object):
+    """
+    Stands in for CollectionIndex, provides get(name) -> collection info.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.infos = {}
+    # --- end of __init__ (...) ---
+
+    def add(self, name, depends=(), wants=(), after=(), virtual=False, has_meta=True):
+        self.infos[name] = types.SimpleNamespace(
+            name                = name,
+            has_meta            = has_meta,
+            has_meta_section    = has_meta,
+            depends             = list(depends),
+            wants               = list(wants),
+            after               = list(after),
+            virtual             = virtual,
+        )
+    # --- end of add (...) ---
+
+    def get(self, name):
+        info = self.infos.get(name)
+        if info is None:
+            # missing collection
+            self.add(name, has_meta=False)
+            info = self.infos[name]
+        return info
+    # --- end of get (...) ---
+
+# --- end of SyntheticCollectionIndex ---
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    rng = random.Random(arg_config.seed)
+
+    num_failed = 0
+    num_cycles = 0
+
+    for k in range(arg_config.num_random):
+        bcol_index, wanted = gen_random_graph(rng)
+        graph = build_collection_graph(bcol_index, wanted)
+
+        expected = get_order(resolve_passes, graph)
+        result   = get_order(resolve_coldeps, graph)
+
+        if expected is None:
+            num_cycles += 1
+
+        if result != expected:
+            num_failed += 1
+            sys.stdout.write(
+                f'MISMATCH <random#{k}>: wanted={wanted!r}\n'
+                f'  passes:  {expected!r}\n  coldeps: {result!r}\n'
+            )
+        # --
+    # --
+
+    sys.stdout.write(
+        f'checked {arg_config.num_random} random graph(s)'
+        f' ({num_cycles} with cycles), {num_failed} mismatch(es)\n'
+    )
+
+    if arg_config.no_bench:
+        sizes = []
+    else:
+        sizes = (arg_config.sizes or [2000, 4000])
+    # --
+
+    for size in sizes:
+        for kind, gen_graph in [
+            ('random DAG', gen_random_dag),
+            ('chain', gen_chain),
+        ]:
+            bcol_index, wanted = gen_graph(rng, size)
+            graph = build_collection_graph(bcol_index, wanted)
+
+            timings = []
+            for resolve in [resolve_passes, resolve_coldeps]:
+                timings.append(bench_resolve(resolve, graph, arg_config.bench_rounds))
+            # --
+
+            sys.stdout.write(
+                '{kind:<10} n={n:<6} passes {t_old:8.3f}s  coldeps {t_new:8.3f}s\n'.format(
+                    kind=kind, n=size, t_old=timings[0], t_new=timings[1]
+                )
+            )
+        # --
+    # --
+
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+def resolve_coldeps(graph):
+    return [node.name for node in graph.resolve() if not node.virtual]
+# --- end of resolve_coldeps (...) ---
+
+
+def resolve_passes(graph):
+    """
+    Reference: the pass-based resolver mkimage used before dbuild.coldeps.
+    """
+    todo_dep   = graph.get_dep_map()
+    todo_queue = [(name, node.virtual) for name, node in graph.nodes.items()]
+    done       = set()
+    order      = []
+
+    while todo_queue:
+        resolved_any_dep = False
+        todo_queue_next  = []
+
+        for name, is_virtual in todo_queue:
+            if name not in done:
+                if not todo_dep[name]:
+                    done.add(name)
+                    del todo_dep[name]
+
+                    for other_dep_set in todo_dep.values():
+                        other_dep_set.discard(name)
+
+                    if not is_virtual:
+                        order.append(name)
+
+                    resolved_any_dep = True
+
+                else:
+                    todo_queue_next.append((name, is_virtual))
+            # --
+        # --
+
+        if not resolved_any_dep:
+            raise CollectionDependencyCycleError(list(todo_dep))
+
+        todo_queue = todo_queue_next
+    # --
+
+    return order
+# --- end of resolve_passes (...) ---
+
+
+def get_order(resolve, graph):
+    try:
+        return resolve(graph)
+    except CollectionDependencyCycleError:
+        return None
+# --- end of get_order (...) ---
+
+
+def bench_resolve(resolve, graph, num_rounds):
+    # best of num_rounds
+    best = None
+
+    for _ in range(num_rounds):
+        t_start = time.perf_counter()
+        resolve(graph)
+        t_run = (time.perf_counter() - t_start)
+
+        if best is None or t_run < best:
+            best = t_run
+    # --
+
+    return best
+# --- end of bench_resolve (...) ---
+
+
+def gen_random_graph(rng):
+    """
+    Small random collection graph, may contain cycles
+    (edges mostly point to collections further down the list).
+    Returns (index, wanted).
+    """
+    names = [f'c{k}' for k in range(rng.randint(1, 25))]
+    bcol_index = SyntheticCollectionIndex()
+
+    def sample(k_max, candidates=names):
+        if rng.random() < 0.02:
+            # may create a cycle
+            candidates = names
+
+        return rng.sample(candidates, rng.randint(0, min(k_max, len(candidates))))
+    # --- end of sample (...) ---
+
+    for k, name in enumerate(names):
+        if rng.random() < 0.1:
+            bcol_index.add(name, has_meta=False)
+            continue
+        # --
+
+        virtual = (rng.random() < 0.1)
+        depends = sample(2, names[k + 1:])
+        after   = sample(2, names[k + 1:])
+
+        if not virtual and rng.random() < 0.05:
+            (depends if rng.random() < 0.3 else after).append('*')
+
+        bcol_index.add(
+            name, depends=depends, wants=sample(2, names[k + 1:]), after=after, virtual=virtual
+        )
+    # --
+
+    return (bcol_index, sample(5) or [names[0]])
+# --- end of gen_random_graph (...) ---
+
+
+def gen_random_dag(rng, size, max_deps=4):
+    """
+    Random DAG of size collections, all of them requested in random order.
+    """
+    topo_order = [f'c{k}' for k in range(size)]
+    rng.shuffle(topo_order)
+
+    bcol_index = SyntheticCollectionIndex()
+
+    for k, name in enumerate(topo_order):
+        deps = (rng.sample(topo_order[:k], min(k, rng.randint(0, max_deps))) if k else [])
+        if deps and rng.random() < 0.5:
+            bcol_index.add(name, depends=deps[1:], after=deps[:1])
+        else:
+            bcol_index.add(name, depends=deps)
+    # --
+
+    wanted = list(topo_order)
+    rng.shuffle(wanted)
+
+    return (bcol_index, wanted)
+# --- end of gen_random_dag (...) ---
+
+
+def gen_chain(rng, size):
+    """
+    c0 depends on c1, ..., depends on c<size-1>, only c0 is requested:
+    the pass-based resolver resolves one collection per pass.
+    """
+    bcol_index = SyntheticCollectionIndex()
+
+    for k in range(size):
+        bcol_index.add(f'c{k}', depends=([f'c{k + 1}'] if (k + 1) < size else []))
+
+    return (bcol_index, ['c0'])
+# --- end of gen_chain (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '-n', '--num-random', metavar='<n>',
+        dest='num_random', default=3000, type=int,
+        help='number of random graphs to check (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the random graphs (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-N', '--size', metavar='<n>',
+        dest='sizes', default=[], action='append', type=int,
+        help='benchmark: number of collections, may be given more than once (default: 2000, 4000)'
+    )
+
+    parser.add_argument(
+        '-r', '--bench-rounds', metavar='<n>',
+        dest='bench_rounds', default=3, type=int,
+        help='benchmark: best of <n> runs (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-B', '--no-bench',
+        dest='no_bench',
+        default=False, action='store_true',
+        help='skip the benchmark'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
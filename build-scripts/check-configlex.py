@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Differential test and benchmark of the config tokenizer (dbuild.configlex)
+#  against shlex.shlex(..., posix=True, punctuation_chars=True).
+#
+#  Compares the token lists (or the error raised) of both tokenizers
+#  for the config files of the project (collections, profiles) and
+#  for randomly generated inputs, then times both on the given files.
+#
+#  Usage: check-configlex.py [-n <num_random>] [-s <seed>] [<file>...]
+#
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from dbuild.configlex import gen_tokenize
+from dbuild.configlex import gen_tokenize_shlex
+
+
+PRJROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# chars for fully random inputs, biased towards chars with a meaning
+RANDOM_CHARS = (
+    'aZ09_-./=*?:@%+,~'
+    + '\'\'""\\\\##'
+    + ' \t\n\n\r'
+    + '();<>|&'
+    + '$`{}[]!^ä€'
+)
+
+# fragments for structured random inputs
+RANDOM_FRAGMENTS = [
+    'NAME', 'x', 'FOO_BAR', '=', '*=', '?=', ' ', '\t', '\n', '\\\n',
+    "'value'", "'it''s'", "''", '"v a l"', '"a\\"b"', '"a\\\\b"', '"a\\nb"', '""',
+    '\\ ', '\\\'', '\\"', '\\\\', '\\#', '#', '# comment\n', ' # c',
+    '(', ')', ';', '&&', '||', '<', '>>', '|',
+    '$X', '${X}', '@{x}', '/usr/bin', 'a,b', 'ä',
+    "'", '"', '\\',
+]
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    infiles = (arg_config.infiles or list(gen_default_infiles()))
+    texts = []
+    for infile in infiles:
+        with open(infile, 'rt') as fh:
+            texts.append((infile, fh.read()))
+    # --
+
+    rng = random.Random(arg_config.seed)
+
+    num_failed = 0
+    num_checked = 0
+
+    for source, text in texts:
+        num_checked += 1
+        if not check_text(text, source):
+            num_failed += 1
+    # --
+
+    for k in range(arg_config.num_random):
+        num_checked += 1
+        if not check_text(gen_random_text(rng), f'<random#{k}>'):
+            num_failed += 1
+    # --
+
+    sys.stdout.write(f'checked {num_checked} input(s), {num_failed} mismatch(es)\n')
+
+    if texts and not arg_config.no_bench:
+        for name, tokenize in [
+            ('shlex', gen_tokenize_shlex),
+            ('configlex', gen_tokenize),
+        ]:
+            sys.stdout.write(
+                '{name:<10} {t:8.3f} ms per pass over {n} file(s)\n'.format(
+                    name=name, n=len(texts),
+                    t=(1000 * bench_tokenize(tokenize, texts, arg_config.bench_rounds)),
+                )
+            )
+        # --
+    # --
+
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+def gen_default_infiles():
+    for dirname in ['collections', 'profiles']:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(PRJROOT, dirname)):
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+                if dirname == 'profiles' or filename == 'config':
+                    yield os.path.join(dirpath, filename)
+            # -- end for
+        # -- end for
+    # -- end for
+# --- end of gen_default_infiles (...) ---
+
+
+def get_tokens(tokenize, text, source):
+    try:
+        return (True, list(tokenize(text, source)))
+    except ValueError as err:
+        return (False, str(err))
+# --- end of get_tokens (...) ---
+
+
+def check_text(text, source):
+    expected = get_tokens(gen_tokenize_shlex, text, source)
+    result   = get_tokens(gen_tokenize, text, source)
+
+    if result != expected:
+        sys.stdout.write(
+            f'MISMATCH {source}: {text!r}\n  shlex:     {expected!r}\n  configlex: {result!r}\n'
+        )
+        return False
+    # --
+
+    return True
+# --- end of check_text (...) ---
+
+
+def gen_random_text(rng):
+    if rng.random() < 0.5:
+        return ''.join(rng.choices(RANDOM_CHARS, k=rng.randint(0, 40)))
+    else:
+        return ''.join(rng.choices(RANDOM_FRAGMENTS, k=rng.randint(0, 12)))
+# --- end of gen_random_text (...) ---
+
+
+def bench_tokenize(tokenize, texts, num_rounds):
+    # best of num_rounds
+    best = None
+
+    for _ in range(num_rounds):
+        t_start = time.perf_counter()
+        for source, text in texts:
+            for _ in tokenize(text, source):
+                pass
+        t_pass = (time.perf_counter() - t_start)
+
+        if best is None or t_pass < best:
+            best = t_pass
+    # --
+
+    return best
+# --- end of bench_tokenize (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        'infiles', metavar='<file>', nargs='*',
+        help='config files to check (default: collection and profile configs)'
+    )
+
+    parser.add_argument(
+        '-n', '--num-random', metavar='<n>',
+        dest='num_random', default=100000, type=int,
+        help='number of random inputs to check (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the random inputs (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-r', '--bench-rounds', metavar='<n>',
+        dest='bench_rounds', default=20, type=int,
+        help='benchmark: best of <n> passes (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-B', '--no-bench',
+        dest='no_bench',
+        default=False, action='store_true',
+        help='skip the benchmark'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Equivalence check and benchmark of the sinkhole route aggregation
+#  (dbuild.netroutes.PrefixSet) against ipaddress.collapse_addresses(),
+#  which expand_config() used before.
+#
+#  Compares the aggregated routes (or the error raised) for a list of
+#  odd prefix notations and for random clustered prefix sets (IPv4/IPv6),
+#  IPv6 prefixes with scope id are compared without it (PrefixSet drops it,
+#  collapse_addresses() kept it for some prefix lengths),
+#  then times both on files of random IPv4 /20../32 prefixes,
+#  each run in a forked process to report its peak memory usage (maxrss).
+#
+#  Usage: check-netroutes.py [-n <num_random>] [-s <seed>] [-N <size>...]
+#
+
+import argparse
+import hashlib
+import ipaddress
+import os
+import random
+import sys
+import tempfile
+import time
+
+from dbuild.netroutes import PrefixSet
+
+
+# single prefixes with notations that take the slow path or fail
+ODD_PREFIXES = {
+    4: [
+        '0.0.0.0/0', '10.0.0.0/8', '10.0.0.1/8', '10.0.0.1', '10.0.0.0/32',
+        '10.0.0.0/08', '10.0.0.0/33', '10.0.0.0/-1', '10.0.0.0/', '/8',
+        '10.0.0.0/255.0.0.0', '10.0.0.0/0.255.255.255', '10.0.0.0/255.0.255.0',
+        '010.0.0.0/8', '10.0.0/24', '10.0.0.256/32', '1.2.3.4/32/1',
+        '10.0.0.0/٨', '١.2.3.4', '::/0', 'a.b.c.d', '',
+    ],
+    6: [
+        '::/0', '::', '::1', '::1/127', '2001:db8::/32', '2001:DB8::/32',
+        '2001:db8::1/32', '2001:0db8:0000::/48', '2001:db8::/129', '2001:db8::/032',
+        '2001:db8::/ffff::', '::ffff:1.2.3.4/128', '::ffff:1.2.3.0/120',
+        '::1.2.3.4', '64:ff9b::/96', '2001:db8:::/48', '2001:db8::g/128', '10.0.0.0/8', '',
+    ],
+}
+
+# IPv6 prefixes with scope id -> same prefix without scope id
+SCOPED_PREFIXES = {
+    'fe80::1%eth0/128'  : 'fe80::1/128',
+    'fe80::%1/64'       : 'fe80::/64',
+}
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    rng = random.Random(arg_config.seed)
+
+    num_checked = 0
+    num_failed = 0
+
+    for ip_version, prefixes in sorted(ODD_PREFIXES.items()):
+        for prefix in prefixes:
+            num_checked += 1
+            if not check_prefixes(ip_version, [prefix], repr(prefix)):
+                num_failed += 1
+        # --
+    # --
+
+    for prefix, prefix_unscoped in sorted(SCOPED_PREFIXES.items()):
+        num_checked += 1
+        if not check_prefixes(6, [prefix], repr(prefix), [prefix_unscoped]):
+            num_failed += 1
+    # --
+
+    for k in range(arg_config.num_random):
+        ip_version = rng.choice([4, 6])
+
+        num_checked += 1
+        if not check_prefixes(
+            ip_version, gen_random_prefixes(rng, ip_version), f'<random#{k}>'
+        ):
+            num_failed += 1
+    # --
+
+    sys.stdout.write(f'checked {num_checked} prefix list(s), {num_failed} mismatch(es)\n')
+
+    if arg_config.no_bench:
+        sizes = []
+    else:
+        sizes = (arg_config.sizes or [100000, 1000000])
+    # --
+
+    for size in sizes:
+        with tempfile.NamedTemporaryFile('wt', prefix='prefixes.', suffix='.txt') as fh:
+            for start, prefixlen in gen_random_bench_prefixes(rng, size):
+                fh.write('{}/{}\n'.format(ipaddress.IPv4Address(start), prefixlen))
+            fh.flush()
+
+            results = []
+            for name, aggregate in [
+                ('collapse_addresses', aggregate_file_collapse),
+                ('PrefixSet', aggregate_file_prefixset),
+            ]:
+                t_run, maxrss, digest = run_forked(aggregate, fh.name)
+                results.append(digest)
+
+                sys.stdout.write(
+                    '{name:<18} n={n:<8} {t:8.2f}s  {mem:6.0f} MiB maxrss\n'.format(
+                        name=name, n=size, t=t_run, mem=(maxrss / 1024)
+                    )
+                )
+            # --
+        # --
+
+        if results[0] != results[1]:
+            num_failed += 1
+            sys.stdout.write(f'MISMATCH n={size}: aggregated routes differ\n')
+        # --
+    # --
+
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+def get_routes_collapse(ip_version, prefixes):
+    """
+    Reference: aggregation as done by expand_config() before PrefixSet.
+    """
+    network_cls = (ipaddress.IPv4Network if ip_version == 4 else ipaddress.IPv6Network)
+
+    return ' '.join(map(str, ipaddress.collapse_addresses(
+        set((network_cls(o) for o in prefixes))
+    )))
+# --- end of get_routes_collapse (...) ---
+
+
+def get_routes_prefixset(ip_version, prefixes):
+    prefix_set = PrefixSet(ip_version)
+    prefix_set.update(prefixes)
+    return ' '.join(prefix_set.gen_networks_str())
+# --- end of get_routes_prefixset (...) ---
+
+
+def get_result(get_routes, ip_version, prefixes):
+    try:
+        return get_routes(ip_version, prefixes)
+    except ValueError as err:
+        return (type(err).__name__, str(err))
+# --- end of get_result (...) ---
+
+
+def check_prefixes(ip_version, prefixes, source, ref_prefixes=None):
+    expected = get_result(get_routes_collapse, ip_version, (ref_prefixes or prefixes))
+    result   = get_result(get_routes_prefixset, ip_version, prefixes)
+
+    if result != expected:
+        sys.stdout.write(
+            f'MISMATCH {source} (IPv{ip_version}): {prefixes!r}\n'
+            f'  collapse_addresses: {expected!r}\n  PrefixSet:          {result!r}\n'
+        )
+        return False
+    # --
+
+    return True
+# --- end of check_prefixes (...) ---
+
+
+def gen_random_prefixes(rng, ip_version):
+    """
+    Random prefixes clustered around a few base addresses,
+    so that they overlap, nest and adjoin.
+    """
+    bits = (32 if ip_version == 4 else 128)
+    network_cls = (ipaddress.IPv4Network if ip_version == 4 else ipaddress.IPv6Network)
+
+    bases = [rng.getrandbits(bits) for _ in range(rng.randint(1, 3))]
+    prefixes = []
+
+    for _ in range(rng.randint(0, 40)):
+        prefixlen = rng.randint((bits - 12), bits)
+        if rng.random() < 0.05:
+            prefixlen = rng.randint(0, bits)
+
+        addr = (rng.choice(bases) ^ rng.getrandbits(12))
+        # clear host bits
+        addr &= (((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1))
+
+        prefixes.append(str(network_cls((addr, prefixlen))))
+
+        if rng.random() < 0.2:
+            prefixes.append(prefixes[rng.randrange(len(prefixes))])
+    # --
+
+    return prefixes
+# --- end of gen_random_prefixes (...) ---
+
+
+def gen_random_bench_prefixes(rng, size):
+    for _ in range(size):
+        prefixlen = rng.randint(20, 32)
+        yield ((rng.getrandbits(prefixlen) << (32 - prefixlen)), prefixlen)
+# --- end of gen_random_bench_prefixes (...) ---
+
+
+def aggregate_file_collapse(filepath):
+    with open(filepath, 'rt') as fh:
+        return get_routes_collapse(4, fh.read().split())
+# --- end of aggregate_file_collapse (...) ---
+
+
+def aggregate_file_prefixset(filepath):
+    prefix_set = PrefixSet(4)
+    prefix_set.update_from_file(filepath)
+    return ' '.join(prefix_set.gen_networks_str())
+# --- end of aggregate_file_prefixset (...) ---
+
+
+def run_forked(aggregate, filepath):
+    """
+    Runs aggregate(filepath) in a child process.
+    Returns (run time, maxrss in KiB, digest of the aggregated routes).
+    """
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if not pid:
+        exit_code = 1
+        try:
+            os.close(read_fd)
+
+            t_start = time.perf_counter()
+            routes = aggregate(filepath)
+            t_run = (time.perf_counter() - t_start)
+
+            digest = hashlib.sha256(routes.encode('ascii')).hexdigest()
+            os.write(write_fd, f'{t_run} {digest}'.encode('ascii'))
+            exit_code = 0
+        finally:
+            os._exit(exit_code)
+    # --
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as fh:
+        data = fh.read().decode('ascii')
+
+    _, status, rusage = os.wait4(pid, 0)
+    if status or not data:
+        raise RuntimeError('benchmark process failed', aggregate.__name__, status)
+
+    t_run, digest = data.split()
+
+    return (float(t_run), rusage.ru_maxrss, digest)
+# --- end of run_forked (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '-n', '--num-random', metavar='<n>',
+        dest='num_random', default=2000, type=int,
+        help='number of random prefix lists to check (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the random prefixes (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-N', '--size', metavar='<n>',
+        dest='sizes', default=[], action='append', type=int,
+        help='benchmark: number of prefixes, may be given more than once (default: 100000, 1000000)'
+    )
+
+    parser.add_argument(
+        '-B', '--no-bench',
+        dest='no_bench',
+        default=False, action='store_true',
+        help='skip the benchmark'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
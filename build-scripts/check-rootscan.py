@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Equivalence check and benchmark of the rootfs scanner (dbuild.rootscan)
+#  on a synthetic rootfs tree (default: 200k entries).
+#
+#  Symlink rewriting (fix-symlinks.py, dry run) is compared with the
+#  os.walk() + pathlib walker that fix-symlinks.py used before,
+#  scanning single-threaded (--jobs 1) and with a thread pool.
+#  File metadata (scan-rootfs.py --metadata) is compared between
+#  single-threaded and concurrent scans, over several rounds.
+#
+#  Run it under fakeroot to check the concurrent scans against fakeroot's
+#  stat() emulation: the tree then gets random faked ownership, modes,
+#  device nodes and file capabilities, which the scans must report:
+#
+#    $ fakeroot ./check-rootscan.py
+#
+#  Usage: check-rootscan.py [-N <num_entries>] [-j <jobs>] [-s <seed>] [-d <dir>]
+#
+
+import argparse
+import itertools
+import os
+import pathlib
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from dbuild.rootscan import MetadataVisitor
+from dbuild.rootscan import RootfsScanner
+from dbuild.rootscan import SymlinkFixVisitor
+
+
+# top-level directories of the synthetic tree (usrmerge layout)
+TOP_LEVEL_DIRS = [
+    'boot', 'dev', 'etc', 'home', 'opt', 'root', 'run', 'srv', 'tmp',
+    'usr', 'usr/bin', 'usr/lib', 'usr/sbin', 'usr/share', 'var', 'var/lib',
+]
+
+# file capability xattr (cap_net_raw+ep), as set by setcap
+CAPABILITY_XATTR = (
+    'security.capability',
+    bytes.fromhex('0100000200200000000000000000000000000000'),
+)
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    rng = random.Random(arg_config.seed)
+    is_root = (os.geteuid() == 0)
+
+    if arg_config.tree_dir:
+        root = arg_config.tree_dir
+        if os.path.lexists(root):
+            arg_parser.error(f'tree directory exists: {root}')
+        os.makedirs(root)
+    else:
+        root = tempfile.mkdtemp(prefix='check-rootscan.')
+    # --
+
+    try:
+        t_start = time.perf_counter()
+        num_links = make_tree(root, arg_config.num_entries, rng, fake_owner=is_root)
+        sys.stdout.write(
+            '{n} entries, {l} links to the tree root, created in {t:.1f}s{f}\n'.format(
+                n=arg_config.num_entries, l=num_links, t=(time.perf_counter() - t_start),
+                f=(
+                    (' (random ownership, fakeroot)' if os.environ.get('FAKEROOTKEY') else ' (random ownership)')
+                    if is_root else ''
+                ),
+            )
+        )
+
+        num_failed = 0
+
+        # fix-symlinks: reference walker vs. scanner
+        timings  = {}
+        expected = None
+
+        for name, get_links in [
+            ('os.walk + pathlib', get_links_walk),
+            ('scandir, --jobs 1', (lambda root: get_links_scan(root, 1))),
+            (f'scandir, --jobs {arg_config.jobs}', (lambda root: get_links_scan(root, arg_config.jobs))),
+        ]:
+            t_run, links = bench(get_links, root, arg_config.bench_rounds)
+            timings[name] = t_run
+
+            if expected is None:
+                expected = links
+
+            elif links != expected:
+                num_failed += 1
+                sys.stdout.write(f'MISMATCH fix-symlinks ({name}): {len(links)} vs. {len(expected)} links\n')
+            # --
+        # --
+
+        for name, t_run in timings.items():
+            sys.stdout.write(f'fix-symlinks  {name:<22} {t_run:8.3f}s\n')
+
+        # metadata: single-threaded vs. concurrent scans
+        expected = get_metadata_scan(root, 1)
+
+        for k in range(arg_config.metadata_rounds):
+            if get_metadata_scan(root, arg_config.jobs) != expected:
+                num_failed += 1
+                sys.stdout.write(f'MISMATCH metadata (round {k}, --jobs {arg_config.jobs})\n')
+        # --
+
+        num_faked = sum((1 for item in expected if item['uid'] or item['gid']))
+        sys.stdout.write(
+            f'metadata: {arg_config.metadata_rounds} concurrent scan(s) of {len(expected)} entries'
+            f' ({num_faked} not owned by root:root) compared\n'
+        )
+
+    finally:
+        if not arg_config.tree_dir:
+            shutil.rmtree(root)
+    # --
+
+    sys.stdout.write(f'{num_failed} mismatch(es)\n')
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+def make_tree(root, num_entries, rng, fake_owner=False):
+    """
+    Creates a rootfs-like tree of num_entries files, directories
+    and symlinks below root.
+    Returns the number of symlinks pointing into root (absolute).
+    """
+    root_prefix = root.rstrip('/') + '/'
+    dirs = []
+
+    for relpath in TOP_LEVEL_DIRS:
+        os.makedirs(os.path.join(root, relpath))
+        dirs.append(relpath)
+    # --
+
+    files = []
+    num_links = 0
+
+    for k in range(len(dirs), num_entries):
+        parent = rng.choice(dirs)
+        relpath = f'{parent}/e{k}'
+        fpath = os.path.join(root, relpath)
+        kind = rng.random()
+
+        if kind < 0.02:
+            os.mkdir(fpath)
+            dirs.append(relpath)
+
+        elif kind < 0.07:
+            if rng.random() < 0.5:
+                # absolute link to the build-time rootfs
+                os.symlink(root_prefix + rng.choice(dirs + files), fpath)
+                num_links += 1
+            else:
+                os.symlink(f'../e{rng.randrange(k)}', fpath)
+
+        elif kind < 0.075 and files:
+            os.link(os.path.join(root, rng.choice(files)), fpath)
+
+        elif kind < 0.077 and fake_owner:
+            os.mknod(fpath, (stat.S_IFCHR | 0o660), os.makedev(rng.randint(1, 10), k % 256))
+
+        else:
+            with open(fpath, 'wb'):
+                pass
+            files.append(relpath)
+        # --
+
+        if fake_owner and not os.path.islink(fpath):
+            if rng.random() < 0.3:
+                os.chown(fpath, rng.randint(0, 1000), rng.randint(0, 1000))
+                os.chmod(fpath, (rng.choice([0o755, 0o750, 0o644, 0o640, 0o4755, 0o2755])))
+
+            if rng.random() < 0.01 and os.path.isfile(fpath):
+                try:
+                    os.setxattr(fpath, *CAPABILITY_XATTR)
+                except OSError:
+                    pass
+            # --
+        # --
+    # --
+
+    return num_links
+# --- end of make_tree (...) ---
+
+
+def get_links_walk(root):
+    """
+    Reference: symlinks to rewrite, as found by fix-symlinks.py
+    before dbuild.rootscan (os.walk() + pathlib).
+    """
+    root_prefix = root.rstrip('/') + '/'
+    links = []
+
+    for (dirpath, dirnames, filenames) in os.walk(root, followlinks=False):
+        for filename in itertools.chain(filenames, dirnames):
+            fpath = pathlib.Path(dirpath, filename)
+
+            if fpath.is_symlink():
+                link_target = str(fpath.readlink())
+
+                if link_target == root or link_target.startswith(root_prefix):
+                    links.append((str(fpath), link_target, ('/' + link_target[len(root_prefix):])))
+            # --
+        # --
+    # --
+
+    return sorted(links)
+# --- end of get_links_walk (...) ---
+
+
+def get_links_scan(root, jobs):
+    scanner = RootfsScanner(root, jobs=jobs)
+    fix_symlinks = scanner.add_visitor(SymlinkFixVisitor(root, '/', dry_run=True))
+    scanner.run()
+    return fix_symlinks.items
+# --- end of get_links_scan (...) ---
+
+
+def get_metadata_scan(root, jobs):
+    scanner = RootfsScanner(root, jobs=jobs)
+    metadata = scanner.add_visitor(MetadataVisitor())
+    scanner.run()
+    return metadata.items
+# --- end of get_metadata_scan (...) ---
+
+
+def bench(func, arg, num_rounds):
+    # best of num_rounds, returns (time, result of the last run)
+    best = None
+    result = None
+
+    for _ in range(num_rounds):
+        t_start = time.perf_counter()
+        result = func(arg)
+        t_run = (time.perf_counter() - t_start)
+
+        if best is None or t_run < best:
+            best = t_run
+    # --
+
+    return (best, result)
+# --- end of bench (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '-N', '--num-entries', metavar='<n>',
+        dest='num_entries', default=200000, type=int,
+        help='number of entries in the synthetic tree (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs', metavar='<n>',
+        dest='jobs', default=((os.cpu_count() or 1) + 4), type=int,
+        help='threads for the concurrent scans (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the synthetic tree (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-d', '--tree-dir', metavar='<dir>',
+        dest='tree_dir', default=None,
+        help='create the tree in <dir> (must not exist) and keep it (default: temporary directory)'
+    )
+
+    parser.add_argument(
+        '-r', '--bench-rounds', metavar='<n>',
+        dest='bench_rounds', default=3, type=int,
+        help='benchmark: best of <n> runs (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-m', '--metadata-rounds', metavar='<n>',
+        dest='metadata_rounds', default=5, type=int,
+        help='number of concurrent metadata scans to compare (default: %(default)s)'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,493 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Equivalence check and benchmark of the uid/gid allocator
+#  of make_sysusers.py (IdAllocator) against the per-range UidGidGenerator
+#  that merge_sysusers() used before (with its name lookup fixed
+#  to return the id instead of the entry, it crashed otherwise).
+#
+#  Merges random sysusers entries (users and group-only entries,
+#  automatic system/regular ids and explicit ids, shared member groups)
+#  into random passwd/group databases with scattered pre-existing ids
+#  and small id ranges (exhausted now and then).
+#  Both must produce the same passwd/group files, or fail the same way.
+#  Not covered are the cases where IdAllocator differs intentionally:
+#  ids changed on existing entries (reserved now, reused before) and
+#  a user/group pair of the same name in different id ranges
+#  (same id now, one id from each range before).
+#
+#  The benchmark times merge_sysusers() and the allocation alone
+#  with both allocators, for thousands of service accounts in 50 shared
+#  groups, with enlarged id ranges and 3000 scattered pre-existing ids.
+#
+#  Usage: check-sysusers.py [-n <num_random>] [-s <seed>] [-N <size>...]
+#
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+
+import make_sysusers
+
+from make_sysusers import EntryDB
+from make_sysusers import GroupEntry
+from make_sysusers import IdAllocator
+from make_sysusers import OrderedSet
+from make_sysusers import SysusersEntry
+from make_sysusers import UserEntry
+from make_sysusers import UsersGroupsDB
+
+
+# id ranges for the benchmark (system, regular)
+BENCH_ID_RANGES = ((100, 29999), (30000, 59999))
+
+BENCH_NUM_PREEXISTING = 3000
+BENCH_NUM_SHARED_GROUPS = 50
+
+
+class UidGidGenerator(object):
+    """
+    Reference: the id generator make_sysusers.py used before IdAllocator,
+    one instance per id range, each with its own cursor and name cache.
+    """
+
+    def __init__(self, users_groups_db, id_min, id_max):
+        super().__init__()
+        self.users_groups_db = users_groups_db
+        self.id_max          = id_max
+        self._id_next        = id_min
+        self._name_id_cache  = {}
+    # --- end of __init__ (...) ---
+
+    def get(self, name):
+        name_id_cache = self._name_id_cache
+
+        try:
+            return name_id_cache[name]
+        except KeyError:
+            pass
+
+        passwd_entry = self.users_groups_db.passwd.by_name.get(name, None)
+        group_entry  = self.users_groups_db.group.by_name.get(name, None)
+
+        passwd_id = (passwd_entry.get_id() if passwd_entry is not None else None)
+        group_id  = (group_entry.get_id() if group_entry is not None else None)
+
+        if passwd_id is not None:
+            if group_id is None or passwd_id == group_id:
+                name_id_cache[name] = passwd_id
+                return passwd_id
+
+        elif group_id is not None:
+            name_id_cache[name] = group_id
+            return group_id
+
+        passwd_id_db = self.users_groups_db.passwd.by_id
+        group_id_db  = self.users_groups_db.group.by_id
+
+        id_next = self._id_next
+
+        while id_next <= self.id_max and (id_next in passwd_id_db or id_next in group_id_db):
+            id_next += 1
+
+        if id_next > self.id_max:
+            raise RuntimeError('uid/gid generator exhausted', id_next, self.id_max)
+
+        name_id_cache[name] = id_next
+        self._id_next = id_next + 1
+        return id_next
+    # --- end of get (...) ---
+
+# --- end of UidGidGenerator ---
+
+
+class UidGidGeneratorAllocator(object):
+    """
+    Provides the IdAllocator interface on top of per-range UidGidGenerators,
+    as merge_sysusers() used them before (explicit ids were not reserved).
+    """
+
+    def __init__(self, users_groups_db, id_ranges):
+        super().__init__()
+        self.generators = {
+            id_range: UidGidGenerator(users_groups_db, *id_range)
+            for id_range in id_ranges
+        }
+    # --- end of __init__ (...) ---
+
+    def reserve(self, entry_id):
+        pass
+    # --- end of reserve (...) ---
+
+    def get(self, name, id_min, id_max):
+        return self.generators[(id_min, id_max)].get(name)
+    # --- end of get (...) ---
+
+# --- end of UidGidGeneratorAllocator ---
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    rng = random.Random(arg_config.seed)
+
+    num_failed = 0
+    num_errors = 0
+
+    for k in range(arg_config.num_random):
+        id_ranges, db_entries, sysuser_entries = gen_random_case(rng)
+
+        expected = get_merged(UidGidGeneratorAllocator, id_ranges, db_entries, sysuser_entries)
+        result   = get_merged(IdAllocator, id_ranges, db_entries, sysuser_entries)
+
+        if isinstance(expected, tuple):
+            num_errors += 1
+
+        if result != expected:
+            num_failed += 1
+            sys.stdout.write(
+                f'MISMATCH <random#{k}>: ranges={id_ranges!r}\n'
+                f'  UidGidGenerator: {expected!r}\n  IdAllocator:     {result!r}\n'
+            )
+        # --
+    # --
+
+    sys.stdout.write(
+        f'checked {arg_config.num_random} random merge(s)'
+        f' ({num_errors} failing), {num_failed} mismatch(es)\n'
+    )
+
+    if arg_config.no_bench:
+        sizes = []
+    else:
+        sizes = (arg_config.sizes or [2000, 10000])
+    # --
+
+    for size in sizes:
+        db_entries, sysuser_entries = gen_bench_case(rng, size)
+        users_groups_db = new_users_groups_db(db_entries)
+        results = []
+
+        for name, allocator_cls in [
+            ('UidGidGenerator', UidGidGeneratorAllocator),
+            ('IdAllocator', IdAllocator),
+        ]:
+            t_merge, merged = bench(
+                (lambda: get_merged(allocator_cls, BENCH_ID_RANGES, db_entries, sysuser_entries)),
+                arg_config.bench_rounds
+            )
+            t_alloc, _ = bench(
+                (lambda: allocate_all(allocator_cls, users_groups_db, size)),
+                arg_config.bench_rounds
+            )
+            results.append(merged)
+
+            sys.stdout.write(
+                '{name:<16} n={n:<6} merge {t_merge:8.3f}s  allocate {t_alloc:8.3f}s\n'.format(
+                    name=name, n=size, t_merge=t_merge, t_alloc=t_alloc
+                )
+            )
+        # --
+
+        if results[0] != results[1]:
+            num_failed += 1
+            sys.stdout.write(f'MISMATCH n={size}: merged passwd/group files differ\n')
+        # --
+    # --
+
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+@contextlib.contextmanager
+def patch_merge_sysusers(allocator_cls, id_ranges):
+    # merge_sysusers() reads the allocator class and the id ranges at call time
+    globals_obj = make_sysusers.Globals
+    orig = (
+        make_sysusers.IdAllocator,
+        globals_obj.SYSTEM_USER_ID_RANGE,
+        globals_obj.REGULAR_USER_ID_RANGE,
+    )
+
+    make_sysusers.IdAllocator = allocator_cls
+    globals_obj.SYSTEM_USER_ID_RANGE, globals_obj.REGULAR_USER_ID_RANGE = id_ranges
+    try:
+        yield
+    finally:
+        (
+            make_sysusers.IdAllocator,
+            globals_obj.SYSTEM_USER_ID_RANGE,
+            globals_obj.REGULAR_USER_ID_RANGE,
+        ) = orig
+    # --
+# --- end of patch_merge_sysusers (...) ---
+
+
+def new_users_groups_db(db_entries):
+    """
+    Creates a passwd/group database from a list of
+    ('user', name, uid, gid) and ('group', name, gid) tuples.
+    """
+    passwd_db = EntryDB()
+    group_db  = EntryDB()
+
+    for kind, name, *ids in db_entries:
+        if kind == 'user':
+            passwd_db.add(UserEntry(
+                raw=None, pw_name=name, pw_passwd='x', pw_uid=ids[0], pw_gid=ids[1],
+                pw_gecos='', pw_dir='/', pw_shell='/usr/sbin/nologin',
+            ))
+        else:
+            group_db.add(GroupEntry(
+                raw=None, gr_name=name, gr_passwd='x', gr_gid=ids[0], gr_mem=OrderedSet(),
+            ))
+    # --
+
+    return UsersGroupsDB(passwd=passwd_db, group=group_db, shadow=None, gshadow=None)
+# --- end of new_users_groups_db (...) ---
+
+
+def get_merged(allocator_cls, id_ranges, db_entries, sysuser_entries):
+    """
+    Merges sysuser_entries into a new database using the given allocator.
+    Returns (passwd lines, group lines), or (error name,) if it failed
+(the error args name implementation-specific ids).
+    """
+    users_groups_db = new_users_groups_db(db_entries)
+
+    try:
+        with patch_merge_sysusers(allocator_cls, id_ranges):
+            make_sysusers.merge_sysusers(users_groups_db, sysuser_entries)
+
+    except (RuntimeError, KeyError) as err:
+        return (type(err).__name__,)
+    # --
+
+    return [
+        [str(entry) for entry in users_groups_db.passwd.iter_entries()],
+        [str(entry) for entry in users_groups_db.group.iter_entries()],
+    ]
+# --- end of get_merged (...) ---
+
+
+def allocate_all(allocator_cls, users_groups_db, size):
+    # allocation only (the database is not modified): system ids for size names
+    allocator = allocator_cls(users_groups_db, BENCH_ID_RANGES)
+
+    for k in range(size):
+        allocator.get(f'svc{k}', *BENCH_ID_RANGES[0])
+# --- end of allocate_all (...) ---
+
+
+def new_sysusers_entry(username, uid, group, gid, groups=None):
+    return SysusersEntry(
+        raw='', username=username, uid=uid, group=group, gid=gid,
+        password=('*' if username else None), home=None, shell=None,
+        groups=groups, comment=None,
+    )
+# --- end of new_sysusers_entry (...) ---
+
+
+def gen_random_case(rng):
+    """
+    Small random merge: id ranges, pre-existing db entries, sysusers entries.
+
+    Every name has a fixed id spec (-1: system, -2: regular, or an
+    explicit id for names not in the database), used for both the user
+    and the group of that name.
+    """
+    sys_min = rng.randint(100, 120)
+    reg_min = rng.randint(200, 220)
+    id_ranges = (
+        (sys_min, (sys_min + rng.randint(0, 60))),
+        (reg_min, (reg_min + rng.randint(0, 60))),
+    )
+
+    def gen_free_id():
+        # ids around and within the ranges
+        return rng.choice([rng.randint(90, 170), rng.randint(190, 270)])
+    # --- end of gen_free_id (...) ---
+
+    names = [f'n{k}' for k in range(rng.randint(1, 40))]
+
+    # pre-existing users and groups, scattered ids
+    db_entries = []
+    used_uids = set()
+    used_gids = set()
+    existing = set()
+
+    for name in rng.sample(names, rng.randint(0, len(names) // 2)):
+        entry_id = gen_free_id()
+
+        if rng.random() < 0.7 and entry_id not in used_uids:
+            used_uids.add(entry_id)
+            db_entries.append(('user', name, entry_id, entry_id))
+            existing.add(name)
+
+        if rng.random() < 0.7:
+            gid = (entry_id if rng.random() < 0.8 else gen_free_id())
+            if gid not in used_gids:
+                used_gids.add(gid)
+                db_entries.append(('group', name, gid))
+                existing.add(name)
+        # --
+    # --
+
+    explicit_ids = set()
+    id_specs = {}
+    for name in names:
+        if name not in existing and rng.random() < 0.15:
+            entry_id = gen_free_id()
+            if entry_id not in used_uids and entry_id not in used_gids and entry_id not in explicit_ids:
+                explicit_ids.add(entry_id)
+                id_specs[name] = entry_id
+                continue
+        # --
+        id_specs[name] = rng.choice([-1, -2])
+    # --
+
+    sysuser_entries = []
+    for _ in range(rng.randint(0, 30)):
+        name = rng.choice(names)
+
+        if rng.random() < 0.2:
+            # group-only
+            sysuser_entries.append(new_sysusers_entry(None, None, name, id_specs[name]))
+            continue
+        # --
+
+        group = (name if rng.random() < 0.6 else rng.choice(names))
+        groups = (rng.sample(names, rng.randint(1, min(3, len(names)))) if rng.random() < 0.3 else None)
+
+        sysuser_entries.append(
+            new_sysusers_entry(name, id_specs[name], group, id_specs[group], groups)
+        )
+    # --
+
+    return (id_ranges, db_entries, sysuser_entries)
+# --- end of gen_random_case (...) ---
+
+
+def gen_bench_case(rng, size):
+    """
+    Benchmark merge: scattered pre-existing user/group pairs,
+    size service accounts (system ids, some regular) with their own group,
+    members of BENCH_NUM_SHARED_GROUPS shared groups.
+    """
+    db_entries = []
+
+    for k, entry_id in enumerate(sorted(rng.sample(
+        range(BENCH_ID_RANGES[0][0], BENCH_ID_RANGES[1][1] + 1), BENCH_NUM_PREEXISTING
+    ))):
+        db_entries.append(('user', f'pre{k}', entry_id, entry_id))
+        db_entries.append(('group', f'pre{k}', entry_id))
+    # --
+
+    shared_groups = [f'shared{k}' for k in range(BENCH_NUM_SHARED_GROUPS)]
+
+    sysuser_entries = []
+    for k in range(size):
+        name = f'svc{k}'
+        id_spec = (-2 if rng.random() < 0.1 else -1)
+
+        sysuser_entries.append(new_sysusers_entry(
+            name, id_spec, name, id_spec, rng.sample(shared_groups, rng.randint(0, 3))
+        ))
+    # --
+
+    return (db_entries, sysuser_entries)
+# --- end of gen_bench_case (...) ---
+
+
+def bench(func, num_rounds):
+    # best of num_rounds, returns (time, result of the last run)
+    best = None
+    result = None
+
+    for _ in range(num_rounds):
+        t_start = time.perf_counter()
+        result = func()
+        t_run = (time.perf_counter() - t_start)
+
+        if best is None or t_run < best:
+            best = t_run
+    # --
+
+    return (best, result)
+# --- end of bench (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '-n', '--num-random', metavar='<n>',
+        dest='num_random', default=5000, type=int,
+        help='number of random merges to check (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the random merges (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-N', '--size', metavar='<n>',
+        dest='sizes', default=[], action='append', type=int,
+        help='benchmark: number of service accounts, may be given more than once (default: 2000, 10000)'
+    )
+
+    parser.add_argument(
+        '-r', '--bench-rounds', metavar='<n>',
+        dest='bench_rounds', default=3, type=int,
+        help='benchmark: best of <n> runs (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-B', '--no-bench',
+        dest='no_bench',
+        default=False, action='store_true',
+        help='skip the benchmark'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,564 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Equivalence check and benchmark of the split rootfs extraction
+#  (dbuild.tarsplit) against the serial 'tar -xap' run that
+#  convert-tar-to-disk used before, extracting into freshly created,
+#  loop-mounted filesystems laid out like a hardware image
+#  (root, /boot, /boot/efi, /var/log, /var/cache/apt by default).
+#
+#  Each method extracts the tarball once per round into new filesystems,
+#  timed including a sync. The trees extracted by the last round
+#  get compared with the serial extraction: filesystem, type, mode,
+#  ownership, size, mtime, link count, hardlinks, xattrs, symlink targets,
+#  device numbers and file contents (directory sizes are fs-specific).
+#
+#  Without a tarball, a synthetic rootfs-like one gets created first.
+#  For a real-world benchmark, pass the rootfs tarball of a deb13
+#  hardware image build and run on a multi-core host (needs root):
+#
+#    $ mkimage ./profiles/examples/deb13/deb13-amd64-hardware-uefi
+#    # ./check-tarsplit.py obj/deb13-amd64-hardware-uefi/deb13-amd64-hardware-uefi_rootfs.tar.zst
+#
+#  Usage: check-tarsplit.py [-M <mount_dir>...] [-t <fstype>] [-r <rounds>] [<tarball>]
+#
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from dbuild.tarsplit import MountPrefixMap
+from dbuild.tarsplit import TarSplitExtractor
+
+
+# volumes of the hardware image targets (see DEFAULT_MNT_DIR_MAP in convert-tar-to-disk)
+DEFAULT_MOUNT_DIRS = ['/boot', '/boot/efi', '/var/log', '/var/cache/apt']
+
+# tar options for extracting the rootfs, as convert-tar-to-disk passes them
+TAR_OPTS = ['--xattrs-include=*.*', '--numeric-owner']
+
+# no lazy init, as convert-tar-to-disk: keeps background writes out of the timing
+MKFS_CMDV = {
+    'ext4'  : ['mkfs.ext4', '-q', '-E', 'lazy_itable_init=0,lazy_journal_init=0'],
+    'btrfs' : ['mkfs.btrfs', '-q'],
+}
+
+SIZE_SUFFIXES = {'K': (1 << 10), 'M': (1 << 20), 'G': (1 << 30)}
+
+# large files of a rootfs: relpath -> size
+SYNTHETIC_LARGE_FILES = {
+    'boot/vmlinuz'                      : (10 << 20),
+    'boot/initrd.img'                   : (40 << 20),
+    'var/cache/apt/pkgcache.bin'        : (30 << 20),
+    'var/cache/apt/srcpkgcache.bin'     : (30 << 20),
+    'var/log/journal/system.journal'    : (8 << 20),
+}
+
+SYNTHETIC_TOP_LEVEL_DIRS = [
+    'boot', 'boot/efi', 'boot/efi/EFI', 'etc', 'root', 'srv', 'tmp',
+    'usr', 'usr/bin', 'usr/lib', 'usr/sbin', 'usr/share',
+    'var', 'var/cache', 'var/cache/apt', 'var/lib', 'var/log', 'var/log/journal',
+]
+
+
+class LoopVolumeTree(object):
+    """
+    A mount tree of loop-mounted filesystems, one per volume:
+    the root filesystem at root and one at root/<mount_dir> for each mount_dir.
+    """
+
+    def __init__(self, work_dir, name, mount_dirs, fstype, volume_size):
+        super().__init__()
+        self.work_dir       = work_dir
+        self.root           = os.path.join(work_dir, name)
+        self.name           = name
+        self.mount_dirs     = sorted(mount_dirs, key=lambda p: p.count('/'))
+        self.fstype         = fstype
+        self.volume_size    = volume_size
+        # (image file, loop device, mountpoint) of set up volumes
+        self.volumes        = []
+    # --- end of __init__ (...) ---
+
+    def setup(self):
+        os.makedirs(self.root)
+
+        for k, mount_dir in enumerate(['/'] + self.mount_dirs):
+            image_file = os.path.join(self.work_dir, f'{self.name}.{k}.img')
+            mountpoint = os.path.join(self.root, mount_dir.lstrip('/'))
+
+            with open(image_file, 'wb') as fh:
+                fh.truncate(self.volume_size)
+
+            loop_dev = subprocess.run(
+                ['losetup', '--find', '--show', image_file],
+                stdout=subprocess.PIPE, check=True, text=True
+            ).stdout.strip()
+
+            self.volumes.append((image_file, loop_dev, None))
+
+            subprocess.run((MKFS_CMDV[self.fstype] + [loop_dev]), stdout=subprocess.DEVNULL, check=True)
+
+            os.makedirs(mountpoint, exist_ok=True)
+            subprocess.run(['mount', '-t', self.fstype, loop_dev, mountpoint], check=True)
+
+            self.volumes[-1] = (image_file, loop_dev, mountpoint)
+        # --
+    # --- end of setup (...) ---
+
+    def teardown(self):
+        while self.volumes:
+            image_file, loop_dev, mountpoint = self.volumes.pop()
+
+            if mountpoint is not None:
+                subprocess.run(['umount', mountpoint], check=True)
+
+            subprocess.run(['losetup', '-d', loop_dev], check=True)
+            os.unlink(image_file)
+        # --
+
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+    # --- end of teardown (...) ---
+
+    def get_dev_names(self):
+        # st_dev -> mount dir
+        return {
+            os.stat(mountpoint).st_dev: mount_dir
+            for mount_dir, (_, _, mountpoint) in zip(['/'] + self.mount_dirs, self.volumes)
+        }
+    # --- end of get_dev_names (...) ---
+
+    def get_mkfs_relpaths(self):
+        # entries created by mkfs, not from the tarball
+        return {
+            os.path.normpath(os.path.join(mount_dir.lstrip('/'), 'lost+found'))
+            for mount_dir in (['/'] + self.mount_dirs)
+        }
+    # --- end of get_mkfs_relpaths (...) ---
+
+# --- end of LoopVolumeTree ---
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    if os.geteuid() != 0:
+        arg_parser.error('must be run as root (loop devices, mount)')
+
+    mount_dirs = (arg_config.mount_dirs or DEFAULT_MOUNT_DIRS)
+
+    work_dir = tempfile.mkdtemp(prefix='check-tarsplit.', dir=arg_config.work_dir)
+    trees = []
+
+    try:
+        tarball = arg_config.tarball
+
+        if not tarball:
+            tarball = os.path.join(work_dir, 'rootfs.tar.zst')
+
+            t_start = time.perf_counter()
+            num_entries = make_synthetic_tarball(
+                tarball, os.path.join(work_dir, 'rootfs'), mount_dirs,
+                arg_config.num_entries, random.Random(arg_config.seed)
+            )
+            sys.stdout.write(
+                f'synthetic rootfs tarball: {num_entries} entries,'
+                f' created in {(time.perf_counter() - t_start):.1f}s\n'
+            )
+        # --
+
+        sys.stdout.write(
+            '{t} ({s:.0f} MiB), volumes: / {m} ({f}), {c} CPU(s)\n'.format(
+                t=tarball, s=(os.stat(tarball).st_size / (1 << 20)),
+                m=' '.join(mount_dirs), f=arg_config.fstype, c=(os.cpu_count() or 1),
+            )
+        )
+
+        # page cache: all methods read a cached tarball
+        with open(tarball, 'rb') as fh:
+            while fh.read(1 << 20):
+                pass
+        # --
+
+        methods = [
+            ('tar -xap (serial)', extract_serial),
+            ('TarSplitExtractor (split)', extract_split),
+            ('TarSplitExtractor.run()', extract_run),
+        ]
+
+        expected = None
+        num_failed = 0
+
+        for k, (name, extract) in enumerate(methods):
+            timings = []
+
+            for round_no in range(arg_config.bench_rounds):
+                tree = LoopVolumeTree(
+                    work_dir, f'm{k}r{round_no}', mount_dirs,
+                    arg_config.fstype, arg_config.volume_size
+                )
+                trees.append(tree)
+                tree.setup()
+
+                t_start = time.perf_counter()
+                extract(tarball, tree.root, mount_dirs)
+                os.sync()
+                timings.append(time.perf_counter() - t_start)
+
+                if (round_no + 1) < arg_config.bench_rounds:
+                    tree.teardown()
+                    trees.remove(tree)
+            # --
+
+            sys.stdout.write(
+                '{name:<26} best {best:8.2f}s  median {median:8.2f}s\n'.format(
+                    name=name, best=min(timings), median=sorted(timings)[len(timings) // 2]
+                )
+            )
+
+            # compare the last round with the serial extraction
+            tree = trees.pop()
+            result = scan_tree(tree.root, tree.get_dev_names(), tree.get_mkfs_relpaths())
+            tree.teardown()
+
+            if expected is None:
+                expected = result
+
+            else:
+                num_failed += compare_trees(name, expected, result)
+        # --
+
+        sys.stdout.write(
+            f'compared {len(expected)} entries of {(len(methods) - 1)} method(s)'
+            f' with the serial extraction, {num_failed} mismatch(es)\n'
+        )
+
+    finally:
+        for tree in trees:
+            tree.teardown()
+
+        shutil.rmtree(work_dir)
+    # --
+
+    return (num_failed == 0)
+# --- end of main (...) ---
+
+
+def extract_serial(tarball, root, mount_dirs):
+    # the extraction convert-tar-to-disk did before dbuild.tarsplit
+    subprocess.run(
+        (['tar', '-xap'] + TAR_OPTS + ['-f', tarball, '-C', root]),
+        stdin=subprocess.DEVNULL, check=True
+    )
+# --- end of extract_serial (...) ---
+
+
+def extract_split(tarball, root, mount_dirs):
+    # split extraction, regardless of the number of CPUs
+    TarSplitExtractor(tarball, root, mount_dirs=mount_dirs, tar_opts=TAR_OPTS).run_split()
+# --- end of extract_split (...) ---
+
+
+def extract_run(tarball, root, mount_dirs):
+    # as used by convert-tar-to-disk (single tar on single-CPU hosts)
+    TarSplitExtractor(tarball, root, mount_dirs=mount_dirs, tar_opts=TAR_OPTS).run()
+# --- end of extract_run (...) ---
+
+
+def scan_tree(root, dev_names, skip_relpaths=frozenset()):
+    """
+    Returns a dict relpath -> metadata tuple of all entries below root,
+    except for skip_relpaths.
+    """
+    entries = {}
+    inodes = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted((
+            name for name in dirnames
+            if os.path.relpath(os.path.join(dirpath, name), root) not in skip_relpaths
+        ))
+
+        for name in (sorted(filenames) + dirnames):
+            fpath = os.path.join(dirpath, name)
+            relpath = os.path.relpath(fpath, root)
+            sb = os.lstat(fpath)
+
+            xattrs = {
+                key: os.getxattr(fpath, key, follow_symlinks=False)
+                for key in sorted(os.listxattr(fpath, follow_symlinks=False))
+            }
+
+            if stat.S_ISREG(sb.st_mode):
+                # hardlinks: path of the first link seen
+                link_to = inodes.setdefault((sb.st_dev, sb.st_ino), relpath)
+                data = (link_to if link_to != relpath else get_file_digest(fpath))
+
+            elif stat.S_ISLNK(sb.st_mode):
+                data = os.readlink(fpath)
+
+            elif stat.S_ISCHR(sb.st_mode) or stat.S_ISBLK(sb.st_mode):
+                data = sb.st_rdev
+
+            else:
+                data = None
+            # --
+
+            entries[relpath] = (
+                dev_names.get(sb.st_dev),
+                sb.st_mode, sb.st_uid, sb.st_gid,
+                (None if stat.S_ISDIR(sb.st_mode) else sb.st_size),
+                (None if stat.S_ISLNK(sb.st_mode) else sb.st_mtime_ns),
+                sb.st_nlink, xattrs, data,
+            )
+        # --
+    # --
+
+    return entries
+# --- end of scan_tree (...) ---
+
+
+def get_file_digest(fpath):
+    hasher = hashlib.sha256()
+
+    with open(fpath, 'rb') as fh:
+        for chunk in iter((lambda: fh.read(1 << 20)), b''):
+            hasher.update(chunk)
+    # --
+
+    return hasher.hexdigest()
+# --- end of get_file_digest (...) ---
+
+
+def compare_trees(name, expected, result, max_report=10):
+    """
+    Returns the number of entries that differ (or exist in one tree only).
+    """
+    mismatches = sorted(
+        relpath for relpath in (set(expected) | set(result))
+        if expected.get(relpath) != result.get(relpath)
+    )
+
+    for relpath in mismatches[:max_report]:
+        sys.stdout.write(
+            f'MISMATCH {name}: {relpath}\n'
+            f'  serial: {expected.get(relpath)!r}\n  split:  {result.get(relpath)!r}\n'
+        )
+    # --
+
+    if len(mismatches) > max_report:
+        sys.stdout.write(f'... {len(mismatches) - max_report} more\n')
+
+    return len(mismatches)
+# --- end of compare_trees (...) ---
+
+
+def make_synthetic_tarball(tarball, tree_root, mount_dirs, num_entries, rng):
+    """
+    Creates a rootfs-like tree with num_entries entries (file sizes
+    log-normally distributed, plus a few large files) and packs it
+    like build-image does. Returns the number of entries.
+    Hardlinks stay on one volume (mount_dirs).
+    """
+    get_volume = MountPrefixMap(mount_dirs).lookup
+    dirs = []
+
+    for relpath in SYNTHETIC_TOP_LEVEL_DIRS:
+        os.makedirs(os.path.join(tree_root, relpath))
+        dirs.append(relpath)
+
+    for relpath, size in SYNTHETIC_LARGE_FILES.items():
+        write_synthetic_file(os.path.join(tree_root, relpath), size, rng)
+
+    # volume index -> files
+    files = {}
+    for relpath in SYNTHETIC_LARGE_FILES:
+        files.setdefault(get_volume(os.fsencode(relpath)), []).append(relpath)
+
+    for k in range(len(dirs) + len(SYNTHETIC_LARGE_FILES), num_entries):
+        relpath = f'{rng.choice(dirs)}/e{k}'
+        fpath = os.path.join(tree_root, relpath)
+        volume_files = files.setdefault(get_volume(os.fsencode(relpath)), [])
+        kind = rng.random()
+
+        if kind < 0.05:
+            os.mkdir(fpath)
+            dirs.append(relpath)
+
+        elif kind < 0.15:
+            os.symlink(f'../e{rng.randrange(k)}', fpath)
+            continue
+
+        elif kind < 0.16 and volume_files:
+            os.link(os.path.join(tree_root, rng.choice(volume_files)), fpath)
+            continue
+
+        elif kind < 0.161:
+            os.mknod(fpath, (stat.S_IFCHR | 0o660), os.makedev(1, (k % 256)))
+
+        elif kind < 0.162:
+            os.mkfifo(fpath)
+
+        elif kind < 0.163:
+            # sparse file
+            with open(fpath, 'wb') as fh:
+                fh.write(rng.randbytes(4096))
+                fh.truncate(1 << 24)
+            volume_files.append(relpath)
+
+        else:
+            write_synthetic_file(fpath, min(int(rng.lognormvariate(8, 2)), (16 << 20)), rng)
+            volume_files.append(relpath)
+        # --
+
+        if rng.random() < 0.2:
+            os.chown(fpath, rng.randint(0, 1000), rng.randint(0, 1000))
+            os.chmod(fpath, rng.choice([0o755, 0o750, 0o644, 0o640, 0o4755, 0o2755]))
+
+        if rng.random() < 0.01 and not stat.S_ISFIFO(os.lstat(fpath).st_mode):
+            os.setxattr(fpath, 'user.dbuild', rng.randbytes(8).hex().encode('ascii'))
+    # --
+
+    subprocess.run(
+        [
+            'tar', '-C', tree_root,
+            '--sort=name', '--numeric-owner', '--xattrs', '--xattrs-include=*.*',
+            '-caf', tarball, '.'
+        ],
+        check=True
+    )
+
+    shutil.rmtree(tree_root)
+
+    return num_entries
+# --- end of make_synthetic_tarball (...) ---
+
+
+def write_synthetic_file(fpath, size, rng):
+    # partly compressible content
+    with open(fpath, 'wb') as fh:
+        random_size = (size // 3)
+        fh.write(rng.randbytes(random_size))
+
+        pattern = rng.randbytes(64)
+        remaining = (size - random_size)
+        while remaining > 0:
+            chunk = pattern * min((remaining // 64 + 1), (1 << 14))
+            fh.write(chunk[:remaining])
+            remaining -= min(len(chunk), remaining)
+        # --
+    # --
+# --- end of write_synthetic_file (...) ---
+
+
+def parse_size(arg):
+    """
+    Parses a size with optional K/M/G suffix, e.g. '4G'.
+    """
+    factor = SIZE_SUFFIXES.get(arg[-1:].upper())
+    if factor is not None:
+        arg = arg[:-1]
+
+    try:
+        return (int(arg) * (factor or 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size: {arg!r}') from None
+# --- end of parse_size (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        'tarball', metavar='<tarball>', nargs='?',
+        help='rootfs tarball to extract (default: create a synthetic one)'
+    )
+
+    parser.add_argument(
+        '-M', '--mount-dir', metavar='<mount_dir>',
+        dest='mount_dirs', default=[], action='append',
+        help='volume mountpoint below the rootfs, may be given more than once (default: {})'.format(
+            ', '.join(DEFAULT_MOUNT_DIRS)
+        )
+    )
+
+    parser.add_argument(
+        '-t', '--fstype', metavar='<fstype>',
+        dest='fstype', default='ext4', choices=sorted(MKFS_CMDV),
+        help='filesystem of the volumes (%(choices)s, default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-S', '--volume-size', metavar='<size>',
+        dest='volume_size', default=parse_size('4G'), type=parse_size,
+        help='size of each (sparse) volume image (default: 4G)'
+    )
+
+    parser.add_argument(
+        '-d', '--work-dir', metavar='<dir>',
+        dest='work_dir', default='/var/tmp',
+        help='directory for the volume images and the synthetic tarball (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-N', '--num-entries', metavar='<n>',
+        dest='num_entries', default=30000, type=int,
+        help='number of entries of the synthetic tarball (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-s', '--seed', metavar='<seed>',
+        dest='seed', default=0, type=int,
+        help='seed for the synthetic tarball (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-r', '--bench-rounds', metavar='<n>',
+        dest='bench_rounds', default=3, type=int,
+        help='benchmark: extractions per method (default: %(default)s)'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
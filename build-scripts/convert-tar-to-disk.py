@@ -17,13 +17,19 @@ import re
 import shlex
 import subprocess
 import sys
-import tempfile
 import uuid
 
 import dataclasses
 from dataclasses import dataclass
 from typing import Optional
 
+from dbuild.imgpack import SeekableZstdWriter
+from dbuild.imgpack import write_sparse_tar
+from dbuild.privhelper import PrivHelperClient
+from dbuild.privhelper import PrivOps
+from dbuild.trace import SpanTracer
+from dbuild.treecopy import get_metadata_file
+
 # optional dep: yaml  (using json as fallback)
 import json
 try:
@@ -57,6 +63,7 @@ class RuntimeEnvironment(object):
         self.project_share_dir      = None
 
         self.cmd_wrapper            = None
+        self.tracer                 = None
     # --- end of __init__ (...) ---
 
     def prepare_run_env(self, kwargs):
@@ -113,7 +120,48 @@ class RuntimeEnvironment(object):
         return self.cmd_wrapper.run_as_admin(admin_cmdv, **kwargs)
     # --- end of run_as_admin (...) ---
 
-    def run_as_admin_chroot(self, chroot_dir, cmdv, **kwargs):
+    def _admin_op(self, op, *args, **kwargs):
+        # file contents are not logged
+        print("PRIV:", op, shlex.join((str(a) for a in args if not isinstance(a, bytes))))
+        return getattr(self.cmd_wrapper.priv_ops, op)(*args, **kwargs)
+    # --- end of _admin_op (...) ---
+
+    def admin_mkdir(self, path, mode=None, parents=False):
+        return self._admin_op('mkdir', path, mode=mode, parents=parents)
+
+    def admin_rmdir(self, path):
+        return self._admin_op('rmdir', path)
+
+    def admin_chmod(self, path, mode):
+        return self._admin_op('chmod', path, mode)
+
+    def admin_write_file(self, path, data, mode=0o644, uid=0, gid=0):
+        return self._admin_op('write_file', path, data, mode=mode, uid=uid, gid=gid)
+
+    def admin_read_file(self, path):
+        return self._admin_op('read_file', path)
+
+    def admin_mount(self, source, target, fstype=None, options=None):
+        return self._admin_op('mount', source, target, fstype=fstype, options=options)
+
+    def admin_umount(self, target):
+        return self._admin_op('umount', target)
+
+    def admin_syncfs(self, path):
+        return self._admin_op('syncfs', path)
+
+    def admin_ismount(self, path):
+        return self.cmd_wrapper.priv_ops.ismount(path)
+
+    def admin_extract_tar(self, tarball, root, mount_dirs=(), tar_opts=()):
+        return self._admin_op(
+            'extract_tar', tarball, root, mount_dirs=mount_dirs, tar_opts=tar_opts
+        )
+
+    def admin_copy_tree(self, src_root, dst_root, metadata_file=None):
+        return self._admin_op('copy_tree', src_root, dst_root, metadata_file=metadata_file)
+
+    def run_as_admin_chroot(self, chroot_dir, cmdv, *, interactive=False, **kwargs):
 
         # chroot variant for prepare_run_env():
         #  - create a basic environment,
@@ -141,7 +189,10 @@ class RuntimeEnvironment(object):
         chroot_cmdv.append(str(chroot_dir))
         chroot_cmdv.extend(cmdv)
 
-        return self.cmd_wrapper.run_as_admin(chroot_cmdv, **kwargs)
+        if interactive:
+            return self.cmd_wrapper.run_as_admin_interactive(chroot_cmdv, **kwargs)
+        else:
+            return self.cmd_wrapper.run_as_admin(chroot_cmdv, **kwargs)
     # --- end of run_as_admin_chroot (...) ---
 
 # --- end of RuntimeEnvironment ---
@@ -253,6 +304,16 @@ class MountEntry:
 
 class CommandWrapper(object):
 
+    def __init__(self):
+        super().__init__()
+        # privileged file/mount operations (PrivOps or PrivHelperClient)
+        self.priv_ops = None
+    # --- end of __init__ (...) ---
+
+    def close(self):
+        pass
+    # --- end of close (...) ---
+
     def normalize_cmdv(self, cmdv):
         return [str(a) for a in cmdv]
     # --- end of normalize_cmdv (...) ---
@@ -274,27 +335,68 @@ class CommandWrapper(object):
         raise NotImplementedError(self)
     # --- end of run_as_admin (...) ---
 
+    def run_as_admin_interactive(self, cmdv, **kwargs):
+        return self.run_as_admin(cmdv, **kwargs)
+    # --- end of run_as_admin_interactive (...) ---
+
 # --- end of CommandWrapper ---
 
 
 class DefaultCommandWrapper(CommandWrapper):
 
+    def __init__(self):
+        super().__init__()
+        self.priv_ops = PrivOps()
+    # --- end of __init__ (...) ---
+
     def run_as_admin(self, cmdv, **kwargs):
         return self.run(cmdv, **kwargs)
 
 # --- end of DefaultCommandWrapper ---
 
 
-class SudoCommandWrapper(CommandWrapper):
+class PrivHelperCommandWrapper(CommandWrapper):
+    """
+    Runs privileged commands and operations through a helper process
+    that gets started once via sudo (see dbuild.privhelper).
+    """
 
-    def run_as_admin(self, cmdv, **kwargs):
+    def __init__(self):
+        super().__init__()
+        self.priv_ops = PrivHelperClient(['sudo'])
+    # --- end of __init__ (...) ---
+
+    def close(self):
+        self.priv_ops.close()
+    # --- end of close (...) ---
+
+    def run_as_admin(self, cmdv, *, check=False, input=None, stdout=None):
+        cmdv = self.normalize_cmdv(cmdv)
+
+        if stdout not in {None, subprocess.PIPE}:
+            raise ValueError('stdout must be None or subprocess.PIPE', stdout)
+        # --
+
+        print("CMD:", shlex.join(cmdv))
+        returncode, proc_stdout = self.priv_ops.run(
+            cmdv, input=input, capture_stdout=(stdout == subprocess.PIPE)
+        )
+
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmdv, output=proc_stdout)
+
+        return subprocess.CompletedProcess(cmdv, returncode, stdout=proc_stdout)
+    # --- end of run_as_admin (...) ---
+
+    def run_as_admin_interactive(self, cmdv, **kwargs):
+        # needs the terminal, bypass the helper
         return self._run(
             (['sudo'] + self.normalize_cmdv(cmdv)),
             **kwargs
         )
-    # --- end of run_as_admin (...) ---
+    # --- end of run_as_admin_interactive (...) ---
 
-# --- end of SudoCommandWrapper ---
+# --- end of PrivHelperCommandWrapper ---
 
 
 class DJ(object):
@@ -375,6 +477,14 @@ class DJ(object):
 
         self.opened_loop_dev[loop_dev] = filepath
 
+        # direct I/O: no double caching of the image in the page cache
+        # (loop device + backing file), non-fatal, stays off if not supported
+        # by the backing filesystem, the kernel or losetup
+        self.env.run_as_admin(
+            ['losetup', '--direct-io=on', loop_dev],
+            check=False
+        )
+
         # scan partition table (non-fatal)
         self.env.run_as_admin(
             ['partx', '-a', loop_dev],
@@ -419,6 +529,7 @@ class DJ(object):
             [
                 'cryptsetup',
                 '--key-file', '-',      # read passphrase from stdin
+                '--allow-discards',     # pass fstrim through (see mounts_trim())
                 'luksOpen',
                 blk_dev,
                 enc_name,
@@ -489,43 +600,40 @@ class DJ(object):
             mnt_opts_str = 'defaults'
         # -- end if
 
-        cmdv = [
-            'mount',
-            '-t', str(mnt_type),
-            '-o', mnt_opts_str,
-            mnt_fsname,
-            mnt_dir_abs
-        ]
-
         # create directory
-        self.env.run_as_admin(['mkdir', '-p', mnt_dir_abs], check=True)
+        self.env.admin_mkdir(mnt_dir_abs, parents=True)
 
         # mount fs
-        self.env.run_as_admin(cmdv, check=True)
+        self.env.admin_mount(mnt_fsname, mnt_dir_abs, str(mnt_type), mnt_opts_str)
 
         mnt_entry = MountEntry(mnt_fsname, mnt_dir_root_pov, mnt_type, mnt_opts_str)
         self.opened_mount[mnt_dir_abs] = mnt_entry
         return (mnt_dir_abs, mnt_entry)
     # --- end of mount_open (...) ---
 
-    def mount_close(self, mnt_dir):
-        self.env.run_as_admin(
-            ['sync', '-f', os.path.join(mnt_dir, '.')],
-            check=False
-        )
+    def mounts_trim(self, mnt_entries):
+        # discard unused blocks of the opened mounts listed in mnt_entries,
+        # i.e. the disk image's volumes (non-fatal),
+        # passed through LVM/LUKS/mdadm down to the loop devices,
+        # which punch holes in the disk image files
+        for mnt_dir, mnt_entry in self.opened_mount.items():
+            if mnt_entry in mnt_entries:
+                self.env.run_as_admin(['fstrim', str(mnt_dir)], check=False)
+        # --
+    # --- end of mounts_trim (...) ---
 
-        proc_umount = self.env.run_as_admin(
-            ['umount', mnt_dir],
-            check=False
-        )
+    def mount_close(self, mnt_dir):
+        # non-fatal
+        try:
+            self.env.admin_syncfs(mnt_dir)
+        except OSError:
+            pass
 
-        if proc_umount.returncode != 0:
-            proc_check_mount = self.env.run_as_admin(
-                ['mountpoint', '-q', mnt_dir],
-                check=False
-            )
+        try:
+            self.env.admin_umount(mnt_dir)
 
-            if proc_check_mount.returncode == 0:
+        except OSError:
+            if self.env.admin_ismount(mnt_dir):
                 raise RuntimeError(f'Failed to unmount {mnt_dir}')
             # else assume already unmounted
         # --
@@ -1006,7 +1114,7 @@ def main(prog, argv):
     if os.getuid() == 0:
         env.cmd_wrapper = DefaultCommandWrapper()
     else:
-        env.cmd_wrapper = SudoCommandWrapper()
+        env.cmd_wrapper = PrivHelperCommandWrapper()
     # --
 
     outdir = pathlib.Path(arg_config.outdir or os.getcwd()).absolute()
@@ -1026,18 +1134,33 @@ def main(prog, argv):
         disk_config = get_default_disk_config(arg_config.default_disk_config)
     # --
 
-    return main_create_disk_image(
-        arg_config  = arg_config,
-        env         = env,
-        disk_config = disk_config,
-        mount_root  = mount_root,
-        outdir      = outdir,
-        rootfs_tarball_filepath = pathlib.Path(arg_config.infile).absolute(),
-    )
+    if arg_config.trace_file:
+        env.tracer = SpanTracer(
+            pathlib.Path(arg_config.trace_file).absolute(), 'convert-tar-to-disk'
+        )
+    else:
+        env.tracer = SpanTracer.from_env('convert-tar-to-disk')
+    # --
+
+    try:
+        with env.tracer.span('convert-tar-to-disk', infile=arg_config.infile):
+            return main_create_disk_image(
+                arg_config  = arg_config,
+                env         = env,
+                disk_config = disk_config,
+                mount_root  = mount_root,
+                outdir      = outdir,
+                rootfs_filepath = pathlib.Path(arg_config.infile).absolute(),
+            )
+        # --
+
+    finally:
+        env.cmd_wrapper.close()
+    # --
 # --- end of main (...) ---
 
 
-def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, rootfs_tarball_filepath):
+def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, rootfs_filepath):
 
     def mdadm_init_raid1(dj, mdadm_config, blk_dev):
         md_dev = f'/dev/md/{mdadm_config.name_dbuild}'
@@ -1193,17 +1316,11 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
                 check=True
             )
 
-            env.run_as_admin(
-                ['chmod', '--', '0700', os.path.join(mp, btrfs_snapshots_subvol)],
-                check=True
-            )
+            env.admin_chmod(os.path.join(mp, btrfs_snapshots_subvol), 0o700)
 
             # create snapshots mountpoint
             #  NOTE: this will be removed when initializing snapper (if enabled)
-            env.run_as_admin(
-                ['mkdir', '-m', '0700', '--', os.path.join(mp, btrfs_subvol, '.snapshots')],
-                check=True
-            )
+            env.admin_mkdir(os.path.join(mp, btrfs_subvol, '.snapshots'), mode=0o700)
 
             dj.mount_close(mp)
 
@@ -1286,38 +1403,14 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             text = '\n'.join(text) + '\n'
         # --
 
-        # write to temporary file as user first, then install to dst
-        temp_outfile = None
-
-        try:
-            with tempfile.NamedTemporaryFile(mode='wt', delete=False) as temp_outfile:
-                temp_outfile.write(text)
-            # --
-
-            # drop existing dst file
-            # FIXME: may or may not exist
-            env.run_as_admin(['rm', '-f', '--', outfile], check=True)
-
-            # copy new file to dst
-            env.run_as_admin(
-                [
-                    'install',
-                    '-m', mode,
-                    '-o', owner,
-                    '-g', group,
-                    '--',
-                    temp_outfile.name,
-                    outfile,
-                ],
-                check=True
-            )
-
-        finally:
-            if temp_outfile:
-                # already closed due to with-context above, remove it then
-                pathlib.Path(temp_outfile.name).unlink(missing_ok=True)
-            # --
-        # --
+        # replaces an existing dst file
+        env.admin_write_file(
+            outfile,
+            text.encode('utf-8'),
+            mode=int(mode, 8),
+            uid=int(owner),
+            gid=int(group),
+        )
     # --- end of write_text_file (...) ---
 
     def rewrite_vars_in_text_file(filepath, vars_map, **write_kwargs):
@@ -1330,13 +1423,7 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
 
         except IOError:
             # read file as admin
-            proc = env.run_as_admin(
-                ['cat', '--', filepath],
-                check=True,
-                stdout=subprocess.PIPE
-            )
-
-            file_data = proc.stdout.decode('utf-8')
+            file_data = env.admin_read_file(filepath).decode('utf-8')
         # --
 
         re_varsub = re.compile(
@@ -1361,7 +1448,7 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
 
     os.makedirs(outdir, exist_ok=True)
 
-    env.run_as_admin(['mkdir', '-p', mount_root], check=True)
+    env.admin_mkdir(mount_root, parents=True)
 
     disk_img_parts = []
 
@@ -1376,6 +1463,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
         root_part_swap  = None
         root_part_vg    = None
 
+        env.tracer.step('create disk images')
+
         # create sparse file
         #  (using truncate command instead of built-in fh.truncate()
         #  as that allows to specify a human-readable size argument)
@@ -1472,6 +1561,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             )
         # -- end for
 
+        env.tracer.step('storage layers')
+
         #> open disk image(s) as loop device
         loop_dev_root = dj.loop_dev_open(disk_img_root)
 
@@ -1538,6 +1629,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
         )
         dj.lvm_vg_open(disk_config.root_vg_name)
 
+        env.tracer.step('filesystems')
+
         #> initialize filesystems (create LV ifneedbe, mkfs, mount)
         ##> initialize rootfs LV
         volume_config = disk_config.root_vg_volumes['root']
@@ -1598,18 +1691,44 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             init_fs(dj, fstab_entries, volume_config, blk_dev)
         # -- end for
 
-        #> unpack rootfs tarball to mounted fs tree
-        env.run_as_admin(
-            [
-                'tar', '-xap',
-                '--xattrs-include=*.*',
-                '--numeric-owner',
-                '-f', rootfs_tarball_filepath,
-                '-C', mount_root,
-                './'
-            ],
-            check=True
-        )
+        if rootfs_filepath.is_dir():
+            #> copy rootfs directory to mounted fs tree
+            #  (e.g. build-image target format 'dir')
+            rootfs_metadata_file = (
+                arg_config.rootfs_metadata_file or get_metadata_file(rootfs_filepath)
+            )
+
+            if not rootfs_metadata_file:
+                print(f"No metadata file for {rootfs_filepath}, keeping its file ownership")
+            # --
+
+            copy_step = env.tracer.step('copy rootfs')
+
+            _, num_bytes = env.admin_copy_tree(
+                rootfs_filepath, mount_root, metadata_file=rootfs_metadata_file
+            )
+
+            copy_step.set_attr('bytes_read', num_bytes)
+
+        else:
+            env.tracer.step(
+                'unpack rootfs', bytes_read=os.stat(rootfs_filepath).st_size
+            )
+
+            #> unpack rootfs tarball to mounted fs tree
+            #  (decompressed once, extracted by one tar process per filesystem)
+            env.admin_extract_tar(
+                rootfs_filepath,
+                mount_root,
+                mount_dirs=[
+                    mnt_entry.mnt_dir for mnt_entry in dj.opened_mount.values()
+                    if mnt_entry.mnt_dir != '/'
+                ],
+                tar_opts=['--xattrs-include=*.*', '--numeric-owner']
+            )
+        # --
+
+        env.tracer.step('configure')
 
         #> chroot mounts
         ##> proc
@@ -1750,7 +1869,7 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
                 # -- end if
             # -- end for
 
-            env.run_as_admin(['mkdir', '-p', mdadm_config_dir], check=True)
+            env.admin_mkdir(mdadm_config_dir, parents=True)
             write_text_file((mdadm_config_file), mdadm_config_lines)
         # -- end if write mdadm.conf
 
@@ -1845,6 +1964,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             filepath = mount_root / (filepath_rel.lstrip('/'))
             rewrite_vars_in_text_file(filepath, rewrite_fs_uuid_map)
 
+        env.tracer.step('initramfs')
+
         #> update initramfs
         #  required because /etc/fstab has been modified
         print("update initramfs")
@@ -1855,6 +1976,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             check=True
         )
 
+        env.tracer.step('bootloader')
+
         #> install bootloader
         if disk_config.boot_type == BootType.BIOS:
             print("install grub (BIOS)")
@@ -1879,6 +2002,8 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
             raise NotImplementedError("install bootloader for boot type", disk_config.boot_type)
         # --
 
+        env.tracer.step('snapper')
+
         #> initialize snapper
         if disk_config.snapper:
             target_have_snapper = False
@@ -1910,10 +2035,7 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
                         # (not mounted here),let snapper create the subvolume
                         # and then nuke it and recreate the mountpoint again.
 
-                        env.run_as_admin(
-                            ['rmdir', '--', snapshots_dir_abs],
-                            check=True
-                        )
+                        env.admin_rmdir(snapshots_dir_abs)
 
                         env.run_as_admin_chroot(
                             mount_root,
@@ -1931,10 +2053,7 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
                             check=True
                         )
 
-                        env.run_as_admin(
-                            ['mkdir', '-m', '0700', '--', snapshots_dir_abs],
-                            check=True
-                        )
+                        env.admin_mkdir(snapshots_dir_abs, mode=0o700)
                     # -- end if
                 # -- end for
             # -- end if
@@ -1942,27 +2061,50 @@ def main_create_disk_image(arg_config, env, disk_config, mount_root, outdir, roo
 
         #> optionally execute a chrooted shell
         if arg_config.exec_chroot:
+            env.tracer.step('chroot shell')
             print("spawning chroot shell")
-            env.run_as_admin_chroot(mount_root, ["/bin/bash", "-i"])
+            env.run_as_admin_chroot(mount_root, ["/bin/bash", "-i"], interactive=True)
         # -- end if exec chroot?
+
+        #> free blocks of deleted files (e.g. apt lists, caches),
+        #  so that they do not end up in the packaged image
+        env.tracer.step('trim')
+        dj.mounts_trim([mnt_entry for _, mnt_entry in fstab_entries])
+
+        # unmount, close devices
+        env.tracer.step('teardown')
     # -- end with
 
-    # tar it up
-    disk_img_tarball = outdir / 'dbuild-image.tar.zst'
+    package_step = env.tracer.step('package', format=arg_config.package_format)
 
-    cmdv = [
-        'tar', '-c', '--zstd',
-        '-f', str(disk_img_tarball),
-        '--sparse',
-        '-C', str(outdir),
-    ]
+    if arg_config.package_format == 'seekable':
+        #> compress each image to <name>.zst (zstd seekable format)
+        zst_writer = SeekableZstdWriter()
+        package_files = []
+        num_bytes = 0
 
-    cmdv.extend((
-        disk_img_file.name
-        for disk_img_file in disk_img_parts
-    ))
+        for disk_img_file in disk_img_parts:
+            zst_file = disk_img_file.with_name(f'{disk_img_file.name}.zst')
+            num_bytes += zst_writer.write(disk_img_file, zst_file)
+            package_files.append(zst_file)
+        # --
 
-    env.run(cmdv, check=True)
+    else:
+        #> tar it up (sparse files, data extents only)
+        disk_img_tarball = outdir / 'dbuild-image.tar.zst'
+
+        num_bytes = write_sparse_tar(
+            disk_img_tarball, outdir,
+            [disk_img_file.name for disk_img_file in disk_img_parts]
+        )
+        package_files = [disk_img_tarball]
+    # --
+
+    package_step.set_attr('bytes_read', num_bytes)
+    package_step.set_attr(
+        'bytes_written', sum((os.stat(filepath).st_size for filepath in package_files))
+    )
+    env.tracer.end_step()
 
     for disk_img_file in disk_img_parts:
         disk_img_file.unlink(missing_ok=False)  # file should exist at this point
@@ -1974,7 +2116,10 @@ def get_arg_parser(prog):
 
     parser.add_argument(
         'infile',
-        help='rootfs tarball'
+        help=(
+            'rootfs tarball or directory'
+            ' (e.g. from build-image with DBUILD_TARGET_IMAGE_FORMAT=dir)'
+        )
     )
 
     parser.add_argument(
@@ -1996,6 +2141,34 @@ def get_arg_parser(prog):
         help='suppress informational output'
     )
 
+    parser.add_argument(
+        '--trace', metavar='<file>',
+        dest='trace_file', default=None,
+        help=(
+            'append build trace spans to <file> (JSON lines, see trace-report.py), '
+            'default: $DBUILD_TRACE_FILE'
+        )
+    )
+
+    parser.add_argument(
+        '--package-format', metavar='<format>',
+        dest='package_format', default='tar', choices=['tar', 'seekable'],
+        help=(
+            'output format: \'tar\' creates dbuild-image.tar.zst (sparse files),'
+            ' \'seekable\' creates <image>.zst per disk image (zstd seekable format,'
+            ' allows restoring single partitions), default: %(default)s'
+        )
+    )
+
+    parser.add_argument(
+        '--rootfs-metadata', metavar='<file>',
+        dest='rootfs_metadata_file', default=None,
+        help=(
+            'file ownership, modes etc. for a rootfs directory'
+            ' (see scan-rootfs.py --metadata), default: <infile>.meta.jsonl if it exists'
+        )
+    )
+
     parser.add_argument(
         '-x', '--exec-chroot',
         dest='exec_chroot',
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+#
+#  Shared code for the dbuild build scripts.
+#
+#  The build scripts are executed directly (and possibly via symlinks),
+#  Python puts the real script directory on sys.path, which makes
+#  this package importable from any script in build-scripts/.
+#
@@ -0,0 +1,857 @@
+# -*- coding: utf-8 -*-
+#
+#  Caching HTTP proxy for apt, served by an asyncio event loop
+#  running in a background thread.
+#
+#  Cacheable responses (.deb files, Packages/Sources/Translation indices,
+#  (In)Release files and by-hash objects) are kept in a content-addressed
+#  store:
+#
+#    <root>/objects/<kk>/<digest>   -- file contents (sha256 digest)
+#    <root>/urls/<kk>/<urlhash>     -- url entry (json): digest, size, headers
+#    <root>/tmp/                    -- downloads in progress
+#
+#  The mtime of an object records its last use (LRU eviction by total size).
+#  Only bodies whose length can be verified (Content-Length or chunked)
+#  get stored, the end of a connection-delimited body cannot be told
+#  apart from a dropped upstream connection.
+#  Index files get revalidated upstream once older than index_max_age seconds,
+#  all other cacheable files are considered immutable.
+#
+#  Other requests are passed through, CONNECT (https) gets tunneled.
+#
+#  File I/O of the store runs in the default executor of the event loop,
+#  AptProxyStore methods may thus be called from several threads.
+#
+
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+RE_INDEX_FILE = re.compile(
+    r'/(?:InRelease|Release(?:\.gpg)?'
+    r'|(?:Packages|Sources|Translation-[^/]+)(?:\.(?:gz|xz|bz2|lzma|lz4|zst))?)$'
+)
+
+RE_IMMUTABLE_FILE = re.compile(
+    r'(?:\.u?deb|/by-hash/[A-Za-z0-9]+/[0-9a-fA-F]+)$'
+)
+
+# headers that must not be forwarded
+HOP_BY_HOP_HEADERS = frozenset({
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+})
+
+# response headers kept in url entries and sent on cache hits
+CACHED_RESPONSE_HEADERS = [
+    'content-type',
+    'last-modified',
+    'etag',
+]
+
+COPY_CHUNK_SIZE = 2**16
+
+
+class AptProxyStore(object):
+
+    def __init__(self, root, max_size=None):
+        super().__init__()
+        self.root        = pathlib.Path(root)
+        self.objects_dir = self.root / 'objects'
+        self.urls_dir    = self.root / 'urls'
+        self.tmp_dir     = self.root / 'tmp'
+        self.max_size    = max_size
+        self.total_size  = 0
+        # protects total_size (commit, evict)
+        self._lock       = threading.Lock()
+    # --- end of __init__ (...) ---
+
+    def init_dirs(self):
+        for dirpath in [self.objects_dir, self.urls_dir, self.tmp_dir]:
+            os.makedirs(dirpath, exist_ok=True)
+        # --
+
+        self.total_size = sum((size for _, _, size in self._gen_objects()))
+    # --- end of init_dirs (...) ---
+
+    def get_object_path(self, digest):
+        return self.objects_dir / digest[:2] / digest
+    # --- end of get_object_path (...) ---
+
+    def get_url_entry_path(self, url):
+        url_digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return self.urls_dir / url_digest[:2] / url_digest
+    # --- end of get_url_entry_path (...) ---
+
+    def lookup(self, url):
+        """
+        Returns the url entry (a dict) if the url and its object are known,
+        and None otherwise.
+        """
+        try:
+            with open(self.get_url_entry_path(url), 'rt') as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        # --
+
+        if entry.get('url') != url:
+            return None
+
+        elif not self.get_object_path(entry['digest']).is_file():
+            return None
+
+        else:
+            return entry
+    # --- end of lookup (...) ---
+
+    def touch(self, entry):
+        try:
+            os.utime(self.get_object_path(entry['digest']))
+        except OSError:
+            pass
+    # --- end of touch (...) ---
+
+    def update_entry(self, entry):
+        entry_path = self.get_url_entry_path(entry['url'])
+
+        os.makedirs(entry_path.parent, exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(
+            'wt', dir=self.tmp_dir, prefix='url.', delete=False
+        ) as fh:
+            json.dump(entry, fh)
+        # --
+
+        os.replace(fh.name, entry_path)
+    # --- end of update_entry (...) ---
+
+    def new_tmpfile(self):
+        return tempfile.NamedTemporaryFile(
+            'wb', dir=self.tmp_dir, prefix='obj.', delete=False
+        )
+    # --- end of new_tmpfile (...) ---
+
+    def commit(self, entry, tmpfile_path):
+        """
+        Moves a completely downloaded file into the object store
+        and records its url entry.
+        """
+        object_path = self.get_object_path(entry['digest'])
+
+        with self._lock:
+            if object_path.is_file():
+                # same content is already known (e.g. by-hash vs. plain path)
+                os.unlink(tmpfile_path)
+                os.utime(object_path)
+
+            else:
+                os.makedirs(object_path.parent, exist_ok=True)
+                os.replace(tmpfile_path, object_path)
+                self.total_size += entry['size']
+            # --
+
+            self.update_entry(entry)
+            self._evict()
+        # --
+    # --- end of commit (...) ---
+
+    def _gen_objects(self):
+        for dirent_kk in os.scandir(self.objects_dir):
+            if dirent_kk.is_dir(follow_symlinks=False):
+                for dirent in os.scandir(dirent_kk.path):
+                    try:
+                        sb = dirent.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+
+                    yield (dirent.path, sb.st_mtime, sb.st_size)
+                # -- end for
+            # --
+        # -- end for
+    # --- end of _gen_objects (...) ---
+
+    def evict(self):
+        """
+        Removes least recently used objects until the store fits max_size.
+        Url entries referencing removed objects become misses on lookup.
+        """
+        with self._lock:
+            self._evict()
+    # --- end of evict (...) ---
+
+    def _evict(self):
+        if self.max_size is None or self.total_size <= self.max_size:
+            return
+        # --
+
+        objects = sorted(self._gen_objects(), key=lambda kv: kv[1])
+        self.total_size = sum((size for _, _, size in objects))
+
+        for object_path, _, size in objects:
+            if self.total_size <= self.max_size:
+                break
+
+            try:
+                os.unlink(object_path)
+            except FileNotFoundError:
+                pass
+            else:
+                self.total_size -= size
+        # -- end for
+    # --- end of _evict (...) ---
+
+# --- end of AptProxyStore ---
+
+
+class HttpMessageHead(object):
+
+    def __init__(self, start_line, headers):
+        super().__init__()
+        self.start_line = start_line
+        # list of (name, value), names in original spelling
+        self.headers    = headers
+    # --- end of __init__ (...) ---
+
+    def get_header(self, name, fallback=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return fallback
+    # --- end of get_header (...) ---
+
+    def gen_end_to_end_headers(self, exclude=None):
+        exclude_names = HOP_BY_HOP_HEADERS
+        if exclude:
+            exclude_names = exclude_names | frozenset(exclude)
+
+        for key, value in self.headers:
+            if key.lower() not in exclude_names:
+                yield (key, value)
+    # --- end of gen_end_to_end_headers (...) ---
+
+    @classmethod
+    async def read_from(cls, reader):
+        start_line = await reader.readline()
+        if not start_line:
+            return None
+
+        headers = []
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise asyncio.IncompleteReadError(line, None)
+
+            line = line.rstrip(b'\r\n')
+            if not line:
+                break
+
+            key, sep, value = line.decode('latin-1').partition(':')
+            if sep:
+                headers.append((key.strip(), value.strip()))
+        # -- end while
+
+        return cls(start_line.decode('latin-1').rstrip('\r\n'), headers)
+    # --- end of read_from (...) ---
+
+# --- end of HttpMessageHead ---
+
+
+class AptCacheProxy(object):
+    """
+    Caching http proxy for apt.
+
+    Call start() to serve requests from a background thread
+    and stop() to shut it down. The proxy url is available as .url
+    once started. A single instance can be shared by concurrent builds.
+    """
+
+    def __init__(self, root, max_size=None, host='127.0.0.1', port=0, index_max_age=300):
+        super().__init__()
+        self.store          = AptProxyStore(root, max_size=max_size)
+        self.host           = host
+        self.port           = port
+        self.index_max_age  = index_max_age
+
+        self.stats          = {
+            'hits'          : 0,
+            'misses'        : 0,
+            'revalidated'   : 0,
+            'passthrough'   : 0,
+            'bytes_cached'  : 0,
+            'bytes_fetched' : 0,
+        }
+
+        self._loop          = None
+        self._thread        = None
+        self._server        = None
+        self._ready         = None
+        self._start_error   = None
+        # url -> future, for coalescing concurrent downloads of the same url
+        self._inflight      = {}
+    # --- end of __init__ (...) ---
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/'
+
+    def start(self):
+        self.store.init_dirs()
+
+        self._ready  = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_loop, name='apt-proxy', daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+        if self._start_error is not None:
+            raise self._start_error
+    # --- end of start (...) ---
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+        # --
+    # --- end of stop (...) ---
+
+    def format_stats(self):
+        return (
+            'apt proxy: {hits} hits ({bytes_cached} bytes), '
+            '{misses} misses ({bytes_fetched} bytes), '
+            '{revalidated} revalidated, {passthrough} passed through'
+        ).format(**self.stats)
+    # --- end of format_stats (...) ---
+
+    def _run_loop(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+
+        try:
+            self._server = loop.run_until_complete(
+                asyncio.start_server(self._handle_client, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+
+        except Exception as err:
+            self._start_error = err
+            self._ready.set()
+            loop.close()
+            return
+        # --
+
+        self._ready.set()
+
+        try:
+            loop.run_forever()
+        finally:
+            self._server.close()
+
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+        # --
+    # --- end of _run_loop (...) ---
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                request = await HttpMessageHead.read_from(reader)
+                if request is None:
+                    break
+
+                keep_alive = await self._handle_request(request, reader, writer)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+            # -- end while
+
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+
+        finally:
+            writer.close()
+        # --
+    # --- end of _handle_client (...) ---
+
+    async def _handle_request(self, request, reader, writer):
+        try:
+            method, target, version = request.start_line.split(' ', 2)
+        except ValueError:
+            await self._send_error(writer, 400, 'Bad Request')
+            return False
+        # --
+
+        if method == 'CONNECT':
+            await self._handle_connect(target, reader, writer)
+            return False
+        # --
+
+        keep_alive = (
+            version == 'HTTP/1.1'
+            and request.get_header('connection', '').lower() != 'close'
+            and request.get_header('proxy-connection', '').lower() != 'close'
+        )
+
+        if method not in {'GET', 'HEAD'}:
+            await self._send_error(writer, 501, 'Not Implemented')
+            return False
+        # --
+
+        url_parts = urllib.parse.urlsplit(target)
+        if url_parts.scheme != 'http' or not url_parts.hostname:
+            await self._send_error(writer, 400, 'Bad Request')
+            return False
+        # --
+
+        if method == 'GET' and RE_IMMUTABLE_FILE.search(url_parts.path):
+            return await self._handle_cacheable(
+                request, url_parts, writer, keep_alive, immutable=True
+            )
+
+        elif method == 'GET' and RE_INDEX_FILE.search(url_parts.path):
+            return await self._handle_cacheable(
+                request, url_parts, writer, keep_alive, immutable=False
+            )
+
+        else:
+            self.stats['passthrough'] += 1
+            return await self._handle_passthrough(
+                method, request, url_parts, writer, keep_alive
+            )
+        # --
+    # --- end of _handle_request (...) ---
+
+    async def _handle_connect(self, target, reader, writer):
+        host, sep, port = target.rpartition(':')
+        if not sep:
+            await self._send_error(writer, 400, 'Bad Request')
+            return
+        # --
+
+        try:
+            up_reader, up_writer = await asyncio.open_connection(host.strip('[]'), int(port))
+        except (OSError, ValueError):
+            await self._send_error(writer, 502, 'Bad Gateway')
+            return
+        # --
+
+        self.stats['passthrough'] += 1
+
+        writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+        await writer.drain()
+
+        async def pipe(src, dst):
+            try:
+                while True:
+                    data = await src.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    dst.write(data)
+                    await dst.drain()
+                # -- end while
+            except ConnectionError:
+                pass
+            finally:
+                dst.close()
+        # --- end of pipe (...) ---
+
+        await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+    # --- end of _handle_connect (...) ---
+
+    async def _handle_cacheable(self, request, url_parts, writer, keep_alive, immutable):
+        url = urllib.parse.urlunsplit(url_parts)
+
+        # wait for concurrent downloads of the same url, then retry from cache
+        while True:
+            while url in self._inflight:
+                await asyncio.shield(self._inflight[url])
+
+            entry = await self._run_io(self.store.lookup, url)
+
+            # another download may have started during the lookup
+            if url not in self._inflight:
+                break
+        # -- end while
+
+        if entry is not None and (
+            immutable or (time.time() - entry['time_checked']) < self.index_max_age
+        ):
+            object_fh = await self._open_cached(entry)
+
+            if object_fh is not None:
+                self.stats['hits'] += 1
+                try:
+                    return await self._send_cached(entry, object_fh, writer, keep_alive)
+                finally:
+                    object_fh.close()
+            # --
+
+            # evicted since the lookup: cache miss
+            entry = None
+        # --
+
+        inflight = asyncio.get_running_loop().create_future()
+        self._inflight[url] = inflight
+
+        try:
+            return await self._fetch_cacheable(request, url, url_parts, entry, writer, keep_alive)
+
+        finally:
+            del self._inflight[url]
+            inflight.set_result(None)
+        # --
+    # --- end of _handle_cacheable (...) ---
+
+    async def _fetch_cacheable(self, request, url, url_parts, entry, writer, keep_alive):
+        # open the cached object before revalidating it,
+        # a 304 response is of no use if it got evicted in the meantime
+        object_fh = None
+        if entry is not None:
+            object_fh = await self._open_cached(entry)
+            if object_fh is None:
+                entry = None
+        # --
+
+        try:
+            return await self._fetch_cacheable_revalidate(
+                request, url, url_parts, entry, object_fh, writer, keep_alive
+            )
+        finally:
+            if object_fh is not None:
+                object_fh.close()
+        # --
+    # --- end of _fetch_cacheable (...) ---
+
+    async def _fetch_cacheable_revalidate(
+        self, request, url, url_parts, entry, object_fh, writer, keep_alive
+    ):
+        extra_headers = []
+
+        if entry is not None:
+            if entry['headers'].get('etag'):
+                extra_headers.append(('If-None-Match', entry['headers']['etag']))
+            if entry['headers'].get('last-modified'):
+                extra_headers.append(('If-Modified-Since', entry['headers']['last-modified']))
+        # --
+
+        try:
+            response, up_reader, up_writer = await self._upstream_request(
+                'GET', url_parts,
+                list(request.gen_end_to_end_headers(
+                    exclude={'range', 'if-range', 'if-modified-since', 'if-none-match'}
+                )) + extra_headers
+            )
+
+        except OSError:
+            if entry is not None:
+                # upstream unreachable: serve stale index
+                self.stats['hits'] += 1
+                return await self._send_cached(entry, object_fh, writer, keep_alive)
+            # --
+
+            await self._send_error(writer, 502, 'Bad Gateway')
+            return False
+        # --
+
+        try:
+            status = self._get_status(response)
+
+            if status == 304 and entry is not None:
+                self.stats['revalidated'] += 1
+                entry['time_checked'] = time.time()
+                await self._run_io(self.store.update_entry, entry)
+                return await self._send_cached(entry, object_fh, writer, keep_alive)
+
+            elif status != 200:
+                return await self._relay_response(
+                    'GET', response, up_reader, writer, keep_alive
+                )
+            # --
+
+            self.stats['misses'] += 1
+
+            if not self._has_delimited_body(response):
+                # a truncated download would look complete, do not store it
+                return await self._relay_response(
+                    'GET', response, up_reader, writer, keep_alive
+                )
+            # --
+
+            new_entry = {
+                'url'           : url,
+                'digest'        : None,
+                'size'          : 0,
+                'time_checked'  : time.time(),
+                'headers'       : {
+                    name: response.get_header(name)
+                    for name in CACHED_RESPONSE_HEADERS
+                    if response.get_header(name) is not None
+                },
+            }
+
+            hasher = hashlib.sha256()
+            tmpfh  = await self._run_io(self.store.new_tmpfile)
+
+            async def store_body(data):
+                hasher.update(data)
+                new_entry['size'] += len(data)
+                await self._run_io(tmpfh.write, data)
+            # --- end of store_body (...) ---
+
+            try:
+                keep_alive = await self._relay_response(
+                    'GET', response, up_reader, writer, keep_alive,
+                    body_callback=store_body
+                )
+                await self._run_io(tmpfh.close)
+
+            except BaseException:
+                tmpfh.close()
+                os.unlink(tmpfh.name)
+                raise
+            # --
+
+            new_entry['digest'] = hasher.hexdigest()
+            self.stats['bytes_fetched'] += new_entry['size']
+
+            await self._run_io(self.store.commit, new_entry, tmpfh.name)
+
+            return keep_alive
+
+        finally:
+            up_writer.close()
+        # --
+    # --- end of _fetch_cacheable_revalidate (...) ---
+
+    async def _handle_passthrough(self, method, request, url_parts, writer, keep_alive):
+        try:
+            response, up_reader, up_writer = await self._upstream_request(
+                method, url_parts, list(request.gen_end_to_end_headers())
+            )
+        except OSError:
+            await self._send_error(writer, 502, 'Bad Gateway')
+            return False
+        # --
+
+        try:
+            return await self._relay_response(method, response, up_reader, writer, keep_alive)
+        finally:
+            up_writer.close()
+    # --- end of _handle_passthrough (...) ---
+
+    async def _upstream_request(self, method, url_parts, headers):
+        path = url_parts.path or '/'
+        if url_parts.query:
+            path = f'{path}?{url_parts.query}'
+
+        up_reader, up_writer = await asyncio.open_connection(
+            url_parts.hostname, (url_parts.port or 80)
+        )
+
+        try:
+            head = [f'{method} {path} HTTP/1.1', f'Host: {url_parts.netloc}']
+            head.extend((
+                f'{key}: {value}' for key, value in headers
+                if key.lower() != 'host'
+            ))
+            head.append('Connection: close')
+
+            up_writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+            await up_writer.drain()
+
+            response = await HttpMessageHead.read_from(up_reader)
+            if response is None:
+                raise ConnectionResetError('upstream closed connection')
+
+        except BaseException:
+            up_writer.close()
+            raise
+        # --
+
+        return (response, up_reader, up_writer)
+    # --- end of _upstream_request (...) ---
+
+    def _get_status(self, response):
+        return int(response.start_line.split(' ', 2)[1])
+    # --- end of _get_status (...) ---
+
+    def _has_delimited_body(self, response):
+        return (
+            'chunked' in response.get_header('transfer-encoding', '').lower()
+            or response.get_header('content-length') is not None
+        )
+    # --- end of _has_delimited_body (...) ---
+
+    async def _run_io(self, func, *args):
+        # blocking file I/O, keeps the event loop responsive
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+    # --- end of _run_io (...) ---
+
+    async def _gen_response_body(self, method, response, reader):
+        status = self._get_status(response)
+
+        if method == 'HEAD' or status in {204, 304} or 100 <= status < 200:
+            return
+
+        elif 'chunked' in response.get_header('transfer-encoding', '').lower():
+            while True:
+                size_line = await reader.readline()
+                if not size_line.endswith(b'\n'):
+                    raise asyncio.IncompleteReadError(size_line, None)
+
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+
+                if size == 0:
+                    # skip trailer
+                    while (await reader.readline()).strip():
+                        pass
+                    return
+                # --
+
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+            # -- end while
+
+        elif response.get_header('content-length') is not None:
+            remaining = int(response.get_header('content-length'))
+            while remaining > 0:
+                data = await reader.read(min(remaining, COPY_CHUNK_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                remaining -= len(data)
+                yield data
+            # -- end while
+
+        else:
+            while True:
+                data = await reader.read(COPY_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+            # -- end while
+        # --
+    # --- end of _gen_response_body (...) ---
+
+    async def _relay_response(
+        self, method, response, up_reader, writer, keep_alive, body_callback=None
+    ):
+        # the upstream body gets decoded and re-framed for the client:
+        # content-length is kept, otherwise chunked (keep-alive) or close
+        content_length = response.get_header('content-length')
+        chunked = False
+
+        headers = list(response.gen_end_to_end_headers())
+        if content_length is None and method != 'HEAD':
+            if keep_alive:
+                chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                keep_alive = False
+        # --
+
+        headers.append(('Connection', ('keep-alive' if keep_alive else 'close')))
+
+        self._write_head(writer, response.start_line.split(' ', 1)[1], headers)
+
+        async for data in self._gen_response_body(method, response, up_reader):
+            if body_callback is not None:
+                await body_callback(data)
+
+            if chunked:
+                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                writer.write(data)
+
+            await writer.drain()
+        # -- end for
+
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+
+        return keep_alive
+    # --- end of _relay_response (...) ---
+
+    async def _open_cached(self, entry):
+        """
+        Opens the object file of a url entry.
+        Returns None if it is gone (evicted after the lookup).
+        """
+        try:
+            return await self._run_io(open, self.store.get_object_path(entry['digest']), 'rb')
+        except FileNotFoundError:
+            return None
+    # --- end of _open_cached (...) ---
+
+    async def _send_cached(self, entry, object_fh, writer, keep_alive):
+        # object_fh: opened by _open_cached(), closed by the caller
+        await self._run_io(self.store.touch, entry)
+
+        headers = [
+            (name.title().replace('Etag', 'ETag'), value)
+            for name, value in entry['headers'].items()
+        ]
+        headers.append(('Content-Length', str(entry['size'])))
+        headers.append(('Connection', ('keep-alive' if keep_alive else 'close')))
+
+        self._write_head(writer, '200 OK', headers)
+
+        while True:
+            data = await self._run_io(object_fh.read, COPY_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        # -- end while
+
+        self.stats['bytes_cached'] += entry['size']
+
+        return keep_alive
+    # --- end of _send_cached (...) ---
+
+    async def _send_error(self, writer, status, reason):
+        body = f'{status} {reason}\n'.encode('ascii')
+        self._write_head(
+            writer, f'{status} {reason}',
+            [
+                ('Content-Type', 'text/plain'),
+                ('Content-Length', str(len(body))),
+                ('Connection', 'close'),
+            ]
+        )
+        writer.write(body)
+        await writer.drain()
+    # --- end of _send_error (...) ---
+
+    def _write_head(self, writer, status, headers):
+        head = [f'HTTP/1.1 {status}']
+        head.extend((f'{key}: {value}' for key, value in headers))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+    # --- end of _write_head (...) ---
+
+# --- end of AptCacheProxy ---
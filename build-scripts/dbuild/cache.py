@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+#
+#  Content-addressed artifact cache with LRU eviction by total size.
+#
+#  Layout of the cache directory:
+#
+#    <root>/lock                        -- flock(2) lock file
+#    <root>/tmp/                        -- entries under construction
+#    <root>/<namespace>/<kk>/<key>/     -- cache entry (kk: key[:2])
+#    <root>/<namespace>/<kk>/<key>/.meta  -- entry size, file list
+#
+#  The mtime of the .meta file records the last use of an entry.
+#
+#  Files get copied in and out of the cache (reflinked if possible),
+#  so that modifying a published file does not alter the cache entry.
+#  Callers that only read the files and remove them right afterwards
+#  may ask for hardlinks instead.
+#
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import stat
+import tempfile
+
+from .imgpack import get_data_extents
+from .treecopy import COPY_METHOD_ERRNOS
+from .treecopy import FICLONE
+
+
+# chunk size when falling back to read/write
+COPY_CHUNK_SIZE = (1 << 20)
+
+def get_default_cache_root():
+    try:
+        return pathlib.Path(os.environ['DBUILD_CACHE_DIR'])
+    except KeyError:
+        pass
+
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    if xdg_cache_home:
+        return pathlib.Path(xdg_cache_home) / 'dbuild'
+    else:
+        return pathlib.Path(os.path.expanduser('~')) / '.cache' / 'dbuild'
+# --- end of get_default_cache_root (...) ---
+
+
+def get_digest_hasher():
+    return hashlib.sha256()
+# --- end of get_digest_hasher (...) ---
+
+
+def update_digest_from_bytes(hasher, label, data):
+    # length-prefixed to avoid ambiguities when concatenating inputs
+    label_b = label.encode('utf-8')
+    hasher.update(b'%d:%s:%d:' % (len(label_b), label_b, len(data)))
+    hasher.update(data)
+# --- end of update_digest_from_bytes (...) ---
+
+
+def update_digest_from_file(hasher, label, filepath):
+    with open(filepath, 'rb') as fh:
+        update_digest_from_bytes(hasher, label, fh.read())
+# --- end of update_digest_from_file (...) ---
+
+
+def update_digest_from_tree(hasher, label, root, exclude_names=None):
+    """
+    Adds a directory tree to the digest:
+    relative paths, file types, modes, symlink targets and file contents.
+    Does nothing if root does not exist.
+    """
+    root = str(root)
+
+    if not os.path.isdir(root):
+        return
+    # --
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        if exclude_names:
+            dirnames[:] = [d for d in dirnames if d not in exclude_names]
+            filenames = [f for f in filenames if f not in exclude_names]
+        # --
+
+        dirnames.sort()
+
+        relpath_dir = os.path.relpath(dirpath, root)
+
+        for name in sorted(dirnames + filenames):
+            fpath = os.path.join(dirpath, name)
+            relpath = os.path.normpath(os.path.join(label, relpath_dir, name))
+            sb = os.lstat(fpath)
+
+            update_digest_from_bytes(
+                hasher, relpath,
+                b'%o' % stat.S_IMODE(sb.st_mode)
+            )
+
+            if stat.S_ISLNK(sb.st_mode):
+                update_digest_from_bytes(
+                    hasher, relpath, os.fsencode(os.readlink(fpath))
+                )
+
+            elif stat.S_ISREG(sb.st_mode):
+                update_digest_from_file(hasher, relpath, fpath)
+            # --
+        # -- end for
+    # -- end for
+# --- end of update_digest_from_tree (...) ---
+
+
+def copy_file_extent(src_fd, dst_fd, offset, length):
+    use_copy_file_range = True
+
+    while length > 0:
+        num_copied = None
+
+        if use_copy_file_range:
+            try:
+                num_copied = os.copy_file_range(src_fd, dst_fd, length, offset, offset)
+            except OSError as err:
+                if err.errno not in COPY_METHOD_ERRNOS:
+                    raise
+                use_copy_file_range = False
+            # --
+        # --
+
+        if num_copied is None:
+            data = os.pread(src_fd, min(length, COPY_CHUNK_SIZE), offset)
+            num_copied = (os.pwrite(dst_fd, data, offset) if data else 0)
+        # --
+
+        if not num_copied:
+            raise OSError(errno.EIO, 'unexpected end of file')
+
+        offset += num_copied
+        length -= num_copied
+    # --
+# --- end of copy_file_extent (...) ---
+
+
+def reflink_or_copy_file(src, dst):
+    """
+    Places a copy of src at dst, preferring a reflink (shared extents,
+    copy-on-write) and falling back to copying the data extents
+    (holes in sparse disk images are kept).
+    """
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        src_fd = src_fh.fileno()
+        dst_fd = dst_fh.fileno()
+
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+        except OSError as err:
+            if err.errno not in COPY_METHOD_ERRNOS:
+                raise
+
+            size = os.fstat(src_fd).st_size
+            for offset, length in get_data_extents(src_fd, size):
+                copy_file_extent(src_fd, dst_fd, offset, length)
+
+            os.ftruncate(dst_fd, size)
+        # --
+    # --
+
+    shutil.copymode(src, dst)
+# --- end of reflink_or_copy_file (...) ---
+
+
+def link_or_copy_file(src, dst):
+    """
+    Places src at dst as hardlink,
+    falling back to copying file data (reflinked if possible).
+    """
+    try:
+        os.link(src, dst)
+
+    except OSError:
+        # different filesystem, ...
+        reflink_or_copy_file(src, dst)
+    # --
+# --- end of link_or_copy_file (...) ---
+
+
+class ArtifactCache(object):
+
+    META_FILE_NAME = '.meta'
+
+    def __init__(self, root, namespace, max_size=None, budget_namespaces=None):
+        super().__init__()
+        self.root           = pathlib.Path(root)
+        self.namespace      = namespace
+        self.max_size       = max_size
+        # namespaces sharing max_size (LRU eviction across all of them)
+        self.budget_namespaces = (
+            list(budget_namespaces) if budget_namespaces else [namespace]
+        )
+        self.entries_root   = self.root / namespace
+        self.tmpdir_root    = self.root / 'tmp'
+        self.lock_file      = self.root / 'lock'
+    # --- end of __init__ (...) ---
+
+    def init_dirs(self):
+        for dirpath in [self.root, self.entries_root, self.tmpdir_root]:
+            os.makedirs(dirpath, mode=0o700, exist_ok=True)
+    # --- end of init_dirs (...) ---
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=True):
+        self.init_dirs()
+
+        with open(self.lock_file, 'ab') as fh:
+            fcntl.flock(fh, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH))
+            try:
+                yield self
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        # --
+    # --- end of locked (...) ---
+
+    def get_entry_dir(self, key):
+        return (self.entries_root / key[:2] / key)
+    # --- end of get_entry_dir (...) ---
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open((entry_dir / self.META_FILE_NAME), 'rt') as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+    # --- end of _read_meta (...) ---
+
+    def lookup(self, key):
+        """
+        Returns the list of files stored for key
+        (paths below the entry dir), or None if not cached.
+        The lookup counts as use of the entry.
+
+        Should be called while holding the lock (at least shared),
+        as long as the files are being accessed.
+        """
+        entry_dir = self.get_entry_dir(key)
+        meta = self._read_meta(entry_dir)
+
+        if meta is None:
+            return None
+        # --
+
+        # record last use
+        os.utime((entry_dir / self.META_FILE_NAME))
+
+        return [(entry_dir / name) for name in meta['files']]
+    # --- end of lookup (...) ---
+
+    def publish(self, key, dst_dir, hardlink=False):
+        """
+        Copies the files of a cache entry to dst_dir.
+        Returns the list of created files, or None if not cached.
+
+        With hardlink=True, the files get hardlinked if possible.
+        They must not be modified then.
+        """
+        copy_file = (link_or_copy_file if hardlink else reflink_or_copy_file)
+
+        with self.locked(exclusive=False):
+            files = self.lookup(key)
+            if files is None:
+                return None
+            # --
+
+            os.makedirs(dst_dir, exist_ok=True)
+
+            published = []
+            for src in files:
+                dst = pathlib.Path(dst_dir) / src.name
+
+                try:
+                    os.unlink(dst)
+                except FileNotFoundError:
+                    pass
+
+                copy_file(src, dst)
+                published.append(dst)
+            # --
+        # -- end with
+
+        return published
+    # --- end of publish (...) ---
+
+    def store(self, key, files, hardlink=False):
+        """
+        Stores copies of files as cache entry for key,
+        replacing any existing entry, and evicts old entries afterwards.
+
+        With hardlink=True, the files get hardlinked if possible.
+        They must not be modified afterwards.
+        """
+        copy_file = (link_or_copy_file if hardlink else reflink_or_copy_file)
+
+        self.init_dirs()
+
+        # prepare entry outside of the lock
+        tmp_entry_dir = pathlib.Path(tempfile.mkdtemp(dir=self.tmpdir_root))
+        try:
+            size = 0
+            names = []
+
+            for src in files:
+                src = pathlib.Path(src)
+                dst = tmp_entry_dir / src.name
+
+                copy_file(src, dst)
+                size += os.stat(dst).st_size
+                names.append(src.name)
+            # --
+
+            with open((tmp_entry_dir / self.META_FILE_NAME), 'wt') as fh:
+                json.dump({'size': size, 'files': names}, fh)
+            # --
+
+            with self.locked():
+                entry_dir = self.get_entry_dir(key)
+
+                if os.path.lexists(entry_dir):
+                    shutil.rmtree(entry_dir)
+                # --
+
+                os.makedirs(entry_dir.parent, exist_ok=True)
+                os.rename(tmp_entry_dir, entry_dir)
+                tmp_entry_dir = None
+
+                self._evict()
+            # -- end with
+
+        finally:
+            if tmp_entry_dir is not None:
+                shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+        # --
+    # --- end of store (...) ---
+
+    def _gen_entries(self):
+        # yields (last_use, size, entry_dir) for all budget namespaces
+        for namespace in self.budget_namespaces:
+            yield from self._gen_namespace_entries(self.root / namespace)
+    # --- end of _gen_entries (...) ---
+
+    def _gen_namespace_entries(self, entries_root):
+        try:
+            prefix_it = os.scandir(entries_root)
+        except FileNotFoundError:
+            return
+        # --
+
+        with prefix_it:
+            for prefix_entry in prefix_it:
+                if not prefix_entry.is_dir(follow_symlinks=False):
+                    continue
+
+                with os.scandir(prefix_entry.path) as entry_it:
+                    for entry in entry_it:
+                        entry_dir = pathlib.Path(entry.path)
+                        meta_file = entry_dir / self.META_FILE_NAME
+
+                        try:
+                            last_use = os.stat(meta_file).st_mtime
+                        except FileNotFoundError:
+                            # incomplete entry
+                            last_use = 0
+
+                        meta = self._read_meta(entry_dir)
+                        size = (meta['size'] if meta else 0)
+
+                        yield (last_use, size, entry_dir)
+                    # --
+                # --
+            # --
+        # --
+    # --- end of _gen_namespace_entries (...) ---
+
+    def _evict(self):
+        # must be called while holding the exclusive lock
+        if not self.max_size:
+            return
+        # --
+
+        entries = sorted(self._gen_entries(), key=lambda xv: xv[0])
+        total_size = sum((xv[1] for xv in entries))
+
+        # least recently used first
+        for last_use, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+            # --
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+        # --
+    # --- end of _evict (...) ---
+
+    def evict(self):
+        with self.locked():
+            self._evict()
+    # --- end of evict (...) ---
+
+# --- end of ArtifactCache ---
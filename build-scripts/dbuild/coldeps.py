@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+#  Build collection dependency graph: expansion of the requested collections
+#  via their meta config (depends, wants, after, virtual)
+#  and resolution into build order.
+#
+
+import collections
+import json
+import sys
+
+
+class CollectionDependencyCycleError(RuntimeError):
+
+    def __init__(self, cycle):
+        super().__init__('Cannot resolve build collection dependencies', cycle)
+        self.cycle = cycle
+    # --- end of __init__ (...) ---
+
+    def __str__(self):
+        return 'dependency cycle: {}'.format(' -> '.join(self.cycle))
+    # --- end of __str__ (...) ---
+
+# --- end of CollectionDependencyCycleError ---
+
+
+class CollectionNode(object):
+
+    def __init__(self, name, index):
+        super().__init__()
+        # position in scan order, used as tie-break when resolving
+        self.name       = name
+        self.index      = index
+        self.virtual    = False
+        # 'after = *': depends on all non-late collections
+        self.late       = False
+
+        # declared dependencies (for graph export),
+        # order-only deps are filtered out in get_deps()
+        self.depends    = []
+        self.wants      = []
+        self.after      = []
+    # --- end of __init__ (...) ---
+
+# --- end of CollectionNode ---
+
+
+class CollectionGraph(object):
+    """
+    Dependency graph of build collections.
+
+    Build order: collections get resolved in passes over the scan order,
+    where each pass picks any collection whose dependencies have been
+    resolved already, including those resolved earlier in the same pass.
+    This preserves the order requested in the config as much as possible.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nodes          = collections.OrderedDict()
+        # names that are referenced only via 'after' (not pulled in)
+        self.order_only     = set()
+    # --- end of __init__ (...) ---
+
+    def add_node(self, name):
+        node = CollectionNode(name, len(self.nodes))
+        self.nodes[name] = node
+        return node
+    # --- end of add_node (...) ---
+
+    def get_deps(self, node):
+        """
+        Returns the set of effective dependencies of the given node
+        (excluding late deps).
+        """
+        return set((
+            dep for dep in (node.depends + node.after)
+            if dep != '*' and dep not in self.order_only
+        ))
+    # --- end of get_deps (...) ---
+
+    def get_dep_map(self):
+        dep_map = collections.OrderedDict((
+            (name, self.get_deps(node)) for name, node in self.nodes.items()
+        ))
+
+        early = [name for name, node in self.nodes.items() if not node.late]
+
+        for name, node in self.nodes.items():
+            if node.late:
+                dep_map[name].update(early)
+        # --
+
+        return dep_map
+    # --- end of get_dep_map (...) ---
+
+    def resolve(self):
+        """
+        Returns the list of all collection nodes in build order,
+        including virtual ones.
+
+        Raises CollectionDependencyCycleError if not resolvable.
+        """
+        nodes   = self.nodes
+        dep_map = self.get_dep_map()
+
+        # Kahn's algorithm, computing the resolver pass of each node:
+        # a node gets resolved in the same pass as its dependency
+        # if it comes after the dependency in scan order,
+        # and in the next pass otherwise.
+        pending = {}
+        rdeps   = {name: [] for name in nodes}
+
+        for name, deps in dep_map.items():
+            pending[name] = len(deps)
+            for dep in deps:
+                rdeps[dep].append(name)
+        # --
+
+        passno = dict.fromkeys(nodes, 0)
+        ready  = [name for name, num_deps in pending.items() if not num_deps]
+        done   = []
+
+        while ready:
+            name = ready.pop()
+            done.append(name)
+            node_index = nodes[name].index
+
+            for rdep in rdeps[name]:
+                rdep_pass = passno[name] + (1 if node_index > nodes[rdep].index else 0)
+                if rdep_pass > passno[rdep]:
+                    passno[rdep] = rdep_pass
+
+                pending[rdep] -= 1
+                if not pending[rdep]:
+                    ready.append(rdep)
+            # --
+        # --
+
+        if len(done) != len(nodes):
+            unresolved = [name for name in nodes if pending[name]]
+            raise CollectionDependencyCycleError(
+                find_shortest_cycle(dep_map, unresolved)
+            )
+        # --
+
+        return sorted(
+            (nodes[name] for name in done),
+            key=lambda node: (passno[node.name], node.index)
+        )
+    # --- end of resolve (...) ---
+
+    def gen_dot(self, name='collections'):
+        def q(s):
+            return json.dumps(s)
+
+        yield f'digraph {q(name)} {{'
+        yield '  rankdir=LR;'
+        yield '  node [shape=box];'
+
+        for node in self.nodes.values():
+            attrs = []
+            if node.virtual:
+                attrs.append('style=dashed')
+            if node.late:
+                attrs.append('peripheries=2')
+
+            yield '  {}{};'.format(q(node.name), (' [{}]'.format(', '.join(attrs)) if attrs else ''))
+        # --
+
+        for node in self.nodes.values():
+            for dep in node.depends:
+                if dep != '*':
+                    yield f'  {q(node.name)} -> {q(dep)};'
+
+            for dep in node.wants:
+                yield f'  {q(node.name)} -> {q(dep)} [style=dotted, label="wants"];'
+
+            for dep in node.after:
+                if dep != '*' and dep not in self.order_only:
+                    yield f'  {q(node.name)} -> {q(dep)} [style=dashed, label="after"];'
+        # --
+
+        yield '}'
+    # --- end of gen_dot (...) ---
+
+    def get_json_data(self):
+        try:
+            order = {node.name: k for k, node in enumerate(self.resolve())}
+        except CollectionDependencyCycleError:
+            order = {}
+
+        return [
+            {
+                'name'      : node.name,
+                'order'     : order.get(node.name),
+                'virtual'   : node.virtual,
+                'late'      : node.late,
+                'depends'   : [dep for dep in node.depends if dep != '*'],
+                'wants'     : node.wants,
+                'after'     : [
+                    dep for dep in node.after
+                    if dep != '*' and dep not in self.order_only
+                ],
+            }
+            for node in self.nodes.values()
+        ]
+    # --- end of get_json_data (...) ---
+
+# --- end of CollectionGraph ---
+
+
+def build_collection_graph(bcol_index, wanted):
+    """
+    Expands the wanted collections (breadth-first, in requested order)
+    and returns the dependency graph.
+    """
+    graph = CollectionGraph()
+
+    # collection names referenced as order-only dep:
+    # when False or not found => strict dep
+    # when True => order-only dep
+    order_only_map = {}
+
+    scan_queue = collections.deque(wanted)
+
+    while scan_queue:
+        name = scan_queue.popleft()
+        if name in graph.nodes:
+            continue
+
+        # any scanned collection is a strict dep and not order-only
+        order_only_map[name] = False
+
+        node = graph.add_node(name)
+        info = bcol_index.get(name)
+
+        # NOTE on missing collections: will raise an error in mkimage later on
+        if not info.has_meta:
+            continue
+
+        elif not info.has_meta_section:
+            sys.stderr.write(f'WARN: dbuild collection meta config has no [collection] section: {name}\n')
+            continue
+        # --
+
+        node.virtual = info.virtual
+
+        # depends X: add dep on X, enqueue scanning of X
+        # ('depends = *' is DEPRECATED, should use 'after = *' instead)
+        node.depends = list(info.depends)
+        scan_queue.extend((item for item in node.depends if item != '*'))
+
+        # wants X: enqueue scanning of X
+        node.wants = list(info.wants)
+        scan_queue.extend(node.wants)
+
+        # after X: order-only dependency on X,
+        # but do not enqueue scanning of X
+        node.after = list(info.after)
+        for item in node.after:
+            if item != '*':
+                # mark as order-only dep if not already marked
+                # (which may be either 'strict dep' or 'only-order' dep)
+                order_only_map.setdefault(item, True)
+        # --
+
+        if '*' in node.depends or '*' in node.after:
+            # depend on most/all other collections,
+            # Not allowed for virtual collections
+            if node.virtual:
+                raise RuntimeError('late-dep on all not allowed for virtual collections', name)
+
+            node.late = True
+        # --
+    # -- end while
+
+    # filter-out order-only dependencies
+    # that are not pulled in by any collection as strict dep
+    graph.order_only = set((k for k, v in order_only_map.items() if v))
+
+    return graph
+# --- end of build_collection_graph (...) ---
+
+
+def find_shortest_cycle(dep_map, names):
+    """
+    Returns the shortest dependency cycle through any of the given names
+    as list [a, b, ..., a].
+    """
+    names_set = set(names)
+    best      = None
+
+    for start in names:
+        # breadth-first search for the shortest path back to start
+        parent = {start: None}
+        queue  = collections.deque([start])
+        found  = False
+
+        while queue and not found:
+            name = queue.popleft()
+
+            for dep in sorted(dep_map[name] & names_set):
+                if dep == start:
+                    found = True
+                    break
+
+                elif dep not in parent:
+                    parent[dep] = name
+                    queue.append(dep)
+            # --
+        # --
+
+        if found:
+            # start -> ... -> name -> start
+            path = []
+            while name is not None:
+                path.append(name)
+                name = parent[name]
+            path.reverse()
+            path.append(start)
+
+            if best is None or len(path) < len(best):
+                best = path
+                if len(best) == 2:
+                    break
+        # --
+    # --
+
+    return (best or list(names))
+# --- end of find_shortest_cycle (...) ---
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+#
+#  Collection index: per-collection summary of meta dependencies,
+#  hook lists, overlays, package lists and presence of config files,
+#  persisted to a cache file (json).
+#
+#  Cached entries are validated on lookup against stamps
+#  (mtime, size) of the files and directories they were derived from.
+#  Adding/removing files changes the mtime of the containing directory,
+#  so only a handful of stat() calls per collection are needed
+#  instead of re-scanning and re-parsing.
+#
+
+import configparser
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+
+
+# bump when changing the entry format
+COLLECTION_INDEX_VERSION = 1
+
+
+class CollectionMetaError(ValueError):
+    pass
+# --- end of CollectionMetaError ---
+
+
+class CollectionInfo(object):
+    """
+    Read-only view of a collection index entry.
+    """
+
+    def __init__(self, name, root, entry):
+        super().__init__()
+        self.name               = name
+        self.root               = root
+        self.exists             = entry['exists']
+
+        # meta: None if there is no meta file,
+        # has_meta_section is False if it lacks the [collection] section
+        meta = entry['meta']
+        self.has_meta           = (meta is not None)
+        self.has_meta_section   = bool(meta and meta['section'])
+        self.depends            = (meta['depends'] if meta else [])
+        self.wants              = (meta['wants'] if meta else [])
+        self.after              = (meta['after'] if meta else [])
+        self.virtual            = bool(meta and meta['virtual'])
+
+        self.files              = frozenset(entry['files'])
+        # hook phase -> sorted list of hook file names (*.sh)
+        self.hooks              = entry['hooks']
+        # phases with overlay/<phase>/ resp. overlay/<phase>.permtab
+        self.overlay_phases     = frozenset(entry['overlay_phases'])
+        self.permtab_phases     = frozenset(entry['permtab_phases'])
+        # list of items or None
+        self.package_list       = entry['package_list']
+    # --- end of __init__ (...) ---
+
+    def has_file(self, name):
+        """Returns True if the collection has a regular file <name> (e.g. 'config')."""
+        return (name in self.files)
+    # --- end of has_file (...) ---
+
+    def get_hooks(self, hook_phase):
+        return self.hooks.get(hook_phase, [])
+    # --- end of get_hooks (...) ---
+
+# --- end of CollectionInfo ---
+
+
+class CollectionIndex(object):
+    """
+    Index of the collections below root, optionally persisted to cache_file.
+    Lookups are thread-safe.
+    """
+
+    def __init__(self, root, cache_file=None):
+        super().__init__()
+        self.root           = pathlib.Path(root)
+        self.cache_file     = (pathlib.Path(cache_file) if cache_file else None)
+        self._entries       = None
+        self._infos         = {}
+        self._dirty         = False
+        self._lock          = threading.RLock()
+    # --- end of __init__ (...) ---
+
+    def load(self):
+        entries = {}
+
+        if self.cache_file is not None:
+            try:
+                with open(self.cache_file, 'rt') as fh:
+                    data = json.load(fh)
+
+            except (OSError, ValueError):
+                pass
+
+            else:
+                if (
+                    data.get('version') == COLLECTION_INDEX_VERSION
+                    and data.get('root') == str(self.root)
+                ):
+                    entries = data['entries']
+            # --
+        # --
+
+        self._entries = entries
+    # --- end of load (...) ---
+
+    def save(self):
+        with self._lock:
+            if self.cache_file is None or not self._dirty:
+                return
+
+            os.makedirs(self.cache_file.parent, exist_ok=True)
+
+            with tempfile.NamedTemporaryFile(
+                'wt', dir=self.cache_file.parent, prefix='.colindex.', delete=False
+            ) as fh:
+                json.dump(
+                    {
+                        'version'   : COLLECTION_INDEX_VERSION,
+                        'root'      : str(self.root),
+                        'entries'   : self._entries,
+                    },
+                    fh
+                )
+            # --
+
+            os.replace(fh.name, self.cache_file)
+            self._dirty = False
+        # --
+    # --- end of save (...) ---
+
+    def get(self, name):
+        """
+        Returns the CollectionInfo for the given collection name
+        (relative path below root), re-scanning the collection if needed.
+        Missing collections get reported with exists=False.
+        """
+        with self._lock:
+            info = self._infos.get(name)
+            if info is not None:
+                return info
+
+            if self._entries is None:
+                self.load()
+
+            bcol_dir = self.root / name
+            entry    = self._entries.get(name)
+
+            if entry is None or not check_stamps(bcol_dir, entry['stamps']):
+                entry = scan_collection(bcol_dir)
+                self._entries[name] = entry
+                self._dirty = True
+            # --
+
+            info = CollectionInfo(name, bcol_dir, entry)
+            self._infos[name] = info
+            return info
+        # --
+    # --- end of get (...) ---
+
+# --- end of CollectionIndex ---
+
+
+def get_collection_index_file(cache_root, bcol_root):
+    # one index file per collections root (e.g. per project checkout)
+    root_digest = hashlib.sha256(os.fsencode(os.path.abspath(bcol_root))).hexdigest()
+    return pathlib.Path(cache_root) / 'collection-index' / f'{root_digest[:16]}.json'
+# --- end of get_collection_index_file (...) ---
+
+
+def get_stamp(filepath):
+    try:
+        sb = os.stat(filepath)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    else:
+        return [sb.st_mtime_ns, sb.st_size]
+# --- end of get_stamp (...) ---
+
+
+def check_stamps(bcol_dir, stamps):
+    return all((
+        get_stamp(os.path.join(bcol_dir, relpath)) == stamp
+        for relpath, stamp in stamps.items()
+    ))
+# --- end of check_stamps (...) ---
+
+
+def scan_collection(bcol_dir):
+    bcol_dir = str(bcol_dir)
+
+    stamps = {}
+
+    def scandir_stamped(relpath):
+        dirpath = os.path.join(bcol_dir, relpath) if relpath else bcol_dir
+        stamps[relpath or '.'] = get_stamp(dirpath)
+
+        try:
+            with os.scandir(dirpath) as it:
+                return list(it)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+    # --- end of scandir_stamped (...) ---
+
+    entry = {
+        'stamps'            : stamps,
+        'exists'            : os.path.isdir(bcol_dir),
+        'meta'              : None,
+        'files'             : [],
+        'hooks'             : {},
+        'overlay_phases'    : [],
+        'permtab_phases'    : [],
+        'package_list'      : None,
+    }
+
+    top_entries = {d.name: d for d in scandir_stamped(None)}
+
+    entry['files'] = sorted((
+        name for name, d in top_entries.items() if d.is_file()
+    ))
+
+    if 'meta' in entry['files']:
+        stamps['meta'] = get_stamp(os.path.join(bcol_dir, 'meta'))
+        entry['meta'] = read_meta_file(os.path.join(bcol_dir, 'meta'))
+    # --
+
+    if 'package.list' in entry['files']:
+        stamps['package.list'] = get_stamp(os.path.join(bcol_dir, 'package.list'))
+        entry['package_list'] = list(gen_read_list_file(os.path.join(bcol_dir, 'package.list')))
+    # --
+
+    if 'hooks' in top_entries and top_entries['hooks'].is_dir():
+        for d in scandir_stamped('hooks'):
+            if d.is_dir():
+                entry['hooks'][d.name] = sorted((
+                    h.name for h in scandir_stamped(f'hooks/{d.name}')
+                    if h.name.endswith('.sh') and h.name != '.sh' and h.is_file()
+                ))
+            # --
+        # --
+    # --
+
+    if 'overlay' in top_entries and top_entries['overlay'].is_dir():
+        for d in scandir_stamped('overlay'):
+            if d.is_dir():
+                entry['overlay_phases'].append(d.name)
+
+            elif d.name.endswith('.permtab') and d.is_file():
+                entry['permtab_phases'].append(d.name[:-len('.permtab')])
+            # --
+        # --
+
+        entry['overlay_phases'].sort()
+        entry['permtab_phases'].sort()
+    # --
+
+    return entry
+# --- end of scan_collection (...) ---
+
+
+def read_meta_file(filepath):
+    def section_iter_list(d, k):
+        try:
+            v = d[k]
+
+        except KeyError:
+            return
+
+        else:
+            for item in v.split():
+                if item:
+                    yield item
+    # --- end of section_iter_list (...) ---
+
+    parser = configparser.ConfigParser()
+
+    # ConfigParser.read() does not throw an error on missing file(s),
+    # use open() + ConfigParser.read_file() instead
+    with open(filepath, 'rt') as fh:
+        parser.read_file(fh, source=filepath)
+    # --
+
+    try:
+        section = parser['collection']
+
+    except KeyError:
+        return {
+            'section'   : False,
+            'depends'   : [],
+            'wants'     : [],
+            'after'     : [],
+            'virtual'   : False,
+        }
+    # --
+
+    try:
+        virtual = parser.getboolean('collection', 'virtual', fallback=False)
+    except ValueError as err:
+        raise CollectionMetaError(filepath, err) from err
+    # --
+
+    return {
+        'section'   : True,
+        'depends'   : list(section_iter_list(section, 'depends')),
+        'wants'     : list(section_iter_list(section, 'wants')),
+        'after'     : list(section_iter_list(section, 'after')),
+        'virtual'   : virtual,
+    }
+# --- end of read_meta_file (...) ---
+
+
+def gen_read_list_file(filepath):
+    with open(filepath, 'rt') as fh:
+        for line in fh:
+            sline = line.strip()
+            if sline and sline[0] != '#':
+                yield from sline.split()
+        # --
+    # --
+# --- end of gen_read_list_file (...) ---
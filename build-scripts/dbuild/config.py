@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+#
+#  Config file handling: parsing of config files (varname[*|?]=value),
+#  merging them into a single config and writing the merged config
+#  as shell-sourceable file plus a pre-parsed JSON sidecar (<config>.json).
+#
+#  Used by merge-config.py (command line interface), mkimage and build-image.
+#
+
+import hashlib
+import json
+import re
+import threading
+
+from .configlex import get_tokenizer
+from .netroutes import PrefixSet
+from .pwhash import PasswordHashCache
+
+
+# bump when changing the format of the JSON sidecar
+CONFIG_JSON_VERSION = 1
+
+# read size when computing file digests
+FILE_DIGEST_CHUNK_SIZE = (1 << 16)
+
+
+def expand_config(vmap, pwhash_cache=None, input_files=None):
+    def expand_config_pwvars(vmap):
+        pwvars = {k: v for k, v in vmap.items() if k[-9:].lower() == '_password'}
+
+        # cleartext passwords, hashed in one go
+        pwvars_plaintext = {}
+
+        for varname, orig_value in pwvars.items():
+            value = '*'
+
+            if not orig_value:
+                value = '*'
+
+            elif orig_value[0] == '$':
+                value = orig_value
+
+            else:
+                pwvars_plaintext[varname] = orig_value
+            # --
+
+            vmap[varname] = value
+        # --
+
+        if pwvars_plaintext:
+            pw_hashes = (
+                pwhash_cache if pwhash_cache is not None else PasswordHashCache()
+            ).get_hashes(list(pwvars_plaintext.values()), 'yescrypt')
+
+            for varname, orig_value in pwvars_plaintext.items():
+                vmap[varname] = pw_hashes[orig_value]
+        # --
+    # ---
+
+    def expand_config_net_sinkhole(vmap):
+        vmap_bool = lambda k, *, _vmap=vmap: (_vmap.get(k) == '1')
+
+        def build_routes(vmap, ip_version, config_routes_map):
+            accumulated_routes = PrefixSet(ip_version)
+
+            for varname_suffix, var_routes in config_routes_map.items():
+                varname = f"OFEAT_NET_SINKHOLE_ROUTES_IP{ip_version}_{varname_suffix}"
+                if vmap_bool(varname):
+                    accumulated_routes.update(var_routes)
+
+            var_routes = vmap.get(f"OCONF_NET_SINKHOLE_ROUTES_IP{ip_version}_CUSTOM")
+            if var_routes:
+                accumulated_routes.update((o for o in var_routes.strip().split() if o))
+
+            # prefix list files, e.g. from threat feeds
+            var_route_files = vmap.get(f"OCONF_NET_SINKHOLE_ROUTES_IP{ip_version}_CUSTOM_FILES")
+            if var_route_files:
+                for route_file in var_route_files.split():
+                    accumulated_routes.update_from_file(route_file)
+
+                    if input_files is not None:
+                        input_files.append(route_file)
+            # --
+
+            return accumulated_routes.gen_networks_str()
+        # --- end of build_routes (...) ---
+
+        def build_routes_str(*args, **kwargs):
+            return ' '.join(build_routes(*args, **kwargs))
+
+        if vmap_bool('OFEAT_NET_SINKHOLE'):
+            vmap['OCONF_NET_SINKHOLE_ROUTES_IP4'] = build_routes_str(
+                vmap,
+                4,
+                {
+                    'DOC'       : ['192.0.2.0/24', '198.51.100.0/24', '203.0.113.0/24'],
+                    'CGNAT'     : ['100.64.0.0/10'],
+                    'DSLITE'    : ['192.0.0.0/24'],
+                    'BENCHMARK' : ['198.18.0.0/15'],
+                    'RFC1918'   : ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16'],
+                }
+            )
+
+            vmap['OCONF_NET_SINKHOLE_ROUTES_IP6'] = build_routes_str(
+                vmap,
+                6,
+                {
+                    'DOC'       : ['2001:db8::/32'],
+                    'ULA'       : ['fc00::/7'],
+                    'TEREDO'    : ['2001:0000::/32'],
+                    'BENCHMARK' : ['2001:2::/48'],
+                    '6TO4'      : ['2002::/16'],
+                }
+            )
+
+        else:
+            vmap.pop('OFEAT_NET_SINKHOLE_ROUTES_IP4', None)
+            vmap.pop('OFEAT_NET_SINKHOLE_ROUTES_IP6', None)
+    # ---
+
+    expand_config_pwvars(vmap)
+    expand_config_net_sinkhole(vmap)
+# --- end of expand_config (...) ---
+
+
+def unalias_varname(alias_map, varname_orig):
+    visited = set()
+    varname_cur = varname_orig
+
+    while varname_cur not in visited:
+        visited.add(varname_cur)
+
+        try:
+            varname_next = alias_map[varname_cur]
+        except KeyError:
+            return varname_cur
+        # --
+
+        varname_cur = varname_next
+    # -- end while
+
+    raise ValueError(f'circular ref in alias map: start={varname_orig} break={varname_cur}', alias_map)
+# --- end of unalias_varname (...) ---
+
+
+def get_unalias_varname_func(alias_map):
+    if alias_map:
+        return (lambda v, *, _m=alias_map: unalias_varname(_m, v))
+    else:
+        return (lambda v: v)
+# --- end of get_unalias_varname_func (...) ---
+
+
+def merge_config_vars(vmap, new_vars, *, alias_map=None, varnames_merge_value=None, source=None):
+    fn_unalias_varname = get_unalias_varname_func(alias_map)
+
+    if varnames_merge_value is None:
+        varnames_merge_value = set()
+    # --
+
+    for is_declaration, varname_orig, value in new_vars:
+        varname = fn_unalias_varname(varname_orig)
+
+        if is_declaration is not None:
+            if not is_declaration and varname not in vmap:
+                raise RuntimeError(f'variable {varname_orig} gets set in {source}, but has not been declared yet')
+
+            elif is_declaration and varname in vmap:
+                raise RuntimeError(f'variable {varname_orig} gets declared in {source}, but has already been declared previously')
+            # --
+        # --
+
+        if varname in varnames_merge_value:
+            old_value = vmap.get(varname, None)
+            new_value = ' '.join((
+                item for item in (old_value, value) if item
+            ))
+
+            vmap[varname] = new_value
+
+        else:
+            # replace any existing value
+            vmap[varname] = value
+        # --
+    # -- end for
+# --- end of merge_config_vars (...) ---
+
+
+def shell_quote(s):
+    """
+    Encloses the input string in quotes,
+    even if not strictly necessary for shell usage.
+    """
+
+    return ("'" + s.replace("'", "'\"'\"'") + "'")
+# --- end of shell_quote (...) ---
+
+
+class ConfigParser(object):
+
+    RESTR_VARNAME = r'^[A-Za-z][A-Za-z0-9_]*$'
+
+    def __init__(self):
+        super().__init__()
+        self.re_varname = re.compile(self.RESTR_VARNAME)
+        self.tokenizer = get_tokenizer()
+        # parsed files: sha256 of file content -> vars
+        self._parse_cache = {}
+        self._parse_cache_lock = threading.Lock()
+    # --- end of __init__ (...) ---
+
+    def gen_parse(self, infile):
+        # Parsed files are kept in memory, keyed by content digest,
+        # so that e.g. the configs of collections shared by several
+        # profiles get tokenized only once.
+        with open(infile, 'rt') as fh:
+            text = fh.read()
+
+        cache_key = hashlib.sha256(text.encode('utf-8')).digest()
+
+        with self._parse_cache_lock:
+            parsed_vars = self._parse_cache.get(cache_key)
+        # --
+
+        if parsed_vars is None:
+            parsed_vars = list(self.gen_parse_text(text, infile))
+
+            with self._parse_cache_lock:
+                self._parse_cache[cache_key] = parsed_vars
+        # --
+
+        yield from parsed_vars
+    # --- end of gen_parse (...) ---
+
+    def gen_parse_text(self, text, infile):
+        re_varname = self.re_varname  # ref
+
+        for tok in self.tokenizer(text, infile):
+            varname_tok, vsep, value = tok.partition('=')
+
+            if not varname_tok:
+                varname = varname_tok
+                is_declaration = False
+
+            elif varname_tok[-1] == '*':
+                varname = varname_tok[:-1]
+                is_declaration = True
+
+            elif varname_tok[-1] == '?':
+                varname = varname_tok[:-1]
+                is_declaration = None
+
+            else:
+                varname = varname_tok
+                is_declaration = False
+            # --
+
+            if vsep and re_varname.match(varname):
+                yield (is_declaration, varname, value)
+
+            else:
+                raise ValueError("Failed to match vardef", infile, tok)
+        # -- end for
+    # --- end of gen_parse_text (...) ---
+
+    def gen_parse_vars(self, infile):
+        # format: varname[*|?]=value
+        yield from self.gen_parse(infile)
+    # --- end of gen_parse_vars (...) ---
+
+    def gen_parse_alias_map(self, infile):
+        # format: old_varname=new_varname
+        re_varname = self.re_varname  # ref
+
+        for is_declaration, old_varname, new_varname in self.gen_parse(infile):
+            if is_declaration is not False:
+                raise ValueError("alias mapping does not support declaration syntax")
+            # --
+
+            if re_varname.match(new_varname):
+                yield (old_varname, new_varname)
+            else:
+                raise ValueError("Failed to match alias mapping", infile, (old_varname, new_varname))
+        # -- end for
+    # --- end of gen_parse_alias_map (...) ---
+
+    def gen_parse_merge_vars(self, infile):
+        # format: varname
+        re_varname = self.re_varname  # ref
+
+        with open(infile, 'rt') as fh:
+            for line in filter(None, (l.rstrip() for l in fh)):
+                if line[0] == '#':
+                    # comment
+                    pass
+
+                elif re_varname.match(line):
+                    yield line
+
+                else:
+                    raise ValueError("invalid merge_vars file", infile, line)
+            # -- end for
+        # -- end with
+    # --- end of gen_parse_merge_vars (...) ---
+
+# --- end of ConfigParser ---
+
+
+def load_merge_rules(config_parser, *, alias_map_file=None, merge_vars_file=None, merge_vars=None):
+    """
+    Loads the varname alias map and the set of variables
+    whose values get merged (instead of replaced).
+
+    Returns a 2-tuple (alias_map, varnames_merge_value).
+    """
+    alias_map = {}
+    if alias_map_file:
+        alias_map.update(config_parser.gen_parse_alias_map(alias_map_file))
+    # --
+
+    varnames_merge_value = set()
+
+    if merge_vars_file:
+        varnames_merge_value.update(
+            map(
+                get_unalias_varname_func(alias_map),
+                config_parser.gen_parse_merge_vars(merge_vars_file)
+            )
+        )
+    # --
+
+    if merge_vars:
+        varnames_merge_value.update(
+            map(get_unalias_varname_func(alias_map), merge_vars)
+        )
+    # --
+
+    return (alias_map, varnames_merge_value)
+# --- end of load_merge_rules (...) ---
+
+
+def merge_config_files(
+    config_parser, infiles, *,
+    alias_map=None, varnames_merge_value=None, extra_vars=None, pwhash_cache=None,
+    input_files=None
+):
+    """
+    Merges the given config files and extra vars (list of (False, varname, value))
+    and returns the expanded config as dict.
+
+    Cleartext *_PASSWORD vars get hashed, using pwhash_cache if given
+    (PasswordHashCache).
+
+    All files read get appended to input_files (if not None).
+    """
+    if input_files is not None:
+        input_files.extend(infiles)
+
+    vmap = {}
+    for infile in infiles:
+        merge_config_vars(
+            vmap, config_parser.gen_parse_vars(infile),
+            alias_map=alias_map,
+            varnames_merge_value=varnames_merge_value,
+            source=infile,
+        )
+    # -- end for
+
+    if extra_vars:
+        merge_config_vars(
+            vmap, extra_vars,
+            alias_map=alias_map,
+            varnames_merge_value=varnames_merge_value,
+            source='cmdline',
+        )
+    # --
+
+    expand_config(vmap, pwhash_cache=pwhash_cache, input_files=input_files)
+
+    return vmap
+# --- end of merge_config_files (...) ---
+
+
+def merge_config_to_file(
+    config_parser, outfile, infiles, *,
+    alias_map_file=None, merge_vars_file=None, merge_vars=None, extra_vars=None,
+    pwhash_cache=None, force=False
+):
+    """
+    Merges the given config files and writes the result to outfile
+    (and its JSON sidecar), unless outfile is up-to-date:
+    The sidecar records the digests of all input files
+    (configs, alias map, merge vars file, sinkhole route files)
+    and of the remaining arguments.
+
+    Returns a 2-tuple (vmap, merged), where merged is False if outfile
+    was up-to-date.
+    """
+    args_digest = get_digest_str(
+        json.dumps(
+            [
+                [str(f) for f in infiles],
+                (str(alias_map_file) if alias_map_file else None),
+                (str(merge_vars_file) if merge_vars_file else None),
+                sorted(merge_vars or ()),
+                [list(v) for v in (extra_vars or ())],
+            ]
+        ).encode('utf-8')
+    )
+
+    if not force:
+        data = read_config_json(outfile)
+
+        if (
+            data is not None
+            and data.get('inputs', {}).get('args') == args_digest
+            and all((
+                get_file_digest_str(filepath) == digest
+                for filepath, digest in data['inputs']['files'].items()
+            ))
+        ):
+            return (data['vars'], False)
+        # --
+    # --
+
+    input_files = [f for f in (alias_map_file, merge_vars_file) if f]
+
+    alias_map, varnames_merge_value = load_merge_rules(
+        config_parser,
+        alias_map_file=alias_map_file,
+        merge_vars_file=merge_vars_file,
+        merge_vars=merge_vars,
+    )
+
+    vmap = merge_config_files(
+        config_parser, infiles,
+        alias_map=alias_map,
+        varnames_merge_value=varnames_merge_value,
+        extra_vars=extra_vars,
+        pwhash_cache=pwhash_cache,
+        input_files=input_files,
+    )
+
+    write_config(
+        outfile, vmap,
+        inputs={
+            'args'  : args_digest,
+            'files' : {
+                str(filepath): get_file_digest_str(filepath)
+                for filepath in input_files
+            },
+        }
+    )
+
+    return (vmap, True)
+# --- end of merge_config_to_file (...) ---
+
+
+def get_digest_str(data):
+    return hashlib.sha256(data).hexdigest()
+# --- end of get_digest_str (...) ---
+
+
+def get_file_digest_str(filepath):
+    hasher = hashlib.sha256()
+
+    try:
+        with open(filepath, 'rb') as fh:
+            for chunk in iter((lambda: fh.read(FILE_DIGEST_CHUNK_SIZE)), b''):
+                hasher.update(chunk)
+    except FileNotFoundError:
+        return None
+
+    return hasher.hexdigest()
+# --- end of get_file_digest_str (...) ---
+
+
+def format_config(vmap):
+    return '\n'.join((
+        '{name}={value}'.format(name=name, value=shell_quote(value))
+        for name, value in sorted(vmap.items(), key=lambda kv: kv[0])
+    ))
+# --- end of format_config (...) ---
+
+
+def get_config_json_file(config_file):
+    return '{}.json'.format(config_file)
+# --- end of get_config_json_file (...) ---
+
+
+def write_config(outfile, vmap, inputs=None):
+    """
+    Writes the merged config as shell-sourceable file
+    and the pre-parsed JSON sidecar next to it
+    (optionally recording input digests, see merge_config_to_file()).
+    """
+    config_data = (format_config(vmap) + '\n').encode('utf-8')
+
+    with open(outfile, 'wb') as fh:
+        fh.write(config_data)
+    # --
+
+    with open(get_config_json_file(outfile), 'wt') as fh:
+        json.dump(
+            {
+                'version'       : CONFIG_JSON_VERSION,
+                # the config file may have been edited manually
+                'config_sha256' : get_digest_str(config_data),
+                'inputs'        : inputs,
+                'vars'          : vmap,
+            },
+            fh
+        )
+    # --
+# --- end of write_config (...) ---
+
+
+def read_config_json(filepath):
+    """
+    Returns the data of the JSON sidecar of the given merged config file
+    if it matches the config file, else None.
+    """
+    try:
+        with open(get_config_json_file(filepath), 'rt') as fh:
+            data = json.load(fh)
+
+    except (FileNotFoundError, ValueError):
+        return None
+    # --
+
+    if (
+        data.get('version') == CONFIG_JSON_VERSION
+        and data.get('config_sha256') == get_file_digest_str(filepath)
+    ):
+        return data
+    else:
+        return None
+# --- end of read_config_json (...) ---
+
+
+def load_config(filepath):
+    """
+    Loads a merged config file,
+    preferring the JSON sidecar if it matches the config file.
+    """
+    data = read_config_json(filepath)
+
+    if data is not None:
+        return data['vars']
+    else:
+        return dict(gen_load_config(filepath))
+# --- end of load_config (...) ---
+
+
+def gen_load_config(filepath):
+    with open(filepath, 'rt') as fh:
+        text = fh.read()
+
+    for tok in get_tokenizer()(text, filepath):
+        varname, vsep, value = tok.partition('=')
+
+        # no validation here.
+        yield (varname, value)
+    # --
+# --- end of gen_load_config (...) ---
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+#  Tokenizer for config files (NAME[*|?]='value' ...).
+#
+#  Produces the same tokens as
+#    shlex.shlex(..., posix=True, punctuation_chars=True),
+#  but matches whole tokens with compiled regular expressions
+#  instead of reading the input character by character.
+#
+#  Token rules (posix mode, as implemented by shlex):
+#    - whitespace separates tokens, '#' starts a comment (until end of line)
+#    - a word consists of word chars, single-quoted strings,
+#      double-quoted strings (backslash escapes only '"' and '\')
+#      and backslash-escaped chars (including newline)
+#    - runs of punctuation chars '();<>|&' are tokens of their own
+#    - any other char is a single-char token
+#
+#  Inputs that shlex rejects (unterminated quotes or escapes)
+#  are handed to shlex so that the error is the same.
+#
+#  Set DBUILD_CONFIG_TOKENIZER=shlex in the environment to use shlex instead.
+#
+
+import os
+import re
+import shlex
+
+
+# word chars as configured by shlex in posix mode w/ punctuation chars
+SHLEX_WORDCHARS = shlex.shlex(posix=True, punctuation_chars=True).wordchars
+
+RE_TOKEN = re.compile(
+    r'''
+        (?P<word>(?:{wc}+|'[^']*'|"(?:[^"\\]|\\.)*"|\\.)+)
+        | (?:[ \t\r\n]+|[#][^\n]*(?:\n|$))+
+        | (?P<punct>[();<>|&]+)
+        | (?P<other>.)
+    '''.format(
+        wc='[{}]'.format(''.join(map(re.escape, SHLEX_WORDCHARS)))
+    ),
+    flags=(re.VERBOSE | re.DOTALL)
+)
+
+RE_WORD_SEGMENT = re.compile(
+    r'''
+        '(?P<squoted>[^']*)'
+        | "(?P<dquoted>(?:[^"\\]|\\.)*)"
+        | \\(?P<escaped>.)
+        | (?P<plain>[^'"\\]+)
+    ''',
+    flags=(re.VERBOSE | re.DOTALL)
+)
+
+# within double quotes, only the quote char itself and the escape char
+# can be escaped, the backslash is kept otherwise
+RE_DQUOTED_ESCAPE = re.compile(r'\\(.)', flags=re.DOTALL)
+
+
+def get_tokenizer():
+    if os.environ.get('DBUILD_CONFIG_TOKENIZER') == 'shlex':
+        return gen_tokenize_shlex
+    else:
+        return gen_tokenize
+# --- end of get_tokenizer (...) ---
+
+
+def gen_tokenize_shlex(text, source=None):
+    yield from shlex.shlex(text, source, posix=True, punctuation_chars=True)
+# --- end of gen_tokenize_shlex (...) ---
+
+
+def gen_tokenize(text, source=None):
+    tokens = []
+
+    for match in RE_TOKEN.finditer(text):
+        kind = match.lastgroup
+
+        if kind is None:
+            # whitespace, comments
+            pass
+
+        elif kind == 'word':
+            tokens.append(unquote_word(match.group()))
+
+        elif kind == 'punct':
+            tokens.append(match.group())
+
+        elif kind == 'other':
+            char = match.group()
+
+            if char in '\'"\\':
+                # unterminated quote / escape at end of input
+                yield from gen_tokenize_shlex(text, source)
+                return
+            # --
+
+            tokens.append(char)
+        # --
+    # --
+
+    yield from tokens
+# --- end of gen_tokenize (...) ---
+
+
+def unquote_word(word):
+    if '"' not in word and '\\' not in word:
+        num_squotes = word.count("'")
+
+        if not num_squotes:
+            return word
+
+        elif num_squotes == 2 and word[-1] == "'":
+            # common case: NAME='value'
+            prefix, sep, value = word[:-1].partition("'")
+            return (prefix + value)
+        # --
+    # --
+
+    parts = []
+
+    for match in RE_WORD_SEGMENT.finditer(word):
+        kind = match.lastgroup
+
+        if kind == 'dquoted':
+            parts.append(
+                RE_DQUOTED_ESCAPE.sub(
+                    lambda m: (m.group(1) if m.group(1) in '"\\' else m.group()),
+                    match.group(kind)
+                )
+            )
+
+        else:
+            parts.append(match.group(kind))
+        # --
+    # --
+
+    return ''.join(parts)
+# --- end of unquote_word (...) ---
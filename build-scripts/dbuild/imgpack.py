@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+#  Packaging of (sparse) disk image files.
+#
+#  The data extents of an image are looked up with SEEK_DATA/SEEK_HOLE,
+#  so holes never get read (tar --sparse reads the whole file to find them).
+#
+#  Two output variants:
+#
+#  * tar: a zstd-compressed tarball with the images stored as
+#    pax 1.0 sparse files (as written by 'tar --sparse --format=pax',
+#    GNU tar and bsdtar restore the holes when extracting).
+#    Only the data extents get passed to 'zstd -T0' (multi-threaded),
+#    moved with sendfile(2).
+#
+#  * seekable: one <image>.zst file per image in the zstd seekable format
+#    (independent frames of SEEKABLE_FRAME_SIZE bytes plus a seek table
+#    in a trailing skippable frame), so that a byte range, e.g. a partition,
+#    can be restored without decompressing the frames before it.
+#    Frames get compressed concurrently, frames covering holes only
+#    are compressed once per size and reused.
+#    The file is also a regular zstd stream ('zstd -d --sparse' keeps holes).
+#
+
+import collections
+import concurrent.futures
+import errno
+import os
+import stat
+import struct
+import subprocess
+import tarfile
+
+from .tarstream import BLOCKSIZE
+
+
+# compression level, same as 'tar --zstd'
+ZSTD_LEVEL = 3
+
+# uncompressed size of the frames in the seekable variant,
+# restoring a byte range decompresses the frames overlapping it
+SEEKABLE_FRAME_SIZE = (32 << 20)
+
+# zstd seekable format, see zstd's contrib/seekable_format
+SEEKABLE_SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_FOOTER_MAGIC    = 0x8F92EAB1
+
+
+def get_data_extents(fd, size):
+    """
+    Returns the data extents (offset, length) of an open file of the given size.
+    Falls back to a single extent if the filesystem does not report holes.
+    """
+    extents = []
+    offset  = 0
+
+    try:
+        while offset < size:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    # no data after offset
+                    break
+                raise
+            # --
+
+            data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), size)
+            if data_end > data_start:
+                extents.append((data_start, (data_end - data_start)))
+            offset = data_end
+        # --
+
+    except OSError as err:
+        if err.errno != errno.EINVAL:
+            raise
+        extents = ([(0, size)] if size else [])
+    # --
+
+    return extents
+# --- end of get_data_extents (...) ---
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+# --- end of write_all (...) ---
+
+
+def sendfile_all(out_fd, in_fd, offset, count):
+    while count > 0:
+        num_sent = os.sendfile(out_fd, in_fd, offset, count)
+        if not num_sent:
+            raise OSError(errno.EIO, 'unexpected end of file')
+
+        offset += num_sent
+        count  -= num_sent
+    # --
+# --- end of sendfile_all (...) ---
+
+
+def get_zstd_cmdv(*args, level=ZSTD_LEVEL):
+    return ['zstd', '-q', f'-{level}', *args]
+# --- end of get_zstd_cmdv (...) ---
+
+
+def get_sparse_tar_header(name, st, extents):
+    """
+    Returns the tar headers and the sparse map of a pax 1.0 sparse file,
+    to be followed by the data extents and padding to BLOCKSIZE.
+    """
+    sparse_map = list(extents)
+
+    # the map has at least one entry and covers the whole file
+    if not sparse_map or sum(sparse_map[-1]) < st.st_size:
+        sparse_map.append((st.st_size, 0))
+
+    map_text = ''.join(
+        [f'{len(sparse_map)}\n'] + [f'{offset}\n{length}\n' for offset, length in sparse_map]
+    ).encode('ascii')
+    map_block = map_text + bytes(-len(map_text) % BLOCKSIZE)
+
+    tarinfo = tarfile.TarInfo(f'GNUSparseFile.0/{name}')
+    tarinfo.size        = len(map_block) + sum((length for _, length in extents))
+    tarinfo.mode        = stat.S_IMODE(st.st_mode)
+    tarinfo.mtime       = int(st.st_mtime)
+    tarinfo.uid         = st.st_uid
+    tarinfo.gid         = st.st_gid
+    tarinfo.pax_headers = {
+        'GNU.sparse.major'      : '1',
+        'GNU.sparse.minor'      : '0',
+        'GNU.sparse.name'       : name,
+        'GNU.sparse.realsize'   : str(st.st_size),
+    }
+
+    return tarinfo.tobuf(tarfile.PAX_FORMAT) + map_block
+# --- end of get_sparse_tar_header (...) ---
+
+
+def write_sparse_tar(outfile, root, names, level=ZSTD_LEVEL):
+    """
+    Writes a zstd-compressed tarball containing the files names
+    (relative to root) as sparse files.
+    Returns the number of data bytes read.
+    """
+    num_bytes = 0
+
+    with open(outfile, 'wb') as outfh:
+        proc = subprocess.Popen(
+            get_zstd_cmdv('-T0', '-c', level=level),
+            stdin=subprocess.PIPE, stdout=outfh
+        )
+
+        try:
+            pipe_fd = proc.stdin.fileno()
+
+            for name in names:
+                fd = os.open(os.path.join(root, name), os.O_RDONLY)
+                try:
+                    st      = os.fstat(fd)
+                    extents = get_data_extents(fd, st.st_size)
+
+                    header  = get_sparse_tar_header(name, st, extents)
+                    write_all(pipe_fd, header)
+
+                    for offset, length in extents:
+                        sendfile_all(pipe_fd, fd, offset, length)
+                        num_bytes += length
+                    # --
+
+                    data_size = (len(header) + sum((length for _, length in extents)))
+                    write_all(pipe_fd, bytes(-data_size % BLOCKSIZE))
+                finally:
+                    os.close(fd)
+            # -- end for
+
+            # end of archive
+            write_all(pipe_fd, bytes(2 * BLOCKSIZE))
+
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            returncode = proc.wait()
+        # --
+    # -- end with
+
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, proc.args)
+
+    return num_bytes
+# --- end of write_sparse_tar (...) ---
+
+
+class SeekableZstdWriter(object):
+    """
+    Compresses an image file to the zstd seekable format,
+    with up to num_jobs zstd processes running concurrently.
+    """
+
+    def __init__(self, frame_size=SEEKABLE_FRAME_SIZE, num_jobs=None, level=ZSTD_LEVEL):
+        super().__init__()
+        self.frame_size     = frame_size
+        self.num_jobs       = (num_jobs or os.cpu_count() or 1)
+        self.level          = level
+        # frame length -> compressed frame of zeros
+        self.hole_frames    = {}
+    # --- end of __init__ (...) ---
+
+    def compress(self, data):
+        proc = subprocess.run(
+            get_zstd_cmdv('-c', level=self.level),
+            input=data, stdout=subprocess.PIPE, check=True
+        )
+        return proc.stdout
+    # --- end of compress (...) ---
+
+    def compress_range(self, fd, offset, length):
+        return self.compress(os.pread(fd, length, offset))
+    # --- end of compress_range (...) ---
+
+    def get_hole_frame(self, length):
+        frame = self.hole_frames.get(length)
+        if frame is None:
+            frame = self.compress(bytes(length))
+            self.hole_frames[length] = frame
+        return frame
+    # --- end of get_hole_frame (...) ---
+
+    def iter_frames(self, extents, size):
+        """
+        Generates (offset, length, has_data) for the frames of a file.
+        """
+        extent_it = iter(extents)
+        extent    = next(extent_it, None)
+
+        for offset in range(0, size, self.frame_size):
+            frame_end = min((offset + self.frame_size), size)
+
+            # skip extents ending before this frame
+            while extent is not None and sum(extent) <= offset:
+                extent = next(extent_it, None)
+
+            yield (offset, (frame_end - offset), (extent is not None and extent[0] < frame_end))
+        # --
+    # --- end of iter_frames (...) ---
+
+    def write(self, infile, outfile):
+        """
+        Writes infile to outfile in the seekable format.
+        Returns the number of data bytes read.
+        """
+        num_bytes = 0
+        seek_table = []
+
+        fd = os.open(infile, os.O_RDONLY)
+        try:
+            size    = os.fstat(fd).st_size
+            extents = get_data_extents(fd, size)
+
+            with open(outfile, 'wb') as outfh, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.num_jobs) as executor:
+
+                # frames in order: compressed data or a pending future,
+                # at most 2 * num_jobs futures in flight
+                pending = collections.deque()
+                num_futures = 0
+
+                def write_next():
+                    nonlocal num_futures
+
+                    length, frame = pending.popleft()
+                    if isinstance(frame, concurrent.futures.Future):
+                        frame = frame.result()
+                        num_futures -= 1
+                    # --
+
+                    outfh.write(frame)
+                    seek_table.append((len(frame), length))
+                # --- end of write_next (...) ---
+
+                for offset, length, has_data in self.iter_frames(extents, size):
+                    if has_data:
+                        pending.append(
+                            (length, executor.submit(self.compress_range, fd, offset, length))
+                        )
+                        num_futures += 1
+                        num_bytes += length
+
+                        while num_futures >= (2 * self.num_jobs):
+                            write_next()
+
+                    else:
+                        pending.append((length, self.get_hole_frame(length)))
+                    # --
+                # -- end for
+
+                while pending:
+                    write_next()
+
+                outfh.write(get_seek_table_frame(seek_table))
+            # -- end with
+        finally:
+            os.close(fd)
+
+        return num_bytes
+    # --- end of write (...) ---
+
+# --- end of SeekableZstdWriter ---
+
+
+def get_seek_table_frame(seek_table):
+    """
+    Returns the skippable frame containing the seek table,
+    a list of (compressed size, decompressed size) per frame.
+    """
+    entries = b''.join((struct.pack('<II', csize, dsize) for csize, dsize in seek_table))
+    # no checksums (the frames have their own)
+    footer  = struct.pack('<IBI', len(seek_table), 0, SEEKABLE_FOOTER_MAGIC)
+
+    return (
+        struct.pack('<II', SEEKABLE_SKIPPABLE_MAGIC, (len(entries) + len(footer)))
+        + entries + footer
+    )
+# --- end of get_seek_table_frame (...) ---
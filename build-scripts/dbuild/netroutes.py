@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+#  Aggregation of IP network prefixes into a minimal list of routes,
+#  equivalent to ipaddress.collapse_addresses(), but operating on
+#  integer intervals instead of network objects.
+#
+#  Prefixes get stored as single int keys (<start> << <bits> | <end>),
+#  which are sorted and merged when collapsing the set
+#  (and on the fly once a batch of new prefixes has been added,
+#  which keeps memory usage low for redundant inputs).
+#
+
+import ipaddress
+import re
+import socket
+
+
+# IPv6 addresses consisting of hex groups only (no IPv4 suffix, no scope id)
+RE_IPV6_HEX_ADDR = re.compile(r'^[0-9A-Fa-f:]+$')
+
+
+class PrefixSet(object):
+    """
+    Set of IPv4 or IPv6 network prefixes.
+
+    Prefixes are parsed like ipaddress.ip_network(..., strict=True),
+    i.e. host bits must not be set.
+    """
+
+    # merge pending prefixes when exceeding this number of keys
+    COMPACT_THRESHOLD = (1 << 18)
+
+    def __init__(self, ip_version):
+        super().__init__()
+
+        if ip_version == 4:
+            self.network_cls = ipaddress.IPv4Network
+            self.bits = 32
+        elif ip_version == 6:
+            self.network_cls = ipaddress.IPv6Network
+            self.bits = 128
+        else:
+            raise NotImplementedError(ip_version)
+        # --
+
+        self.ip_version = ip_version
+        self.mask = ((1 << self.bits) - 1)
+
+        self._keys = []
+        self._compact_threshold = self.COMPACT_THRESHOLD
+    # --- end of __init__ (...) ---
+
+    def __len__(self):
+        self.compact()
+        return len(self._keys)
+    # --- end of __len__ (...) ---
+
+    def parse_prefix(self, arg):
+        """
+        Returns the (start, end) interval for the given prefix str.
+        """
+        addr, sep, prefixlen_str = arg.partition('/')
+        packed = None
+
+        if not sep:
+            prefixlen = self.bits
+
+        elif prefixlen_str.isascii() and prefixlen_str.isdigit():
+            prefixlen = int(prefixlen_str)
+
+        else:
+            prefixlen = None    # netmask notation etc.
+        # --
+
+        if prefixlen is not None and prefixlen <= self.bits:
+            try:
+                if self.ip_version == 4:
+                    packed = socket.inet_pton(socket.AF_INET, addr)
+                elif RE_IPV6_HEX_ADDR.match(addr):
+                    packed = socket.inet_pton(socket.AF_INET6, addr)
+            except OSError:
+                pass
+        # --
+
+        if packed is not None:
+            start = int.from_bytes(packed, 'big')
+            hostmask = (self.mask >> prefixlen)
+
+            if not (start & hostmask):
+                return (start, (start | hostmask))
+        # --
+
+        # slow path / errors as reported by ipaddress,
+        # an IPv6 scope id gets dropped (not valid in a route prefix)
+        network = self.network_cls(arg)
+        return (int(network.network_address), int(network.broadcast_address))
+    # --- end of parse_prefix (...) ---
+
+    def add(self, arg):
+        start, end = self.parse_prefix(arg)
+        self._keys.append((start << self.bits) | end)
+
+        if len(self._keys) > self._compact_threshold:
+            self.compact()
+            # amortized O(n log n) even if compaction does not help much
+            self._compact_threshold = max(self._compact_threshold, (2 * len(self._keys)))
+        # --
+    # --- end of add (...) ---
+
+    def update(self, args):
+        for arg in args:
+            self.add(arg)
+    # --- end of update (...) ---
+
+    def update_from_file(self, filepath):
+        """
+        Adds prefixes read from a file,
+        whitespace-separated, '#' starts a comment.
+        """
+        with open(filepath, 'rt') as fh:
+            for line in fh:
+                data, csep, comment = line.partition('#')
+                self.update(data.split())
+        # --
+    # --- end of update_from_file (...) ---
+
+    def compact(self):
+        """
+        Merges overlapping and adjacent intervals.
+        """
+        bits = self.bits
+        mask = self.mask
+
+        merged = []
+        cur_start = None
+        cur_end = None
+
+        self._keys.sort()
+
+        for key in self._keys:
+            start = (key >> bits)
+            end = (key & mask)
+
+            if cur_end is not None and start <= (cur_end + 1):
+                if end > cur_end:
+                    cur_end = end
+
+            else:
+                if cur_end is not None:
+                    merged.append((cur_start << bits) | cur_end)
+                cur_start = start
+                cur_end = end
+            # --
+        # --
+
+        if cur_end is not None:
+            merged.append((cur_start << bits) | cur_end)
+
+        self._keys = merged
+    # --- end of compact (...) ---
+
+    def gen_prefixes(self):
+        """
+        Generates the minimal list of (network address, prefixlen) tuples
+        covering all prefixes in this set, sorted by address.
+        """
+        bits = self.bits
+        mask = self.mask
+
+        self.compact()
+
+        for key in self._keys:
+            start = (key >> bits)
+            end = (key & mask)
+
+            while start <= end:
+                # largest block aligned at start that does not exceed end
+                size = ((start & -start) if start else (1 << bits))
+                while size > (end - start + 1):
+                    size >>= 1
+
+                yield (start, (bits - size.bit_length() + 1))
+                start += size
+            # --
+        # --
+    # --- end of gen_prefixes (...) ---
+
+    def gen_networks_str(self):
+        if self.ip_version == 4:
+            for start, prefixlen in self.gen_prefixes():
+                yield '{}/{}'.format(socket.inet_ntoa(start.to_bytes(4, 'big')), prefixlen)
+
+        else:
+            # ipaddress formatting (inet_ntop may differ, e.g. for v4-mapped addresses)
+            for start, prefixlen in self.gen_prefixes():
+                yield '{}/{}'.format(ipaddress.IPv6Address(start), prefixlen)
+        # --
+    # --- end of gen_networks_str (...) ---
+
+# --- end of PrefixSet ---
@@ -0,0 +1,635 @@
+# -*- coding: utf-8 -*-
+#
+#  Privileged helper process.
+#
+#  Instead of running each privileged command via sudo (which pays for
+#  PAM, logging and a fresh process tree every time), a helper process
+#  gets started once (e.g. "sudo python3 -c ...") and carries out
+#  requests sent over its stdin/stdout pipes.
+#
+#  File writes, mkdir, chmod, mount/umount and syncfs are handled natively,
+#  tarball extraction and tree copies via dbuild.tarsplit / dbuild.treecopy,
+#  other commands are executed by the helper (exec request).
+#
+#  Protocol: each message is a 4-byte big-endian length followed by
+#  that many bytes of UTF-8 encoded JSON.
+#
+#    request:   {"op": <name>, "args": [...], "kwargs": {...}}
+#    response:  {"result": <value>}
+#               {"error": <exception type>, "errno": ..., "strerror": ...,
+#                "filename": ..., "message": ...}
+#
+#  Byte strings are encoded as {"b64": <base64 str>}.
+#
+#  Output of executed commands that is not captured goes to the helper's
+#  stderr, since its stdout carries the protocol.
+#
+
+import base64
+import ctypes
+import json
+import os
+import pathlib
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+from .tarsplit import TarSplitExtractor
+from .treecopy import copy_tree
+
+
+# mount(2) flags
+MS_RDONLY       = (1 << 0)
+MS_NOSUID       = (1 << 1)
+MS_NODEV        = (1 << 2)
+MS_NOEXEC       = (1 << 3)
+MS_SYNCHRONOUS  = (1 << 4)
+MS_DIRSYNC      = (1 << 7)
+MS_NOATIME      = (1 << 10)
+MS_NODIRATIME   = (1 << 11)
+MS_BIND         = (1 << 12)
+MS_REC          = (1 << 14)
+MS_RELATIME     = (1 << 21)
+MS_STRICTATIME  = (1 << 24)
+MS_LAZYTIME     = (1 << 25)
+
+# mount option -> (flags to set, flags to clear),
+# other options get passed to the filesystem (mount data)
+MOUNT_OPTION_FLAGS = {
+    'defaults'      : (0, 0),
+    'ro'            : (MS_RDONLY, 0),
+    'rw'            : (0, MS_RDONLY),
+    'nosuid'        : (MS_NOSUID, 0),
+    'suid'          : (0, MS_NOSUID),
+    'nodev'         : (MS_NODEV, 0),
+    'dev'           : (0, MS_NODEV),
+    'noexec'        : (MS_NOEXEC, 0),
+    'exec'          : (0, MS_NOEXEC),
+    'sync'          : (MS_SYNCHRONOUS, 0),
+    'async'         : (0, MS_SYNCHRONOUS),
+    'dirsync'       : (MS_DIRSYNC, 0),
+    'noatime'       : (MS_NOATIME, 0),
+    'atime'         : (0, MS_NOATIME),
+    'nodiratime'    : (MS_NODIRATIME, 0),
+    'diratime'      : (0, MS_NODIRATIME),
+    'relatime'      : (MS_RELATIME, 0),
+    'norelatime'    : (0, MS_RELATIME),
+    'strictatime'   : (MS_STRICTATIME, 0),
+    'lazytime'      : (MS_LAZYTIME, 0),
+    'bind'          : (MS_BIND, 0),
+    'rbind'         : ((MS_BIND | MS_REC), 0),
+}
+
+# options only interpreted by mount(8), fstab and systemd,
+# dropped instead of being passed to the filesystem
+MOUNT_OPTIONS_USERSPACE = frozenset({
+    'auto', 'noauto', 'nofail', '_netdev',
+    'user', 'nouser', 'users', 'owner', 'group',
+})
+MOUNT_OPTION_PREFIXES_USERSPACE = ('x-', 'X-', 'comment=', 'helper=', 'uhelper=')
+
+# options that need mount(8) (loop device setup)
+MOUNT_OPTIONS_MOUNT8 = frozenset({'loop'})
+MOUNT_OPTION_PREFIXES_MOUNT8 = ('loop=', 'offset=', 'sizelimit=')
+
+# filesystem types that need to be detected by mount(8)
+MOUNT_FSTYPE_AUTO = {None, '', 'auto'}
+
+MESSAGE_HEADER = struct.Struct('>I')
+
+
+class PrivHelperError(RuntimeError):
+    pass
+# --- end of PrivHelperError ---
+
+
+def encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'b64': base64.b64encode(value).decode('ascii')}
+
+    elif isinstance(value, dict):
+        return {k: encode_value(v) for k, v in value.items()}
+
+    elif isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+
+    elif isinstance(value, os.PathLike):
+        return os.fspath(value)
+
+    else:
+        return value
+# --- end of encode_value (...) ---
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if len(value) == 1 and 'b64' in value:
+            return base64.b64decode(value['b64'])
+        else:
+            return {k: decode_value(v) for k, v in value.items()}
+
+    elif isinstance(value, list):
+        return [decode_value(v) for v in value]
+
+    else:
+        return value
+# --- end of decode_value (...) ---
+
+
+def write_message(fh, data):
+    payload = json.dumps(encode_value(data)).encode('utf-8')
+    fh.write(MESSAGE_HEADER.pack(len(payload)))
+    fh.write(payload)
+    fh.flush()
+# --- end of write_message (...) ---
+
+
+def read_exact(fh, size):
+    buf = bytearray()
+
+    while len(buf) < size:
+        chunk = fh.read(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    # --
+
+    return bytes(buf)
+# --- end of read_exact (...) ---
+
+
+def read_message(fh):
+    """
+    Reads a message from fh. Returns None on EOF.
+    """
+    header = read_exact(fh, MESSAGE_HEADER.size)
+    if header is None:
+        return None
+
+    (size, ) = MESSAGE_HEADER.unpack(header)
+
+    payload = read_exact(fh, size)
+    if payload is None:
+        raise PrivHelperError('truncated message')
+
+    return decode_value(json.loads(payload.decode('utf-8')))
+# --- end of read_message (...) ---
+
+
+def unescape_mountinfo(value):
+    # octal escapes for space, tab, newline and backslash
+    return re.sub(rb'\\([0-7]{3})', (lambda m: bytes((int(m.group(1), 8), ))), value)
+# --- end of unescape_mountinfo (...) ---
+
+
+def parse_mount_options(options):
+    """
+    Splits mount options into mount(2) flags and filesystem data,
+    dropping options that are only meaningful to mount(8) (e.g. nofail).
+    Returns a 2-tuple (flags, data str)
+    or None if the options need to be handled by mount(8),
+    e.g. options containing escaped commas ('\\,', see DJ.mount_open()).
+    """
+    flags = 0
+    data = []
+
+    if not options:
+        return (flags, '')
+
+    elif '\\' in options:
+        return None
+    # --
+
+    for opt in options.split(','):
+        try:
+            flags_set, flags_clear = MOUNT_OPTION_FLAGS[opt]
+
+        except KeyError:
+            if (
+                opt in MOUNT_OPTIONS_MOUNT8
+                or opt.startswith(MOUNT_OPTION_PREFIXES_MOUNT8)
+            ):
+                return None
+
+            elif (
+                opt in MOUNT_OPTIONS_USERSPACE
+                or opt.startswith(MOUNT_OPTION_PREFIXES_USERSPACE)
+            ):
+                pass
+
+            elif opt:
+                data.append(opt)
+            # --
+
+        else:
+            flags = ((flags & ~flags_clear) | flags_set)
+    # --
+
+    return (flags, ','.join(data))
+# --- end of parse_mount_options (...) ---
+
+
+class PrivOps(object):
+    """
+    Privileged operations, carried out in-process.
+
+    Used by the helper process,
+    and directly when the calling process is already privileged.
+    """
+
+    # ops that may be requested via the helper protocol
+    OPS = frozenset({
+        'mkdir',
+        'rmdir',
+        'chmod',
+        'write_file',
+        'read_file',
+        'mount',
+        'umount',
+        'syncfs',
+        'ismount',
+        'extract_tar',
+        'copy_tree',
+        'run',
+    })
+
+    def __init__(self, output_fd=None):
+        super().__init__()
+        # stdout of executed commands if not captured (None: inherit)
+        self.output_fd  = output_fd
+        self._libc      = None
+    # --- end of __init__ (...) ---
+
+    def get_libc(self):
+        if self._libc is None:
+            self._libc = ctypes.CDLL(None, use_errno=True)
+        return self._libc
+    # --- end of get_libc (...) ---
+
+    def _check_libc_ret(self, ret, *filenames):
+        if ret != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), *filenames)
+    # --- end of _check_libc_ret (...) ---
+
+    def mkdir(self, path, mode=None, parents=False):
+        """
+        Creates a directory (parents=True: like "mkdir -p").
+        An explicit mode gets applied regardless of the umask.
+        """
+        if parents:
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.mkdir(path)
+
+        if mode is not None:
+            os.chmod(path, mode)
+    # --- end of mkdir (...) ---
+
+    def rmdir(self, path):
+        os.rmdir(path)
+    # --- end of rmdir (...) ---
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+    # --- end of chmod (...) ---
+
+    def write_file(self, path, data, mode=0o644, uid=0, gid=0):
+        """
+        Atomically replaces path with a new file
+        (replaces the file itself if it is a symlink).
+        """
+        path = pathlib.Path(path)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        try:
+            with open(fd, 'wb') as fh:
+                os.fchown(fh.fileno(), uid, gid)
+                os.fchmod(fh.fileno(), mode)
+                fh.write(data)
+            # --
+
+            os.replace(tmp_path, path)
+
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        # --
+    # --- end of write_file (...) ---
+
+    def read_file(self, path):
+        with open(path, 'rb') as fh:
+            return fh.read()
+    # --- end of read_file (...) ---
+
+    def mount(self, source, target, fstype=None, options=None):
+        """
+        Mounts a filesystem via mount(2).
+        Falls back to mount(8) if the filesystem type needs to be detected
+        or the options cannot be passed to mount(2) (see parse_mount_options()).
+        """
+        parsed_options = (
+            None if fstype in MOUNT_FSTYPE_AUTO else parse_mount_options(options)
+        )
+
+        if parsed_options is None:
+            cmdv = ['mount']
+            if fstype not in MOUNT_FSTYPE_AUTO:
+                cmdv.extend(['-t', fstype])
+            cmdv.extend(['-o', (options or 'defaults'), source, target])
+
+            self.run(cmdv, check=True)
+            return
+        # --
+
+        flags, data = parsed_options
+
+        self._check_libc_ret(
+            self.get_libc().mount(
+                os.fsencode(source),
+                os.fsencode(target),
+                os.fsencode(fstype),
+                ctypes.c_ulong(flags),
+                (os.fsencode(data) if data else None)
+            ),
+            source, target
+        )
+    # --- end of mount (...) ---
+
+    def umount(self, target):
+        self._check_libc_ret(self.get_libc().umount(os.fsencode(target)), target)
+    # --- end of umount (...) ---
+
+    def syncfs(self, path):
+        fd = os.open(path, (os.O_RDONLY | os.O_DIRECTORY))
+        try:
+            self._check_libc_ret(self.get_libc().syncfs(fd), path)
+        finally:
+            os.close(fd)
+    # --- end of syncfs (...) ---
+
+    def ismount(self, path):
+        """
+        Returns True if path is a mountpoint, like mountpoint(1).
+        Also detects bind mounts within the same filesystem
+        (which os.path.ismount() does not).
+        """
+        try:
+            with open('/proc/self/mountinfo', 'rb') as fh:
+                mountinfo_data = fh.read()
+
+        except OSError:
+            return os.path.ismount(path)
+        # --
+
+        mnt_dir = os.fsencode(os.path.realpath(path))
+
+        for line in mountinfo_data.splitlines():
+            fields = line.split(b' ', 5)
+
+            if len(fields) > 4 and unescape_mountinfo(fields[4]) == mnt_dir:
+                return True
+        # --
+
+        return False
+    # --- end of ismount (...) ---
+
+    def extract_tar(self, tarball, root, mount_dirs=(), tar_opts=()):
+        """
+        Extracts a (compressed) tarball to root,
+        with one tar process per filesystem mounted at root/<mount_dirs>.
+        """
+        TarSplitExtractor(tarball, root, mount_dirs=mount_dirs, tar_opts=tar_opts).run()
+    # --- end of extract_tar (...) ---
+
+    def copy_tree(self, src_root, dst_root, metadata_file=None):
+        """
+        Copies a rootfs directory to dst_root,
+        returns the number of files and bytes copied.
+        """
+        return copy_tree(src_root, dst_root, metadata_file=metadata_file)
+    # --- end of copy_tree (...) ---
+
+    def run(self, cmdv, input=None, capture_stdout=False, check=False):
+        """
+        Runs a command, stdin is /dev/null unless input is given.
+        Returns a 2-tuple (returncode, stdout or None).
+        """
+        proc = subprocess.run(
+            [os.fspath(a) for a in cmdv],
+            input=input,
+            stdin=(None if input is not None else subprocess.DEVNULL),
+            stdout=(subprocess.PIPE if capture_stdout else self.output_fd),
+            check=check,
+        )
+
+        return (proc.returncode, proc.stdout)
+    # --- end of run (...) ---
+
+# --- end of PrivOps ---
+
+
+def run_server(infh, outfh, ops):
+    """
+    Serves requests read from infh until EOF.
+    """
+    while True:
+        request = read_message(infh)
+        if request is None:
+            break
+        # --
+
+        try:
+            op = request['op']
+            if op not in ops.OPS:
+                raise PrivHelperError(f'unknown op: {op}')
+
+            response = {
+                'result': getattr(ops, op)(
+                    *request.get('args', ()), **request.get('kwargs', {})
+                )
+            }
+
+        except OSError as err:
+            response = {
+                'error'     : 'OSError',
+                'errno'     : err.errno,
+                'strerror'  : err.strerror,
+                'filename'  : (os.fspath(err.filename) if err.filename is not None else None),
+                'message'   : str(err),
+            }
+
+        except Exception as err:
+            response = {
+                'error'     : type(err).__name__,
+                'message'   : str(err),
+            }
+        # --
+
+        write_message(outfh, response)
+    # --
+# --- end of run_server (...) ---
+
+
+def main_serve():
+    # keep the protocol pipe away from commands executed by the helper
+    proto_infh  = os.fdopen(os.dup(sys.stdin.fileno()), 'rb', buffering=0)
+    proto_outfh = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+
+    devnull_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull_fd, sys.stdin.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    os.close(devnull_fd)
+
+    try:
+        run_server(proto_infh, proto_outfh, PrivOps())
+
+    except KeyboardInterrupt:
+        return getattr(os, 'EX_OK', 0) ^ 130
+    # --
+
+    return getattr(os, 'EX_OK', 0)
+# --- end of main_serve (...) ---
+
+
+class PrivHelperClient(object):
+    """
+    Starts the helper process on first use (cmdv_prefix, e.g. ['sudo'])
+    and forwards requests to it.
+
+    Thread-safe, requests get serialized.
+    """
+
+    def __init__(self, cmdv_prefix=('sudo', )):
+        super().__init__()
+        self.cmdv_prefix    = list(cmdv_prefix)
+        self._proc          = None
+        self._lock          = threading.Lock()
+    # --- end of __init__ (...) ---
+
+    def get_helper_cmdv(self):
+        # run the module from its package dir (sudo resets PYTHONPATH)
+        return self.cmdv_prefix + [
+            sys.executable,
+            '-c',
+            (
+                'import sys; sys.path.insert(0, sys.argv[1]); '
+                'import dbuild.privhelper; '
+                'sys.exit(dbuild.privhelper.main_serve())'
+            ),
+            str(pathlib.Path(__file__).resolve().parent.parent),
+        ]
+    # --- end of get_helper_cmdv (...) ---
+
+    def start(self):
+        with self._lock:
+            self._start()
+    # --- end of start (...) ---
+
+    def _start(self):
+        if self._proc is None:
+            self._proc = subprocess.Popen(
+                self.get_helper_cmdv(),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        # --
+    # --- end of _start (...) ---
+
+    def close(self):
+        with self._lock:
+            proc = self._proc
+            self._proc = None
+
+            if proc is not None:
+                proc.stdin.close()
+                proc.wait()
+                proc.stdout.close()
+            # --
+        # --
+    # --- end of close (...) ---
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def call(self, op, *args, **kwargs):
+        with self._lock:
+            self._start()
+
+            try:
+                write_message(self._proc.stdin, {'op': op, 'args': args, 'kwargs': kwargs})
+                response = read_message(self._proc.stdout)
+
+            except BrokenPipeError:
+                response = None
+            # --
+
+            if response is None:
+                raise PrivHelperError(
+                    f'privileged helper exited unexpectedly: {self._proc.poll()}'
+                )
+            # --
+        # --
+
+        if 'error' not in response:
+            return response.get('result')
+
+        elif response['error'] == 'OSError':
+            raise OSError(response['errno'], response['strerror'], response['filename'])
+
+        else:
+            raise PrivHelperError(f"{response['error']}: {response['message']}")
+        # --
+    # --- end of call (...) ---
+
+    def mkdir(self, path, mode=None, parents=False):
+        return self.call('mkdir', path, mode=mode, parents=parents)
+
+    def rmdir(self, path):
+        return self.call('rmdir', path)
+
+    def chmod(self, path, mode):
+        return self.call('chmod', path, mode)
+
+    def write_file(self, path, data, mode=0o644, uid=0, gid=0):
+        return self.call('write_file', path, data, mode=mode, uid=uid, gid=gid)
+
+    def read_file(self, path):
+        return self.call('read_file', path)
+
+    def mount(self, source, target, fstype=None, options=None):
+        return self.call('mount', source, target, fstype=fstype, options=options)
+
+    def umount(self, target):
+        return self.call('umount', target)
+
+    def syncfs(self, path):
+        return self.call('syncfs', path)
+
+    def ismount(self, path):
+        return self.call('ismount', path)
+
+    def extract_tar(self, tarball, root, mount_dirs=(), tar_opts=()):
+        return self.call(
+            'extract_tar', tarball, root, mount_dirs=list(mount_dirs), tar_opts=list(tar_opts)
+        )
+
+    def copy_tree(self, src_root, dst_root, metadata_file=None):
+        return self.call('copy_tree', src_root, dst_root, metadata_file=metadata_file)
+
+    def run(self, cmdv, input=None, capture_stdout=False):
+        returncode, stdout = self.call(
+            'run', cmdv, input=input, capture_stdout=capture_stdout
+        )
+        return (returncode, stdout)
+
+# --- end of PrivHelperClient ---
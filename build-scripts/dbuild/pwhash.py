@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#
+#  Password hashing with a persistent cache of computed hashes.
+#
+#  Hashes are computed via libcrypt (ctypes) if available,
+#  falling back to mkpasswd otherwise.
+#  Since ctypes releases the GIL during foreign calls
+#  and the reentrant crypt_rn()/crypt_gensalt_rn() variants are used,
+#  several passwords get hashed concurrently in a thread pool.
+#
+#  Layout of the cache directory (mode 0700):
+#
+#    <root>/key           -- random HMAC key (mode 0600)
+#    <root>/hashes.json   -- {<hmac(key, method, plaintext)>: <hash>} (mode 0600)
+#    <root>/lock          -- flock(2) lock file
+#
+#  The plaintext is never stored. Note that cached hashes are reused,
+#  i.e. the salt does not change between builds.
+#
+
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import pathlib
+import secrets
+import subprocess
+import tempfile
+import threading
+
+
+# method name (mkpasswd) -> crypt prefix
+PWHASH_METHOD_PREFIX = {
+    'yescrypt'      : b'$y$',
+    'sha512crypt'   : b'$6$',
+    'sha256crypt'   : b'$5$',
+}
+
+# sizeof(struct crypt_data) in libxcrypt
+CRYPT_DATA_SIZE = 32768
+CRYPT_OUTPUT_SIZE = 384
+
+
+class LibCrypt(object):
+
+    def __init__(self, lib):
+        super().__init__()
+        self.lib = lib
+
+        self.lib.crypt_rn.restype = ctypes.c_char_p
+        self.lib.crypt_rn.argtypes = [
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_int
+        ]
+
+        self.lib.crypt_gensalt_rn.restype = ctypes.c_char_p
+        self.lib.crypt_gensalt_rn.argtypes = [
+            ctypes.c_char_p, ctypes.c_ulong,
+            ctypes.c_char_p, ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_int,
+        ]
+    # --- end of __init__ (...) ---
+
+    def crypt(self, plaintext, method):
+        salt_buf = ctypes.create_string_buffer(CRYPT_OUTPUT_SIZE)
+
+        # rbytes=NULL: random bytes are read from the OS
+        salt = self.lib.crypt_gensalt_rn(
+            PWHASH_METHOD_PREFIX[method], 0, None, 0, salt_buf, len(salt_buf)
+        )
+        if not salt:
+            raise OSError(ctypes.get_errno(), f'crypt_gensalt_rn() failed for {method}')
+        # --
+
+        crypt_data = ctypes.create_string_buffer(CRYPT_DATA_SIZE)
+
+        result = self.lib.crypt_rn(
+            plaintext.encode('utf-8'), salt, crypt_data, len(crypt_data)
+        )
+        if not result or result[:1] == b'*':
+            raise OSError(ctypes.get_errno(), f'crypt_rn() failed for {method}')
+        # --
+
+        return result.decode('ascii')
+    # --- end of crypt (...) ---
+
+# --- end of LibCrypt ---
+
+
+_libcrypt = None
+_libcrypt_lock = threading.Lock()
+
+
+def get_libcrypt():
+    """
+    Returns a LibCrypt object or False if libcrypt is not usable
+    (missing or lacking crypt_rn/crypt_gensalt_rn).
+    """
+    global _libcrypt
+
+    with _libcrypt_lock:
+        if _libcrypt is None:
+            _libcrypt = False
+
+            libname = ctypes.util.find_library('crypt')
+            if libname:
+                try:
+                    _libcrypt = LibCrypt(ctypes.CDLL(libname, use_errno=True))
+                except (OSError, AttributeError):
+                    pass
+            # --
+        # --
+
+        return _libcrypt
+    # --
+# --- end of get_libcrypt (...) ---
+
+
+def crypt_password_mkpasswd(plaintext, method):
+    proc = subprocess.run(
+        ['mkpasswd', '--stdin', f'--method={method}'],
+        input=plaintext.encode('utf-8'),
+        capture_output=True,
+        check=True
+    )
+    stdout_lines = proc.stdout.decode('utf-8').splitlines()
+    return (stdout_lines[0] or '*')
+# --- end of crypt_password_mkpasswd (...) ---
+
+
+def crypt_password(plaintext, method):
+    libcrypt = get_libcrypt()
+
+    if libcrypt:
+        try:
+            return libcrypt.crypt(plaintext, method)
+        except OSError:
+            # e.g. method not supported by this libcrypt
+            pass
+    # --
+
+    return crypt_password_mkpasswd(plaintext, method)
+# --- end of crypt_password (...) ---
+
+
+def crypt_passwords(plaintexts, method, jobs=None):
+    """
+    Hashes the given passwords concurrently.
+    Returns a list of hashes (in the same order as plaintexts).
+    """
+    if len(plaintexts) < 2:
+        return [crypt_password(plaintext, method) for plaintext in plaintexts]
+    # --
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(len(plaintexts), (jobs or os.cpu_count() or 1))
+    ) as executor:
+        return list(
+            executor.map(lambda p: crypt_password(p, method), plaintexts)
+        )
+    # --
+# --- end of crypt_passwords (...) ---
+
+
+class PasswordHashCache(object):
+    """
+    Cache of password hashes, keyed by a keyed digest of method and plaintext.
+    With root=None, hashes are only kept in memory.
+    Thread-safe.
+    """
+
+    KEY_FILE_NAME   = 'key'
+    STORE_FILE_NAME = 'hashes.json'
+    LOCK_FILE_NAME  = 'lock'
+
+    def __init__(self, root=None, jobs=None):
+        super().__init__()
+        self.root       = (pathlib.Path(root) if root is not None else None)
+        self.jobs       = jobs
+        self._key       = None
+        self._hashes    = None
+        self._lock      = threading.Lock()
+    # --- end of __init__ (...) ---
+
+    @contextlib.contextmanager
+    def locked(self):
+        if self.root is None:
+            yield self
+            return
+        # --
+
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+
+        with open(os.open((self.root / self.LOCK_FILE_NAME), (os.O_WRONLY | os.O_CREAT), 0o600), 'wb') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        # --
+    # --- end of locked (...) ---
+
+    def _load_key(self):
+        if self.root is None:
+            return secrets.token_bytes(32)
+        # --
+
+        key_file = self.root / self.KEY_FILE_NAME
+
+        try:
+            with open(key_file, 'rb') as fh:
+                key = fh.read()
+
+        except FileNotFoundError:
+            key = secrets.token_bytes(32)
+
+            with open(os.open(key_file, (os.O_WRONLY | os.O_CREAT | os.O_EXCL), 0o600), 'wb') as fh:
+                fh.write(key)
+        # --
+
+        if len(key) < 32:
+            raise ValueError('password hash cache key is too short', key_file)
+
+        return key
+    # --- end of _load_key (...) ---
+
+    def _read_store(self):
+        if self.root is None:
+            return {}
+
+        try:
+            with open((self.root / self.STORE_FILE_NAME), 'rt') as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return {}
+    # --- end of _read_store (...) ---
+
+    def _write_store(self, hashes):
+        with tempfile.NamedTemporaryFile(
+            'wt', dir=self.root, prefix='.hashes.', delete=False
+        ) as fh:
+            # NamedTemporaryFile creates files with mode 0600
+            json.dump(hashes, fh)
+        # --
+
+        os.replace(fh.name, (self.root / self.STORE_FILE_NAME))
+    # --- end of _write_store (...) ---
+
+    def _load(self):
+        # must be called while holding self._lock
+        if self._key is None:
+            with self.locked():
+                self._key = self._load_key()
+                self._hashes = self._read_store()
+        # --
+    # --- end of _load (...) ---
+
+    def get_keyed_digest(self, data):
+        """
+        Returns a keyed digest (HMAC) of data (bytes),
+        stable across runs if the cache has a root directory.
+        """
+        with self._lock:
+            self._load()
+
+        return hmac.new(self._key, data, hashlib.sha256).hexdigest()
+    # --- end of get_keyed_digest (...) ---
+
+    def get_digest(self, plaintext, method):
+        return hmac.new(
+            self._key,
+            b'\0'.join((method.encode('utf-8'), plaintext.encode('utf-8'))),
+            hashlib.sha256
+        ).hexdigest()
+    # --- end of get_digest (...) ---
+
+    def get_hashes(self, plaintexts, method):
+        """
+        Returns a dict plaintext -> hash for the given passwords,
+        hashing those not found in the cache.
+        """
+        with self._lock:
+            self._load()
+
+            digests = {p: self.get_digest(p, method) for p in set(plaintexts)}
+            result  = {p: self._hashes.get(d) for p, d in digests.items()}
+        # --
+
+        misses = [p for p, h in result.items() if h is None]
+
+        if misses:
+            new_hashes = dict(zip(misses, crypt_passwords(misses, method, jobs=self.jobs)))
+            result.update(new_hashes)
+
+            with self._lock:
+                self._hashes.update(((digests[p], h) for p, h in new_hashes.items()))
+
+                if self.root is not None:
+                    with self.locked():
+                        # merge with entries added by other processes
+                        hashes = self._read_store()
+                        hashes.update(self._hashes)
+                        self._write_store(hashes)
+                        self._hashes = hashes
+                # --
+            # --
+        # --
+
+        return result
+    # --- end of get_hashes (...) ---
+
+# --- end of PasswordHashCache ---
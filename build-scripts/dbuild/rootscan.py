@@ -0,0 +1,692 @@
+# -*- coding: utf-8 -*-
+#
+#  Single-pass rootfs scanner with pluggable visitors.
+#
+#  The tree gets walked once with os.scandir(), top-level directories
+#  are scanned concurrently in a thread pool (os.scandir(), os.lstat()
+#  and os.readlink() release the GIL). Each registered visitor sees
+#  every entry below the root (excluding the root itself).
+#
+#  Visitors must not modify the tree while scanning, changes are
+#  collected per worker (visitor state), merged in scan order
+#  and applied in RootfsVisitor.finish() afterwards.
+#
+#  Entry paths are passed as relative path str with leading '/',
+#  e.g. '/usr/bin/env'.
+#
+
+import base64
+import collections
+import concurrent.futures
+import errno
+import json
+import os
+import re
+import stat
+
+
+class RootfsVisitor(object):
+    """
+    Base class for rootfs scan visitors.
+
+    Per-worker state is created with create_state() and passed
+    to visit_entry(). Worker states get merged with merge_state()
+    in scan order (main thread), followed by finish().
+    """
+
+    # whether visit_entry() needs the lstat() result (else st is None)
+    need_stat = False
+
+    def create_state(self):
+        return None
+    # --- end of create_state (...) ---
+
+    def visit_entry(self, state, entry, relpath, st):
+        raise NotImplementedError(self)
+    # --- end of visit_entry (...) ---
+
+    def merge_state(self, state):
+        pass
+    # --- end of merge_state (...) ---
+
+    def finish(self, scanner):
+        """
+        Called once after merging all states,
+        returns the visitor's result.
+        """
+        return None
+    # --- end of finish (...) ---
+
+# --- end of RootfsVisitor ---
+
+
+class ListCollectVisitor(RootfsVisitor):
+    """
+    Visitor that collects items in per-worker lists (self.items).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.items = []
+    # --- end of __init__ (...) ---
+
+    def create_state(self):
+        return []
+    # --- end of create_state (...) ---
+
+    def merge_state(self, state):
+        self.items.extend(state)
+    # --- end of merge_state (...) ---
+
+# --- end of ListCollectVisitor ---
+
+
+class SymlinkFixVisitor(ListCollectVisitor):
+    """
+    Rewrites absolute symlinks pointing to link_root_src (usually the
+    build-time path of the rootfs) so that they point to link_root_dst.
+
+    Result: sorted list of (link path, old target, new target).
+    """
+
+    def __init__(self, link_root_src, link_root_dst='/', dry_run=False):
+        super().__init__()
+        self.link_root_src          = link_root_src
+        self.link_root_src_prefix   = link_root_src.rstrip('/') + '/'
+        self.link_root_dst          = link_root_dst
+        self.link_root_dst_prefix   = link_root_dst.rstrip('/') + '/'
+        self.dry_run                = dry_run
+    # --- end of __init__ (...) ---
+
+    def visit_entry(self, state, entry, relpath, st):
+        if not entry.is_symlink():
+            return
+
+        link_target = os.readlink(entry.path)
+
+        if link_target == self.link_root_src:
+            state.append((entry.path, link_target, self.link_root_dst))
+
+        elif link_target.startswith(self.link_root_src_prefix):
+            link_target_rel_to_root = link_target[len(self.link_root_src_prefix):]
+
+            if link_target_rel_to_root:
+                link_target_new = self.link_root_dst_prefix + link_target_rel_to_root
+            else:
+                link_target_new = self.link_root_dst
+            # --
+
+            state.append((entry.path, link_target, link_target_new))
+        # --
+    # --- end of visit_entry (...) ---
+
+    def finish(self, scanner):
+        self.items.sort()
+
+        if not self.dry_run:
+            for fpath, link_target_old, link_target_new in self.items:
+                replace_symlink(fpath, link_target_new)
+        # --
+
+        return self.items
+    # --- end of finish (...) ---
+
+# --- end of SymlinkFixVisitor ---
+
+
+class CleanupVisitor(ListCollectVisitor):
+    """
+    Deletes files and symlinks (not directories) matching any of
+    the given glob patterns. Patterns are matched against the relative
+    path with leading '/', '*' does not match '/', e.g.:
+
+      /var/cache/apt/*.bin
+      /var/lib/apt/lists/**       (anything below, '**' matches '/')
+
+    Result: sorted list of deleted paths (relative).
+    """
+
+    def __init__(self, patterns, dry_run=False):
+        super().__init__()
+        self.patterns   = list(patterns)
+        self.dry_run    = dry_run
+        self.re_match   = compile_glob_patterns(self.patterns)
+    # --- end of __init__ (...) ---
+
+    def visit_entry(self, state, entry, relpath, st):
+        if (
+            self.re_match is not None
+            and not entry.is_dir(follow_symlinks=False)
+            and self.re_match(relpath)
+        ):
+            state.append(relpath)
+        # --
+    # --- end of visit_entry (...) ---
+
+    def finish(self, scanner):
+        self.items.sort()
+
+        if not self.dry_run:
+            for relpath in self.items:
+                os.unlink(scanner.get_path(relpath))
+        # --
+
+        return self.items
+    # --- end of finish (...) ---
+
+# --- end of CleanupVisitor ---
+
+
+class ManifestVisitor(ListCollectVisitor):
+    """
+    File manifest.
+
+    Result: sorted list of
+    (relpath, type char, mode, uid, gid, size, link target or None).
+    """
+
+    need_stat = True
+
+    def visit_entry(self, state, entry, relpath, st):
+        link_target = None
+
+        if stat.S_ISLNK(st.st_mode):
+            link_target = os.readlink(entry.path)
+
+        state.append((
+            relpath,
+            get_file_type_char(st.st_mode),
+            stat.S_IMODE(st.st_mode),
+            st.st_uid,
+            st.st_gid,
+            (st.st_size if stat.S_ISREG(st.st_mode) else 0),
+            link_target,
+        ))
+    # --- end of visit_entry (...) ---
+
+    def finish(self, scanner):
+        self.items.sort()
+        return self.items
+    # --- end of finish (...) ---
+
+    def gen_lines(self):
+        for relpath, ftype, mode, uid, gid, size, link_target in self.items:
+            line = f'{ftype} {mode:04o} {uid}:{gid} {size} {relpath}'
+            yield (line if link_target is None else f'{line} -> {link_target}')
+    # --- end of gen_lines (...) ---
+
+# --- end of ManifestVisitor ---
+
+
+class MetadataVisitor(ListCollectVisitor):
+    """
+    File metadata for recreating the tree elsewhere (see dbuild.treecopy),
+    as seen by the scanning process (e.g. ownership faked by fakeroot).
+    Unlike the other visitors, the root directory is included ('/').
+
+    Result: sorted list of dicts with keys
+    path, mode (incl. file type), uid, gid, mtime_ns
+    and optionally rdev (device nodes), xattrs (name -> value bytes)
+    and link (hardlinks: path of the first entry sharing the inode).
+    """
+
+    need_stat = True
+
+    def visit_entry(self, state, entry, relpath, st):
+        state.append(get_metadata_entry(entry.path, relpath, st))
+    # --- end of visit_entry (...) ---
+
+    def finish(self, scanner):
+        self.items.append(
+            get_metadata_entry(scanner.root, '/', os.lstat(scanner.root))
+        )
+        self.items.sort(key=lambda item: item['path'])
+
+        # hardlinks refer to the first path (in sorted order)
+        inode_map = {}
+
+        for item in self.items:
+            inode = item.pop('_inode', None)
+
+            if inode is not None:
+                link = inode_map.setdefault(inode, item['path'])
+                if link != item['path']:
+                    item['link'] = link
+            # --
+        # --
+
+        return self.items
+    # --- end of finish (...) ---
+
+    def gen_lines(self):
+        for item in self.items:
+            xattrs = item.get('xattrs')
+
+            if xattrs:
+                item = dict(
+                    item,
+                    xattrs={
+                        name: base64.b64encode(value).decode('ascii')
+                        for name, value in xattrs.items()
+                    }
+                )
+            # --
+
+            yield json.dumps(item, sort_keys=True)
+        # --
+    # --- end of gen_lines (...) ---
+
+# --- end of MetadataVisitor ---
+
+
+class PermAuditVisitor(ListCollectVisitor):
+    """
+    Reports questionable permissions/ownership:
+
+      setuid            -- setuid file
+      setgid            -- setgid file (not directory)
+      world-writable    -- world-writable file, or directory w/o sticky bit
+      unknown-uid       -- owner not in the target's /etc/passwd
+      unknown-gid       -- group not in the target's /etc/group
+
+    Result: sorted list of (relpath, issue).
+    """
+
+    need_stat = True
+
+    def __init__(self, known_uids=None, known_gids=None):
+        super().__init__()
+        self.known_uids = known_uids
+        self.known_gids = known_gids
+    # --- end of __init__ (...) ---
+
+    def visit_entry(self, state, entry, relpath, st):
+        mode = st.st_mode
+
+        if stat.S_ISLNK(mode):
+            pass
+
+        elif stat.S_ISDIR(mode):
+            if (mode & stat.S_IWOTH) and not (mode & stat.S_ISVTX):
+                state.append((relpath, 'world-writable'))
+
+        else:
+            if mode & stat.S_ISUID:
+                state.append((relpath, 'setuid'))
+
+            if mode & stat.S_ISGID:
+                state.append((relpath, 'setgid'))
+
+            if mode & stat.S_IWOTH:
+                state.append((relpath, 'world-writable'))
+        # --
+
+        if self.known_uids is not None and st.st_uid not in self.known_uids:
+            state.append((relpath, 'unknown-uid'))
+
+        if self.known_gids is not None and st.st_gid not in self.known_gids:
+            state.append((relpath, 'unknown-gid'))
+    # --- end of visit_entry (...) ---
+
+    def finish(self, scanner):
+        self.items.sort()
+        return self.items
+    # --- end of finish (...) ---
+
+# --- end of PermAuditVisitor ---
+
+
+class DirSizeVisitor(RootfsVisitor):
+    """
+    Disk usage (allocated blocks) and apparent size per directory,
+    accumulated up to the given depth ('/' is depth 0, '/usr' depth 1).
+    Hardlinked files are counted once.
+
+    Result: dict relpath -> [disk usage, apparent size, number of entries].
+    """
+
+    need_stat = True
+
+    def __init__(self, max_depth=2):
+        super().__init__()
+        self.max_depth  = max_depth
+        self.sizes      = collections.defaultdict(lambda: [0, 0, 0])
+        self.inodes     = set()
+    # --- end of __init__ (...) ---
+
+    def create_state(self):
+        # (sizes, {(dev, ino): (usage, size, relpath)} for nlink > 1)
+        return (collections.defaultdict(lambda: [0, 0, 0]), {})
+    # --- end of create_state (...) ---
+
+    def get_accounting_dirs(self, relpath):
+        parts = relpath.split('/')[1:-1]
+        return ['/'] + [
+            '/' + '/'.join(parts[:k]) for k in range(1, min(len(parts), self.max_depth) + 1)
+        ]
+    # --- end of get_accounting_dirs (...) ---
+
+    def visit_entry(self, state, entry, relpath, st):
+        sizes, hardlinks = state
+        usage = (st.st_blocks * 512)
+        size  = st.st_size
+
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            hardlinks.setdefault((st.st_dev, st.st_ino), (usage, size, relpath))
+            usage = size = 0
+        # --
+
+        for dirpath in self.get_accounting_dirs(relpath):
+            acc = sizes[dirpath]
+            acc[0] += usage
+            acc[1] += size
+            acc[2] += 1
+        # --
+    # --- end of visit_entry (...) ---
+
+    def merge_state(self, state):
+        sizes, hardlinks = state
+
+        for dirpath, (usage, size, count) in sizes.items():
+            acc = self.sizes[dirpath]
+            acc[0] += usage
+            acc[1] += size
+            acc[2] += count
+        # --
+
+        for key, (usage, size, relpath) in hardlinks.items():
+            if key not in self.inodes:
+                self.inodes.add(key)
+
+                for dirpath in self.get_accounting_dirs(relpath):
+                    acc = self.sizes[dirpath]
+                    acc[0] += usage
+                    acc[1] += size
+            # --
+        # --
+    # --- end of merge_state (...) ---
+
+    def finish(self, scanner):
+        return dict(sorted(self.sizes.items()))
+    # --- end of finish (...) ---
+
+# --- end of DirSizeVisitor ---
+
+
+class RootfsScanner(object):
+    """
+    Walks a rootfs directory once, passing each entry to all visitors.
+    Unreadable directories are skipped (as with os.walk()).
+    """
+
+    def __init__(self, root, visitors=None, jobs=None):
+        super().__init__()
+        self.root       = os.fspath(root).rstrip('/') or '/'
+        self.visitors   = list(visitors or ())
+        self.jobs       = jobs
+    # --- end of __init__ (...) ---
+
+    def add_visitor(self, visitor):
+        self.visitors.append(visitor)
+        return visitor
+    # --- end of add_visitor (...) ---
+
+    def get_path(self, relpath):
+        return (self.root.rstrip('/') + relpath)
+    # --- end of get_path (...) ---
+
+    def run(self):
+        """
+        Scans the tree and returns the list of visitor results
+        (in order of registration).
+        """
+        subdirs = []
+
+        top_states = self.scan_entries(
+            [(self.root, '')], top_level=True, subdirs=subdirs
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            subdir_states = list(
+                executor.map(lambda item: self.scan_entries([item]), subdirs)
+            )
+        # --
+
+        for states in [top_states] + subdir_states:
+            for visitor, state in zip(self.visitors, states):
+                visitor.merge_state(state)
+        # --
+
+        return [visitor.finish(self) for visitor in self.visitors]
+    # --- end of run (...) ---
+
+    def scan_entries(self, dir_stack, top_level=False, subdirs=None):
+        """
+        Scans the given directories (list of (path, relpath))
+        and returns the list of visitor states.
+
+        With top_level=True, only the entries of the given directories
+        get visited and their subdirectories are appended to subdirs.
+        """
+        visitors    = self.visitors
+        states      = [visitor.create_state() for visitor in visitors]
+        calls       = list(zip(visitors, states))
+        need_stat   = any((visitor.need_stat for visitor in visitors))
+
+        while dir_stack:
+            dirpath, dir_relpath = dir_stack.pop()
+
+            for entry in scandir_list(dirpath):
+                relpath = f'{dir_relpath}/{entry.name}'
+                st      = (entry.stat(follow_symlinks=False) if need_stat else None)
+
+                for visitor, state in calls:
+                    visitor.visit_entry(state, entry, relpath, st)
+
+                if entry.is_dir(follow_symlinks=False):
+                    if top_level:
+                        subdirs.append((entry.path, relpath))
+                    else:
+                        dir_stack.append((entry.path, relpath))
+                # --
+            # --
+        # --
+
+        return states
+    # --- end of scan_entries (...) ---
+
+# --- end of RootfsScanner ---
+
+
+def scandir_list(dirpath):
+    try:
+        with os.scandir(dirpath) as entries:
+            return list(entries)
+
+    except OSError:
+        return []
+# --- end of scandir_list (...) ---
+
+
+def replace_symlink(fpath, link_target):
+    """
+    Atomically replaces the symlink at fpath (via a temporary symlink).
+    """
+    dirpath, name = os.path.split(fpath)
+    tmp_fpath = os.path.join(dirpath, f'.{name}.fix-symlinks.{os.getpid()}')
+
+    try:
+        os.unlink(tmp_fpath)
+    except FileNotFoundError:
+        pass
+
+    os.symlink(link_target, tmp_fpath)
+
+    try:
+        os.replace(tmp_fpath, fpath)
+
+    except OSError:
+        os.unlink(tmp_fpath)
+        raise
+    # --
+# --- end of replace_symlink (...) ---
+
+
+def compile_glob_patterns(patterns):
+    """
+    Returns a match function for the given glob patterns, or None if empty.
+    """
+    if not patterns:
+        return None
+
+    return re.compile(
+        '(?s:{})\\Z'.format('|'.join((translate_glob(p) for p in patterns)))
+    ).match
+# --- end of compile_glob_patterns (...) ---
+
+
+def translate_glob(pattern):
+    """
+    Translates a glob pattern to a regular expression,
+    where '*', '?' and '[...]' do not match '/', but '**' does.
+    """
+    parts   = []
+    idx     = 0
+    end     = len(pattern)
+
+    while idx < end:
+        char = pattern[idx]
+        idx += 1
+
+        if char == '*':
+            if pattern[idx:idx + 1] == '*':
+                parts.append('.*')
+                idx += 1
+            else:
+                parts.append('[^/]*')
+
+        elif char == '?':
+            parts.append('[^/]')
+
+        elif char == '[':
+            # ']' directly after '[' or '[!' is part of the set
+            jdx = idx
+            if pattern[jdx:jdx + 1] == '!':
+                jdx += 1
+            if pattern[jdx:jdx + 1] == ']':
+                jdx += 1
+            jdx = pattern.find(']', jdx)
+
+            if jdx < 0:
+                parts.append(re.escape(char))
+
+            else:
+                chars = re.sub(r'([\\\[\]^])', r'\\\1', pattern[idx:jdx])
+                idx   = jdx + 1
+
+                if chars[:1] == '!':
+                    parts.append('[^/{}]'.format(chars[1:]))
+                else:
+                    parts.append('(?!/)[{}]'.format(chars))
+            # --
+
+        else:
+            parts.append(re.escape(char))
+        # --
+    # --
+
+    return '(?:{})'.format(''.join(parts))
+# --- end of translate_glob (...) ---
+
+
+def get_file_type_char(mode):
+    if stat.S_ISREG(mode):
+        return 'f'
+    elif stat.S_ISDIR(mode):
+        return 'd'
+    elif stat.S_ISLNK(mode):
+        return 'l'
+    elif stat.S_ISCHR(mode):
+        return 'c'
+    elif stat.S_ISBLK(mode):
+        return 'b'
+    elif stat.S_ISFIFO(mode):
+        return 'p'
+    elif stat.S_ISSOCK(mode):
+        return 's'
+    else:
+        return '?'
+# --- end of get_file_type_char (...) ---
+
+
+def get_metadata_entry(fpath, relpath, st):
+    """
+    Returns the metadata dict of a file (see MetadataVisitor),
+    with the inode key '_inode' for hardlinked files.
+    """
+    item = {
+        'path'      : relpath,
+        'mode'      : st.st_mode,
+        'uid'       : st.st_uid,
+        'gid'       : st.st_gid,
+        'mtime_ns'  : st.st_mtime_ns,
+    }
+
+    if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        item['rdev'] = st.st_rdev
+
+    elif stat.S_ISLNK(st.st_mode):
+        # xattrs of symlinks are not preserved (as with tar)
+        return item
+
+    elif st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+        item['_inode'] = (st.st_dev, st.st_ino)
+    # --
+
+    xattrs = read_xattrs(fpath)
+    if xattrs:
+        item['xattrs'] = xattrs
+
+    return item
+# --- end of get_metadata_entry (...) ---
+
+
+def read_xattrs(fpath):
+    """
+    Returns the extended attributes of a file as dict (name -> value bytes),
+    empty if not supported.
+    """
+    try:
+        return {
+            name: os.getxattr(fpath, name, follow_symlinks=False)
+            for name in os.listxattr(fpath, follow_symlinks=False)
+        }
+
+    except OSError as err:
+        if err.errno in {errno.ENOTSUP, errno.ENODATA}:
+            return {}
+        raise
+    # --
+# --- end of read_xattrs (...) ---
+
+
+def read_target_ids(root, filename):
+    """
+    Returns the set of numeric ids from the target's /etc/passwd or /etc/group
+    (third field), or None if the file does not exist.
+    """
+    ids = set()
+
+    try:
+        with open(os.path.join(root, 'etc', filename), 'rt') as fh:
+            for line in fh:
+                fields = line.split(':')
+                if len(fields) > 2 and fields[2].isdigit():
+                    ids.add(int(fields[2]))
+        # --
+
+    except FileNotFoundError:
+        return None
+
+    return ids
+# --- end of read_target_ids (...) ---
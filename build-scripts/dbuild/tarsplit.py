@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#
+#  Extraction of a (compressed) rootfs tarball into a directory tree
+#  that spans several mounted filesystems (e.g. root, /boot, /var/log).
+#
+#  The archive gets decompressed once, in a separate process.
+#  Its tar stream is split by mountpoint (see dbuild.tarstream),
+#  with one tar process per filesystem extracting the entries that
+#  reside on it, so that writes to the filesystems happen concurrently.
+#  GNU tar still does the extraction, keeping ownership, permissions,
+#  xattrs, hardlinks and mtimes as before.
+#
+#  File data is moved from the decompressor's pipe to the tar processes'
+#  pipes with splice(2), only headers pass through this process.
+#
+
+import fcntl
+import os
+import subprocess
+
+from .tarstream import TarStreamSplitter
+
+
+# Linux-specific, Python >= 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+USE_SPLICE   = hasattr(os, 'splice')
+
+# magic bytes -> decompressor, reading from the file given as last arg
+DECOMPRESS_CMDV = [
+    (b'\x28\xb5\x2f\xfd',   ['zstd', '-d', '-c', '-q']),
+    (b'\xfd7zXZ\x00',       ['xz', '-d', '-c', '-T0']),
+    (b'\x1f\x8b',           ['gzip', '-d', '-c']),
+    (b'BZh',                ['bzip2', '-d', '-c']),
+]
+
+
+def get_decompress_cmdv(filepath):
+    """
+    Returns the decompressor command for the given tarball
+    or None if it is not compressed.
+    Detection is based on the file's contents, like 'tar -x' does.
+    """
+    with open(filepath, 'rb') as fh:
+        magic = fh.read(8)
+
+    for magic_prefix, cmdv in DECOMPRESS_CMDV:
+        if magic.startswith(magic_prefix):
+            return cmdv + [os.fspath(filepath)]
+    # --
+
+    return None
+# --- end of get_decompress_cmdv (...) ---
+
+
+def normalize_path(path):
+    """
+    Converts a path (str or bytes, relative to the extraction root)
+    to a normalized relative path (bytes), b'' for the root itself.
+    """
+    return os.path.normpath(b'/' + os.fsencode(path)).lstrip(b'/')
+# --- end of normalize_path (...) ---
+
+
+class MountPrefixMap(object):
+    """
+    Maps entry paths to the index of the filesystem they reside on:
+    0 for the root filesystem, k for mount_dirs[k-1].
+    """
+
+    def __init__(self, mount_dirs):
+        super().__init__()
+        self.mount_index    = {
+            mount_dir: k
+            for k, mount_dir in enumerate(map(normalize_path, mount_dirs), 1)
+            if mount_dir
+        }
+        # directories containing a mountpoint, entries therein are looked up
+        self.mount_parents  = {
+            mount_dir.rpartition(b'/')[0] for mount_dir in self.mount_index
+        }
+        # longest (deepest) mountpoint first
+        self.prefixes       = sorted(self.mount_index.items(), key=lambda kv: -len(kv[0]))
+        # dirpath as found in the archive -> index
+        self.dir_cache      = {}
+    # --- end of __init__ (...) ---
+
+    def __call__(self, path):
+        # entries in the same directory are usually adjacent
+        dirpath, _, _ = path.rstrip(b'/').rpartition(b'/')
+
+        index = self.dir_cache.get(dirpath)
+        if index is None:
+            index = self.lookup(normalize_path(path))
+
+            if normalize_path(dirpath) not in self.mount_parents:
+                self.dir_cache[dirpath] = index
+        # --
+
+        return index
+    # --- end of __call__ (...) ---
+
+    def lookup(self, path):
+        for mount_dir, index in self.prefixes:
+            if path == mount_dir or path.startswith(mount_dir + b'/'):
+                return index
+        # --
+
+        return 0
+    # --- end of lookup (...) ---
+
+# --- end of MountPrefixMap ---
+
+
+class TarExtractJob(object):
+    """
+    A tar process extracting the stream written to its stdin pipe.
+
+    The pipe buffer gets enlarged to PIPE_SIZE (if permitted),
+    so that a slow filesystem only stalls the other ones
+    once that much data is pending.
+    """
+
+    PIPE_SIZE = (1 << 20)
+
+    def __init__(self, cmdv):
+        super().__init__()
+        self.cmdv       = cmdv
+        self.proc       = None
+    # --- end of __init__ (...) ---
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmdv, stdin=subprocess.PIPE)
+
+        try:
+            fcntl.fcntl(self.proc.stdin.fileno(), F_SETPIPE_SZ, self.PIPE_SIZE)
+        except OSError:
+            # exceeds /proc/sys/fs/pipe-max-size, keep default size
+            pass
+    # --- end of start (...) ---
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    # --- end of close (...) ---
+
+    def wait(self):
+        return self.proc.wait()
+    # --- end of wait (...) ---
+
+# --- end of TarExtractJob ---
+
+
+class TarSplitExtractor(object):
+    """
+    Extracts tarball to root, with one tar process per mounted filesystem
+    (mount_dirs: mountpoints relative to root, e.g. '/boot').
+
+    tar_opts are passed to each tar process, e.g. --numeric-owner.
+    """
+
+    def __init__(self, tarball, root, mount_dirs=(), tar_opts=()):
+        super().__init__()
+        self.tarball    = os.fspath(tarball)
+        self.root       = os.fspath(root)
+        self.mount_dirs = list(mount_dirs)
+        self.tar_opts   = list(tar_opts)
+    # --- end of __init__ (...) ---
+
+    def get_tar_cmdv(self, tarball='-'):
+        cmdv = ['tar', '-x', '-p']
+        cmdv.extend(self.tar_opts)
+        cmdv.extend(['-f', tarball, '-C', self.root])
+        return cmdv
+    # --- end of get_tar_cmdv (...) ---
+
+    def run(self):
+        if self.mount_dirs and (os.cpu_count() or 1) > 1:
+            self.run_split()
+
+        else:
+            # nothing to split, or no CPU to run the splitter concurrently:
+            # a single tar process is faster
+            subprocess.run(self.get_tar_cmdv(self.tarball), stdin=subprocess.DEVNULL, check=True)
+        # --
+    # --- end of run (...) ---
+
+    def run_split(self):
+        # root filesystem + one job per mountpoint
+        jobs = [TarExtractJob(self.get_tar_cmdv()) for _ in range(len(self.mount_dirs) + 1)]
+
+        decompress_cmdv = get_decompress_cmdv(self.tarball)
+        decompress_proc = None
+
+        if decompress_cmdv is not None:
+            decompress_proc = subprocess.Popen(
+                decompress_cmdv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                bufsize=0,
+            )
+            infh = decompress_proc.stdout
+        else:
+            infh = open(self.tarball, 'rb', buffering=0)
+        # --
+
+        broken_pipe = False
+
+        try:
+            for job in jobs:
+                job.start()
+
+            TarStreamSplitter(
+                infh,
+                [job.proc.stdin for job in jobs],
+                MountPrefixMap(self.mount_dirs),
+                use_splice=USE_SPLICE
+            ).run()
+
+        except BrokenPipeError:
+            # a tar process exited early, its status gets reported below
+            broken_pipe = True
+
+        finally:
+            infh.close()
+
+            for job in jobs:
+                if job.proc is not None:
+                    job.close()
+            # --
+        # --
+
+        failed = []
+
+        for job in jobs:
+            if job.proc is not None:
+                returncode = job.wait()
+                if returncode:
+                    failed.append((job.cmdv, returncode))
+        # --
+
+        if decompress_proc is not None:
+            returncode = decompress_proc.wait()
+            if returncode and not broken_pipe:
+                failed.append((decompress_cmdv, returncode))
+        # --
+
+        if failed:
+            cmdv, returncode = failed[0]
+            raise subprocess.CalledProcessError(returncode, cmdv)
+
+        elif broken_pipe:
+            raise subprocess.SubprocessError('tar exited before reading all input')
+        # --
+    # --- end of run_split (...) ---
+
+# --- end of TarSplitExtractor ---
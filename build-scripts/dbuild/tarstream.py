@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+#
+#  Rewriting of symlink targets in a tar stream,
+#  splitting of a tar stream by path prefix.
+#
+#  Operates on the raw 512-byte blocks: only the headers of symlinks
+#  that get rewritten are re-encoded, all other headers and file data
+#  are copied as-is. Long link targets stored in GNU long link ('K')
+#  or pax extended ('x', linkpath) headers are handled, too.
+#
+
+import os
+
+
+BLOCKSIZE = 512
+ZERO_BLOCK = bytes(BLOCKSIZE)
+
+# copy file data in chunks of this size
+COPY_BUFSIZE = (1 << 20)
+
+# header field offsets
+HDR_NAME        = slice(0, 100)
+HDR_SIZE        = slice(124, 136)
+HDR_CHKSUM      = slice(148, 156)
+HDR_TYPEFLAG    = 156
+HDR_LINKNAME    = slice(157, 257)
+HDR_MAGIC       = slice(257, 263)
+HDR_PREFIX      = slice(345, 500)
+# old GNU sparse format: extension blocks follow the header
+HDR_GNU_SPARSE_ISEXTENDED = 482
+EXT_GNU_SPARSE_ISEXTENDED = 504
+
+TYPE_SYMLINK    = ord('2')
+TYPE_GNU_LONGLINK = ord('K')
+TYPE_GNU_LONGNAME = ord('L')
+TYPE_PAX_HEADER = ord('x')
+TYPE_PAX_GLOBAL = ord('g')
+TYPE_GNU_SPARSE = ord('S')
+
+PAX_LINKPATH    = b'linkpath'
+PAX_PATH        = b'path'
+
+# ustar (POSIX) magic, the GNU format has no prefix field
+MAGIC_USTAR     = b'ustar\0'
+
+
+class TarStreamError(ValueError):
+    pass
+# --- end of TarStreamError ---
+
+
+class SymlinkPrefixRewriter(object):
+    """
+    Maps symlink targets (bytes) starting with link_root_src
+    to link_root_dst (see fix-symlinks.py), returns None if not affected.
+
+    link_root_src may also be a function that returns the prefix str
+    (or None), it gets called once when the first symlink is seen.
+    """
+
+    def __init__(self, link_root_src, link_root_dst='/'):
+        super().__init__()
+        self._link_root_src         = link_root_src
+        self.link_root_src          = None
+        self.link_root_src_prefix   = None
+        self.link_root_dst          = os.fsencode(link_root_dst)
+        self.link_root_dst_prefix   = self.link_root_dst.rstrip(b'/') + b'/'
+    # --- end of __init__ (...) ---
+
+    def _init_prefix(self):
+        link_root_src = self._link_root_src
+        self._link_root_src = None
+
+        if callable(link_root_src):
+            link_root_src = link_root_src()
+
+        if link_root_src:
+            self.link_root_src = os.fsencode(link_root_src)
+            self.link_root_src_prefix = self.link_root_src.rstrip(b'/') + b'/'
+        # --
+    # --- end of _init_prefix (...) ---
+
+    def __call__(self, link_target):
+        if self._link_root_src is not None:
+            self._init_prefix()
+
+        if self.link_root_src is None:
+            return None
+
+        elif link_target == self.link_root_src:
+            return self.link_root_dst
+
+        elif link_target.startswith(self.link_root_src_prefix):
+            link_target_rel_to_root = link_target[len(self.link_root_src_prefix):]
+            return (self.link_root_dst_prefix + link_target_rel_to_root)
+
+        else:
+            return None
+        # --
+    # --- end of __call__ (...) ---
+
+# --- end of SymlinkPrefixRewriter ---
+
+
+def read_exact(fh, size):
+    data = fh.read(size)
+
+    if len(data) != size:
+        # short read on pipes
+        parts = [data]
+        remaining = size - len(data)
+
+        while remaining > 0:
+            chunk = fh.read(remaining)
+            if not chunk:
+                raise TarStreamError('unexpected end of tar stream')
+            parts.append(chunk)
+            remaining -= len(chunk)
+        # --
+
+        data = b''.join(parts)
+    # --
+
+    return data
+# --- end of read_exact (...) ---
+
+
+def get_padded_size(size):
+    return ((size + BLOCKSIZE - 1) // BLOCKSIZE) * BLOCKSIZE
+# --- end of get_padded_size (...) ---
+
+
+def parse_size_field(field):
+    if field[0] & 0x80:
+        # base-256 (GNU), positive values only
+        return int.from_bytes(field[1:], 'big')
+    # --
+
+    value = bytes(field).strip(b'\0 ')
+    return (int(value, 8) if value else 0)
+# --- end of parse_size_field (...) ---
+
+
+def set_size_field(hdr, size):
+    hdr[HDR_SIZE] = b'%011o\0' % size
+# --- end of set_size_field (...) ---
+
+
+def update_chksum(hdr):
+    hdr[HDR_CHKSUM] = b' ' * 8
+    hdr[HDR_CHKSUM] = b'%06o\0 ' % sum(hdr)
+# --- end of update_chksum (...) ---
+
+
+def get_str_field(field):
+    return bytes(field).split(b'\0', 1)[0]
+# --- end of get_str_field (...) ---
+
+
+def set_str_field(hdr, field_slice, value):
+    size = field_slice.stop - field_slice.start
+    hdr[field_slice] = value[:size].ljust(size, b'\0')
+# --- end of set_str_field (...) ---
+
+
+def parse_pax_records(data):
+    """
+    Returns the list of (key, value) records of a pax extended header.
+    """
+    records = []
+    pos     = 0
+    end     = len(data)
+
+    while pos < end and data[pos] != 0:
+        sep = data.index(b' ', pos)
+        length = int(data[pos:sep])
+        if length <= 0:
+            raise TarStreamError('invalid pax record length', length)
+
+        key, eq, value = data[sep + 1:pos + length - 1].partition(b'=')
+        records.append((key, value))
+
+        pos += length
+    # --
+
+    return records
+# --- end of parse_pax_records (...) ---
+
+
+def format_pax_record(key, value):
+    payload = b' ' + key + b'=' + value + b'\n'
+
+    # length includes its own digits
+    length = len(payload) + 1
+    while len(payload) + len(str(length)) != length:
+        length = len(payload) + len(str(length))
+
+    return str(length).encode('ascii') + payload
+# --- end of format_pax_record (...) ---
+
+
+def create_ext_header(base_hdr, typeflag, data):
+    """
+    Creates an extended header ('x' or 'K') preceding the entry base_hdr,
+    returns the header + padded data blocks.
+    """
+    hdr = bytearray(base_hdr)
+    if typeflag == TYPE_GNU_LONGLINK:
+        set_str_field(hdr, HDR_NAME, b'././@LongLink')
+    else:
+        set_str_field(hdr, HDR_NAME, b'././@PaxHeader')
+
+    hdr[HDR_TYPEFLAG] = typeflag
+    set_str_field(hdr, HDR_LINKNAME, b'')
+    set_size_field(hdr, len(data))
+    update_chksum(hdr)
+
+    return bytes(hdr) + data.ljust(get_padded_size(len(data)), b'\0')
+# --- end of create_ext_header (...) ---
+
+
+class TarStreamFilter(object):
+    """
+    Copies a tar stream from infh to outfh,
+    rewriting symlink targets with rewrite_link (bytes -> bytes or None).
+    """
+
+    def __init__(self, infh, outfh, rewrite_link):
+        super().__init__()
+        self.infh           = infh
+        self.outfh          = outfh
+        self.rewrite_link   = rewrite_link
+        self.num_rewritten  = 0
+    # --- end of __init__ (...) ---
+
+    def read_exact(self, size):
+        return read_exact(self.infh, size)
+    # --- end of read_exact (...) ---
+
+    def copy_bytes(self, size):
+        while size > 0:
+            chunk = self.infh.read(min(size, COPY_BUFSIZE))
+            if not chunk:
+                raise TarStreamError('unexpected end of tar stream')
+
+            self.outfh.write(chunk)
+            size -= len(chunk)
+        # --
+    # --- end of copy_bytes (...) ---
+
+    def copy_remainder(self):
+        while True:
+            chunk = self.infh.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            self.outfh.write(chunk)
+        # --
+    # --- end of copy_remainder (...) ---
+
+    def run(self):
+        # extended headers ('x', 'K', 'L') of the next entry: [hdr, data]
+        pending = []
+
+        while True:
+            hdr = self.infh.read(BLOCKSIZE)
+
+            if not hdr:
+                # no end-of-archive marker
+                break
+
+            elif len(hdr) != BLOCKSIZE:
+                hdr += self.read_exact(BLOCKSIZE - len(hdr))
+            # --
+
+            if hdr == ZERO_BLOCK:
+                # end of archive, copy zero blocks and padding as-is
+                self.outfh.write(hdr)
+                self.copy_remainder()
+                break
+            # --
+
+            typeflag = hdr[HDR_TYPEFLAG]
+            size     = parse_size_field(hdr[HDR_SIZE])
+
+            if typeflag in (TYPE_PAX_HEADER, TYPE_GNU_LONGLINK, TYPE_GNU_LONGNAME):
+                pending.append([hdr, self.read_exact(get_padded_size(size))])
+                continue
+
+            elif typeflag == TYPE_SYMLINK:
+                hdr = self.rewrite_symlink_entry(hdr, pending)
+            # --
+
+            for ext_hdr, ext_data in pending:
+                self.outfh.write(ext_hdr)
+                self.outfh.write(ext_data)
+            pending.clear()
+
+            self.outfh.write(hdr)
+
+            if typeflag == TYPE_GNU_SPARSE and hdr[HDR_GNU_SPARSE_ISEXTENDED]:
+                while True:
+                    ext_block = self.read_exact(BLOCKSIZE)
+                    self.outfh.write(ext_block)
+                    if not ext_block[EXT_GNU_SPARSE_ISEXTENDED]:
+                        break
+            # --
+
+            self.copy_bytes(get_padded_size(size))
+        # --
+
+        if pending:
+            raise TarStreamError('unexpected end of tar stream')
+    # --- end of run (...) ---
+
+    def rewrite_symlink_entry(self, hdr, pending):
+        """
+        Rewrites the link target of a symlink entry (header + pending
+        extended headers, modified in-place). Returns the new header.
+        """
+        rewrite_link    = self.rewrite_link
+        # whether the link target is stored in an extended header
+        has_long_link   = False
+        changed         = False
+
+        # pax 'linkpath' takes precedence over 'K' and the header field
+        for item in pending:
+            ext_hdr, ext_data = item
+            ext_type = ext_hdr[HDR_TYPEFLAG]
+
+            if ext_type == TYPE_PAX_HEADER:
+                ext_size = parse_size_field(ext_hdr[HDR_SIZE])
+                records  = parse_pax_records(ext_data[:ext_size])
+                records_changed = False
+
+                for k, (key, value) in enumerate(records):
+                    if key == PAX_LINKPATH:
+                        has_long_link = True
+                        value_new = rewrite_link(value)
+                        if value_new is not None:
+                            records[k] = (key, value_new)
+                            records_changed = True
+                # --
+
+                if records_changed:
+                    changed = True
+                    data = b''.join((format_pax_record(key, value) for key, value in records))
+                    item[0] = self.update_ext_header(ext_hdr, len(data))
+                    item[1] = data.ljust(get_padded_size(len(data)), b'\0')
+                # --
+
+            elif ext_type == TYPE_GNU_LONGLINK:
+                ext_size = parse_size_field(ext_hdr[HDR_SIZE])
+                value    = get_str_field(ext_data[:ext_size])
+                value_new = rewrite_link(value)
+                has_long_link = True
+
+                if value_new is not None:
+                    changed = True
+                    data = value_new + b'\0'
+                    item[0] = self.update_ext_header(ext_hdr, len(data))
+                    item[1] = data.ljust(get_padded_size(len(data)), b'\0')
+                # --
+            # --
+        # --
+
+        linkname     = get_str_field(hdr[HDR_LINKNAME])
+        linkname_new = rewrite_link(linkname)
+
+        if linkname_new is None or (has_long_link and not changed):
+            # (header field holds a truncated copy of the long link target)
+            if changed:
+                self.num_rewritten += 1
+            return hdr
+        # --
+
+        self.num_rewritten += 1
+
+        hdr = bytearray(hdr)
+        set_str_field(hdr, HDR_LINKNAME, linkname_new)
+        update_chksum(hdr)
+
+        if not has_long_link and len(linkname_new) > (HDR_LINKNAME.stop - HDR_LINKNAME.start):
+            # new link target does not fit into the header field
+            if bytes(hdr[HDR_MAGIC]) == b'ustar ':
+                # GNU format
+                pending.append(
+                    self.split_ext_block(
+                        create_ext_header(hdr, TYPE_GNU_LONGLINK, (linkname_new + b'\0'))
+                    )
+                )
+            else:
+                pending.append(
+                    self.split_ext_block(
+                        create_ext_header(
+                            hdr, TYPE_PAX_HEADER,
+                            format_pax_record(PAX_LINKPATH, linkname_new)
+                        )
+                    )
+                )
+            # --
+        # --
+
+        return bytes(hdr)
+    # --- end of rewrite_symlink_entry (...) ---
+
+    def update_ext_header(self, ext_hdr, size):
+        ext_hdr = bytearray(ext_hdr)
+        set_size_field(ext_hdr, size)
+        update_chksum(ext_hdr)
+        return bytes(ext_hdr)
+    # --- end of update_ext_header (...) ---
+
+    def split_ext_block(self, block):
+        return [block[:BLOCKSIZE], block[BLOCKSIZE:]]
+    # --- end of split_ext_block (...) ---
+
+# --- end of TarStreamFilter ---
+
+
+def get_entry_path(hdr, pending):
+    """
+    Returns the path (bytes) of an entry, given its header
+    and the list of pending extended headers ([hdr, data]).
+    """
+    path = None
+
+    for ext_hdr, ext_data in pending:
+        ext_type = ext_hdr[HDR_TYPEFLAG]
+        ext_size = parse_size_field(ext_hdr[HDR_SIZE])
+
+        if ext_type == TYPE_PAX_HEADER:
+            # skip parsing records if there is no path record for sure
+            if (PAX_PATH + b'=') in ext_data:
+                for key, value in parse_pax_records(ext_data[:ext_size]):
+                    if key == PAX_PATH:
+                        return value
+            # --
+
+        elif ext_type == TYPE_GNU_LONGNAME:
+            path = get_str_field(ext_data[:ext_size])
+        # --
+    # --
+
+    if path is not None:
+        return path
+
+    name = get_str_field(hdr[HDR_NAME])
+
+    if bytes(hdr[HDR_MAGIC]) == MAGIC_USTAR:
+        prefix = get_str_field(hdr[HDR_PREFIX])
+        if prefix:
+            return prefix + b'/' + name
+    # --
+
+    return name
+# --- end of get_entry_path (...) ---
+
+
+class TarStreamSplitter(object):
+    """
+    Splits a tar stream from infh into several tar streams.
+
+    Each entry (including its extended headers) gets copied as-is
+    to outfhs[get_index(path)], where path is the entry's path (bytes).
+    Global pax headers are copied to all outputs,
+    and each output gets terminated with an end-of-archive marker.
+
+    With use_splice, file data is moved with splice(2) without copying
+    it to userspace. infh must then be unbuffered, e.g. open(..., buffering=0),
+    and either infh or the outputs must be pipes.
+    """
+
+    def __init__(self, infh, outfhs, get_index, use_splice=False):
+        super().__init__()
+        self.infh       = infh
+        self.outfhs     = outfhs
+        self.get_index  = get_index
+        self.use_splice = use_splice
+    # --- end of __init__ (...) ---
+
+    def read_exact(self, size):
+        return read_exact(self.infh, size)
+    # --- end of read_exact (...) ---
+
+    def copy_bytes(self, outfh, size):
+        if self.use_splice:
+            outfh.flush()
+
+            in_fd  = self.infh.fileno()
+            out_fd = outfh.fileno()
+
+            while size > 0:
+                num_copied = os.splice(in_fd, out_fd, size)
+                if not num_copied:
+                    raise TarStreamError('unexpected end of tar stream')
+
+                size -= num_copied
+            # --
+
+            return
+        # --
+
+        while size > 0:
+            chunk = self.infh.read(min(size, COPY_BUFSIZE))
+            if not chunk:
+                raise TarStreamError('unexpected end of tar stream')
+
+            outfh.write(chunk)
+            size -= len(chunk)
+        # --
+    # --- end of copy_bytes (...) ---
+
+    def run(self):
+        # extended headers ('x', 'K', 'L') of the next entry: [hdr, data]
+        pending = []
+
+        while True:
+            hdr = self.infh.read(BLOCKSIZE)
+
+            if not hdr:
+                # no end-of-archive marker
+                break
+
+            elif len(hdr) != BLOCKSIZE:
+                hdr += self.read_exact(BLOCKSIZE - len(hdr))
+            # --
+
+            if hdr == ZERO_BLOCK:
+                # end of archive, drain input
+                while self.infh.read(COPY_BUFSIZE):
+                    pass
+                break
+            # --
+
+            typeflag = hdr[HDR_TYPEFLAG]
+            size     = parse_size_field(hdr[HDR_SIZE])
+
+            if typeflag in (TYPE_PAX_HEADER, TYPE_GNU_LONGLINK, TYPE_GNU_LONGNAME):
+                pending.append([hdr, self.read_exact(get_padded_size(size))])
+                continue
+
+            elif typeflag == TYPE_PAX_GLOBAL:
+                data = self.read_exact(get_padded_size(size))
+                for outfh in self.outfhs:
+                    outfh.write(hdr)
+                    outfh.write(data)
+                continue
+            # --
+
+            outfh = self.outfhs[self.get_index(get_entry_path(hdr, pending))]
+
+            for ext_hdr, ext_data in pending:
+                outfh.write(ext_hdr)
+                outfh.write(ext_data)
+            pending.clear()
+
+            outfh.write(hdr)
+
+            if typeflag == TYPE_GNU_SPARSE and hdr[HDR_GNU_SPARSE_ISEXTENDED]:
+                while True:
+                    ext_block = self.read_exact(BLOCKSIZE)
+                    outfh.write(ext_block)
+                    if not ext_block[EXT_GNU_SPARSE_ISEXTENDED]:
+                        break
+            # --
+
+            self.copy_bytes(outfh, get_padded_size(size))
+        # --
+
+        if pending:
+            raise TarStreamError('unexpected end of tar stream')
+
+        for outfh in self.outfhs:
+            outfh.write(ZERO_BLOCK)
+            outfh.write(ZERO_BLOCK)
+    # --- end of run (...) ---
+
+# --- end of TarStreamSplitter ---
+
+
+def filter_tar_stream_symlinks(infh, outfh, link_root_src, link_root_dst='/'):
+    """
+    Copies a tar stream, rewriting symlink targets (see SymlinkPrefixRewriter).
+    Returns the number of rewritten link targets.
+    """
+    tar_filter = TarStreamFilter(
+        infh, outfh, SymlinkPrefixRewriter(link_root_src, link_root_dst)
+    )
+    tar_filter.run()
+    return tar_filter.num_rewritten
+# --- end of filter_tar_stream_symlinks (...) ---
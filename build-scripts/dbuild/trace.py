@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+#
+#  Build traces: spans with parent/child relationships,
+#  exported in Chrome trace-event format (chrome://tracing, Perfetto)
+#  and as text report.
+#
+#  Spans get appended as JSON lines to a trace file shared by all
+#  processes of a build. Child processes pick up the trace file
+#  and their parent span from the environment:
+#
+#    DBUILD_TRACE_FILE      -- trace file (JSON lines)
+#    DBUILD_TRACE_PARENT    -- id of the parent span
+#
+#  Additionally, the generated hook scripts record per-block timing
+#  (see dbuild_trace_begin/dbuild_trace_end in share/hooks/functions.sh)
+#  as tab-separated lines:
+#
+#    phase category collection name t_begin_ns t_end_ns rc cpu_begin cpu_end
+#
+#  with cpu_begin/cpu_end being 'times' output ("<m>m<s>s <m>m<s>s",
+#  user and system time of terminated child processes).
+#
+
+import collections
+import contextlib
+import json
+import os
+import re
+import time
+
+
+RE_TIMES_VALUE = re.compile(r'^(?P<min>[0-9]+)m(?P<sec>[0-9]+(?:[.,][0-9]*)?)s$')
+
+
+class Span(object):
+
+    def __init__(
+        self, span_id, parent_id, name, category='step', attrs=None,
+        t_begin_ns=None, t_end_ns=None, pid=None, process=None, status=None
+    ):
+        super().__init__()
+        self.span_id    = span_id
+        self.parent_id  = parent_id
+        self.name       = name
+        self.category   = category
+        self.attrs      = (dict(attrs) if attrs else {})
+        self.t_begin_ns = t_begin_ns
+        self.t_end_ns   = t_end_ns
+        self.pid        = pid
+        self.process    = process
+        self.status     = status
+    # --- end of __init__ (...) ---
+
+    def set_attr(self, key, value):
+        self.attrs[key] = value
+    # --- end of set_attr (...) ---
+
+    def get_duration_ns(self):
+        return (self.t_end_ns - self.t_begin_ns)
+    # --- end of get_duration_ns (...) ---
+
+    def get_overlap_ns(self, t_begin_ns, t_end_ns):
+        return max(0, (min(self.t_end_ns, t_end_ns) - max(self.t_begin_ns, t_begin_ns)))
+    # --- end of get_overlap_ns (...) ---
+
+    def to_dict(self):
+        return {
+            'id'        : self.span_id,
+            'parent'    : self.parent_id,
+            'name'      : self.name,
+            'cat'       : self.category,
+            'begin_ns'  : self.t_begin_ns,
+            'end_ns'    : self.t_end_ns,
+            'pid'       : self.pid,
+            'process'   : self.process,
+            'status'    : self.status,
+            'attrs'     : self.attrs,
+        }
+    # --- end of to_dict (...) ---
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            span_id     = data['id'],
+            parent_id   = data.get('parent'),
+            name        = data['name'],
+            category    = data.get('cat', 'step'),
+            attrs       = data.get('attrs'),
+            t_begin_ns  = data['begin_ns'],
+            t_end_ns    = data['end_ns'],
+            pid         = data.get('pid'),
+            process     = data.get('process'),
+            status      = data.get('status'),
+        )
+    # --- end of from_dict (...) ---
+
+# --- end of Span ---
+
+
+class SpanTracer(object):
+    """
+    Records spans to a trace file (JSON lines).
+    A tracer without trace file does nothing, so that callers
+    do not need to check whether tracing is enabled.
+
+    Spans get written on end(), so the trace file contains
+    children before their parents.
+    """
+
+    ENV_FILE    = 'DBUILD_TRACE_FILE'
+    ENV_PARENT  = 'DBUILD_TRACE_PARENT'
+
+    def __init__(self, outfile, process_name, parent_id=None):
+        super().__init__()
+        self.outfile        = (str(outfile) if outfile else None)
+        self.process_name   = process_name
+        self.parent_id      = parent_id
+        self._stack         = []
+        self._step          = None
+    # --- end of __init__ (...) ---
+
+    @classmethod
+    def from_env(cls, process_name, environ=None):
+        if environ is None:
+            environ = os.environ
+
+        return cls(
+            (environ.get(cls.ENV_FILE) or None),
+            process_name,
+            parent_id=(environ.get(cls.ENV_PARENT) or None)
+        )
+    # --- end of from_env (...) ---
+
+    @property
+    def enabled(self):
+        return bool(self.outfile)
+
+    def get_current_id(self):
+        return (self._stack[-1].span_id if self._stack else self.parent_id)
+    # --- end of get_current_id (...) ---
+
+    def get_env(self):
+        """
+        Returns environment vars for passing the trace file
+        and the current span to a child process.
+        """
+        if not self.enabled:
+            return {}
+
+        env = {self.ENV_FILE: self.outfile}
+
+        current_id = self.get_current_id()
+        if current_id:
+            env[self.ENV_PARENT] = current_id
+
+        return env
+    # --- end of get_env (...) ---
+
+    def begin(self, name, category='step', **attrs):
+        span = Span(
+            os.urandom(8).hex(), self.get_current_id(), name,
+            category=category, attrs=attrs,
+            t_begin_ns=time.time_ns(),
+            pid=os.getpid(), process=self.process_name
+        )
+
+        self._stack.append(span)
+        return span
+    # --- end of begin (...) ---
+
+    def end(self, span, status='ok'):
+        span.t_end_ns = time.time_ns()
+        span.status   = status
+
+        # also closes unfinished child spans
+        while self._stack:
+            top = self._stack.pop()
+            if top is span:
+                break
+
+            top.t_end_ns = span.t_end_ns
+            top.status   = status
+            self.write(top)
+        # --
+
+        self.write(span)
+        return span
+    # --- end of end (...) ---
+
+    @contextlib.contextmanager
+    def span(self, name, category='step', **attrs):
+        span = self.begin(name, category, **attrs)
+
+        try:
+            yield span
+        except BaseException:
+            self.end(span, status='error')
+            raise
+        else:
+            self.end(span)
+    # --- end of span (...) ---
+
+    def step(self, name, category='step', **attrs):
+        """
+        Ends the previous step (if any) and begins a new one,
+        for sequences of steps without explicit nesting.
+        """
+        self.end_step()
+        self._step = self.begin(name, category, **attrs)
+        return self._step
+    # --- end of step (...) ---
+
+    def end_step(self, status='ok'):
+        if self._step is not None:
+            step, self._step = self._step, None
+            self.end(step, status=status)
+        # --
+    # --- end of end_step (...) ---
+
+    def write(self, span):
+        if not self.enabled:
+            return
+
+        # single write() in append mode:
+        # lines from concurrent processes do not get interleaved
+        data = (json.dumps(span.to_dict()) + '\n').encode('utf-8')
+
+        fd = os.open(self.outfile, (os.O_WRONLY | os.O_CREAT | os.O_APPEND), 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    # --- end of write (...) ---
+
+# --- end of SpanTracer ---
+
+
+class HookTraceRecord(object):
+
+    def __init__(
+        self, phase, category, collection, name,
+        t_begin_ns, t_end_ns, returncode, cpu_user, cpu_sys
+    ):
+        super().__init__()
+        self.phase      = phase
+        self.category   = category
+        self.collection = collection
+        self.name       = name
+        self.t_begin_ns = t_begin_ns
+        self.t_end_ns   = t_end_ns
+        self.returncode = returncode
+        self.cpu_user   = cpu_user
+        self.cpu_sys    = cpu_sys
+    # --- end of __init__ (...) ---
+
+# --- end of HookTraceRecord ---
+
+
+def parse_times_value(arg):
+    match = RE_TIMES_VALUE.match(arg)
+    if not match:
+        raise ValueError(arg)
+
+    return (60 * int(match.group('min'))) + float(match.group('sec').replace(',', '.'))
+# --- end of parse_times_value (...) ---
+
+
+def parse_times_pair(arg):
+    cpu_user, cpu_sys = arg.split()
+    return (parse_times_value(cpu_user), parse_times_value(cpu_sys))
+# --- end of parse_times_pair (...) ---
+
+
+def gen_read_hook_trace(filepath):
+    """
+    Reads hook trace records from filepath.
+    Incomplete lines (e.g. from an interrupted build) get skipped.
+    """
+    with open(filepath, 'rt') as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+
+            if len(fields) != 9:
+                continue
+
+            (
+                phase, category, collection, name,
+                t_begin_ns, t_end_ns, returncode, cpu_begin, cpu_end
+            ) = fields
+
+            try:
+                cpu_user_begin, cpu_sys_begin = parse_times_pair(cpu_begin)
+                cpu_user_end, cpu_sys_end = parse_times_pair(cpu_end)
+
+                yield HookTraceRecord(
+                    phase, category, collection, name,
+                    int(t_begin_ns), int(t_end_ns), int(returncode),
+                    max(0.0, (cpu_user_end - cpu_user_begin)),
+                    max(0.0, (cpu_sys_end - cpu_sys_begin)),
+                )
+            except ValueError:
+                continue
+        # -- end for
+    # -- end with
+# --- end of gen_read_hook_trace (...) ---
+
+
+def gen_read_spans(filepath):
+    """
+    Reads spans from a trace file (JSON lines)
+    or from a Chrome trace file created by write_chrome_trace().
+    """
+    with open(filepath, 'rt') as fh:
+        data = fh.read()
+
+    if data.lstrip().startswith('{"id"'):
+        for line in data.splitlines():
+            try:
+                yield Span.from_dict(json.loads(line))
+            except (ValueError, KeyError):
+                # incomplete line
+                continue
+        # -- end for
+
+    else:
+        for event in json.loads(data).get('traceEvents', []):
+            args = event.get('args') or {}
+            if event.get('ph') == 'X' and 'span_id' in args:
+                attrs = dict(args)
+                t_begin_ns = event['ts'] * 1000
+
+                yield Span(
+                    span_id     = attrs.pop('span_id'),
+                    parent_id   = attrs.pop('parent_id', None),
+                    name        = event['name'],
+                    category    = event.get('cat', 'step'),
+                    t_begin_ns  = t_begin_ns,
+                    t_end_ns    = t_begin_ns + (event['dur'] * 1000),
+                    pid         = event.get('pid'),
+                    process     = attrs.pop('process', None),
+                    status      = attrs.pop('status', None),
+                    attrs       = attrs,
+                )
+            # --
+        # -- end for
+    # --
+# --- end of gen_read_spans (...) ---
+
+
+def find_innermost_span(spans, t_begin_ns, t_end_ns, min_overlap=0.9):
+    """
+    Returns the shortest span covering (most of) the given time interval.
+
+    Spans derived from progress output begin slightly late,
+    hence the interval does not need to be contained completely.
+    """
+    best = None
+    min_overlap_ns = min_overlap * (t_end_ns - t_begin_ns)
+
+    for span in spans:
+        if (
+            span.t_begin_ns <= t_end_ns and t_begin_ns <= span.t_end_ns
+            and span.get_overlap_ns(t_begin_ns, t_end_ns) >= min_overlap_ns
+            and (best is None or span.get_duration_ns() < best.get_duration_ns())
+        ):
+            best = span
+    # --
+
+    return best
+# --- end of find_innermost_span (...) ---
+
+
+def gen_hook_trace_spans(records, spans):
+    """
+    Converts hook trace records to spans:
+    one span per hook phase, with nested spans per block.
+
+    Phase spans get attached to the innermost of the given spans
+    containing them (i.e. the mmdebstrap run).
+    """
+    records = list(records)
+    phase_spans = collections.OrderedDict()
+
+    for record in records:
+        span = phase_spans.get(record.phase)
+
+        if span is None:
+            phase_spans[record.phase] = Span(
+                os.urandom(8).hex(), None, f'{record.phase}.sh',
+                category='phase', attrs={'phase': record.phase},
+                t_begin_ns=record.t_begin_ns, t_end_ns=record.t_end_ns,
+                status='ok'
+            )
+        else:
+            span.t_begin_ns = min(span.t_begin_ns, record.t_begin_ns)
+            span.t_end_ns   = max(span.t_end_ns, record.t_end_ns)
+        # --
+    # -- end for
+
+    for phase_span in phase_spans.values():
+        parent = find_innermost_span(spans, phase_span.t_begin_ns, phase_span.t_end_ns)
+        if parent is not None:
+            phase_span.parent_id = parent.span_id
+            phase_span.pid       = parent.pid
+            phase_span.process   = parent.process
+        # --
+
+        yield phase_span
+    # -- end for
+
+    for record in records:
+        phase_span = phase_spans[record.phase]
+
+        yield Span(
+            os.urandom(8).hex(), phase_span.span_id,
+            f'{record.collection} // {record.name}',
+            category=record.category,
+            attrs={
+                'phase'         : record.phase,
+                'collection'    : record.collection,
+                'returncode'    : record.returncode,
+                'cpu_user_s'    : round(record.cpu_user, 6),
+                'cpu_sys_s'     : round(record.cpu_sys, 6),
+            },
+            t_begin_ns=record.t_begin_ns, t_end_ns=record.t_end_ns,
+            pid=phase_span.pid, process=phase_span.process,
+            status=('ok' if record.returncode == 0 else 'error')
+        )
+    # -- end for
+# --- end of gen_hook_trace_spans (...) ---
+
+
+def gen_chrome_trace_events(spans):
+    process_names = {}
+
+    for span in spans:
+        if span.pid is not None and span.process:
+            process_names.setdefault(span.pid, span.process)
+
+        args = dict(span.attrs)
+        args['span_id'] = span.span_id
+
+        if span.parent_id:
+            args['parent_id'] = span.parent_id
+        if span.process:
+            args['process'] = span.process
+        if span.status:
+            args['status'] = span.status
+
+        yield {
+            'name'  : span.name,
+            'cat'   : span.category,
+            'ph'    : 'X',
+            'ts'    : (span.t_begin_ns // 1000),
+            'dur'   : (span.get_duration_ns() // 1000),
+            'pid'   : (span.pid or 0),
+            'tid'   : 1,
+            'args'  : args,
+        }
+    # -- end for
+
+    for pid, process_name in process_names.items():
+        yield {
+            'name'  : 'process_name',
+            'ph'    : 'M',
+            'pid'   : pid,
+            'args'  : {'name': f'{process_name} ({pid})'},
+        }
+    # -- end for
+# --- end of gen_chrome_trace_events (...) ---
+
+
+def write_chrome_trace(outfile, spans):
+    with open(outfile, 'wt') as fh:
+        json.dump(
+            {
+                'traceEvents'       : list(gen_chrome_trace_events(spans)),
+                'displayTimeUnit'   : 'ms',
+            },
+            fh, indent=1
+        )
+        fh.write('\n')
+    # --
+# --- end of write_chrome_trace (...) ---
+
+
+def format_seconds(seconds):
+    if seconds >= 60:
+        return '{:d}m{:04.1f}s'.format(int(seconds // 60), (seconds % 60))
+    else:
+        return f'{seconds:.2f}s'
+# --- end of format_seconds (...) ---
+
+
+def gen_span_report(spans, bar_width=20):
+    """
+    Generates a flame-style text report:
+    spans aggregated by their path of names from the root span,
+    with total time, self time (not covered by child spans) and count.
+    """
+    spans = sorted(spans, key=lambda s: s.t_begin_ns)
+    span_map = {span.span_id: span for span in spans}
+
+    children = collections.defaultdict(list)
+    roots = []
+
+    for span in spans:
+        if span.parent_id and span.parent_id in span_map:
+            children[span.parent_id].append(span)
+        else:
+            roots.append(span)
+    # --
+
+    # path -> [total_ns, self_ns, count], ordered by first occurrence
+    nodes = collections.OrderedDict()
+
+    def visit(span, parent_path):
+        path = parent_path + (span.name,)
+        child_spans = children.get(span.span_id, [])
+
+        node = nodes.setdefault(path, [0, 0, 0])
+        node[0] += span.get_duration_ns()
+        node[1] += max(
+            0, (span.get_duration_ns() - sum((c.get_duration_ns() for c in child_spans)))
+        )
+        node[2] += 1
+
+        for child in child_spans:
+            visit(child, path)
+    # --- end of visit (...) ---
+
+    for span in roots:
+        visit(span, ())
+
+    max_total = max((node[0] for path, node in nodes.items() if len(path) == 1), default=0)
+
+    yield '{:>9} {:>9} {:>5}  {:<{w}}  {}'.format(
+        'TOTAL', 'SELF', 'COUNT', '', 'SPAN', w=bar_width
+    )
+
+    for path, (total_ns, self_ns, count) in nodes.items():
+        bar_len = (round(bar_width * total_ns / max_total) if max_total else 0)
+
+        yield '{:>9} {:>9} {:>5}  {:<{w}}  {}{}'.format(
+            format_seconds(total_ns / 1e9),
+            format_seconds(self_ns / 1e9),
+            count,
+            ('#' * bar_len),
+            ('  ' * (len(path) - 1)),
+            path[-1],
+            w=bar_width
+        )
+    # -- end for
+# --- end of gen_span_report (...) ---
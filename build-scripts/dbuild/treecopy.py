@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+#
+#  Copying of a rootfs directory tree to another location,
+#  e.g. a rootfs left in staging by build-image (target format 'dir')
+#  to the mounted disk image (convert-tar-to-disk).
+#
+#  File data gets copied in-kernel, trying in order:
+#  reflink (FICLONE, same filesystem), copy_file_range(2) and sendfile(2).
+#  A method that is not supported for a destination filesystem
+#  does not get tried again for that filesystem.
+#
+#  Ownership, modes, device nodes, xattrs and hardlinks are taken
+#  from a metadata file (JSON lines, see rootscan.MetadataVisitor) if given.
+#  It gets recorded through fakeroot in the build environment,
+#  where the files on disk are owned by the building user.
+#  Without metadata file, the source tree's own metadata is used.
+#
+#  Files listed in the metadata file that do not exist in the source tree
+#  (e.g. removed by mmdebstrap's cleanup) are skipped,
+#  whereas files without metadata are an error.
+#
+
+import base64
+import errno
+import fcntl
+import json
+import os
+import stat
+
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors indicating that a copy method is not available (try next)
+COPY_METHOD_ERRNOS = frozenset({
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+})
+
+COPY_METHODS = ('reflink', 'copy_file_range', 'sendfile')
+
+# metadata file of <rootfs dir>: <rootfs dir>.meta.jsonl
+METADATA_FILE_SUFFIX = '.meta.jsonl'
+
+
+class TreeCopyError(ValueError):
+    pass
+# --- end of TreeCopyError ---
+
+
+def get_metadata_file(rootfs_dir):
+    """
+    Returns the path of the rootfs dir's metadata file
+    or None if there is none.
+    """
+    filepath = os.fspath(rootfs_dir).rstrip('/') + METADATA_FILE_SUFFIX
+
+    return (filepath if os.path.isfile(filepath) else None)
+# --- end of get_metadata_file (...) ---
+
+
+def load_metadata(filepath):
+    """
+    Reads a metadata file and returns a dict path -> metadata dict.
+    """
+    metadata = {}
+
+    with open(filepath, 'rt') as fh:
+        for line in fh:
+            item = json.loads(line)
+
+            xattrs = item.get('xattrs')
+            if xattrs:
+                item['xattrs'] = {
+                    name: base64.b64decode(value) for name, value in xattrs.items()
+                }
+            # --
+
+            metadata[item['path']] = item
+        # --
+    # --
+
+    return metadata
+# --- end of load_metadata (...) ---
+
+
+def get_stat_metadata(fpath, relpath, st, inode_map):
+    """
+    Returns the metadata dict of a source file (no metadata file given).
+    inode_map is used for detecting hardlinks.
+    """
+    item = {
+        'path'      : relpath,
+        'mode'      : st.st_mode,
+        'uid'       : st.st_uid,
+        'gid'       : st.st_gid,
+        'mtime_ns'  : st.st_mtime_ns,
+    }
+
+    if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+        item['rdev'] = st.st_rdev
+
+    elif stat.S_ISLNK(st.st_mode):
+        return item
+
+    elif st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+        link = inode_map.setdefault((st.st_dev, st.st_ino), relpath)
+        if link != relpath:
+            item['link'] = link
+    # --
+
+    xattrs = {
+        name: os.getxattr(fpath, name, follow_symlinks=False)
+        for name in os.listxattr(fpath, follow_symlinks=False)
+    }
+    if xattrs:
+        item['xattrs'] = xattrs
+
+    return item
+# --- end of get_stat_metadata (...) ---
+
+
+class TreeCopier(object):
+    """
+    Copies the tree at src_root to dst_root (which may already exist,
+    along with mountpoint directories below it).
+
+    Hardlinks get recreated as hardlinks, sockets are skipped (as with tar).
+    """
+
+    def __init__(self, src_root, dst_root, metadata=None):
+        super().__init__()
+        self.src_root       = os.fspath(src_root)
+        self.dst_root       = os.fspath(dst_root)
+        self.metadata       = metadata
+        # hardlink path -> dst path of the file created first
+        self.link_map       = {}
+        # (st_dev, st_ino) -> first path, detecting hardlinks without metadata
+        self.inode_map      = {}
+        # dst device -> list of copy methods to try
+        self.copy_methods   = {}
+        self.num_files      = 0
+        self.num_bytes      = 0
+    # --- end of __init__ (...) ---
+
+    def get_metadata(self, fpath, relpath, st):
+        if self.metadata is None:
+            return get_stat_metadata(fpath, relpath, st, self.inode_map)
+
+        try:
+            return self.metadata[relpath]
+        except KeyError:
+            raise TreeCopyError('no metadata for file', relpath) from None
+    # --- end of get_metadata (...) ---
+
+    def run(self):
+        src_root = self.src_root  # ref
+        dst_root = self.dst_root  # ref
+
+        item = self.get_metadata(src_root, '/', os.lstat(src_root))
+
+        os.makedirs(dst_root, exist_ok=True)
+        self.copy_dir(src_root, dst_root, '')
+        self.apply_metadata(dst_root, item)
+    # --- end of run (...) ---
+
+    def copy_dir(self, src_dir, dst_dir, dir_relpath):
+        dst_dev = os.lstat(dst_dir).st_dev
+
+        with os.scandir(src_dir) as dir_it:
+            entries = sorted(dir_it, key=lambda entry: entry.name)
+
+        for entry in entries:
+            relpath = f'{dir_relpath}/{entry.name}'
+            dst     = os.path.join(dst_dir, entry.name)
+            st      = entry.stat(follow_symlinks=False)
+            item    = self.get_metadata(entry.path, relpath, st)
+            mode    = item['mode']
+
+            if stat.S_ISDIR(mode):
+                try:
+                    os.mkdir(dst, 0o700)
+                except FileExistsError:
+                    # mountpoint
+                    if not os.path.isdir(dst):
+                        raise
+                # --
+
+                self.copy_dir(entry.path, dst, relpath)
+
+            elif stat.S_ISREG(mode):
+                link = item.get('link', relpath)
+                link_dst = self.link_map.get(link)
+
+                if link_dst is not None:
+                    os.link(link_dst, dst)
+                    # metadata has been applied already
+                    continue
+                # --
+
+                self.copy_file(entry.path, dst, st.st_size, dst_dev)
+
+                if 'link' in item or st.st_nlink > 1:
+                    self.link_map[link] = dst
+
+            elif stat.S_ISLNK(mode):
+                os.symlink(os.readlink(entry.path), dst)
+
+            elif stat.S_ISSOCK(mode):
+                continue
+
+            else:
+                # char/block device, fifo
+                os.mknod(dst, (stat.S_IFMT(mode) | 0o600), item.get('rdev', 0))
+            # --
+
+            self.apply_metadata(dst, item)
+        # --
+    # --- end of copy_dir (...) ---
+
+    def copy_file(self, src, dst, size, dst_dev):
+        methods = self.copy_methods.setdefault(dst_dev, list(COPY_METHODS))
+
+        src_fd = os.open(src, (os.O_RDONLY | os.O_NOFOLLOW))
+        try:
+            dst_fd = os.open(
+                dst, (os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW), 0o600
+            )
+            try:
+                if size:
+                    self.copy_file_data(src_fd, dst_fd, size, methods)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+        self.num_files += 1
+        self.num_bytes += size
+    # --- end of copy_file (...) ---
+
+    def copy_file_data(self, src_fd, dst_fd, size, methods):
+        for method in list(methods):
+            try:
+                if method == 'reflink':
+                    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                    return
+
+                elif method == 'copy_file_range':
+                    copy_fd_range(os.copy_file_range, src_fd, dst_fd, size)
+                    return
+
+                else:
+                    copy_fd_range(os.sendfile, src_fd, dst_fd, size)
+                    return
+                # --
+
+            except OSError as err:
+                if err.errno not in COPY_METHOD_ERRNOS or method == COPY_METHODS[-1]:
+                    raise
+
+                methods.remove(method)
+
+                # restart from the beginning
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+            # --
+        # --
+    # --- end of copy_file_data (...) ---
+
+    def apply_metadata(self, dst, item):
+        mode = item['mode']
+
+        os.chown(dst, item['uid'], item['gid'], follow_symlinks=False)
+
+        if not stat.S_ISLNK(mode):
+            # after chown(), which clears setuid/setgid bits
+            os.chmod(dst, stat.S_IMODE(mode))
+
+            for name, value in item.get('xattrs', {}).items():
+                os.setxattr(dst, name, value, follow_symlinks=False)
+        # --
+
+        # directories: after copying their contents
+        mtime_ns = item['mtime_ns']
+        os.utime(dst, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+    # --- end of apply_metadata (...) ---
+
+# --- end of TreeCopier ---
+
+
+def copy_fd_range(copy_func, src_fd, dst_fd, size):
+    """
+    Copies size bytes from src_fd to dst_fd (at their current offsets)
+    with os.copy_file_range() or os.sendfile().
+    """
+    while size > 0:
+        if copy_func is os.sendfile:
+            num_copied = os.sendfile(dst_fd, src_fd, None, size)
+        else:
+            num_copied = copy_func(src_fd, dst_fd, size)
+
+        if not num_copied:
+            raise TreeCopyError('unexpected end of file')
+
+        size -= num_copied
+    # --
+# --- end of copy_fd_range (...) ---
+
+
+def copy_tree(src_root, dst_root, metadata_file=None):
+    """
+    Copies a rootfs tree, see TreeCopier.
+    Returns the number of (regular) files and bytes copied.
+    """
+    copier = TreeCopier(
+        src_root, dst_root,
+        metadata=(load_metadata(metadata_file) if metadata_file else None)
+    )
+    copier.run()
+
+    return (copier.num_files, copier.num_bytes)
+# --- end of copy_tree (...) ---
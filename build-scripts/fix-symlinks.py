@@ -6,64 +6,53 @@
 #
 
 import argparse
-import itertools
 import os
-import pathlib
 import sys
 
+from dbuild.rootscan import RootfsScanner
+from dbuild.rootscan import SymlinkFixVisitor
+from dbuild.tarstream import filter_tar_stream_symlinks
+
 
 def main(prog, argv):
     arg_parser = main_get_arg_parser(prog)
     arg_config = arg_parser.parse_args(argv)
 
-    links_to_fix = {}
+    if arg_config.tar_stream:
+        if not arg_config.link_root_src or arg_config.target_rootfs:
+            arg_parser.error('--tar needs --from and no target_rootfs')
+
+        # tar stream mode: stdin -> stdout
+        num_rewritten = filter_tar_stream_symlinks(
+            sys.stdin.buffer, sys.stdout.buffer,
+            arg_config.link_root_src, arg_config.link_root_dest
+        )
+        sys.stdout.buffer.flush()
+
+        sys.stderr.write(f"{num_rewritten} symlink(s) rewritten\n")
+        return True
+
+    elif not arg_config.target_rootfs:
+        arg_parser.error('target_rootfs is required')
+    # --
 
     link_root_src = (
         (arg_config.link_root_src or arg_config.target_rootfs)
     )
-    link_root_src_prefix = link_root_src.rstrip('/') + '/'
-    link_root_src_prefixlen = len(link_root_src_prefix)
-
-    link_root_dst = arg_config.link_root_dest
-    link_root_dst_prefix = link_root_dst.rstrip('/') + '/'
 
-    for link_path in walk_target_rootfs_symlinks(arg_config.target_rootfs):
-        link_target = str(link_path.readlink())
+    scanner = RootfsScanner(arg_config.target_rootfs, jobs=arg_config.jobs)
 
-        if link_target == link_root_src:
-            link_target_new = link_root_dst
-            links_to_fix[link_path] = (link_target, link_root_dst)
-
-        elif link_target.startswith(link_root_src_prefix):
-            link_target_rel_to_root = link_target[link_root_src_prefixlen:]
+    fix_symlinks = scanner.add_visitor(
+        SymlinkFixVisitor(
+            link_root_src, arg_config.link_root_dest, dry_run=arg_config.dry_run
+        )
+    )
 
-            if link_target_rel_to_root:
-                link_target_new = link_root_dst_prefix + link_target_rel_to_root
-            else:
-                link_target_new = link_root_dst
-            # --
+    scanner.run()
 
-            links_to_fix[link_path] = (link_target, link_target_new)
-        # -- end if
+    for fpath, link_target_old, link_target_new in fix_symlinks.items:
+        print(f"{fpath}: {link_target_old} => {link_target_new}")
     # -- end for
-
-    if arg_config.dry_run:
-        for fpath, (link_target_old, link_target_new) in sorted(
-            links_to_fix.items(), key=lambda kv: kv[0]
-        ):
-            print(f"{fpath}: {link_target_old} => {link_target_new}")
-        # -- end for
-
-    else:
-        for fpath, (link_target_old, link_target_new) in sorted(
-            links_to_fix.items(), key=lambda kv: kv[0]
-        ):
-            print(f"{fpath}: {link_target_old} => {link_target_new}")
-
-            os.unlink(fpath)
-            os.symlink(link_target_new, fpath)
-        # -- end for
-    # -- end if
 # --- end of main (...) ---
 
 
@@ -89,7 +78,21 @@ def main_get_arg_parser(prog):
     )
 
     parser.add_argument(
-        'target_rootfs',
+        '-j', '--jobs',
+        dest='jobs',
+        default=None, type=int,
+        help='number of directory trees to scan concurrently (default: number of CPUs + 4)'
+    )
+
+    parser.add_argument(
+        '--tar',
+        dest='tar_stream',
+        default=False, action='store_true',
+        help='rewrite symlinks in a tar stream read from stdin and written to stdout (needs --from)'
+    )
+
+    parser.add_argument(
+        'target_rootfs', nargs='?',
         help='target rootfs directory'
     )
 
@@ -97,18 +100,6 @@ def main_get_arg_parser(prog):
 # --- end of main_get_arg_parser (...) ---
 
 
-def walk_target_rootfs_symlinks(root):
-    for (dirpath, dirnames, filenames) in os.walk(root, followlinks=False):
-        for filename in itertools.chain(filenames, dirnames):
-            fpath = pathlib.Path(dirpath, filename)
-            if fpath.is_symlink():
-                yield fpath
-            # -- end if
-        # -- end for
-    # -- end for
-# --- end of walk_target_rootfs_symlinks (...) ---
-
-
 def run_main():
     os_ex_ok = getattr(os, 'EX_OK', 0)
 
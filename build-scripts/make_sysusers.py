@@ -7,21 +7,29 @@ from collections.abc import Hashable, Iterable, Iterator
 from typing import Any, Optional
 
 import argparse
+import bisect
 import collections
 import collections.abc
+import hashlib
+import json
 import os
 import pathlib
 import sys
+import tempfile
 import time
 
 from dataclasses import dataclass, field
 
+from dbuild.pwhash import PWHASH_METHOD_PREFIX, PasswordHashCache
+
 
 class Globals:
     DEFAULT_HOME = "/"
     DEFAULT_SHELL = "/usr/sbin/nologin"
     SYSTEM_USER_ID_RANGE = (100, 399)
     REGULAR_USER_ID_RANGE = (1000, 1999)
+    STATE_VERSION = 1
+    USERS_GROUPS_FILES = ("passwd", "group", "shadow", "gshadow")
 
 
 class DuplicateKeyError(KeyError):
@@ -29,11 +37,12 @@ class DuplicateKeyError(KeyError):
 
 
 class OrderedSet(collections.abc.MutableSet):
+    __slots__ = ("data",)
+
     def __init__(self, data: Optional[Iterable[Hashable]] = None):
         super().__init__()
-        self.data = collections.OrderedDict()
-        if data:
-            self.update(data)
+        # insertion-ordered
+        self.data = dict.fromkeys(data, True) if data is not None else {}
 
     def __contains__(self, item: Hashable) -> bool:
         return item in self.data
@@ -51,8 +60,9 @@ class OrderedSet(collections.abc.MutableSet):
         self.data.pop(item, None)
 
 
-@dataclass
+@dataclass(slots=True)
 class SysusersEntry:
+    raw: str
     username: Optional[str]
     uid: Optional[int]
     group: str
@@ -62,9 +72,11 @@ class SysusersEntry:
     shell: Optional[str]
     groups: Optional[list[str]]
     comment: Optional[str]
+    # raw line contains a cleartext password (replaced by its hash later on)
+    cleartext_password: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class AbstractEntry:
     raw: Optional[str]
     changed: bool = field(init=False, default=False)
@@ -85,7 +97,7 @@ class AbstractEntry:
             return self.raw
 
 
-@dataclass
+@dataclass(slots=True)
 class UserEntry(AbstractEntry):
     pw_name: str
     pw_passwd: str
@@ -113,7 +125,7 @@ class UserEntry(AbstractEntry):
         ]
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupEntry(AbstractEntry):
     gr_name: str
     gr_passwd: str
@@ -139,7 +151,8 @@ class SimpleEntryDB(collections.abc.Mapping):
 
     def __init__(self):
         super().__init__()
-        self.data = collections.OrderedDict()
+        self.data = {}  # insertion-ordered
+        self.changed = False
 
     def add(self, key: Hashable, value: Any) -> None:
         if key in self.data:
@@ -148,7 +161,12 @@ class SimpleEntryDB(collections.abc.Mapping):
             self.data[key] = value
 
     def add_or_replace(self, key: Hashable, value: Any) -> None:
-        self.data[key] = value
+        if self.data.get(key, None) != value:
+            self.data[key] = value
+            self.changed = True
+
+    def is_changed(self) -> bool:
+        return self.changed
 
     def __getitem__(self, key: Hashable) -> Any:
         return self.data[key]
@@ -170,7 +188,7 @@ class EntryDB:
 
     def __init__(self):
         super().__init__()
-        self.by_name = collections.OrderedDict()
+        self.by_name = {}  # insertion-ordered
         self.by_id = {}
 
     def add(self, entry: AbstractEntry) -> None:
@@ -197,8 +215,12 @@ class EntryDB:
     def iter_entries(self) -> Iterator[AbstractEntry]:
         yield from self.by_name.values()
 
+    def is_changed(self) -> bool:
+        # new entries are marked as changed, too
+        return any(entry.changed for entry in self.by_name.values())
 
-@dataclass
+
+@dataclass(slots=True)
 class UsersGroupsDB:
     passwd: EntryDB
     group: EntryDB
@@ -206,18 +228,111 @@ class UsersGroupsDB:
     gshadow: Optional[SimpleEntryDB]
 
 
-class UidGidGenerator:
-    # NOTE: manages id_min/id_max exclusively,
-    # cannot cooperate with UidGidGenerator instances sharing the same id range
-    def __init__(self, users_groups_db: UsersGroupsDB, id_min: int, id_max: int):
+class IdAllocator:
+    """
+    Allocates uids/gids from the free ids of several id ranges.
+
+    Free ids are kept as sorted, disjoint intervals [start, end]
+    (parallel lists for bisect), initially the given ranges minus
+    all ids taken by either the passwd or the group database.
+    Allocation picks the lowest free id of the requested range.
+
+    Users and groups share the id space, so that a user and a group
+    with the same name get the same id.
+    """
+
+    def __init__(
+        self, users_groups_db: UsersGroupsDB, id_ranges: Iterable[tuple[int, int]]
+    ):
         super().__init__()
         self.users_groups_db = users_groups_db
-        self.id_min = id_min  # unused
-        self.id_max = id_max
-        self._id_next = id_min
-        self._name_id_cache = {}
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        self._name_id_cache: dict[str, int] = {}
+
+        used_ids = sorted(
+            set(users_groups_db.passwd.by_id) | set(users_groups_db.group.by_id)
+        )
+
+        for id_min, id_max in sorted(id_ranges):
+            self._add_free_range(id_min, id_max, used_ids)
+
+    def _add_free_range(self, id_min: int, id_max: int, used_ids: list[int]) -> None:
+        if self._ends and id_min <= self._ends[-1]:
+            raise ValueError("overlapping uid/gid ranges", id_min, id_max)
+
+        start = id_min
+
+        for used_id in used_ids[
+            bisect.bisect_left(used_ids, id_min) : bisect.bisect_right(used_ids, id_max)
+        ]:
+            if used_id > start:
+                self._starts.append(start)
+                self._ends.append(used_id - 1)
+            start = used_id + 1
+
+        if start <= id_max:
+            self._starts.append(start)
+            self._ends.append(id_max)
 
-    def get(self, name: str) -> int:
+    def reserve(self, entry_id: int) -> None:
+        """Marks the given id as taken (no-op if not free)."""
+        starts = self._starts  # ref/modified
+        ends = self._ends  # ref/modified
+
+        idx = bisect.bisect_right(starts, entry_id) - 1
+
+        if idx < 0 or ends[idx] < entry_id:
+            return
+
+        elif starts[idx] == ends[idx]:
+            del starts[idx]
+            del ends[idx]
+
+        elif entry_id == starts[idx]:
+            starts[idx] += 1
+
+        elif entry_id == ends[idx]:
+            ends[idx] -= 1
+
+        else:
+            # split interval
+            starts.insert(idx + 1, entry_id + 1)
+            ends.insert(idx + 1, ends[idx])
+            ends[idx] = entry_id - 1
+
+    def allocate(self, id_min: int, id_max: int) -> int:
+        """Takes the lowest free id in [id_min, id_max]."""
+        starts = self._starts  # ref/modified
+        ends = self._ends  # ref/modified
+
+        idx = bisect.bisect_left(ends, id_min)
+
+        if idx < len(ends):
+            entry_id = starts[idx]
+
+            if entry_id >= id_min:
+                if entry_id <= id_max:
+                    # common case, take the first id of the interval
+                    if entry_id == ends[idx]:
+                        del starts[idx]
+                        del ends[idx]
+                    else:
+                        starts[idx] = entry_id + 1
+                    return entry_id
+
+            else:
+                # interval overlaps id_min
+                self.reserve(id_min)
+                return id_min
+
+        raise RuntimeError("uid/gid generator exhausted", id_min, id_max)
+
+    def get(self, name: str, id_min: int, id_max: int) -> int:
+        """
+        Returns the id for the given user/group name,
+        reusing the id of an existing user or group with that name.
+        """
         name_id_cache = self._name_id_cache  # ref/modified
 
         try:
@@ -225,35 +340,24 @@ class UidGidGenerator:
         except KeyError:
             pass
 
-        passwd_id = self.users_groups_db.passwd.by_name.get(name, None)
-        group_id = self.users_groups_db.group.by_name.get(name, None)
+        passwd_entry = self.users_groups_db.passwd.by_name.get(name, None)
+        group_entry = self.users_groups_db.group.by_name.get(name, None)
+
+        passwd_id = passwd_entry.get_id() if passwd_entry is not None else None
+        group_id = group_entry.get_id() if group_entry is not None else None
 
         if passwd_id is not None:
             if group_id is None or passwd_id == group_id:
                 name_id_cache[name] = passwd_id
                 return passwd_id
 
-        elif group_id is not None:  # and passwd_is None, already checked
+        elif group_id is not None:  # and passwd_id is None, already checked
             name_id_cache[name] = group_id
             return group_id
 
-        passwd_id_db = self.users_groups_db.passwd.by_id  # ref
-        group_id_db = self.users_groups_db.group.by_id  # ref
-
-        id_max = self.id_max  # ref
-
-        id_next = self._id_next
-
-        while id_next <= id_max and (id_next in passwd_id_db or id_next in group_id_db):
-            id_next += 1
-
-        if id_next > id_max:
-            raise RuntimeError("uid/gid generator exhausted", id_next, id_max)
-
-        else:
-            name_id_cache[name] = id_next
-            self._id_next = id_next + 1
-            return id_next
+        entry_id = self.allocate(id_min, id_max)
+        name_id_cache[name] = entry_id
+        return entry_id
 
 
 def get_argument_parser(prog: str) -> argparse.ArgumentParser:
@@ -279,6 +383,46 @@ def get_argument_parser(prog: str) -> argparse.ArgumentParser:
         help="specify alternate output directory for files",
     )
 
+    parser.add_argument(
+        "-S",
+        "--state",
+        metavar="<state_file>",
+        dest="state_file",
+        default=None,
+        type=pathlib.Path,
+        help=(
+            "remember applied sysusers entries in <state_file>"
+            " and merge only new or changed entries on subsequent runs"
+            " as long as the target's passwd/group/shadow/gshadow files"
+            " did not change in the meantime"
+        ),
+    )
+
+    parser.add_argument(
+        "--pwhash-cache",
+        metavar="<dir>",
+        dest="pwhash_cache_dir",
+        default=None,
+        help="reuse password hashes stored in <dir> (default: no persistent cache)",
+    )
+
+    parser.add_argument(
+        "--pwhash-method",
+        dest="pwhash_method",
+        default="yescrypt",
+        choices=list(PWHASH_METHOD_PREFIX),
+        help="hash method for cleartext passwords (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        default=None,
+        type=int,
+        help="number of passwords to hash concurrently (default: number of CPUs)",
+    )
+
     parser.add_argument("sysusers_file", type=pathlib.Path, help="make-sysusers file")
 
     return parser
@@ -289,29 +433,191 @@ def main(prog: str, argv: list[str]) -> None | int | bool:
     arg_config = arg_parser.parse_args(argv)
 
     target_rootfs = arg_config.target_rootfs
+    target_etc_dir = target_rootfs / "etc"
+    state_file = arg_config.state_file
 
     outdir = arg_config.outdir
     if not outdir:
-        outdir = target_rootfs / "etc"
+        outdir = target_etc_dir
+
+    elif state_file:
+        arg_parser.error("--state cannot be combined with --outdir")
+
+    sysuser_entries = list(iparse_sysusers_file(arg_config.sysusers_file))
+
+    pwhash_cache = PasswordHashCache(arg_config.pwhash_cache_dir, jobs=arg_config.jobs)
+
+    state = load_state(state_file, target_etc_dir) if state_file else None
+
+    if state is not None:
+        # previously applied entries, target files verified by digest
+        applied_entries = set(state["applied"])
+
+        sysuser_entries_todo = [
+            sysuser_entry
+            for sysuser_entry in sysuser_entries
+            if get_sysusers_entry_digest(sysuser_entry, pwhash_cache)
+            not in applied_entries
+        ]
+
+        if not sysuser_entries_todo:
+            return
+
+    else:
+        sysuser_entries_todo = sysuser_entries
+
+    hash_sysusers_passwords(
+        sysuser_entries_todo,
+        pwhash_cache,
+        arg_config.pwhash_method,
+    )
+
     target_users_groups_db = load_users_groups_db(target_rootfs)
 
-    merge_sysusers(
-        target_users_groups_db, iparse_sysusers_file(arg_config.sysusers_file)
+    merge_sysusers(target_users_groups_db, sysuser_entries_todo)
+
+    # files get updated in-place only if something has changed,
+    # an alternate output directory always gets all files
+    write_unchanged = not (outdir.is_dir() and os.path.samefile(outdir, target_etc_dir))
+
+    for filename, entry_db in [
+        ("passwd", target_users_groups_db.passwd),
+        ("group", target_users_groups_db.group),
+        ("shadow", target_users_groups_db.shadow),
+        ("gshadow", target_users_groups_db.gshadow),
+    ]:
+        if entry_db is not None and (write_unchanged or entry_db.is_changed()):
+            write_outfile(outdir / filename, entry_db.iter_entries())
+
+    if state_file:
+        write_state(state_file, target_etc_dir, sysuser_entries, pwhash_cache)
+
+
+def get_sysusers_entry_digest(
+    sysuser_entry: SysusersEntry, pwhash_cache: PasswordHashCache
+) -> str:
+    """
+    Returns the digest of the entry's input line as kept in the state file.
+
+    Lines with a cleartext password get a keyed digest (pwhash cache key),
+    so that the password cannot be guessed from the state file.
+    Without persistent pwhash cache, the key changes with each run
+    and these entries always get applied again.
+    """
+    raw = sysuser_entry.raw.encode("utf-8")
+
+    if sysuser_entry.cleartext_password:
+        return "hmac:" + pwhash_cache.get_keyed_digest(raw)
+    else:
+        return hashlib.sha256(raw).hexdigest()
+
+
+def get_users_groups_files_digest(etc_dir: pathlib.Path) -> dict[str, Optional[str]]:
+    files_digest = {}
+
+    for filename in Globals.USERS_GROUPS_FILES:
+        try:
+            data = (etc_dir / filename).read_bytes()
+        except FileNotFoundError:
+            files_digest[filename] = None
+        else:
+            files_digest[filename] = hashlib.sha256(data).hexdigest()
+
+    return files_digest
+
+
+def load_state(state_file: pathlib.Path, etc_dir: pathlib.Path) -> Optional[dict]:
+    """
+    Loads the sysusers state file.
+
+    Returns None if the state file does not exist, is not usable
+    or if the target files have changed since it has been written,
+    in which case all entries need to be merged again.
+    """
+    try:
+        with open(state_file, "rt") as fh:
+            state = json.load(fh)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        return None
+
+    if not isinstance(state, dict) or state.get("version") != Globals.STATE_VERSION:
+        return None
+
+    elif state.get("etc_dir") != str(etc_dir.resolve()):
+        return None
+
+    elif state.get("files") != get_users_groups_files_digest(etc_dir):
+        return None
+
+    else:
+        return state
+
+
+def write_state(
+    state_file: pathlib.Path,
+    etc_dir: pathlib.Path,
+    sysuser_entries: Iterable[SysusersEntry],
+    pwhash_cache: PasswordHashCache,
+) -> None:
+    state = {
+        "version": Globals.STATE_VERSION,
+        "etc_dir": str(etc_dir.resolve()),
+        "files": get_users_groups_files_digest(etc_dir),
+        "applied": sorted(
+            {
+                get_sysusers_entry_digest(sysuser_entry, pwhash_cache)
+                for sysuser_entry in sysuser_entries
+            }
+        ),
+    }
+
+    write_outfile(state_file, [json.dumps(state, indent=4)], mode=0o600)
+
+
+def write_outfile(
+    filepath: pathlib.Path, entries: Iterable[Any], mode: Optional[int] = None
+) -> None:
+    """
+    Writes entries line by line to a temporary file in the same directory
+    and replaces filepath with it, keeping the mode and owner of an
+    existing file (e.g. root:shadow 0640 for /etc/shadow).
+    A given mode is applied in any case.
+    """
+    try:
+        stat_info = os.stat(filepath)
+    except FileNotFoundError:
+        stat_info = None
+
+    fd, tmp_filepath = tempfile.mkstemp(
+        dir=filepath.parent, prefix=f".{filepath.name}."
     )
+    try:
+        with open(fd, "wt") as fh:
+            if stat_info is not None:
+                os.fchmod(fh.fileno(), stat_info.st_mode & 0o7777)
+                if (stat_info.st_uid, stat_info.st_gid) != (os.geteuid(), os.getegid()):
+                    os.fchown(fh.fileno(), stat_info.st_uid, stat_info.st_gid)
 
-    write_outfile(outdir / "passwd", target_users_groups_db.passwd.iter_entries())
-    write_outfile(outdir / "group", target_users_groups_db.group.iter_entries())
+            else:
+                umask = os.umask(0o022)
+                os.umask(umask)
+                os.fchmod(fh.fileno(), 0o666 & ~umask)
 
-    if target_users_groups_db.shadow is not None:
-        write_outfile(outdir / "shadow", target_users_groups_db.shadow.iter_entries())
+            if mode is not None:
+                os.fchmod(fh.fileno(), mode)
 
-    if target_users_groups_db.gshadow is not None:
-        write_outfile(outdir / "gshadow", target_users_groups_db.gshadow.iter_entries())
+            fh.writelines(f"{entry}\n" for entry in entries)
 
+        os.replace(tmp_filepath, filepath)
 
-def write_outfile(filepath: pathlib.Path, entries: Iterable[Any]) -> None:
-    with open(filepath, "wt") as fh:
-        fh.write("\n".join(map(str, entries)) + "\n")
+    except BaseException:
+        try:
+            os.unlink(tmp_filepath)
+        except FileNotFoundError:
+            pass
+        raise
 
 
 def load_users_groups_db(rootfs: pathlib.Path) -> UsersGroupsDB:
@@ -345,31 +651,25 @@ def merge_sysusers(
     else:
         shadow_password_age = None
 
-    system_id_generator = UidGidGenerator(
+    # shared by users and groups, system and regular id ranges
+    id_allocator = IdAllocator(
         users_groups_db=users_groups_db,
-        id_min=Globals.SYSTEM_USER_ID_RANGE[0],
-        id_max=Globals.SYSTEM_USER_ID_RANGE[1],
-    )
-
-    regular_id_generator = UidGidGenerator(
-        users_groups_db=users_groups_db,
-        id_min=Globals.REGULAR_USER_ID_RANGE[0],
-        id_max=Globals.REGULAR_USER_ID_RANGE[1],
+        id_ranges=[Globals.SYSTEM_USER_ID_RANGE, Globals.REGULAR_USER_ID_RANGE],
     )
 
     def resolve_id(
         name: str,
         value: int,
         *,
-        _system_id_generator=system_id_generator,
-        _regular_id_generator=regular_id_generator,
+        _id_allocator=id_allocator,
     ) -> int:
         if value > 0:
+            _id_allocator.reserve(value)
             return value
         elif value == -1:
-            return _system_id_generator.get(name)
+            return _id_allocator.get(name, *Globals.SYSTEM_USER_ID_RANGE)
         elif value == -2:
-            return _regular_id_generator.get(name)
+            return _id_allocator.get(name, *Globals.REGULAR_USER_ID_RANGE)
         else:
             raise ValueError(name, value)
 
@@ -397,6 +697,7 @@ def merge_sysusers(
         else:
             # update existing group
             if gid > 0 and gid != group_db_entry.gr_gid:
+                id_allocator.reserve(gid)
                 group_db_entry.gr_gid = gid
                 group_db_entry.changed = True
 
@@ -446,6 +747,7 @@ def merge_sysusers(
             else:
                 # update existing user
                 if sysuser_entry.uid > 0 and sysuser_entry.uid != user_db_entry.pw_uid:
+                    id_allocator.reserve(sysuser_entry.uid)
                     user_db_entry.pw_uid = sysuser_entry.uid
                     user_db_entry.changed = True
 
@@ -508,6 +810,42 @@ def merge_sysusers(
                 group_db_entry.changed = True
 
 
+def hash_sysusers_passwords(
+    sysuser_entries: Iterable[SysusersEntry],
+    pwhash_cache: PasswordHashCache,
+    method: str,
+) -> None:
+    """
+    Replaces cleartext passwords ("=<password>", or "!=<password>"
+    with login disabled) with their hash.
+
+    All passwords get hashed in one go, concurrently,
+    reusing hashes found in pwhash_cache.
+    """
+    # list of (sysuser_entry, hash prefix, plaintext)
+    cleartext_entries = []
+
+    for sysuser_entry in sysuser_entries:
+        password = sysuser_entry.password
+
+        if not password:
+            pass
+
+        elif password.startswith("="):
+            cleartext_entries.append((sysuser_entry, "", password[1:]))
+
+        elif password.startswith("!="):
+            cleartext_entries.append((sysuser_entry, "!", password[2:]))
+
+    if cleartext_entries:
+        pw_hashes = pwhash_cache.get_hashes(
+            [plaintext for _, _, plaintext in cleartext_entries], method
+        )
+
+        for sysuser_entry, prefix, plaintext in cleartext_entries:
+            sysuser_entry.password = prefix + pw_hashes[plaintext]
+
+
 def iparse_sysusers_file(filepath: pathlib.Path) -> Iterator[SysusersEntry]:
     def normalize_field_value(value: str, /) -> Optional[str]:
         if not value or value == "-":
@@ -648,9 +986,9 @@ def iparse_sysusers_file(filepath: pathlib.Path) -> Iterator[SysusersEntry]:
                         entry_vars["password"] = arg
 
                     elif arg.startswith("=") or arg.startswith("!="):
-                        raise NotImplementedError(
-                            f"sysuser cleartext password not implemented at line {lino}"
-                        )
+                        # cleartext password, see hash_sysusers_passwords()
+                        entry_vars["password"] = arg
+                        entry_vars["cleartext_password"] = True
 
                     else:
                         # pw hash
@@ -728,7 +1066,7 @@ def iparse_sysusers_file(filepath: pathlib.Path) -> Iterator[SysusersEntry]:
 
                     entry_vars["comment"] = None
 
-                yield SysusersEntry(**entry_vars)
+                yield SysusersEntry(raw=sline, **entry_vars)
 
 
 def load_passwd_file(filepath: pathlib.Path) -> EntryDB:
@@ -767,7 +1105,7 @@ def load_group_file(filepath: pathlib.Path) -> EntryDB:
                 gr_name=fields[0],
                 gr_passwd=fields[1],
                 gr_gid=int(fields[2]),
-                gr_mem=fields[3],
+                gr_mem=OrderedSet(filter(None, fields[3].split(","))),
             )
         )
 
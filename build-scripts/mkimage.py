@@ -6,15 +6,36 @@
 
 import argparse
 import collections
-import configparser
+import concurrent.futures
+import copy
 import datetime
+import json
 import os
 import pathlib
-import shlex
 import shutil
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+
+from dbuild.aptproxy import AptCacheProxy
+from dbuild.cache import get_default_cache_root
+from dbuild.coldeps import CollectionDependencyCycleError
+from dbuild.coldeps import build_collection_graph
+from dbuild.colindex import CollectionIndex
+from dbuild.colindex import get_collection_index_file
+from dbuild.config import ConfigParser
+from dbuild.config import gen_load_config
+from dbuild.config import merge_config_to_file
+from dbuild.pwhash import PasswordHashCache
+from dbuild.trace import SpanTracer
+from dbuild.trace import gen_hook_trace_spans
+from dbuild.trace import gen_read_hook_trace
+from dbuild.trace import gen_read_spans
+from dbuild.trace import gen_span_report
+from dbuild.trace import write_chrome_trace
 
 
 class RuntimeConfig(object):
@@ -27,6 +48,12 @@ class RuntimeConfig(object):
         self.project_scripts_dir    = None
         self.project_share_dir      = None
         self.project_bcol_root      = None
+        # CollectionIndex for project_bcol_root (shared by all builds)
+        self.bcol_index             = None
+        # config file parser, caches parsed files (shared by all builds)
+        self.config_parser          = None
+        # password hashes of *_PASSWORD config vars (shared by all builds)
+        self.pwhash_cache           = None
 
         self.images_root            = None
 
@@ -34,6 +61,12 @@ class RuntimeConfig(object):
         self.profile_config_name    = None
         self.profile_config         = None
         self.profile_bcol           = None
+
+        # batch builds: one staging dir per profile below <staging_dir>
+        self.staging_per_profile    = False
+
+        # url of the local caching apt proxy (shared by all builds)
+        self.apt_proxy_url          = None
     # ---
 
 # --- end of RuntimeConfig ---
@@ -41,10 +74,13 @@ class RuntimeConfig(object):
 
 class StagingEnv(object):
 
-    def __init__(self, staging_dir):
+    def __init__(self, staging_dir, log=None):
         super().__init__()
         self.root = staging_dir
         self.images_root = (staging_dir / 'images')
+        self.log = log
+        # build trace, see main_run_staged()
+        self.tracer = SpanTracer(None, 'mkimage')
     # --- end of __init__ (...) ---
 
     def run_cmd(
@@ -55,12 +91,91 @@ class StagingEnv(object):
         if 'cwd' not in kwargs:
             kwargs['cwd'] = str(self.root)
 
-        return subprocess.run(cmdv, stdin=stdin, check=check, **kwargs)
+        if self.log is None or any((k in kwargs for k in ['stdout', 'stderr', 'capture_output'])):
+            return subprocess.run(cmdv, stdin=stdin, check=check, **kwargs)
+
+        else:
+            # relay output line-wise through the (prefixing) log
+            return self.log.run_cmd(cmdv, stdin=stdin, check=check, **kwargs)
+        # --
     # --- end of run_cmd (...) ---
 
 # --- end of StagingEnv ---
 
 
+class PrefixedLog(object):
+    """
+    Output relay for concurrent builds,
+    each line gets prefixed with the profile name.
+    """
+
+    def __init__(self, prefix, lock, outstream=None):
+        super().__init__()
+        self.prefix = prefix
+        self.lock = lock
+        self.outstream = (outstream if outstream is not None else sys.stdout)
+    # --- end of __init__ (...) ---
+
+    def write(self, text):
+        lines = text.splitlines()
+
+        with self.lock:
+            self.outstream.write(
+                ''.join((f'[{self.prefix}] {line}\n' for line in lines))
+            )
+            self.outstream.flush()
+        # --
+    # --- end of write (...) ---
+
+    def run_cmd(self, cmdv, stdin=subprocess.DEVNULL, check=True, **kwargs):
+        with subprocess.Popen(
+            cmdv,
+            stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            **kwargs
+        ) as proc:
+            for line in proc.stdout:
+                self.write(line.decode('utf-8', errors='replace'))
+            # --
+
+            returncode = proc.wait()
+        # -- end with
+
+        if check and returncode:
+            raise subprocess.CalledProcessError(returncode, cmdv)
+        # --
+
+        return subprocess.CompletedProcess(cmdv, returncode)
+    # --- end of run_cmd (...) ---
+
+# --- end of PrefixedLog ---
+
+
+class BuildResult(object):
+
+    def __init__(self, name):
+        super().__init__()
+        self.name           = name
+        self.success        = False
+        self.error          = None
+        self.time_start     = None
+        self.time_end       = None
+        self.published      = []
+    # --- end of __init__ (...) ---
+
+    def get_duration(self):
+        if self.time_start is None or self.time_end is None:
+            return None
+        else:
+            return (self.time_end - self.time_start)
+    # --- end of get_duration (...) ---
+
+    def get_image_size(self):
+        return sum(map(get_published_size, self.published))
+    # --- end of get_image_size (...) ---
+
+# --- end of BuildResult ---
+
+
 def main(prog, argv):
     cfg = RuntimeConfig()
     cfg.script_file_called  = pathlib.Path(os.path.abspath(__file__))
@@ -73,32 +188,229 @@ def main(prog, argv):
     arg_parser              = get_arg_parser(prog)
     arg_config              = arg_parser.parse_args(argv)
 
+    cfg.config_parser       = ConfigParser()
+
+    # persistent unless --no-cache
+    cfg.pwhash_cache        = PasswordHashCache(
+        (
+            ((arg_config.cache_dir or get_default_cache_root()) / 'pwhash')
+            if arg_config.use_cache else None
+        )
+    )
+
+    cfg.bcol_index          = CollectionIndex(
+        cfg.project_bcol_root,
+        get_collection_index_file(
+            (arg_config.cache_dir or get_default_cache_root()),
+            cfg.project_bcol_root
+        )
+    )
+
     if arg_config.images_dir:
         cfg.images_root = pathlib.Path(os.path.abspath(arg_config.images_dir))
     else:
         cfg.images_root = cfg.project_root / 'obj'
     # --
 
-    cfg.profile_config_file = pathlib.Path(os.path.abspath(arg_config.profile_config))
+    profile_config_files = list(main_gen_profile_config_files(arg_config.profile_config))
+
+    if not profile_config_files:
+        sys.stderr.write('No profile configs found, aborting.\n')
+        return False
+    # --
+
+    profile_config_names = collections.Counter((f.name for f in profile_config_files))
+    profile_config_dups  = sorted((k for k, v in profile_config_names.items() if v > 1))
+
+    if profile_config_dups:
+        sys.stderr.write('Profile names must be unique, got duplicates:\n')
+        sys.stderr.write(''.join((f'  - {name}\n' for name in profile_config_dups)))
+        return False
+    # --
+
+    if arg_config.graph_format:
+        return main_print_graph(cfg, profile_config_files, arg_config.graph_format)
+    # --
+
+    apt_proxy = None
+
+    if arg_config.apt_proxy and not arg_config.dry_run:
+        apt_proxy = AptCacheProxy(
+            ((arg_config.cache_dir or get_default_cache_root()) / 'apt-proxy'),
+            max_size=arg_config.apt_proxy_max_size
+        )
+        apt_proxy.start()
+        cfg.apt_proxy_url = apt_proxy.url
+
+        sys.stdout.write(f'Started local apt proxy at {cfg.apt_proxy_url}\n')
+        sys.stdout.flush()
+    # --
+
+    try:
+        if len(profile_config_files) == 1:
+            # single build: pass-through output, no summary
+            result = main_build_profile(cfg, profile_config_files[0], arg_config)
+            if result.error is not None:
+                raise result.error
+            return result.success
+        # --
+
+        cfg.staging_per_profile = True
+
+        return main_build_batch(cfg, profile_config_files, arg_config)
+
+    finally:
+        if apt_proxy is not None:
+            apt_proxy.stop()
+            sys.stdout.write(apt_proxy.format_stats() + '\n')
+        # --
+    # --
+# --- end of main (...) ---
+
+
+def main_gen_profile_config_files(profile_config_args):
+    # profile configs may be given as files or directories,
+    # directories get searched recursively (skipping hidden files)
+    for arg in profile_config_args:
+        filepath = pathlib.Path(os.path.abspath(arg))
+
+        if filepath.is_dir():
+            for dirpath, dirnames, filenames in os.walk(filepath):
+                dirnames[:] = sorted((d for d in dirnames if d[:1] != '.'))
+
+                for filename in sorted(filenames):
+                    if filename[:1] != '.':
+                        yield pathlib.Path(dirpath, filename)
+                # --
+            # -- end for
+
+        else:
+            yield filepath
+        # --
+    # -- end for
+# --- end of main_gen_profile_config_files (...) ---
+
+
+def main_print_graph(cfg, profile_config_files, graph_format):
+    json_data = collections.OrderedDict()
+
+    for profile_config_file in profile_config_files:
+        profile_config = dict(gen_load_config(profile_config_file))
+
+        graph = build_collection_graph(
+            cfg.bcol_index,
+            [w for w in profile_config.get('DBUILD_TARGET_COLLECTIONS', '').split() if w]
+        )
+
+        if graph_format == 'json':
+            json_data[profile_config_file.name] = graph.get_json_data()
+
+        else:
+            for line in graph.gen_dot(profile_config_file.name):
+                sys.stdout.write(line + '\n')
+        # --
+    # --
+
+    if graph_format == 'json':
+        json.dump(json_data, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    # --
+
+    cfg.bcol_index.save()
+# --- end of main_print_graph (...) ---
+
+
+def main_build_batch(cfg, profile_config_files, arg_config):
+    jobs = get_batch_jobs(arg_config.jobs, arg_config.job_memory)
+    log_lock = threading.Lock()
+
+    sys.stdout.write(f'Building {len(profile_config_files)} profiles using {jobs} job(s)\n')
+    sys.stdout.flush()
+
+    def run_job(profile_config_file):
+        log = PrefixedLog(profile_config_file.name, log_lock)
+        result = main_build_profile(cfg, profile_config_file, arg_config, log=log)
+
+        if result.error is not None:
+            log.write(f'build failed: {result.error}')
+        # --
+
+        return result
+    # --- end of run_job (...) ---
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(run_job, profile_config_files))
+    # --
+
+    main_print_batch_summary(results)
+
+    return all((r.success for r in results))
+# --- end of main_build_batch (...) ---
+
+
+def main_print_batch_summary(results):
+    rows = [('PROFILE', 'STATUS', 'TIME', 'SIZE')]
+
+    for result in results:
+        duration = result.get_duration()
+
+        rows.append((
+            result.name,
+            ('ok' if result.success else 'FAILED'),
+            ('-' if duration is None else format_duration(duration)),
+            (format_size(result.get_image_size()) if result.published else '-'),
+        ))
+    # --
+
+    col_widths = [max((len(row[k]) for row in rows)) for k in range(len(rows[0]))]
+
+    sys.stdout.write('\n')
+    for row in rows:
+        sys.stdout.write(
+            '  '.join((
+                col.ljust(width) for col, width in zip(row, col_widths)
+            )).rstrip() + '\n'
+        )
+    # --
+# --- end of main_print_batch_summary (...) ---
+
+
+def main_init_profile(cfg_base, profile_config_file, arg_config, log=None):
+    cfg = copy.copy(cfg_base)
+
+    cfg.profile_config_file = profile_config_file
     cfg.profile_config_name = cfg.profile_config_file.name
-    cfg.profile_config      = load_config(cfg.profile_config_file)
+    cfg.profile_config      = dict(gen_load_config(cfg.profile_config_file))
+
+    def log_error(msg):
+        if log is None:
+            sys.stderr.write(msg)
+        else:
+            log.write(msg)
+    # ---
 
     try:
         want_bcol_names = [w for w in cfg.profile_config['DBUILD_TARGET_COLLECTIONS'].split() if w]
     except KeyError:
-        sys.stderr.write('DBUILD_TARGET_COLLECTIONS not set in profile config, aborting.\n')
-        return False
+        log_error('DBUILD_TARGET_COLLECTIONS not set in profile config, aborting.\n')
+        return None
     # --
 
     if not want_bcol_names:
-        sys.stderr.write('DBUILD_TARGET_COLLECTIONS is empty in profile config, aborting.\n')
-        return False
+        log_error('DBUILD_TARGET_COLLECTIONS is empty in profile config, aborting.\n')
+        return None
     # --
 
     if arg_config.resolve_bcol_dep:
-        cfg.profile_bcol = collections.OrderedDict(
-            main_gen_expand_build_collections(cfg, want_bcol_names)
-        )
+        try:
+            cfg.profile_bcol = collections.OrderedDict(
+                main_gen_expand_build_collections(cfg, want_bcol_names)
+            )
+
+        except CollectionDependencyCycleError as err:
+            log_error(f'Cannot resolve build collection dependencies, {err}\n')
+            return None
+        # --
 
     else:
         cfg.profile_bcol = collections.OrderedDict((
@@ -109,225 +421,117 @@ def main(prog, argv):
 
     bcol_dir_missing = [
         (name, dirpath) for name, dirpath in cfg.profile_bcol.items()
-        if not dirpath.is_dir()
+        if not cfg.bcol_index.get(name).exists
     ]
 
     if bcol_dir_missing:
-        sys.stderr.write('Missing dbuild collections:\n')
-        sys.stderr.write(
-            ''.join((
+        log_error(
+            'Missing dbuild collections:\n'
+            + ''.join((
                 f'  - {name}\n    {dirpath}\n'
                 for name, dirpath in sorted(bcol_dir_missing, key=lambda xv: xv[0])
             ))
         )
-        return False
+        return None
     # --
 
-    if arg_config.staging_dir:
-        staging_env = StagingEnv(
-            pathlib.Path(os.path.abspath(arg_config.staging_dir))
-        )
+    # make the index available to build-image
+    cfg.bcol_index.save()
 
-        os.makedirs(staging_env.root, exist_ok=True)
+    return cfg
+# --- end of main_init_profile (...) ---
 
-        main_init_staging_dir(cfg, staging_env)
-        main_run_build(cfg, staging_env, arg_config)
 
-        main_run_publish(cfg, staging_env, arg_config)
+def main_build_profile(cfg_base, profile_config_file, arg_config, log=None):
+    result = BuildResult(profile_config_file.name)
+    result.time_start = time.monotonic()
 
-    else:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            staging_env = StagingEnv(pathlib.Path(os.path.abspath(tmpdir)))
+    try:
+        cfg = main_init_profile(cfg_base, profile_config_file, arg_config, log=log)
 
-            main_init_staging_dir(cfg, staging_env)
+        if cfg is not None:
+            main_build_profile_in_staging(cfg, arg_config, result, log=log)
+            result.success = True
+        # --
 
-            main_run_build(cfg, staging_env, arg_config)
+    except Exception as err:
+        # a failed job should not take down the other jobs of a batch
+        result.error = err
+    # --
 
-            main_run_publish(cfg, staging_env, arg_config)
-        # -- end with
-    # -- end if
-# --- end of main (...) ---
+    result.time_end = time.monotonic()
+    return result
+# --- end of main_build_profile (...) ---
 
 
-def main_gen_expand_build_collections(cfg, wanted):
-    def section_iter_list(d, k):
-        try:
-            v = d[k]
+def main_build_profile_in_staging(cfg, arg_config, result, log=None):
+    if arg_config.staging_dir:
+        staging_root = pathlib.Path(os.path.abspath(arg_config.staging_dir))
 
-        except KeyError:
-            return
+        # each job of a batch needs its own staging dir
+        if cfg.staging_per_profile:
+            staging_root = staging_root / cfg.profile_config_name
+        # --
 
-        else:
-            for item in v.split():
-                if item:
-                    yield item
-    # --- end of section_iter_list (...) ---
+        staging_env = StagingEnv(staging_root, log=log)
 
-    # resolve build collection dependencies while preserving
-    # the order requested in the config as much as possible
-    collections_done       = set()
-    collections_todo_queue = []
-    collections_todo_dep   = collections.OrderedDict()
-    collections_dep_late   = set()
-
-    # collection names referenced as order-only dep:
-    # when False or not found => strict dep
-    # when True => order-only dep
-    collections_order_only_map = {}
-
-    ## scan for additional dependencies
-    collections_todo_scan = wanted
-
-    while collections_todo_scan:
-        collections_todo_scan_next = []
-
-        for name in collections_todo_scan:
-            if name not in collections_todo_dep:
-                # any scanned collection is a strict dep and not order-only
-                collections_order_only_map[name] = False
-
-                bcol_dir = cfg.project_bcol_root / name
-
-                dep_set = set()
-
-                bcol_meta_config_file = bcol_dir / 'meta'
-                bcol_is_virtual = False
-
-                # NOTE on missing collections: will raise an error in main() later on
-                if bcol_meta_config_file.is_file():
-                    bcol_meta_config_parser = configparser.ConfigParser()
-
-                    # ConfigParser.read() does not throw an error on missing file(s),
-                    # use open() + ConfigParser.read_file() instead
-                    with open(bcol_meta_config_file, 'rt') as fh:
-                        bcol_meta_config_parser.read_file(fh, source=bcol_meta_config_file)
-                    # --
-
-                    try:
-                        bcol_meta_config = bcol_meta_config_parser['collection']
-
-                    except KeyError:
-                        sys.stderr.write(f'WARN: dbuild collection meta config has no [collection] section: {name}\n')
-                        bcol_meta_config = None
-                    # -- end try
-
-                    if bcol_meta_config:
-                        bcol_is_virtual = bcol_meta_config_parser.getboolean('collection', 'virtual', fallback=False)
-                        add_order_only_late_dep = False
-
-                        # depends X: add dep on X, enqueue scanning of X
-                        for item in section_iter_list(bcol_meta_config, 'depends'):
-                            if item == '*':
-                                # NOTE: DEPRECATED: should use 'after = *' instead
-                                add_order_only_late_dep = True
-
-                            else:
-                                dep_set.add(item)
-                                collections_todo_scan_next.append(item)
-                                # no need to mark <item> as strict dep in collections_order_only_map here,
-                                # will be done during subsequent scan iteration
-                        # --
-
-                        # wants X: enqueue scanning of X
-                        for item in section_iter_list(bcol_meta_config, 'wants'):
-                            collections_todo_scan_next.append(item)
-                            # no need to mark <item> as strict dep in collections_order_only_map here,
-                            # will be done during subsequent scan iteration
-                        # --
-
-                        # after X: order-only dependency on X,
-                        # but do not enqueue scanning of X
-                        for item in section_iter_list(bcol_meta_config, 'after'):
-                            if item == '*':
-                                add_order_only_late_dep = True
-
-                            else:
-                                dep_set.add(item)
-
-                                # mark as order-only dep if not already marked
-                                # (which may be either 'strict dep' or 'only-order' dep)
-                                collections_order_only_map.setdefault(item, True)
-                        # --
-
-                        if add_order_only_late_dep:
-                            # depend on most/all other collections,
-                            # evaluated after dep expansion
-                            # Not allowed for virtual collections
-                            if not bcol_is_virtual:
-                                collections_dep_late.add(name)
-                            else:
-                                raise RuntimeError('late-dep on all not allowed for virtual collections', name)
-                        # -- end if
-                    # -- end if
-                # -- end if have collection meta config file
-
-                collections_todo_queue.append((name, bcol_dir, bcol_is_virtual))
-                collections_todo_dep[name] = dep_set
-            # -- end if dependencies already scanned?
-
-            collections_todo_scan = collections_todo_scan_next
-        # -- end for
-    # -- end while scan for dependencies
+        os.makedirs(staging_env.root, exist_ok=True)
 
-    # filter-out order-only dependencies
-    # that are not pulled in by any collection as strict dep
-    collections_order_only = set((k for k, v in collections_order_only_map.items() if v))
-    for dep in collections_todo_dep.values():
-        dep.difference_update(collections_order_only)
+        main_run_staged(cfg, staging_env, arg_config, result)
 
-    # evaluate late dependencies
-    collections_dep_early = set((
-        name for name in collections_todo_dep
-        if name not in collections_dep_late
-    ))
+    else:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            staging_env = StagingEnv(pathlib.Path(os.path.abspath(tmpdir)), log=log)
 
-    if collections_dep_late:
-        for name in collections_dep_late:
-            collections_todo_dep[name].update(collections_dep_early)
-    # --
+            main_run_staged(cfg, staging_env, arg_config, result)
+        # -- end with
+    # -- end if
+# --- end of main_build_profile_in_staging (...) ---
 
-    ## resolve dependencies
-    while collections_todo_queue:
-        resolved_any_dep = False
-        collections_todo_queue_next = []
 
-        for name, bcol_dir, bcol_is_virtual in collections_todo_queue:
-            if name not in collections_done:
-                dep = collections_todo_dep[name]
+def main_run_staged(cfg, staging_env, arg_config, result):
+    # spans of all processes involved in the build (build-image, ...)
+    # get collected in the staging dir and published as build trace
+    trace_spans_file = staging_env.root / 'trace-spans.jsonl'
+    trace_spans_file.unlink(missing_ok=True)
 
-                if not dep:
-                    # -> resolved (no pending dependencies)
-                    collections_done.add(name)
+    staging_env.tracer = SpanTracer(trace_spans_file, 'mkimage')
 
-                    del collections_todo_dep[name]
+    with staging_env.tracer.span('mkimage', profile=cfg.profile_config_name):
+        main_init_staging_dir(cfg, staging_env)
+
+        main_run_build(cfg, staging_env, arg_config)
 
-                    # remove name from all remaining dependencies
-                    for other_dep_set in collections_todo_dep.values():
-                        other_dep_set.discard(name)
-                    # --
+        timestamp = get_publish_timestamp()
 
-                    # virtual collections may pull in dependencies,
-                    # but are ignored otherwise
-                    # (This skips any collection dir related tasks
-                    # such as copying files from overlay and executing hooks.)
-                    if not bcol_is_virtual:
-                        yield (name, bcol_dir)
+        with staging_env.tracer.span('publish') as span:
+            result.published = main_run_publish(cfg, staging_env, arg_config, timestamp)
+            span.set_attr(
+                'bytes_written', sum(map(get_published_size, result.published))
+            )
+        # --
+    # --
 
-                    resolved_any_dep = True
+    main_run_collect_trace(cfg, staging_env, arg_config)
 
-                else:
-                    # -> not resolved (yet)
-                    collections_todo_queue_next.append((name, bcol_dir, bcol_is_virtual))
-                # -- end if
-            # -- end if name not resolved yet (pre dep check)
-        # -- end for
+    # not counted as image files (build summary)
+    main_run_publish(cfg, staging_env, arg_config, timestamp)
+# --- end of main_run_staged (...) ---
 
-        if not resolved_any_dep:
-            raise RuntimeError("Cannot resolve build collection dependencies", collections_todo_dep)
-        # -- end if
 
-        collections_todo_queue = collections_todo_queue_next
-    # -- end while
+def main_gen_expand_build_collections(cfg, wanted):
+    # resolve build collection dependencies while preserving
+    # the order requested in the config as much as possible
+    graph = build_collection_graph(cfg.bcol_index, wanted)
+
+    for node in graph.resolve():
+        # virtual collections may pull in dependencies,
+        # but are ignored otherwise
+        # (This skips any collection dir related tasks
+        # such as copying files from overlay and executing hooks.)
+        if not node.virtual:
+            yield (node.name, cfg.project_bcol_root / node.name)
+    # --
 # --- end of main_gen_expand_build_collections (...) ---
 
 
@@ -349,9 +553,8 @@ def main_init_staging_dir(cfg, staging_env):
     config_files = []
 
     for bcol_name, bcol_dir in cfg.profile_bcol.items():
-        bcol_config = bcol_dir / 'config'
-        if bcol_config.is_file():
-            config_files.append(bcol_config)
+        if cfg.bcol_index.get(bcol_name).has_file('config'):
+            config_files.append(bcol_dir / 'config')
         # --
     # --
 
@@ -362,26 +565,31 @@ def main_init_staging_dir(cfg, staging_env):
 
     config_files.append(cfg.profile_config_file)
 
-    merge_config_cmdv = [
-        str(cfg.project_scripts_dir / 'merge-config.py'),
-        '-o', str(staging_env.root / 'config'),
-        '-A', str(cfg.project_share_dir / 'merge-config' / 'alias_map'),
-        '-M', str(cfg.project_share_dir / 'merge-config' / 'merge_vars'),
-    ]
-
-    for varname, value in [
-        ('DBUILD_PROFILE_NAME', cfg.profile_config_name),
+    extra_vars = [
+        (False, 'DBUILD_PROFILE_NAME', cfg.profile_config_name),
         (
-            'DBUILD_TARGET_COLLECTIONS',
+            False, 'DBUILD_TARGET_COLLECTIONS',
             ' '.join((name for name in cfg.profile_bcol))
         ),
-    ]:
-        merge_config_cmdv.extend(['-e', f'{varname}={value}'])
-    # --
+    ]
 
-    merge_config_cmdv.extend(map(str, config_files))
+    # merged in-process (see merge-config.py),
+    # build-image reads the JSON sidecar written along with the config.
+    # An existing config in the staging dir is kept
+    # if none of its inputs have changed,
+    # unless password hashes are not cached (new salt on each build).
+    with staging_env.tracer.span('merge-config') as span:
+        vmap, merged = merge_config_to_file(
+            cfg.config_parser, (staging_env.root / 'config'), config_files,
+            alias_map_file=(cfg.project_share_dir / 'merge-config' / 'alias_map'),
+            merge_vars_file=(cfg.project_share_dir / 'merge-config' / 'merge_vars'),
+            extra_vars=extra_vars,
+            pwhash_cache=cfg.pwhash_cache,
+            force=(cfg.pwhash_cache.root is None),
+        )
 
-    staging_env.run_cmd(merge_config_cmdv)
+        span.set_attr('merged', merged)
+    # --
 # --- end of main_init_staging_dir (...) ---
 
 
@@ -394,25 +602,85 @@ def main_run_build(cfg, staging_env, arg_config):
         cmdv.append('-n')
     # --
 
-    staging_env.run_cmd(cmdv)
+    if arg_config.use_cache:
+        cmdv.extend([
+            '--cache-dir', str(arg_config.cache_dir or get_default_cache_root()),
+            '--cache-max-size', str(arg_config.cache_max_size),
+        ])
+
+        if arg_config.cache_refresh:
+            cmdv.append('--refresh')
+
+        if arg_config.incremental:
+            cmdv.append('--incremental')
+    # --
+
+    if cfg.apt_proxy_url:
+        cmdv.extend(['--apt-proxy', cfg.apt_proxy_url])
+    # --
+
+    if cfg.bcol_index.cache_file is not None:
+        cmdv.extend(['--collection-index', str(cfg.bcol_index.cache_file)])
+    # --
+
+    with staging_env.tracer.span('build-image', category='process'):
+        staging_env.run_cmd(cmdv, env=dict(os.environ, **staging_env.tracer.get_env()))
 # --- end of main_run_build (...) ---
 
 
-def main_run_publish(cfg, staging_env, arg_config):
+def main_run_collect_trace(cfg, staging_env, arg_config):
+    # combines the spans recorded by mkimage/build-image
+    # and the hook timing records written by the hook scripts
+    # to a Chrome trace file and a text report,
+    # which get published along with the image
+    trace_spans_file = staging_env.root / 'trace-spans.jsonl'
+    hook_trace_file  = staging_env.root / 'hook-trace.tsv'
+
+    if arg_config.dry_run or not trace_spans_file.is_file():
+        return None
+    # --
+
+    spans = list(gen_read_spans(trace_spans_file))
+
+    if hook_trace_file.is_file():
+        # hook records are missing if mmdebstrap did not run (build cache hit)
+        spans.extend(list(gen_hook_trace_spans(gen_read_hook_trace(hook_trace_file), spans)))
+    # --
+
+    trace_file = staging_env.images_root / 'trace.json'
+    write_chrome_trace(trace_file, spans)
+
+    with open((staging_env.images_root / 'trace-report.txt'), 'wt') as fh:
+        for line in gen_span_report(spans):
+            fh.write(line + '\n')
+    # --
+
+    return trace_file
+# --- end of main_run_collect_trace (...) ---
+
+
+def main_run_publish(cfg, staging_env, arg_config, timestamp=None):
+    published = []
+
     if arg_config.dry_run:
         # nothing to be seen in dry run mode
-        return
+        return published
     # --
 
-    timestamp  = datetime.datetime.now().strftime("%Y-%m-%d_%s")
+    if timestamp is None:
+        timestamp = get_publish_timestamp()
+
     images_dir = cfg.images_root / cfg.profile_config_name
 
     with os.scandir(staging_env.images_root) as dir_it:
         for entry in dir_it:
-            if not entry.name.startswith('.') and entry.is_file():
+            # files and directories (rootfs of target format 'dir')
+            if not entry.name.startswith('.') and (
+                entry.is_file(follow_symlinks=False) or entry.is_dir(follow_symlinks=False)
+            ):
                 src_file = pathlib.Path(entry.path)
                 suffixes = ''.join(src_file.suffixes)
-                name     = src_file.name[:-len(suffixes)]
+                name     = src_file.name[:(len(src_file.name) - len(suffixes))]
 
                 dst_fname = f'{cfg.profile_config_name}_{name}_{timestamp}{suffixes}'
                 dst_lname = f'{cfg.profile_config_name}_{name}{suffixes}'
@@ -420,9 +688,15 @@ def main_run_publish(cfg, staging_env, arg_config):
                 dst_file  = images_dir / dst_fname
                 dst_link  = images_dir / dst_lname
 
-                sys.stdout.write(f'Publishing image: {dst_file}\n')
+                if staging_env.log is None:
+                    sys.stdout.write(f'Publishing image: {dst_file}\n')
+                else:
+                    staging_env.log.write(f'Publishing image: {dst_file}\n')
+                # --
+
                 os.makedirs(images_dir, exist_ok=True)
                 shutil.move(src_file, dst_file)
+                published.append(dst_file)
 
                 try:
                     os.unlink(dst_link)
@@ -433,34 +707,114 @@ def main_run_publish(cfg, staging_env, arg_config):
             # -- end if
         # -- end for
     # -- end with
+
+    return published
 # --- end of main_run_publish (...) ---
 
 
-def load_config(filepath):
-    return dict(gen_load_config(filepath))
-# --- end of load_config (...) ---
+def get_published_size(filepath):
+    # size of an image file or sum of file sizes in a rootfs directory
+    if not os.path.isdir(filepath):
+        return os.stat(filepath).st_size
+
+    size = 0
+
+    for dirpath, dirnames, filenames in os.walk(filepath):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+        # --
+    # --
+
+    return size
+# --- end of get_published_size (...) ---
+
+
+def get_publish_timestamp():
+    return datetime.datetime.now().strftime("%Y-%m-%d_%s")
+# --- end of get_publish_timestamp (...) ---
+
+
+def parse_size(arg):
+    # size with optional unit suffix K/M/G/T (base 1024), e.g. '2G'
+    units = 'KMGT'
+
+    sarg = arg.strip().upper().rstrip('B').rstrip('I')
+
+    if sarg and sarg[-1] in units:
+        return int(float(sarg[:-1]) * (1024 ** (units.index(sarg[-1]) + 1)))
+    else:
+        return int(sarg)
+# --- end of parse_size (...) ---
+
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return (f'{size}{unit}' if not unit else f'{size:.1f}{unit}')
+        size /= 1024
+    # --
+
+    return f'{size:.1f}T'
+# --- end of format_size (...) ---
 
 
-def gen_load_config(filepath):
-    with open(filepath, 'rt') as fh:
-        lexer = shlex.shlex(fh, filepath, posix=True, punctuation_chars=True)
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f'{minutes}:{seconds:02d}'
+# --- end of format_duration (...) ---
 
-        for tok in lexer:
-            varname, vsep, value = tok.partition('=')
 
-            # no validation here.
-            yield (varname, value)
+def get_mem_available():
+    # None if unknown
+    try:
+        with open('/proc/meminfo', 'rt') as fh:
+            for line in fh:
+                key, sep, value = line.partition(':')
+                if key == 'MemAvailable':
+                    # value is given in kB
+                    return (int(value.split()[0]) * 1024)
+            # --
         # --
+
+    except (OSError, ValueError):
+        pass
     # --
-# --- end of gen_load_config (...) ---
+
+    return None
+# --- end of get_mem_available (...) ---
+
+
+def get_batch_jobs(jobs, job_memory):
+    # jobs == 0: one job per CPU
+    if not jobs:
+        jobs = (os.cpu_count() or 1)
+    # --
+
+    # memory-aware limit: do not start more jobs
+    # than the available memory can take
+    if job_memory:
+        mem_available = get_mem_available()
+
+        if mem_available is not None:
+            jobs = min(jobs, max(1, (mem_available // job_memory)))
+        # --
+    # --
+
+    return jobs
+# --- end of get_batch_jobs (...) ---
 
 
 def get_arg_parser(prog):
     parser = argparse.ArgumentParser(prog=os.path.basename(prog))
 
     parser.add_argument(
-        'profile_config',
-        help='path to the profile configuration file'
+        'profile_config', nargs='+',
+        help=(
+            'path to the profile configuration file, '
+            'may be given more than once; directories get searched for profile files'
+        )
     )
 
     parser.add_argument(
@@ -484,6 +838,15 @@ def get_arg_parser(prog):
         help='do not resolve build collection dependencies'
     )
 
+    parser.add_argument(
+        '--graph', metavar='<format>',
+        dest='graph_format', default=None, choices=['dot', 'json'],
+        help=(
+            'print the collection dependency graph of each profile '
+            'in the given format (dot or json) and exit'
+        )
+    )
+
     parser.add_argument(
         '-S', '--staging', metavar='<staging_dir>',
         dest='staging_dir',
@@ -503,6 +866,84 @@ def get_arg_parser(prog):
         help='prepare files, but do not run mmdebstrap'
     )
 
+    parser.add_argument(
+        '-j', '--jobs', metavar='<N>',
+        dest='jobs',
+        default=1, type=int,
+        help='number of profiles to build concurrently (default: %(default)s, 0: one per CPU)'
+    )
+
+    parser.add_argument(
+        '--job-memory', metavar='<size>',
+        dest='job_memory',
+        default=parse_size('2G'), type=parse_size,
+        help=(
+            'expected memory usage per build job, limits concurrency '
+            'to the available memory (default: 2G, 0 disables the limit)'
+        )
+    )
+
+    parser.add_argument(
+        '--cache-dir', metavar='<dir>',
+        dest='cache_dir', default=None, type=pathlib.Path,
+        help=(
+            'build cache directory '
+            '(default: $DBUILD_CACHE_DIR or $XDG_CACHE_HOME/dbuild)'
+        )
+    )
+
+    parser.add_argument(
+        '--cache-max-size', metavar='<size>',
+        dest='cache_max_size',
+        default=parse_size('20G'), type=parse_size,
+        help=(
+            'evict least recently used build cache entries above this total size,'
+            ' shared with phase snapshots (default: 20G)'
+        )
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        dest='use_cache',
+        default=True, action='store_false',
+        help='neither look up nor store build results in the build cache'
+    )
+
+    parser.add_argument(
+        '--refresh',
+        dest='cache_refresh',
+        default=False, action='store_true',
+        help='rebuild even if a cached build result exists, then update the cache'
+    )
+
+    parser.add_argument(
+        '-I', '--incremental',
+        dest='incremental',
+        default=False, action='store_true',
+        help=(
+            'incremental mode: keep a snapshot of the target rootfs taken '
+            'before the customize phase in the build cache, and rebuild '
+            'from that snapshot if only customize hooks/overlays or env.sh changed'
+        )
+    )
+
+    parser.add_argument(
+        '--apt-proxy',
+        dest='apt_proxy',
+        default=False, action='store_true',
+        help=(
+            'run a local caching apt proxy (cache dir: <cache_dir>/apt-proxy) '
+            'while building, takes precedence over DBUILD_APT_PROXY'
+        )
+    )
+
+    parser.add_argument(
+        '--apt-proxy-max-size', metavar='<size>',
+        dest='apt_proxy_max_size',
+        default=parse_size('10G'), type=parse_size,
+        help='evict least recently used apt proxy cache files above this total size (default: 10G)'
+    )
+
     return parser
 # --- end of get_arg_parser (...) ---
 
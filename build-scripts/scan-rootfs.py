@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Runs several post-processing passes over a rootfs in a single traversal:
+# symlink rewriting, cleanup patterns, permission/ownership audit,
+# file manifest, file metadata and size accounting per directory.
+#
+
+import argparse
+import json
+import os
+import sys
+
+from dbuild.rootscan import CleanupVisitor
+from dbuild.rootscan import DirSizeVisitor
+from dbuild.rootscan import ManifestVisitor
+from dbuild.rootscan import MetadataVisitor
+from dbuild.rootscan import PermAuditVisitor
+from dbuild.rootscan import RootfsScanner
+from dbuild.rootscan import SymlinkFixVisitor
+from dbuild.rootscan import read_target_ids
+
+
+def main(prog, argv):
+    arg_parser = main_get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    target_rootfs = arg_config.target_rootfs
+
+    scanner = RootfsScanner(target_rootfs, jobs=arg_config.jobs)
+
+    fix_symlinks = None
+    cleanup      = None
+    audit        = None
+    manifest     = None
+    metadata     = None
+    sizes        = None
+
+    if arg_config.fix_symlinks:
+        fix_symlinks = scanner.add_visitor(
+            SymlinkFixVisitor(
+                (arg_config.link_root_src or target_rootfs),
+                arg_config.link_root_dest,
+                dry_run=arg_config.dry_run
+            )
+        )
+    # --
+
+    if arg_config.cleanup_patterns:
+        cleanup = scanner.add_visitor(
+            CleanupVisitor(arg_config.cleanup_patterns, dry_run=arg_config.dry_run)
+        )
+    # --
+
+    if arg_config.audit_file:
+        audit = scanner.add_visitor(
+            PermAuditVisitor(
+                known_uids=read_target_ids(target_rootfs, 'passwd'),
+                known_gids=read_target_ids(target_rootfs, 'group'),
+            )
+        )
+    # --
+
+    if arg_config.manifest_file:
+        manifest = scanner.add_visitor(ManifestVisitor())
+    # --
+
+    if arg_config.metadata_file:
+        metadata = scanner.add_visitor(MetadataVisitor())
+    # --
+
+    if arg_config.sizes_file:
+        sizes = scanner.add_visitor(DirSizeVisitor(max_depth=arg_config.size_depth))
+    # --
+
+    if not scanner.visitors:
+        arg_parser.error('nothing to do')
+    # --
+
+    scanner.run()
+
+    if fix_symlinks is not None:
+        for fpath, link_target_old, link_target_new in fix_symlinks.items:
+            print(f"{fpath}: {link_target_old} => {link_target_new}")
+    # --
+
+    if cleanup is not None:
+        for relpath in cleanup.items:
+            print(f"{scanner.get_path(relpath)}: removed")
+    # --
+
+    if audit is not None:
+        write_lines(
+            arg_config.audit_file,
+            (f'{issue} {relpath}' for relpath, issue in audit.items)
+        )
+    # --
+
+    if manifest is not None:
+        write_lines(arg_config.manifest_file, manifest.gen_lines())
+    # --
+
+    if metadata is not None:
+        write_lines(arg_config.metadata_file, metadata.gen_lines())
+    # --
+
+    if sizes is not None:
+        write_lines(
+            arg_config.sizes_file,
+            (
+                json.dumps(
+                    {'path': dirpath, 'usage': usage, 'size': size, 'entries': count}
+                )
+                for dirpath, (usage, size, count) in sorted(sizes.sizes.items())
+            )
+        )
+    # --
+# --- end of main (...) ---
+
+
+def write_lines(outfile, lines):
+    if outfile == '-':
+        for line in lines:
+            sys.stdout.write(line + '\n')
+
+    else:
+        with open(outfile, 'wt') as fh:
+            for line in lines:
+                fh.write(line + '\n')
+    # --
+# --- end of write_lines (...) ---
+
+
+def main_get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        '--fix-symlinks',
+        dest='fix_symlinks',
+        default=False, action='store_true',
+        help='rewrite symlinks pointing to the build-time rootfs (see fix-symlinks.py)'
+    )
+
+    parser.add_argument(
+        '--from',
+        dest='link_root_src',
+        help='symlink target prefix to rewrite (default: <target_rootfs>)'
+    )
+
+    parser.add_argument(
+        '--to',
+        dest='link_root_dest',
+        default='/',
+        help='new symlink target prefix (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '--cleanup', metavar='<pattern>',
+        dest='cleanup_patterns',
+        default=[], action='append',
+        help=(
+            'remove files matching <pattern> (path relative to target_rootfs with leading /,'
+            ' \'*\' does not match /, \'**\' does), may be given more than once'
+        )
+    )
+
+    parser.add_argument(
+        '--audit', metavar='<outfile>',
+        dest='audit_file',
+        default=None,
+        help='write permission/ownership audit report to <outfile> (\'-\': stdout)'
+    )
+
+    parser.add_argument(
+        '--manifest', metavar='<outfile>',
+        dest='manifest_file',
+        default=None,
+        help='write file manifest to <outfile> (\'-\': stdout)'
+    )
+
+    parser.add_argument(
+        '--metadata', metavar='<outfile>',
+        dest='metadata_file',
+        default=None,
+        help=(
+            'write file metadata (JSON lines) to <outfile> (\'-\': stdout),'
+            ' for copying the rootfs with convert-tar-to-disk'
+        )
+    )
+
+    parser.add_argument(
+        '--sizes', metavar='<outfile>',
+        dest='sizes_file',
+        default=None,
+        help='write size per directory (JSON lines) to <outfile> (\'-\': stdout)'
+    )
+
+    parser.add_argument(
+        '--size-depth', metavar='<depth>',
+        dest='size_depth',
+        default=2, type=int,
+        help='directory depth for --sizes (default: %(default)s)'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        dest='jobs',
+        default=None, type=int,
+        help='number of directory trees to scan concurrently (default: number of CPUs + 4)'
+    )
+
+    parser.add_argument(
+        '-n', '--dry-run',
+        dest='dry_run',
+        default=False, action='store_true',
+        help='just show what would be done (symlinks, cleanup)'
+    )
+
+    parser.add_argument(
+        'target_rootfs',
+        help='target rootfs directory'
+    )
+
+    return parser
+# --- end of main_get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  Summarizes build traces as flame-style text report
+#  and optionally merges them into a single Chrome trace file.
+#
+#  Input files may be trace files as published by mkimage (<profile>_trace.json)
+#  or span files written by convert-tar-to-disk --trace (JSON lines).
+#
+
+import argparse
+import os
+import sys
+
+from dbuild.trace import gen_read_spans
+from dbuild.trace import gen_span_report
+from dbuild.trace import write_chrome_trace
+
+
+def main(prog, argv):
+    arg_parser = get_arg_parser(prog)
+    arg_config = arg_parser.parse_args(argv)
+
+    spans = []
+    for infile in arg_config.infiles:
+        spans.extend(gen_read_spans(infile))
+    # --
+
+    if not spans:
+        sys.stderr.write('No spans found.\n')
+        return False
+    # --
+
+    if arg_config.outfile:
+        write_chrome_trace(arg_config.outfile, spans)
+    # --
+
+    if not arg_config.quiet:
+        for line in gen_span_report(spans):
+            sys.stdout.write(line + '\n')
+    # --
+# --- end of main (...) ---
+
+
+def get_arg_parser(prog):
+    parser = argparse.ArgumentParser(prog=os.path.basename(prog))
+
+    parser.add_argument(
+        'infiles', metavar='<file>', nargs='+',
+        help='trace file (Chrome trace JSON or JSON lines)'
+    )
+
+    parser.add_argument(
+        '-o', '--output', metavar='<file>',
+        dest='outfile', default=None,
+        help='write merged spans to <file> (Chrome trace JSON)'
+    )
+
+    parser.add_argument(
+        '-q', '--quiet',
+        dest='quiet',
+        default=False, action='store_true',
+        help='do not print the text report'
+    )
+
+    return parser
+# --- end of get_arg_parser (...) ---
+
+
+def run_main():
+    os_ex_ok = getattr(os, 'EX_OK', 0)
+
+    try:
+        exit_code = main(sys.argv[0], sys.argv[1:])
+
+    except BrokenPipeError:
+        for fh in [sys.stdout, sys.stderr]:
+            try:
+                fh.close()
+            except:
+                pass
+
+        exit_code = os_ex_ok ^ 11
+
+    except KeyboardInterrupt:
+        exit_code = os_ex_ok ^ 130
+
+    else:
+        if (exit_code is None) or (exit_code is True):
+            exit_code = os_ex_ok
+
+        elif exit_code is False:
+            exit_code = os_ex_ok ^ 1
+    # --
+
+    sys.exit(exit_code)
+# --- end of run_main (...) ---
+
+
+if __name__ == '__main__':
+    run_main()
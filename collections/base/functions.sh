@@ -75,6 +75,8 @@ dbuild_load_update_initramfs_env() {
 
 ## sysusers (for updating passwd/group/shadow/gshadow in target)
 DBUILD_STAGING_SYSUSERS="${DBUILD_STAGING_TMP:?}/sysusers"
+# applied sysusers entries (make_sysusers.py --state)
+DBUILD_STAGING_SYSUSERS_STATE="${DBUILD_STAGING_TMP:?}/sysusers.state"
 
 # dbuild_sysusers_reset()
 dbuild_sysusers_reset() {
@@ -82,6 +84,10 @@ dbuild_sysusers_reset() {
         autodie rm -- "${DBUILD_STAGING_SYSUSERS}"
     fi
 
+    if check_fs_lexists "${DBUILD_STAGING_SYSUSERS_STATE:?}"; then
+        autodie rm -- "${DBUILD_STAGING_SYSUSERS_STATE}"
+    fi
+
     touch -- "${DBUILD_STAGING_SYSUSERS:?}"
 }
 
@@ -3,6 +3,17 @@
 # so that they do no longer point to the build directory's path.
 # (Rewrite link dst /tmp/tmp_4w466dfgsd/rootfs/usr/lib to /usr/lib, ...)
 #
+# With DBUILD_TARGET_FIX_SYMLINKS=stream, symlinks get rewritten
+# while creating the tarball, only the path of $TARGET_ROOTFS is recorded here.
+#
+
+if [ -n "${DBUILD_STAGING_TAR_ROOTFS_PATH-}" ]; then
+    print_action "Rewrite symbolic links in target (deferred to tarball creation)"
+    {
+        printf '%s\n' "${TARGET_ROOTFS:?}" > "${DBUILD_STAGING_TAR_ROOTFS_PATH}"
+    } || die "Failed to record target rootfs path"
 
-print_action "Rewrite symbolic links in target"
-autodie "${DBUILD_BUILD_SCRIPTS:?}/fix-symlinks.py" "${TARGET_ROOTFS}"
+else
+    print_action "Rewrite symbolic links in target"
+    autodie "${DBUILD_BUILD_SCRIPTS:?}/fix-symlinks.py" "${TARGET_ROOTFS}"
+fi
@@ -5,4 +5,6 @@ dbuild_sysusers_print
 
 autodie "${DBUILD_BUILD_SCRIPTS:?}/make_sysusers.py" \
     --root "${TARGET_ROOTFS:?}" \
+    --state "${DBUILD_STAGING_SYSUSERS_STATE:?}" \
+    ${DBUILD_PWHASH_CACHE:+--pwhash-cache "${DBUILD_PWHASH_CACHE}"} \
     "${DBUILD_STAGING_SYSUSERS:?}"
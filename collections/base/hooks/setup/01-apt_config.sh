@@ -3,13 +3,18 @@
 # (build-time proxy config, ...)
 
 hook_gen_apt_config() {
+    local apt_proxy
+
+    # local caching proxy started by mkimage takes precedence
+    apt_proxy="${DBUILD_APT_PROXY_LOCAL:-${DBUILD_APT_PROXY}}"
+
     printf '%s\n' '# build-time apt configuration'
 
-    if [ -n "${DBUILD_APT_PROXY}" ]; then
+    if [ -n "${apt_proxy}" ]; then
 cat << EOF
 Acquire::http::Pipeline-Depth 0;
-Acquire::http::Proxy "${DBUILD_APT_PROXY}";
-Acquire::https::Proxy "${DBUILD_APT_PROXY}";
+Acquire::http::Proxy "${apt_proxy}";
+Acquire::https::Proxy "${apt_proxy}";
 EOF
     fi
 }
@@ -299,6 +299,110 @@ dbuild_import_overlay() {
 }
 
 
+# dbuild_trace_begin ( **DBUILD_STAGING_TRACE )
+#
+#   Records start time and CPU usage for the next traced block
+#   (hook, overlay import, permtab).
+#   Does nothing unless DBUILD_STAGING_TRACE is set.
+#
+dbuild_trace_begin() {
+    [ -n "${DBUILD_STAGING_TRACE-}" ] || return 0
+
+    __dbuild_trace_read_cpu || return 0
+    __dbuild_trace_cpu0="${__dbuild_trace_cpu}"
+    __dbuild_trace_t0="$(date +%s%N)"
+}
+
+
+# int dbuild_trace_end ( rc, phase, category, collection, name, **DBUILD_STAGING_TRACE )
+#
+#   Appends a trace record for the block started by dbuild_trace_begin()
+#   to DBUILD_STAGING_TRACE (tab-separated):
+#
+#     phase category collection name t_begin_ns t_end_ns rc cpu_begin cpu_end
+#
+#   cpu_begin/cpu_end are the accumulated user/system times
+#   of terminated child processes as reported by 'times'.
+#
+#   Returns rc, so that it can be used as "( ... ); dbuild_trace_end ${?} ... || exit".
+#
+dbuild_trace_end() {
+    local rc
+    local t1
+
+    rc="${1:?}"
+
+    if [ -n "${DBUILD_STAGING_TRACE-}" ] && [ -n "${__dbuild_trace_t0-}" ]; then
+        t1="$(date +%s%N)"
+
+        if __dbuild_trace_read_cpu; then
+            printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' \
+                "${2}" "${3}" "${4}" "${5}" \
+                "${__dbuild_trace_t0}" "${t1}" "${rc}" \
+                "${__dbuild_trace_cpu0}" "${__dbuild_trace_cpu}" \
+                >> "${DBUILD_STAGING_TRACE}"
+        fi
+
+        __dbuild_trace_t0=
+    fi
+
+    return "${rc}"
+}
+
+
+# __dbuild_trace_read_cpu ( **DBUILD_STAGING_TRACE ), sets __dbuild_trace_cpu
+#
+#   'times' must run in the current shell (not in a command substitution),
+#   its second line lists the children's user and system time.
+#
+__dbuild_trace_read_cpu() {
+    local cpu_user
+    local cpu_sys
+
+    times > "${DBUILD_STAGING_TRACE}.times" || return
+    {
+        read -r cpu_user cpu_sys && \
+        read -r cpu_user cpu_sys
+    } < "${DBUILD_STAGING_TRACE}.times" || return
+
+    __dbuild_trace_cpu="${cpu_user} ${cpu_sys}"
+}
+
+
+# int dbuild_phase_snapshot_save ( snapshot_dir, **TARGET_ROOTFS )
+#
+#   Saves the target rootfs as tarball for incremental builds,
+#   along with its build-time path (for rewriting symlinks on restore).
+#
+#   Using tar (instead of copying the directory) preserves file ownership
+#   as seen through fakeroot.
+#
+dbuild_phase_snapshot_save() {
+    local snapshot_dir
+
+    snapshot_dir="${1:?}"
+
+    mkdir -p -- "${snapshot_dir}" || return
+    printf '%s\n' "${TARGET_ROOTFS:?}" > "${snapshot_dir}/rootfs.path" || return
+
+    tar -C "${TARGET_ROOTFS}" \
+        --numeric-owner --xattrs --xattrs-include='*.*' \
+        -c -f "${snapshot_dir}/rootfs.tar" . || return
+}
+
+
+# int dbuild_rootfs_metadata_save ( metadata_file, **TARGET_ROOTFS )
+#
+#   Records file ownership, modes, device nodes, xattrs and hardlinks
+#   of the target rootfs as seen through fakeroot (target format 'dir'),
+#   which get applied when copying the directory (convert-tar-to-disk).
+#
+dbuild_rootfs_metadata_save() {
+    "${DBUILD_BUILD_SCRIPTS:?}/scan-rootfs.py" \
+        --metadata "${1:?}" "${TARGET_ROOTFS:?}"
+}
+
+
 # verify_file_checksum_generic ( checksum_cmd, checksum_file, target_file )
 #
 verify_file_checksum_generic() {